@@ -0,0 +1,263 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Benchmarks the training step of LDIF/SIF models on synthetic data.
+
+The full training graph is built for each combination of model type, batch
+size and session thread settings, and fed a random batch held in memory, so
+the measured throughput is that of the model alone, with no dataset needed.
+Each combination is run in a fresh process, so that its peak memory is its
+own. The results are written to a JSON file.
+"""
+
+# Commands required in-between imports to silence tensorflow
+# pylint: disable=g-import-not-at-top
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import itertools
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+
+from absl import app
+from absl import flags
+
+import numpy as np
+
+import tensorflow as tf
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.datasets import local_inputs
+from ldif.datasets import shapenet
+from ldif.inference import experiment as experiments
+from ldif.model import hparams
+from ldif.training import shared_launcher
+from ldif.util.file_util import log
+# pylint: enable=g-bad-import-order
+# pylint: enable=g-import-not-at-top
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list('model_types', ['ldif', 'sif', 'sif++'],
+                  'The model types to benchmark. See train.py.')
+
+flags.DEFINE_list('batch_sizes', ['1', '2', '4', '8'],
+                  'The batch sizes to benchmark.')
+
+flags.DEFINE_list(
+    'intra_op_threads', ['0'],
+    'The intra-op thread pool sizes to benchmark. 0 lets TensorFlow choose.')
+
+flags.DEFINE_list(
+    'inter_op_threads', ['0'],
+    'The inter-op thread pool sizes to benchmark. 0 lets TensorFlow choose.')
+
+flags.DEFINE_integer(
+    'warmup_step_count', 10,
+    'The number of steps taken before the timing starts, so that one-time'
+    ' costs (graph optimization, allocator growth, autotuning) are excluded.')
+
+flags.DEFINE_integer('step_count', 50, 'The number of timed steps.')
+
+flags.DEFINE_boolean(
+    'subsample_supervision', False,
+    'If true, the synthetic batch has only the uniform and near surface'
+    ' samples the losses use, as train.py feeds with --subsample_supervision.')
+
+flags.DEFINE_string('output_path', 'benchmark_results.json',
+                    'The path of the JSON file the results are written to.')
+
+flags.DEFINE_string('log_level', 'INFO',
+                    'One of VERBOSE, INFO, WARNING, ERROR. Sets logs to print '
+                    'only at or above the specified level.')
+
+HPARAM_BUILDERS = {
+    'ldif': hparams.build_ldif_hparams,
+    'sif': hparams.build_sif_hparams,
+    'sif++': hparams.build_improved_sif_hparams
+}
+
+
+def build_model_config(model_type, batch_size, subsample_supervision):
+  """Creates the training ModelConfig, fed by a synthetic dataset."""
+  model_config = experiments.ModelConfig(HPARAM_BUILDERS[model_type]())
+  model_config.hparams.bs = batch_size
+  model_config.train = True
+  model_config.eval = False
+  model_config.inference = False
+  model_config.inputs['split'] = 'train'
+  model_config.inputs['proto'] = 'ShapeNetNSSDodecaSparseLRGMediumSlimPC'
+  model_config.wrap_optimizer = lambda x: x
+  supervision_sample_count = None
+  if subsample_supervision:
+    supervision_sample_count = shapenet.input_supervision_sample_count(
+        model_config.hparams)
+  model_config.inputs['dataset'] = local_inputs.make_synthetic_dataset(
+      batch_size, supervision_sample_count=supervision_sample_count)
+  return model_config
+
+
+def peak_rss_bytes():
+  """The peak resident memory of this process."""
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes, and macOS bytes:
+  return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_benchmark(setting):
+  """Benchmarks one setting. Runs in its own process.
+
+  Args:
+    setting: A dictionary with the model_type, batch_size, intra_op_threads,
+      inter_op_threads, warmup_step_count, step_count, subsample_supervision
+      and log_level.
+
+  Returns:
+    A dictionary of the setting and its results.
+  """
+  log.set_level(setting['log_level'])
+  tf.disable_v2_behavior()
+  start_t = time.time()
+  model_config = build_model_config(setting['model_type'],
+                                    setting['batch_size'],
+                                    setting['subsample_supervision'])
+  shared_launcher.sif_transcoder(model_config)
+  gpu_name = tf.test.gpu_device_name() or None
+  max_gpu_bytes = None
+  if gpu_name:
+    with tf.device(gpu_name):
+      max_gpu_bytes = tf.contrib.memory_stats.MaxBytesInUse()
+  init_op = tf.initialize_all_variables()
+  tf.get_default_graph().finalize()
+  build_seconds = time.time() - start_t
+
+  config = tf.ConfigProto(
+      intra_op_parallelism_threads=setting['intra_op_threads'],
+      inter_op_parallelism_threads=setting['inter_op_threads'])
+  with tf.Session(config=config) as session:
+    session.run(init_op)
+    start_t = time.time()
+    for _ in range(setting['warmup_step_count']):
+      session.run(model_config.train_op)
+    warmup_seconds = time.time() - start_t
+    step_seconds = []
+    for _ in range(setting['step_count']):
+      start_t = time.time()
+      session.run(model_config.train_op)
+      step_seconds.append(time.time() - start_t)
+    peak_gpu_bytes = None
+    if max_gpu_bytes is not None:
+      peak_gpu_bytes = int(session.run(max_gpu_bytes))
+
+  total_seconds = sum(step_seconds)
+  result = dict(setting)
+  result.update({
+      'build_seconds': build_seconds,
+      'warmup_seconds': warmup_seconds,
+      'steps_per_second': len(step_seconds) / total_seconds,
+      'examples_per_second':
+          len(step_seconds) * setting['batch_size'] / total_seconds,
+      'step_seconds_p50': float(np.percentile(step_seconds, 50)),
+      'step_seconds_p95': float(np.percentile(step_seconds, 95)),
+      'peak_rss_bytes': peak_rss_bytes(),
+      'peak_gpu_bytes': peak_gpu_bytes,
+      'gpu': gpu_name,
+  })
+  return result
+
+
+def _run_benchmark_in_child(setting, connection):
+  try:
+    result = run_benchmark(setting)
+  except Exception as e:  # pylint: disable=broad-except
+    result = dict(setting, error=repr(e))
+  connection.send(result)
+  connection.close()
+
+
+def host_info():
+  return {
+      'platform': platform.platform(),
+      'processor': platform.processor(),
+      'cpu_count': os.cpu_count(),
+      'python_version': platform.python_version(),
+      'tensorflow_version': tf.__version__,
+  }
+
+
+def main(argv):
+  if len(argv) > 1:
+    raise app.UsageError('Too many command-line arguments.')
+  log.set_level(FLAGS.log_level)
+  for model_type in FLAGS.model_types:
+    if model_type not in HPARAM_BUILDERS:
+      raise ValueError(f'Unrecognized model type {model_type}. Expected one'
+                       f' of {list(HPARAM_BUILDERS)}.')
+  if FLAGS.step_count < 1:
+    raise ValueError('At least one step must be timed.')
+  settings = [{
+      'model_type': model_type,
+      'batch_size': int(batch_size),
+      'intra_op_threads': int(intra_op_threads),
+      'inter_op_threads': int(inter_op_threads),
+      'warmup_step_count': FLAGS.warmup_step_count,
+      'step_count': FLAGS.step_count,
+      'subsample_supervision': FLAGS.subsample_supervision,
+      'log_level': FLAGS.log_level,
+  } for model_type, batch_size, intra_op_threads, inter_op_threads in
+              itertools.product(FLAGS.model_types, FLAGS.batch_sizes,
+                                FLAGS.intra_op_threads, FLAGS.inter_op_threads)]
+
+  results = []
+  # Spawn rather than fork, because this process has tensorflow loaded:
+  context = multiprocessing.get_context('spawn')
+  for i, setting in enumerate(settings):
+    log.info(f'Benchmarking setting {i + 1} of {len(settings)}: {setting}')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(
+        target=_run_benchmark_in_child, args=(setting, sender))
+    process.start()
+    sender.close()
+    try:
+      result = receiver.recv()
+    except EOFError:
+      # The process died without a result, for example when it ran out of
+      # memory and was killed.
+      result = None
+    process.join()
+    if result is None:
+      result = dict(setting, error=f'Exited with code {process.exitcode}.')
+    results.append(result)
+    if 'error' in result:
+      # The other settings still run:
+      log.error(f'Setting {setting} failed: {result["error"]}')
+    else:
+      log.info(f'{result["steps_per_second"]:.2f} steps/s,'
+               f' {result["examples_per_second"]:.2f} examples/s, peak'
+               f' memory {result["peak_rss_bytes"] / 2**30:.2f} GiB.')
+    # Rewritten after each setting, so a long sweep that is interrupted keeps
+    # its results so far:
+    with open(FLAGS.output_path, 'wt') as f:
+      json.dump({'host': host_info(), 'results': results}, f, indent=1)
+  log.info(f'Wrote the results to {FLAGS.output_path}')
+
+
+if __name__ == '__main__':
+  app.run(main)
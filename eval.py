@@ -21,6 +21,7 @@ import time
 from absl import app
 from absl import flags
 
+import numpy as np
 import pandas as pd
 # Imports have to be in this order to silence tensorflow:
 # pylint: disable=g-import-not-at-top
@@ -60,6 +61,10 @@ flags.DEFINE_boolean(
     ' be written to the result directory with a structure mirroring'
     ' the dataset directory.')
 
+flags.DEFINE_boolean(
+    'save_part_meshes', False, 'If true, a mesh of each shape element will'
+    ' be written to a directory per shape in the result directory.')
+
 flags.DEFINE_boolean(
     'save_ldifs', False, 'If provided, the output ldif.txt files'
     ' will be written to the result directory with a structure'
@@ -92,6 +97,25 @@ flags.DEFINE_boolean(
     ' The speed increase should be several orders of magnitude'
     ', so it is highly recommended.')
 
+flags.DEFINE_enum(
+    'inference_kernel', 'cuda', ['cuda', 'cpu', 'cpu_worker'], 'Which'
+    ' inference kernel to use if use_inference_kernel is true. \'cuda\' is'
+    ' the compiled CUDA kernel. \'cpu\' evaluates the grid with'
+    ' multithreaded numpy, and is the fastest option on machines without a'
+    ' GPU. \'cpu_worker\' runs the same kernel in a persistent worker'
+    ' process, off of the tensorflow process.')
+
+flags.DEFINE_float(
+    'influence_threshold', 0.0, 'Only used with the cpu inference kernels. RBF'
+    ' element contributions with a weight at or below this value are culled.'
+    ' 0.0 is exact; 1e-4 is typically an order of magnitude faster with'
+    ' visually identical meshes.')
+
+flags.DEFINE_boolean(
+    'symmetric_grid', False, 'Only used with the cpu inference kernels.'
+    ' Samples the marching cubes grid symmetrically about z=0, so the'
+    ' left-right symmetric elements are evaluated once and mirrored.')
+
 flags.DEFINE_string('experiment_name', 'reproduce-ldif',
                     'The name of the experiment to'
                     ' evaluate')
@@ -126,6 +150,27 @@ flags.DEFINE_string(
 flags.DEFINE_integer('resolution', 256,
                      'The resolution at which to do marching cubes.')
 
+flags.DEFINE_integer(
+    'coarse_resolution', 0, 'If nonzero, the marching cubes grid is evaluated'
+    ' coarse to fine starting at this resolution, and only refined near the'
+    ' surface. Requires --inference_kernel=cpu or --nouse_inference_kernel.')
+
+flags.DEFINE_integer(
+    'mcubes_block_resolution', 0, 'If nonzero, the marching cubes grid is'
+    ' evaluated and meshed in blocks of this many voxels per side, so the full'
+    ' grid is never in memory. Requires --inference_kernel=cpu or'
+    ' --nouse_inference_kernel.')
+
+flags.DEFINE_integer(
+    'part_resolution', 0, 'If nonzero, the part meshes written with'
+    ' --save_part_meshes are each evaluated on a grid of their own, with this'
+    ' many samples along the longest side of the element\'s support box.'
+    ' Otherwise on the voxels of the --resolution grid inside the box.')
+
+flags.DEFINE_integer(
+    'decode_batch_size', 8, 'The number of shapes to decode per tensorflow'
+    ' session call when computing IoUs and extracting meshes.')
+
 flags.DEFINE_string(
     'only_class', '', 'Only evaluate on this class, if provided.')
 
@@ -152,8 +197,18 @@ def load_newest_model():
   encoder = predict.DepthEncoder.from_modeldir(
       model_root, model_name, experiment_name, xid=1, ckpt_idx=-1)
   decoder = predict.Decoder.from_modeldir(
-      model_root, model_name, experiment_name, xid=1, ckpt_idx=-1)
-  decoder.use_inference_kernel = FLAGS.use_inference_kernel
+      model_root,
+      model_name,
+      experiment_name,
+      xid=1,
+      ckpt_idx=-1,
+      decode_batch_size=FLAGS.decode_batch_size)
+  if FLAGS.use_inference_kernel:
+    decoder.use_inference_kernel = FLAGS.inference_kernel
+  else:
+    decoder.use_inference_kernel = False
+  decoder.influence_threshold = FLAGS.influence_threshold
+  decoder.symmetric_grid = FLAGS.symmetric_grid
   return encoder, decoder
 
 
@@ -196,14 +251,16 @@ def main(argv):
   tf.disable_v2_behavior()
 
   # gpu_util.get_free_gpu_memory(0)
-  if FLAGS.use_gpu_for_tensorflow and FLAGS.use_inference_kernel:
+  if (FLAGS.use_gpu_for_tensorflow and FLAGS.use_inference_kernel and
+      FLAGS.inference_kernel == 'cuda'):
     log.info('Limiting TensorFlow memory by 1GB so the inference kernel'
              ' has enough left over to run.')
 
   if not FLAGS.dataset_directory:
     raise ValueError('A dataset directory must be provided.')
   if not FLAGS.result_directory:
-    if FLAGS.save_results or FLAGS.save_meshes or FLAGS.save_ldifs:
+    if (FLAGS.save_results or FLAGS.save_meshes or FLAGS.save_part_meshes or
+        FLAGS.save_ldifs):
       raise ValueError('A result directory must be provided to save results.')
   else:
     if not os.path.isdir(FLAGS.result_directory):
@@ -227,53 +284,76 @@ def main(argv):
     results = []
     to_eval = filter_by_class(dataset_items)
     to_eval = filter_by_eval_frac(to_eval)
-    for path in tqdm.tqdm(to_eval):
-      e = examples.InferenceExample.from_directory(path)
-      embedding = encoder.run_example(e)
-      iou = decoder.iou(embedding, e)
-      gt_mesh = e.gt_mesh
-      mesh = decoder.extract_mesh(embedding, resolution=FLAGS.resolution)
-      if FLAGS.visualize:
-        # Visualize in the normalized_coordinate frame, so the camera is
-        # always reasonable. Metrics are computed in the original frame.
-        gaps_util.mshview([e.normalized_gt_mesh, mesh])
+    batch_size = FLAGS.decode_batch_size
+    batch_starts = range(0, len(to_eval), batch_size)
+    for batch_start in tqdm.tqdm(batch_starts):
+      batch = [
+          examples.InferenceExample.from_directory(path)
+          for path in to_eval[batch_start:batch_start + batch_size]
+      ]
+      embeddings = np.stack([encoder.run_example(e) for e in batch])
+      ious = decoder.iou(embeddings, batch)
+      meshes = decoder.extract_mesh(
+          embeddings,
+          resolution=FLAGS.resolution,
+          coarse_resolution=FLAGS.coarse_resolution or None,
+          block_resolution=FLAGS.mcubes_block_resolution or None)
+      for e, embedding, iou, mesh in zip(batch, embeddings, ious, meshes):
+        gt_mesh = e.gt_mesh
+        if FLAGS.visualize:
+          # Visualize in the normalized_coordinate frame, so the camera is
+          # always reasonable. Metrics are computed in the original frame.
+          gaps_util.mshview([e.normalized_gt_mesh, mesh])
   
-      # TODO(kgenova) gaps2occnet is poorly named, it is really normalized ->
-      # unnormalized (where 'gaps' is the normalized training frame and 'occnet'
-      # is whatever the original frame of the input mesh was)
-      post_extract_start = time.time()
-      mesh.apply_transform(e.gaps2occnet)
+        # TODO(kgenova) gaps2occnet is poorly named, it is really normalized
+        # -> unnormalized (where 'gaps' is the normalized training frame and
+        # 'occnet' is whatever the original frame of the input mesh was)
+        post_extract_start = time.time()
+        mesh.apply_transform(e.gaps2occnet)
   
-      if FLAGS.save_meshes:
-        path = (f'{FLAGS.result_directory}/meshes/{split}/{e.cat}/'
-                f'{e.mesh_hash}.ply')
-        if not os.path.isdir(os.path.dirname(path)):
-          os.makedirs(os.path.dirname(path))
-        mesh.export(path)
-      if FLAGS.save_ldifs:
-        path = (f'{FLAGS.result_directory}/ldifs/{split}/{e.cat}/'
-                f'{e.mesh_hash}.txt')
-        if not os.path.isdir(os.path.dirname(path)):
-          os.makedirs(os.path.dirname(path))
-        decoder.savetxt(embedding, path)
+        if FLAGS.save_meshes:
+          path = (f'{FLAGS.result_directory}/meshes/{split}/{e.cat}/'
+                  f'{e.mesh_hash}.ply')
+          if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+          mesh.export(path)
+        if FLAGS.save_part_meshes:
+          part_directory = (f'{FLAGS.result_directory}/parts/{split}/{e.cat}/'
+                            f'{e.mesh_hash}')
+          if not os.path.isdir(part_directory):
+            os.makedirs(part_directory)
+          parts = decoder.extract_part_meshes(
+              embedding,
+              FLAGS.resolution,
+              part_resolution=FLAGS.part_resolution or None)
+          for i, part in enumerate(parts):
+            part.apply_transform(e.gaps2occnet)
+            part.export(f'{part_directory}/part_{i:02d}.ply')
+        if FLAGS.save_ldifs:
+          path = (f'{FLAGS.result_directory}/ldifs/{split}/{e.cat}/'
+                  f'{e.mesh_hash}.txt')
+          if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+          decoder.savetxt(embedding, path)
   
-      nc, fst, fs2t, chamfer = metrics.all_mesh_metrics(mesh, gt_mesh)
-      log.verbose(f'Mesh: {e.mesh_name}')
-      log.verbose(f'IoU: {iou}.')
-      log.verbose(f'F-Score (tau): {fst}')
-      log.verbose(f'Chamfer: {chamfer}')
-      log.verbose(f'F-Score (2*tau): {fs2t}')
-      log.verbose(f'Normal Consistency: {nc}')
-      results.append({
-          'key': e.mesh_name,
-          'Normal Consistency': nc,
-          'F-Score (tau)': fst,
-          'F-Score (2*tau)': fs2t,
-          'Chamfer': chamfer,
-          'IoU': iou
-      })
-      post_extract_end = time.time()
-      log.verbose(f'Time post extract: {post_extract_end - post_extract_start}')
+        nc, fst, fs2t, chamfer = metrics.all_mesh_metrics(mesh, gt_mesh)
+        log.verbose(f'Mesh: {e.mesh_name}')
+        log.verbose(f'IoU: {iou}.')
+        log.verbose(f'F-Score (tau): {fst}')
+        log.verbose(f'Chamfer: {chamfer}')
+        log.verbose(f'F-Score (2*tau): {fs2t}')
+        log.verbose(f'Normal Consistency: {nc}')
+        results.append({
+            'key': e.mesh_name,
+            'Normal Consistency': nc,
+            'F-Score (tau)': fst,
+            'F-Score (2*tau)': fs2t,
+            'Chamfer': chamfer,
+            'IoU': iou
+        })
+        post_extract_end = time.time()
+        log.verbose(
+            f'Time post extract: {post_extract_end - post_extract_start}')
     results = pd.DataFrame(results)
     if FLAGS.save_results:
       complete_csv = results.to_csv()
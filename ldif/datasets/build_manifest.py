@@ -0,0 +1,407 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""A record of what meshes2dataset has built, so rebuilds can be incremental.
+
+The manifest is a JSON file in the dataset directory. It records, for each
+example:
+  - the content hash of its source mesh,
+  - the preprocessing settings it was made with,
+  - the files that were generated in its directory.
+For each split it also records which examples are in each shard, and the
+names of the shard's optimized tfrecords file and memory-mapped directory.
+
+A rebuild preprocesses only the meshes that are new, changed, made with other
+settings, or missing outputs. It then rewrites only the shards that gain,
+lose, or contain a changed example. The other shards are kept, and at most
+renamed.
+
+Examples are keyed by their directory relative to the dataset directory, for
+example 'train/02691156/1a2b3c'.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import random
+import shutil
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.util.file_util import log
+# pylint: enable=g-bad-import-order
+
+MANIFEST_FILENAME = 'manifest.json'
+_VERSION = 1
+
+# The last file the preprocessing of an example writes:
+COMPLETE_MARKER = 'surface_samples_from_dodeca.pts'
+
+# The shard formats whose files the manifest tracks:
+SHARD_FORMATS = ['optimized', 'mmap']
+
+# One shard of a new layout. previous_index is the index of the shard in the
+# previous layout that it continues, or None. affected is whether its contents
+# differ from that shard's.
+ShardPlan = collections.namedtuple('ShardPlan',
+                                   ['examples', 'previous_index', 'affected'])
+
+
+def file_sha256(path, chunk_size=1 << 20):
+  """Returns the hex SHA-256 of a file's contents."""
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def example_key(dataset_directory, example_directory):
+  return os.path.relpath(example_directory, dataset_directory)
+
+
+def plan_shards(previous, examples, changed, examples_per_shard, rng):
+  """Assigns the examples of a split to shards, reusing a previous layout.
+
+  The examples of each previous shard that still exist stay together, so the
+  shard is unaffected unless it lost an example or one of its examples changed.
+  The examples that aren't in any shard are shuffled, then top up the last
+  shard and fill new ones.
+
+  Args:
+    previous: A list of lists of the examples in each previous shard.
+    examples: The sorted list of the current examples of the split.
+    changed: A set of the examples whose contents were regenerated.
+    examples_per_shard: Int. The size of a full shard.
+    rng: A random.Random, or the random module, to shuffle with.
+
+  Returns:
+    A list of ShardPlans.
+  """
+  current = set(examples)
+  plan = []
+  assigned = set()
+  for previous_index, members in enumerate(previous):
+    kept = [e for e in members if e in current]
+    if not kept:
+      continue
+    assigned.update(kept)
+    affected = len(kept) != len(members) or any(e in changed for e in kept)
+    plan.append(ShardPlan(kept, previous_index, affected))
+  added = [e for e in examples if e not in assigned]
+  rng.shuffle(added)
+  if added and plan and len(plan[-1].examples) < examples_per_shard:
+    room = examples_per_shard - len(plan[-1].examples)
+    plan[-1] = ShardPlan(plan[-1].examples + added[:room],
+                         plan[-1].previous_index, True)
+    added = added[room:]
+  for start in range(0, len(added), examples_per_shard):
+    plan.append(ShardPlan(added[start:start + examples_per_shard], None, True))
+  return plan
+
+
+def _remove(path):
+  if os.path.isdir(path):
+    shutil.rmtree(path)
+  else:
+    os.remove(path)
+
+
+def sync_shard_directory(directory, plan, previous_names, names, is_shard):
+  """Keeps the unaffected shards of a directory under their new names.
+
+  Every other shard in the directory is removed.
+
+  Args:
+    directory: String. The directory containing the shards of one split in one
+      format.
+    plan: A list of ShardPlans.
+    previous_names: A list of the file names of the previous shards, with None
+      for a shard that wasn't written in this format.
+    names: A list of the new file name of each planned shard.
+    is_shard: A function that returns whether a file name in the directory is
+      a shard.
+
+  Returns:
+    The indices of the planned shards that must be written.
+  """
+  reused = {}
+  for i, shard in enumerate(plan):
+    if shard.affected or shard.previous_index is None:
+      continue
+    previous_name = previous_names[shard.previous_index]
+    if previous_name and os.path.exists(os.path.join(directory,
+                                                     previous_name)):
+      reused[i] = previous_name
+  # Moved out of the way first, so that no rename can overwrite a kept shard:
+  for i, previous_name in reused.items():
+    os.rename(
+        os.path.join(directory, previous_name),
+        os.path.join(directory, f'{names[i]}.reused'))
+  for f in os.listdir(directory):
+    if is_shard(f) and not f.endswith('.reused'):
+      _remove(os.path.join(directory, f))
+  for i in reused:
+    os.rename(
+        os.path.join(directory, f'{names[i]}.reused'),
+        os.path.join(directory, names[i]))
+  log.info(f'Kept {len(reused)} of the {len(plan)} shards in {directory}.')
+  return [i for i in range(len(plan)) if i not in reused]
+
+
+def _shard_names(shard_format, split, shard_count):
+  """Returns the file names of the shards of a split, and an is_shard test."""
+  if shard_format == 'optimized':
+    return ([
+        f'{split}-%.5d-of-%.5d.tfrecords' % (i, shard_count)
+        for i in range(shard_count)
+    ], lambda f: f.endswith('.tfrecords'))
+  return [f'{i:05d}' for i in range(shard_count)], lambda f: f.isdigit()
+
+
+def update_split_shards(manifest, split, example_keys, changed, directories,
+                        writers, optimized_format, examples_per_shard=64,
+                        rng=random):
+  """Rewrites the shards of a split whose examples have changed.
+
+  The shards of the formats that aren't written this time keep their files if
+  their contents are unchanged. Otherwise the split's directory in that format
+  is removed, because a reader would take its remaining shards for the whole
+  split.
+
+  Args:
+    manifest: The Manifest. It's saved with the new shards.
+    split: String. The split name.
+    example_keys: A list of the keys of the current examples of the split.
+    changed: A set of the keys of the examples that were preprocessed again.
+    directories: A dictionary with the directory of the split's shards in each
+      of the SHARD_FORMATS.
+    writers: A dictionary from each of the SHARD_FORMATS to write to a function
+      that takes a list of (shard path, example directories) pairs and writes
+      those shards.
+    optimized_format: The format version of the optimized shards, if they are
+      written.
+    examples_per_shard: Int. The size of a full shard.
+    rng: A random.Random, or the random module, to shuffle new examples with.
+  """
+  previous = manifest.shards(split)
+  # New examples are shuffled, to make sure shards are totally random:
+  plan = plan_shards([s['examples'] for s in previous], sorted(example_keys),
+                     changed, examples_per_shard, rng)
+  shards = []
+  for p in plan:
+    shard = {'examples': p.examples}
+    for shard_format in SHARD_FORMATS:
+      shard[shard_format] = None
+      if p.previous_index is not None and not p.affected:
+        shard[shard_format] = previous[p.previous_index][shard_format]
+    shards.append(shard)
+  to_write = {}
+  for shard_format in SHARD_FORMATS:
+    directory = directories[shard_format]
+    names, is_shard = _shard_names(shard_format, split, len(plan))
+    if shard_format not in writers:
+      if (os.path.isdir(directory) and
+          any(shard[shard_format] is None for shard in shards)):
+        log.info(f'Removing the out of date shards in {directory}.')
+        shutil.rmtree(directory)
+        for shard in shards:
+          shard[shard_format] = None
+      continue
+    previous_names = [s[shard_format] for s in previous]
+    if (shard_format == 'optimized' and
+        manifest.optimized_format(split) != optimized_format):
+      # A split's shards must all be in the same format:
+      previous_names = [None] * len(previous)
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    indices = sync_shard_directory(directory, plan, previous_names, names,
+                                   is_shard)
+    to_write[shard_format] = indices, names
+    rewritten = set(indices)
+    for i, (shard, name) in enumerate(zip(shards, names)):
+      shard[shard_format] = None if i in rewritten else name
+  if 'optimized' not in writers:
+    optimized_format = manifest.optimized_format(split)
+  # Saved before writing, so that an interrupted run only redoes the writes:
+  manifest.set_shards(split, shards, optimized_format)
+  manifest.save()
+  for shard_format, (indices, names) in to_write.items():
+    writers[shard_format]([(
+        os.path.join(directories[shard_format], names[i]),
+        [f'{manifest.dataset_directory}/{k}/' for k in plan[i].examples]
+    ) for i in indices])
+    for i in indices:
+      shards[i][shard_format] = names[i]
+    manifest.save()
+
+
+class Manifest(object):
+  """The build manifest of a dataset directory."""
+
+  def __init__(self, dataset_directory):
+    """Loads the manifest, or starts an empty one if there isn't one yet."""
+    self.dataset_directory = dataset_directory
+    self.path = os.path.join(dataset_directory, MANIFEST_FILENAME)
+    self.examples = {}
+    self.splits = {}
+    if os.path.isfile(self.path):
+      with open(self.path, 'rt') as f:
+        d = json.load(f)
+      if d.get('version') != _VERSION:
+        raise ValueError(f'The manifest {self.path} has version'
+                         f' {d.get("version")}, but expected {_VERSION}.')
+      self.examples = d['examples']
+      self.splits = d['splits']
+    # The size, mtime and hash of each source mesh seen this run, by key:
+    self._hashes = {}
+
+  def save(self):
+    """Writes the manifest, replacing the previous one atomically."""
+    manifest = {
+        'version': _VERSION,
+        'examples': self.examples,
+        'splits': self.splits,
+    }
+    temp_path = f'{self.path}.tmp'
+    with open(temp_path, 'wt') as f:
+      json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(temp_path, self.path)
+
+  def _source_hash(self, key, mesh_path):
+    """Hashes a source mesh, unless its size and mtime are as already known.
+
+    Returns:
+      A dictionary with the size, mtime_ns and sha256 of the mesh.
+    """
+    stat = os.stat(mesh_path)
+    for known in [self._hashes.get(key), self.examples.get(key)]:
+      if (known is not None and known['size'] == stat.st_size and
+          known['mtime_ns'] == stat.st_mtime_ns):
+        break
+    else:
+      known = {
+          'size': stat.st_size,
+          'mtime_ns': stat.st_mtime_ns,
+          'sha256': file_sha256(mesh_path),
+      }
+    self._hashes[key] = {k: known[k] for k in ['size', 'mtime_ns', 'sha256']}
+    return self._hashes[key]
+
+  def stale_reason(self, mesh_path, example_directory, settings):
+    """Returns why an example must be preprocessed, or None if it's current.
+
+    Args:
+      mesh_path: String. The path to the source mesh.
+      example_directory: String. The example directory made from it.
+      settings: A dictionary of the preprocessing settings that affect the
+        outputs.
+
+    Returns:
+      'new', 'changed' (the mesh content or the settings differ), 'incomplete'
+      (a recorded output is missing), or None.
+    """
+    key = example_key(self.dataset_directory, example_directory)
+    entry = self.examples.get(key)
+    if entry is None:
+      return 'new'
+    sha256 = self._source_hash(key, mesh_path)['sha256']
+    if sha256 != entry['sha256'] or settings != entry['settings']:
+      return 'changed'
+    if not all(
+        os.path.exists(os.path.join(example_directory, f))
+        for f in entry['artifacts']):
+      return 'incomplete'
+    return None
+
+  def stale_examples(self, meshes, settings):
+    """Finds the examples to preprocess, and forgets their previous outputs.
+
+    The recorded outputs of a stale example are removed, so that preprocessing
+    with skip_existing remakes all of them. An incomplete example may have
+    outputs that were made from a missing one, and there is no other record of
+    the outputs that depend on each other.
+
+    Args:
+      meshes: A list of (mesh_path, example_directory) pairs.
+      settings: A dictionary of the preprocessing settings that affect the
+        outputs.
+
+    Returns:
+      The list of the (mesh_path, example_directory) pairs to preprocess, and a
+      collections.Counter of the reasons they are stale.
+    """
+    stale = []
+    reasons = collections.Counter()
+    for mesh_path, example_directory in meshes:
+      reason = self.stale_reason(mesh_path, example_directory, settings)
+      if reason is None:
+        continue
+      reasons[reason] += 1
+      self.forget(example_directory, remove_artifacts=True)
+      stale.append((mesh_path, example_directory))
+    return stale, reasons
+
+  def forget(self, example_directory, remove_artifacts=False):
+    """Forgets an example, optionally removing its recorded outputs first."""
+    entry = self.examples.pop(
+        example_key(self.dataset_directory, example_directory), None)
+    if entry is not None and remove_artifacts:
+      for f in entry['artifacts']:
+        path = os.path.join(example_directory, f)
+        if os.path.lexists(path):
+          _remove(path)
+
+  def record_example(self, mesh_path, example_directory, settings):
+    """Records a preprocessed example, if it's complete.
+
+    Returns:
+      Whether the example was complete.
+    """
+    if not os.path.isfile(os.path.join(example_directory, COMPLETE_MARKER)):
+      return False
+    key = example_key(self.dataset_directory, example_directory)
+    entry = dict(self._source_hash(key, mesh_path))
+    entry.update({
+        'source': mesh_path,
+        'settings': settings,
+        'artifacts': sorted(os.listdir(example_directory)),
+    })
+    self.examples[key] = entry
+    return True
+
+  def prune(self, example_keys):
+    """Forgets the examples that are no longer built. Returns their keys."""
+    removed = sorted(set(self.examples) - set(example_keys))
+    for key in removed:
+      del self.examples[key]
+    return removed
+
+  def shards(self, split):
+    """Returns the list of shard records of a split.
+
+    Each record is a dictionary with the 'examples' of the shard, and the file
+    name of the shard in each of the SHARD_FORMATS, or None.
+    """
+    return self.splits.get(split, {}).get('shards', [])
+
+  def optimized_format(self, split):
+    return self.splits.get(split, {}).get('optimized_format')
+
+  def set_shards(self, split, shards, optimized_format):
+    self.splits[split] = {
+        'shards': shards,
+        'optimized_format': optimized_format
+    }
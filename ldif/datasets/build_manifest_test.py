@@ -0,0 +1,270 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.datasets.build_manifest."""
+
+import os
+import random
+import shutil
+import tempfile
+
+from absl.testing import absltest
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.datasets import build_manifest
+# pylint: enable=g-bad-import-order
+
+SETTINGS = {'sdf_sampler': 'gaps', 'renderer': 'gaps'}
+
+
+class PlanShardsTest(absltest.TestCase):
+
+  def testFirstPlanShufflesIntoFullShards(self):
+    examples = [f'train/a/{i:03d}' for i in range(10)]
+    plan = build_manifest.plan_shards([], examples, set(), 4, random.Random(0))
+    self.assertEqual([len(p.examples) for p in plan], [4, 4, 2])
+    self.assertTrue(all(p.affected and p.previous_index is None for p in plan))
+    self.assertCountEqual(sum([p.examples for p in plan], []), examples)
+    self.assertNotEqual(sum([p.examples for p in plan], []), examples)
+
+  def testOnlyAffectedShardsChange(self):
+    previous = [['a', 'b'], ['c', 'd'], ['e', 'f'], ['g']]
+    # 'd' changed, 'e' was removed, and 'h' and 'i' were added:
+    examples = ['a', 'b', 'c', 'd', 'f', 'g', 'h', 'i']
+    plan = build_manifest.plan_shards(previous, examples, {'d'}, 2,
+                                      random.Random(0))
+    self.assertEqual([p.previous_index for p in plan], [0, 1, 2, 3, None])
+    self.assertEqual([p.affected for p in plan],
+                     [False, True, True, True, True])
+    self.assertEqual(plan[0].examples, ['a', 'b'])
+    self.assertEqual(plan[2].examples, ['f'])
+    # The last shard is topped up first:
+    self.assertLen(plan[3].examples, 2)
+    self.assertCountEqual(plan[3].examples[1:] + plan[4].examples, ['h', 'i'])
+
+  def testEmptiedShardsAreDropped(self):
+    plan = build_manifest.plan_shards([['a'], ['b']], ['b'], set(), 2,
+                                      random.Random(0))
+    self.assertEqual(plan, [build_manifest.ShardPlan(['b'], 1, False)])
+
+
+class SyncShardDirectoryTest(absltest.TestCase):
+
+  def testKeepsAndRenamesUnaffectedShards(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    for name in ['s-0-of-3', 's-1-of-3', 's-2-of-3', 'other.txt']:
+      with open(os.path.join(directory, name), 'wt') as f:
+        f.write(name)
+    # Shard 0 was emptied, so shard 1 becomes 0 and shard 2 becomes 1. Shard 2
+    # gained an example:
+    plan = [
+        build_manifest.ShardPlan(['b'], 1, False),
+        build_manifest.ShardPlan(['c', 'd'], 2, True),
+    ]
+    to_write = build_manifest.sync_shard_directory(
+        directory, plan, ['s-0-of-3', 's-1-of-3', 's-2-of-3'],
+        ['s-0-of-2', 's-1-of-2'], lambda f: f.startswith('s-'))
+    self.assertEqual(to_write, [1])
+    self.assertCountEqual(os.listdir(directory), ['s-0-of-2', 'other.txt'])
+    with open(os.path.join(directory, 's-0-of-2'), 'rt') as f:
+      self.assertEqual(f.read(), 's-1-of-3')
+
+
+class ManifestTest(absltest.TestCase):
+
+  def setUp(self):
+    super(ManifestTest, self).setUp()
+    self.root = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.root)
+    self.dataset_directory = os.path.join(self.root, 'dataset')
+    self.example_directory = os.path.join(self.dataset_directory,
+                                          'train/02691156/mesh/')
+    os.makedirs(self.example_directory)
+    self.mesh_path = os.path.join(self.root, 'mesh.ply')
+    self.write_mesh('ply\nversion 1\n')
+    self.write_example()
+
+  def write_mesh(self, contents):
+    with open(self.mesh_path, 'wt') as f:
+      f.write(contents)
+
+  def write_example(self):
+    for name in ['depth_and_normals.npz', build_manifest.COMPLETE_MARKER]:
+      with open(os.path.join(self.example_directory, name), 'wt') as f:
+        f.write('output')
+
+  def testStaleReasons(self):
+    manifest = build_manifest.Manifest(self.dataset_directory)
+    self.assertEqual(
+        manifest.stale_reason(self.mesh_path, self.example_directory,
+                              SETTINGS), 'new')
+    self.assertTrue(
+        manifest.record_example(self.mesh_path, self.example_directory,
+                                SETTINGS))
+    manifest.save()
+    manifest = build_manifest.Manifest(self.dataset_directory)
+    self.assertIsNone(
+        manifest.stale_reason(self.mesh_path, self.example_directory,
+                              SETTINGS))
+    self.assertEqual(
+        manifest.stale_reason(self.mesh_path, self.example_directory,
+                              dict(SETTINGS, renderer='python')), 'changed')
+    # Touching the mesh without changing it doesn't make it stale:
+    os.utime(self.mesh_path, ns=(0, 0))
+    self.assertIsNone(
+        manifest.stale_reason(self.mesh_path, self.example_directory,
+                              SETTINGS))
+    os.remove(os.path.join(self.example_directory, 'depth_and_normals.npz'))
+    self.assertEqual(
+        manifest.stale_reason(self.mesh_path, self.example_directory,
+                              SETTINGS), 'incomplete')
+    self.write_mesh('ply\nversion 2\n')
+    self.assertEqual(
+        manifest.stale_reason(self.mesh_path, self.example_directory,
+                              SETTINGS), 'changed')
+
+  def testForgetRemovesArtifacts(self):
+    manifest = build_manifest.Manifest(self.dataset_directory)
+    manifest.record_example(self.mesh_path, self.example_directory, SETTINGS)
+    manifest.forget(self.example_directory, remove_artifacts=True)
+    self.assertEmpty(os.listdir(self.example_directory))
+    self.assertEmpty(manifest.examples)
+    # An incomplete example isn't recorded:
+    self.assertFalse(
+        manifest.record_example(self.mesh_path, self.example_directory,
+                                SETTINGS))
+
+  def testStaleExamplesAreRemadeInFull(self):
+    manifest = build_manifest.Manifest(self.dataset_directory)
+    new_directory = os.path.join(self.dataset_directory, 'train/02691156/new/')
+    meshes = [(self.mesh_path, self.example_directory),
+              (self.mesh_path, new_directory)]
+    manifest.record_example(self.mesh_path, self.example_directory, SETTINGS)
+    stale, reasons = manifest.stale_examples(meshes, SETTINGS)
+    self.assertEqual(stale, meshes[1:])
+    self.assertEqual(reasons, {'new': 1})
+    # The outputs that are left of an incomplete example were possibly made
+    # from the missing one, so they're removed rather than skipped:
+    os.remove(os.path.join(self.example_directory, 'depth_and_normals.npz'))
+    stale, reasons = manifest.stale_examples(meshes, SETTINGS)
+    self.assertEqual(stale, meshes)
+    self.assertEqual(reasons, {'incomplete': 1, 'new': 1})
+    self.assertEmpty(os.listdir(self.example_directory))
+    self.assertEmpty(manifest.examples)
+    self.assertFalse(
+        manifest.record_example(self.mesh_path, self.example_directory,
+                                SETTINGS))
+
+  def testPruneAndShards(self):
+    manifest = build_manifest.Manifest(self.dataset_directory)
+    manifest.record_example(self.mesh_path, self.example_directory, SETTINGS)
+    manifest.set_shards('train', [{
+        'examples': ['train/02691156/mesh'],
+        'optimized': 'train-00000-of-00001.tfrecords',
+        'mmap': None
+    }], 2)
+    manifest.save()
+    manifest = build_manifest.Manifest(self.dataset_directory)
+    self.assertEqual(manifest.optimized_format('train'), 2)
+    self.assertEqual(manifest.shards('train')[0]['examples'],
+                     ['train/02691156/mesh'])
+    self.assertEqual(manifest.shards('val'), [])
+    self.assertEqual(manifest.prune([]), ['train/02691156/mesh'])
+
+
+class UpdateSplitShardsTest(absltest.TestCase):
+
+  def setUp(self):
+    super(UpdateSplitShardsTest, self).setUp()
+    self.dataset_directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.dataset_directory)
+    self.directories = {
+        'optimized': os.path.join(self.dataset_directory, 'optimized/train'),
+        'mmap': os.path.join(self.dataset_directory, 'mmap/train'),
+    }
+    self.keys = [f'train/a/{i:02d}' for i in range(10)]
+    self.written = {'optimized': [], 'mmap': []}
+
+  def write_optimized(self, shards):
+    for path, example_dirs in shards:
+      with open(path, 'wt') as f:
+        f.write('\n'.join(example_dirs))
+    self.written['optimized'].extend(path for path, _ in shards)
+
+  def write_mmap(self, shards):
+    for path, _ in shards:
+      os.makedirs(path)
+    self.written['mmap'].extend(path for path, _ in shards)
+
+  def update(self, changed, formats):
+    manifest = build_manifest.Manifest(self.dataset_directory)
+    writers = {
+        'optimized': self.write_optimized,
+        'mmap': self.write_mmap
+    }
+    build_manifest.update_split_shards(
+        manifest, 'train', self.keys, changed, self.directories,
+        {f: writers[f] for f in formats}, 2, examples_per_shard=4,
+        rng=random.Random(0))
+    return build_manifest.Manifest(self.dataset_directory)
+
+  def testWritesEveryShardOfEachFormat(self):
+    manifest = self.update(set(), ['optimized', 'mmap'])
+    shards = manifest.shards('train')
+    self.assertEqual([len(s['examples']) for s in shards], [4, 4, 2])
+    self.assertEqual([s['optimized'] for s in shards], [
+        f'train-{i:05d}-of-00003.tfrecords' for i in range(3)
+    ])
+    self.assertEqual([s['mmap'] for s in shards], ['00000', '00001', '00002'])
+    self.assertEqual(manifest.optimized_format('train'), 2)
+    self.assertCountEqual(
+        os.listdir(self.directories['optimized']),
+        [s['optimized'] for s in shards])
+    with open(os.path.join(self.directories['optimized'],
+                           shards[2]['optimized']), 'rt') as f:
+      self.assertEqual(f.read().split('\n'), [
+          f'{self.dataset_directory}/{k}/' for k in shards[2]['examples']
+      ])
+
+  def testRewritesOnlyAffectedShards(self):
+    shards = self.update(set(), ['optimized', 'mmap']).shards('train')
+    self.written = {'optimized': [], 'mmap': []}
+    manifest = self.update({shards[1]['examples'][0]}, ['optimized', 'mmap'])
+    self.assertEqual(self.written, {
+        'optimized': [
+            os.path.join(self.directories['optimized'], shards[1]['optimized'])
+        ],
+        'mmap': [os.path.join(self.directories['mmap'], shards[1]['mmap'])],
+    })
+    self.assertEqual(manifest.shards('train'), shards)
+
+  def testRemovesStaleShardsOfFormatsNotWritten(self):
+    shards = self.update(set(), ['optimized', 'mmap']).shards('train')
+    # Nothing changed, so the memory-mapped shards are still current:
+    manifest = self.update(set(), ['optimized'])
+    self.assertEqual(manifest.shards('train'), shards)
+    self.assertLen(os.listdir(self.directories['mmap']), 3)
+    # Otherwise the remaining ones would be read as the whole split:
+    manifest = self.update({shards[1]['examples'][0]}, ['optimized'])
+    self.assertFalse(os.path.exists(self.directories['mmap']))
+    self.assertEqual([s['mmap'] for s in manifest.shards('train')],
+                     [None] * 3)
+    self.assertEqual([s['optimized'] for s in manifest.shards('train')],
+                     [s['optimized'] for s in shards])
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,211 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Loads examples from meshes2dataset directories in worker processes.
+
+Reading an example from its directory (decompressing the depth renders, parsing
+the GAPS sample files) is pure python and numpy work. Done in a tf.py_func it
+holds the GIL, so it runs serially however many parallel calls the dataset map
+is given. Here a pool of worker processes reads the examples instead, and each
+writes its example directly into a slot of a shared memory ring buffer. Only
+the slot index and the mesh name are sent back to the parent.
+
+An example reader is any picklable function
+  read_fn(example_directory)
+that returns a dictionary with a numpy array for each field, plus a
+'mesh_name' string. process_element.load_example_dict is one.
+"""
+
+import multiprocessing
+import os
+import queue
+
+import numpy as np
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.datasets import process_element
+from ldif.util.file_util import log
+# pylint: enable=g-bad-import-order
+
+# How often the parent checks that the workers are alive while it waits:
+_POLL_INTERVAL_SECONDS = 1.0
+
+
+def _slot_arrays(ring_buffer, slot, field_shapes):
+  """Returns the numpy views of the fields in one slot of the ring buffer."""
+  slot_length = sum(int(np.prod(s)) for s in field_shapes.values())
+  arrays = {}
+  offset = slot * slot_length
+  for k, shape in field_shapes.items():
+    length = int(np.prod(shape))
+    arrays[k] = np.frombuffer(
+        ring_buffer, dtype=np.float32, count=length,
+        offset=4 * offset).reshape(shape)
+    offset += length
+  return arrays
+
+
+def _serve(read_fn, example_directories, field_shapes, ring_buffer, tasks,
+           results):
+  """The worker process main loop. Exits when it receives None."""
+  while True:
+    task = tasks.get()
+    if task is None:
+      break
+    slot, example_index = task
+    try:
+      d = read_fn(example_directories[example_index])
+      for k, array in _slot_arrays(ring_buffer, slot, field_shapes).items():
+        array[...] = d[k]
+    except Exception as e:  # pylint: disable=broad-except
+      results.put((slot, None, f'{example_directories[example_index]}: {e!r}'))
+      continue
+    results.put((slot, d['mesh_name'], None))
+
+
+class ExampleLoader(object):
+  """Reads examples with a pool of worker processes. Also a context manager."""
+
+  def __init__(self,
+               example_directories,
+               worker_count=None,
+               prefetch_count=None,
+               shuffle=False,
+               repeat=False,
+               field_shapes=None,
+               read_fn=process_element.load_example_dict):
+    """Starts the worker processes.
+
+    Args:
+      example_directories: A list of the meshes2dataset example directories to
+        read, each of the form {split}/{synset}/{mesh_hash}.
+      worker_count: Int. The number of worker processes. Defaults to the number
+        of CPUs.
+      prefetch_count: Int. The number of slots in the ring buffer, so the
+        number of examples that are being read or are ready at once. Defaults
+        to twice the worker count.
+      shuffle: Boolean. Whether to visit the examples in a random order, drawn
+        again each epoch.
+      repeat: Boolean. Whether to loop over the examples indefinitely.
+      field_shapes: A dictionary of the float32 fields to load, mapping each
+        field name to its shape. Defaults to process_element.FIELD_SHAPES.
+      read_fn: The example reader. See the module docstring.
+    """
+    if not example_directories:
+      raise ValueError('No example directories to load.')
+    self.example_directories = list(example_directories)
+    self.worker_count = worker_count or os.cpu_count()
+    self.prefetch_count = prefetch_count or 2 * self.worker_count
+    self.shuffle = shuffle
+    self.repeat = repeat
+    self.field_shapes = dict(field_shapes or process_element.FIELD_SHAPES)
+    slot_length = sum(int(np.prod(s)) for s in self.field_shapes.values())
+    # Spawn rather than fork, because the parent usually has tensorflow loaded:
+    context = multiprocessing.get_context('spawn')
+    self._ring_buffer = context.RawArray('f', self.prefetch_count * slot_length)
+    self._tasks = context.Queue()
+    self._results = context.Queue()
+    self._processes = []
+    for _ in range(self.worker_count):
+      process = context.Process(
+          target=_serve,
+          args=(read_fn, self.example_directories, self.field_shapes,
+                self._ring_buffer, self._tasks, self._results),
+          daemon=True)
+      process.start()
+      self._processes.append(process)
+    log.verbose(f'Started {self.worker_count} example loader workers with a'
+                f' {self.prefetch_count} example ring buffer.')
+
+  def __len__(self):
+    return len(self.example_directories)
+
+  def _example_indices(self):
+    """Yields the order to read the examples in."""
+    while True:
+      if self.shuffle:
+        yield from np.random.permutation(len(self.example_directories))
+      else:
+        yield from range(len(self.example_directories))
+      if not self.repeat:
+        return
+
+  def _get_result(self):
+    """Waits for a worker to finish an example."""
+    while True:
+      try:
+        return self._results.get(timeout=_POLL_INTERVAL_SECONDS)
+      except queue.Empty:
+        exit_codes = [p.exitcode for p in self._processes if not p.is_alive()]
+        if exit_codes:
+          raise ValueError('An example loader worker exited unexpectedly with'
+                           f' code {exit_codes[0]}.')
+
+  def examples(self):
+    """Yields the examples as they are read.
+
+    The examples come in the order that the workers finish them, which is
+    close to, but not exactly, the requested order. Only one iteration may be
+    active at a time.
+
+    Yields:
+      A dictionary with a float32 numpy array for each field, plus the
+      'mesh_name' string. The arrays are copies, so they can be kept.
+    """
+    if not self._processes:
+      raise ValueError('The example loader has been closed.')
+    example_indices = self._example_indices()
+    in_flight = 0
+    try:
+      # Fill the ring buffer:
+      for slot, example_index in zip(range(self.prefetch_count),
+                                     example_indices):
+        self._tasks.put((slot, example_index))
+        in_flight += 1
+      while in_flight:
+        slot, mesh_name, error = self._get_result()
+        in_flight -= 1
+        if error is not None:
+          raise ValueError(f'Failed to load example {error}')
+        d = {
+            k: np.copy(v) for k, v in _slot_arrays(
+                self._ring_buffer, slot, self.field_shapes).items()
+        }
+        d['mesh_name'] = mesh_name
+        # The slot is free again, so start the next read into it:
+        example_index = next(example_indices, None)
+        if example_index is not None:
+          self._tasks.put((slot, example_index))
+          in_flight += 1
+        yield d
+    finally:
+      # Collect the reads still running if iteration stopped early, so that a
+      # later iteration doesn't receive them:
+      for _ in range(in_flight):
+        self._get_result()
+
+  def close(self):
+    """Stops the worker processes."""
+    for _ in self._processes:
+      self._tasks.put(None)
+    for process in self._processes:
+      process.join()
+    self._processes = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
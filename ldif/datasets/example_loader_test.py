@@ -0,0 +1,90 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.datasets.example_loader."""
+
+import numpy as np
+
+from absl.testing import absltest
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.datasets import example_loader
+# pylint: enable=g-bad-import-order
+
+FIELD_SHAPES = {'samples': [5, 4], 'grid': [2, 2, 2]}
+
+
+def read_test_example(example_directory):
+  """Makes an example whose values identify its directory."""
+  index = int(example_directory.split('/')[-1])
+  if index < 0:
+    raise ValueError('Negative example index.')
+  return {
+      'samples': np.full(FIELD_SHAPES['samples'], index, dtype=np.float32),
+      'grid': np.full(FIELD_SHAPES['grid'], -index, dtype=np.float32),
+      'mesh_name': f'00000000|{index}',
+  }
+
+
+class ExampleLoaderTest(absltest.TestCase):
+
+  def testReadsEveryExampleOnce(self):
+    directories = [f'train/00000000/{i}' for i in range(10)]
+    with example_loader.ExampleLoader(
+        directories,
+        worker_count=3,
+        prefetch_count=4,
+        field_shapes=FIELD_SHAPES,
+        read_fn=read_test_example) as loader:
+      examples = list(loader.examples())
+      # The loader can be iterated again:
+      self.assertLen(list(loader.examples()), 10)
+    self.assertCountEqual([d['mesh_name'] for d in examples],
+                          [f'00000000|{i}' for i in range(10)])
+    for d in examples:
+      index = int(d['mesh_name'].split('|')[1])
+      np.testing.assert_array_equal(d['samples'],
+                                    np.full([5, 4], index, dtype=np.float32))
+      np.testing.assert_array_equal(d['grid'],
+                                    np.full([2, 2, 2], -index, dtype=np.float32))
+
+  def testRepeatsAndStopsEarly(self):
+    directories = [f'train/00000000/{i}' for i in range(3)]
+    with example_loader.ExampleLoader(
+        directories,
+        worker_count=2,
+        shuffle=True,
+        repeat=True,
+        field_shapes=FIELD_SHAPES,
+        read_fn=read_test_example) as loader:
+      examples = loader.examples()
+      mesh_names = [next(examples)['mesh_name'] for _ in range(7)]
+      examples.close()
+      self.assertLen(mesh_names, 7)
+      self.assertLen(set(mesh_names), 3)
+      # Reads left in flight by the first iteration don't leak into the next:
+      self.assertLen(list(zip(range(5), loader.examples())), 5)
+
+  def testRaisesReadErrors(self):
+    with example_loader.ExampleLoader(['train/00000000/-1'],
+                                      worker_count=1,
+                                      field_shapes=FIELD_SHAPES,
+                                      read_fn=read_test_example) as loader:
+      with self.assertRaisesRegex(ValueError, 'Negative example index'):
+        list(loader.examples())
+
+
+if __name__ == '__main__':
+  absltest.main()
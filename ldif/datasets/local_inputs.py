@@ -16,22 +16,65 @@
 
 import os
 import glob
-import sys
 import time
 
+import numpy as np
 import tensorflow as tf
 
 # LDIF is an internal package, should be imported last.
 # pylint: disable=g-bad-import-order
+from ldif.datasets import example_loader
 from ldif.datasets import process_element
 from ldif.inference import example
 from ldif.util.file_util import log
 # pylint: enable=g-bad-import-order
 
-def _make_optimized_dataset(directory, batch_size, mode, split):
+# The fields holding the SDF supervision samples, with their indices in the
+# tuples passed to build_dataset_obj():
+SUPERVISION_FIELDS = {'bounding_box_samples': 0, 'near_surface_samples': 3}
+FULL_SUPERVISION_SAMPLE_COUNT = 100000
+
+
+def _subsample_supervision(supervision_sample_count):
+  """Returns a map function that subsamples the supervision of an example.
+
+  The samples are drawn uniformly with replacement, independently for each
+  field, the same as ShapeNetExample._subsample() does in the graph.
+
+  Args:
+    supervision_sample_count: Int. The number of samples to keep per field.
+  """
+
+  def subsample(*example):
+    example = list(example)
+    for field_idx in SUPERVISION_FIELDS.values():
+      samples = example[field_idx]
+      sample_indices = tf.random.uniform([supervision_sample_count],
+                                         minval=0,
+                                         maxval=tf.shape(samples)[0],
+                                         dtype=tf.int32)
+      example[field_idx] = tf.gather(samples, sample_indices)
+    return tuple(example)
+
+  return subsample
+
+
+def _make_optimized_dataset(directory, batch_size, mode, split,
+                            supervision_sample_count=None):
   filenames = glob.glob(f'{directory}/optimized/{split}/*.tfrecords')
   print('FILENAMES:', filenames)
   log.verbose(f'Making dataset from the following files: {filenames}')
+  if not filenames:
+    raise ValueError(f'No optimized shards found for split {split}.')
+  # A rebuild without --trample_optimized can leave shards of an older format
+  # next to the new ones, and each dataset has a single parser:
+  versions = {f: process_element.shard_format_version(f) for f in filenames}
+  if len(set(versions.values())) > 1:
+    raise ValueError(f'The optimized shards of split {split} have mixed format'
+                     f' versions {versions}. Rebuild them with'
+                     ' --trample_optimized.')
+  version = versions[filenames[0]]
+  log.info(f'The optimized dataset has format version {version}.')
   dataset = tf.data.TFRecordDataset(filenames=filenames, compression_type='GZIP',
         buffer_size=None, num_parallel_reads=8)
   log.info('Mapping...')
@@ -39,62 +82,264 @@ def _make_optimized_dataset(directory, batch_size, mode, split):
     dataset = dataset.shuffle(buffer_size=2 * batch_size)
     dataset = dataset.repeat()
 
-  dataset = dataset.map(process_element.parse_tf_example,
+  dataset = dataset.map(process_element.PARSERS[version],
       num_parallel_calls=os.cpu_count())
+  if supervision_sample_count:
+    dataset = dataset.map(_subsample_supervision(supervision_sample_count),
+                          num_parallel_calls=os.cpu_count())
 
   dataset = dataset.batch(batch_size, drop_remainder=True).prefetch(1)
 
   dataset_items = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
-  return build_dataset_obj(dataset_items, batch_size)
+  return build_dataset_obj(dataset_items, batch_size, supervision_sample_count)
+
+
+
+class MemoryMappedSplit(object):
+  """Random access to a split of the memory-mapped dataset.
+
+  The shards are memory-mapped read-only, so nothing is decompressed or parsed,
+  only the rows that are used are read, and the pages are shared through the
+  page cache by every process reading the dataset.
+  """
+
+  def __init__(self, split_directory):
+    shard_directories = sorted(
+        os.path.dirname(f) for f in glob.glob(
+            f'{split_directory}/*/{process_element.MESH_NAMES_FILENAME}'))
+    if not shard_directories:
+      raise ValueError(f'No memory-mapped shards found in {split_directory}.')
+    self.shards = []
+    self.mesh_names = []
+    shard_of_example = []
+    for shard_idx, shard_directory in enumerate(shard_directories):
+      with open(
+          os.path.join(shard_directory, process_element.MESH_NAMES_FILENAME),
+          'rt') as f:
+        mesh_names = f.read().splitlines()
+      shard = {
+          k: np.load(os.path.join(shard_directory, f'{k}.npy'), mmap_mode='r')
+          for k in process_element.FIELD_SHAPES
+      }
+      for k, shape in process_element.FIELD_SHAPES.items():
+        if list(shard[k].shape) != [len(mesh_names)] + shape:
+          raise ValueError(f'The {k} array of shard {shard_directory} has shape'
+                           f' {shard[k].shape}, but expected'
+                           f' {[len(mesh_names)] + shape}.')
+      self.shards.append(shard)
+      self.mesh_names.extend(mesh_names)
+      shard_of_example.append(np.full(len(mesh_names), shard_idx))
+    self._shard_of_example = np.concatenate(shard_of_example)
+    shard_starts = np.cumsum([0] + [len(s['grid']) for s in self.shards])
+    self._row_of_example = (
+        np.arange(len(self.mesh_names)) - shard_starts[self._shard_of_example])
+
+  def __len__(self):
+    return len(self.mesh_names)
+
+  def gather(self, indices, supervision_sample_count=None):
+    """Reads the examples at some indices into the split.
+
+    Args:
+      indices: A numpy int array with shape [batch_size].
+      supervision_sample_count: Int or None. If set, only this many randomly
+        chosen rows (with replacement) of each supervision field are read per
+        example, instead of all of them.
+
+    Returns:
+      A tuple with a numpy array for each field, in the order of
+      build_dataset_obj(), each with a leading batch dimension.
+    """
+    shapes = dict(process_element.FIELD_SHAPES)
+    if supervision_sample_count:
+      for k in SUPERVISION_FIELDS:
+        shapes[k] = [supervision_sample_count] + shapes[k][1:]
+    fields = {
+        k: np.empty([len(indices)] + shape, dtype=np.float32)
+        for k, shape in shapes.items()
+    }
+    for i, index in enumerate(indices):
+      shard = self.shards[self._shard_of_example[index]]
+      row = self._row_of_example[index]
+      for k in process_element.FIELD_SHAPES:
+        if supervision_sample_count and k in SUPERVISION_FIELDS:
+          # Sorted, so the pages of the mapping are touched in order:
+          sample_rows = np.sort(
+              np.random.randint(
+                  process_element.FIELD_SHAPES[k][0],
+                  size=supervision_sample_count))
+          fields[k][i] = shard[k][row, sample_rows]
+        else:
+          fields[k][i] = shard[k][row]
+    mesh_names = np.array(
+        [self.mesh_names[i].encode('utf-8') for i in indices], dtype=object)
+    return (fields['bounding_box_samples'], fields['depth_renders'], mesh_names,
+            fields['near_surface_samples'], fields['grid'],
+            fields['world2grid'], fields['surface_point_samples'])
+
+
+def _make_mmap_dataset(directory, batch_size, mode, split,
+                       supervision_sample_count=None):
+  """Makes a dataset that reads batches from the memory-mapped dataset."""
+  split_data = MemoryMappedSplit(
+      f'{directory}/{process_element.MMAP_DIRECTORY}/{split}')
+  log.info(f'Memory-mapped {len(split_data)} examples of split {split}.')
+  dataset = tf.data.Dataset.range(len(split_data))
+  if mode == 'train':
+    # Shuffling indices is free, so the whole split is shuffled:
+    dataset = dataset.shuffle(buffer_size=len(split_data))
+    dataset = dataset.repeat()
+  dataset = dataset.batch(batch_size, drop_remainder=True)
+  gather = lambda indices: split_data.gather(indices, supervision_sample_count)
+  dataset = dataset.map(
+      lambda indices: tuple(
+          tf.py_func(gather, [indices], [
+              tf.float32, tf.float32, tf.string, tf.float32, tf.float32,
+              tf.float32, tf.float32
+          ])),
+      num_parallel_calls=os.cpu_count())
+  dataset = dataset.prefetch(1)
+  dataset_items = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
+  return build_dataset_obj(dataset_items, batch_size, supervision_sample_count)
+
 
+def build_dataset_obj(dataset_items, bs, supervision_sample_count=None):
+  """Wraps batched dataset tensors in an object with a checked shape per field.
 
+  Args:
+    dataset_items: A tuple of batched tensors, in the order below.
+    bs: Int. The batch size.
+    supervision_sample_count: Int or None. The number of uniform and near
+      surface samples per example, if they were subsampled by the dataset.
 
-def build_dataset_obj(dataset_items, bs):
+  Returns:
+    An object with an attribute per field.
+  """
   dataset_obj = lambda: 0
+  sample_count = supervision_sample_count or FULL_SUPERVISION_SAMPLE_COUNT
   # log.info(f'dataset_items[0]: {type(dataset_items[0])}')  # tf tensor
   dataset_obj.bounding_box_samples = tf.ensure_shape(dataset_items[0],
-                                                     [bs, 100000, 4])
+                                                     [bs, sample_count, 4])
   dataset_obj.depth_renders = tf.ensure_shape(dataset_items[1],
                                               [bs, 20, 224, 224, 1])
   dataset_obj.mesh_name = dataset_items[2]
   dataset_obj.near_surface_samples = tf.ensure_shape(dataset_items[3],
-                                                     [bs, 100000, 4])
+                                                     [bs, sample_count, 4])
   dataset_obj.grid = tf.ensure_shape(dataset_items[4], [bs, 32, 32, 32])
   dataset_obj.world2grid = tf.ensure_shape(dataset_items[5], [bs, 4, 4])
   dataset_obj.surface_point_samples = tf.ensure_shape(dataset_items[6],
                                                       [bs, 10000, 6])
+  dataset_obj.supervision_sample_count = supervision_sample_count
 
   return dataset_obj
 
 
+def split_dataset_obj(dataset_obj, replica_count):
+  """Splits a batch into contiguous equal parts, one per replica.
 
-def make_dataset(directory, batch_size, mode, split):
-  """Generates a one-shot style tf.Dataset."""
+  Replica i always gets examples [i * bs, (i + 1) * bs) of each batch, where
+  bs is the batch size divided by the replica count.
+
+  Args:
+    dataset_obj: An object returned by build_dataset_obj().
+    replica_count: Int. The number of parts. Must divide the batch size.
+
+  Returns:
+    A list of replica_count objects like build_dataset_obj()'s.
+  """
+  batch_size = dataset_obj.bounding_box_samples.get_shape().as_list()[0]
+  if batch_size % replica_count:
+    raise ValueError(f'The batch size {batch_size} is not divisible by the'
+                     f' replica count {replica_count}.')
+  fields = [
+      dataset_obj.bounding_box_samples, dataset_obj.depth_renders,
+      dataset_obj.mesh_name, dataset_obj.near_surface_samples,
+      dataset_obj.grid, dataset_obj.world2grid,
+      dataset_obj.surface_point_samples
+  ]
+  parts = [tf.split(field, replica_count, axis=0) for field in fields]
+  return [
+      build_dataset_obj([p[i] for p in parts], batch_size // replica_count,
+                        dataset_obj.supervision_sample_count)
+      for i in range(replica_count)
+  ]
+
+
+def _loader_dataset(directory, mode, split, worker_count, prefetch_count):
+  """Makes a dataset of examples read on the fly by an ExampleLoader."""
+  example_directories = sorted(
+      os.path.dirname(f)
+      for f in glob.glob(f'{directory}/{split}/*/*/mesh_orig.ply'))
+  loader = example_loader.ExampleLoader(
+      example_directories,
+      worker_count=worker_count,
+      prefetch_count=prefetch_count,
+      shuffle=mode == 'train',
+      repeat=mode == 'train')
+  log.info(f'Loading {len(loader)} examples of split {split} with'
+           f' {loader.worker_count} worker processes.')
+  fields = ['bounding_box_samples', 'depth_renders', 'mesh_name',
+            'near_surface_samples', 'grid', 'world2grid',
+            'surface_point_samples']
+
+  def generator():
+    for d in loader.examples():
+      yield tuple(d[k] for k in fields)
+
+  return tf.data.Dataset.from_generator(
+      generator,
+      output_types=tuple(
+          tf.string if k == 'mesh_name' else tf.float32 for k in fields),
+      output_shapes=tuple(
+          [] if k == 'mesh_name' else process_element.FIELD_SHAPES[k]
+          for k in fields))
+
+
+def make_dataset(directory, batch_size, mode, split,
+                 supervision_sample_count=None, loader_worker_count=None,
+                 loader_prefetch_count=None):
+  """Generates a one-shot style tf.Dataset.
+
+  Args:
+    directory: String. The root directory of the dataset.
+    batch_size: Int. The batch size.
+    mode: String. 'train' to shuffle and repeat the split indefinitely.
+    split: String. One of 'train', 'val' or 'test'.
+    supervision_sample_count: Int or None. If set, the uniform and near surface
+      samples are randomly subsampled to this many per example in the input
+      pipeline, so only the samples the loss uses are batched and fed to the
+      model. The memory-mapped dataset reads only those rows. Otherwise all
+      100K samples of each are returned.
+    loader_worker_count: Int or None. The number of worker processes that
+      read examples when there is no preprocessed dataset. Defaults to the
+      number of CPUs.
+    loader_prefetch_count: Int or None. The number of examples the workers
+      read ahead. Defaults to twice the worker count.
+
+  Returns:
+    An object with an attribute per field of a batch. See build_dataset_obj().
+  """
   assert split in ['train', 'val', 'test']
+  if os.path.isdir(f'{directory}/{process_element.MMAP_DIRECTORY}/{split}'):
+    log.info('Memory-mapped dataset detected at'
+             f' {directory}/{process_element.MMAP_DIRECTORY}')
+    return _make_mmap_dataset(directory, batch_size, mode, split,
+                              supervision_sample_count)
   # Detect if an optimized dataset exists:
-  if os.path.isdir(f'{directory}/optimized' and False):  # if os.path.isdir(f'{directory}/optimized'):
+  if os.path.isdir(f'{directory}/optimized/{split}'):
     log.info(f'Optimized dataset detected at {directory}/optimized')
-    return _make_optimized_dataset(directory, batch_size, mode, split)
+    return _make_optimized_dataset(directory, batch_size, mode, split,
+                                   supervision_sample_count)
   log.info(f'No optimized preprocessed dataset found at {directory}/optimized. '
           'Processing dataset elements on the fly. If an IO bottleneck is '
           'present, please rerun meshes2dataset with --optimize.')
 
-  dataset = tf.data.Dataset.list_files(f'{directory}/{split}/*/*/mesh_orig.ply')  # list of all mesh_orig files
-  print('Dataset:', dataset)
-  print(sys.getsizeof(dataset))
-  # for element in dataset:
-  #   print('Dataset element:', element)
-  log.info('Mapping...')
-  if mode == 'train':  # True when training (obviously)
-    # log.info('Shuffling and repeating...')
-    dataset = dataset.shuffle(buffer_size=2 * batch_size)
-    dataset = dataset.repeat()  # Repeat indefinitely (until stopped)
-
-  # log.info(f'dataset element_spec: {dataset.element_spec}')  # dataset returns tf tensors
-
-  log.info(f'cpu_count: {os.cpu_count()}')
-  dataset = dataset.map(process_element.parse_example,
-      num_parallel_calls=os.cpu_count())
+  # The examples are read in worker processes, which shuffle and repeat:
+  dataset = _loader_dataset(directory, mode, split, loader_worker_count,
+                            loader_prefetch_count)
+  if supervision_sample_count:
+    dataset = dataset.map(_subsample_supervision(supervision_sample_count),
+                          num_parallel_calls=os.cpu_count())
   log.info('dataset: ' + str(dataset))
   # log.info(f'dataset element_spec: {dataset.element_spec}')  # dataset returns tf tensors
 
@@ -107,4 +352,48 @@ def make_dataset(directory, batch_size, mode, split):
   # log.info(f'dataset: {type(dataset)}')  # tensorflow.python.data.ops.dataset_ops.DatasetV1Adapter
   dataset_items = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
   # log.info(f'dataset_items: {type(dataset_items)}')  # tuple
-  return build_dataset_obj(dataset_items, bs)
+  return build_dataset_obj(dataset_items, bs, supervision_sample_count)
+
+
+def make_synthetic_dataset(batch_size, supervision_sample_count=None, seed=0):
+  """Makes a dataset that repeats a random batch held in memory.
+
+  The batch has the shapes and types of make_dataset()'s, so the model built on
+  it is the same, but the input pipeline does no work after the first batch.
+
+  Args:
+    batch_size: Int. The batch size.
+    supervision_sample_count: Int or None. The number of uniform and near
+      surface samples per example. Defaults to all 100K.
+    seed: Int. The seed of the random example.
+
+  Returns:
+    An object with an attribute per field of a batch. See build_dataset_obj().
+  """
+  rng = np.random.RandomState(seed)
+  sample_count = supervision_sample_count or FULL_SUPERVISION_SAMPLE_COUNT
+
+  def sdf_samples(count):
+    xyz = rng.uniform(-0.5, 0.5, size=[count, 3])
+    sdf = rng.normal(scale=0.1, size=[count, 1])
+    return np.concatenate([xyz, sdf], axis=1).astype(np.float32)
+
+  normals = rng.normal(size=[10000, 3])
+  normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+  # Maps the [-0.7, 0.7] box to the 32^3 grid:
+  world2grid = np.diag([32 / 1.4, 32 / 1.4, 32 / 1.4, 1.0])
+  world2grid[:3, 3] = 16.0
+  example = (
+      sdf_samples(sample_count),
+      rng.uniform(0.0, 2.0, size=[20, 224, 224, 1]).astype(np.float32),
+      b'03001627|synthetic',
+      sdf_samples(sample_count),
+      rng.normal(scale=0.1, size=[32, 32, 32]).astype(np.float32),
+      world2grid.astype(np.float32),
+      np.concatenate([rng.uniform(-0.5, 0.5, size=[10000, 3]), normals],
+                     axis=1).astype(np.float32),
+  )
+  dataset = tf.data.Dataset.from_tensors(example).repeat(batch_size)
+  dataset = dataset.batch(batch_size).cache().repeat().prefetch(1)
+  dataset_items = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
+  return build_dataset_obj(dataset_items, batch_size, supervision_sample_count)
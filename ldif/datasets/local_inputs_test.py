@@ -0,0 +1,232 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.datasets.local_inputs."""
+
+import os
+
+import numpy as np
+import tensorflow as tf
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.datasets import local_inputs
+from ldif.datasets import process_element
+from ldif.datasets import process_element_test
+# pylint: enable=g-bad-import-order
+
+
+def run_dataset_obj(dataset_obj):
+  """Evaluates one batch of the fields of a build_dataset_obj() object."""
+  with tf.compat.v1.Session() as session:
+    return session.run([
+        dataset_obj.bounding_box_samples, dataset_obj.depth_renders,
+        dataset_obj.mesh_name, dataset_obj.near_surface_samples,
+        dataset_obj.grid, dataset_obj.world2grid,
+        dataset_obj.surface_point_samples
+    ])
+
+
+class LocalInputsTest(tf.test.TestCase):
+
+  def writeOptimizedShard(self, example_dicts, version, shard_name='00000'):
+    split_directory = self.get_temp_dir() + '/optimized/train'
+    if not os.path.isdir(split_directory):
+      os.makedirs(split_directory)
+    options = tf.io.TFRecordOptions(
+        tf.compat.v1.io.TFRecordCompressionType.GZIP)
+    with tf.io.TFRecordWriter(f'{split_directory}/{shard_name}.tfrecords',
+                              options=options) as writer:
+      for d in example_dicts:
+        writer.write(process_element.SERIALIZERS[version](d))
+
+  def randomExampleDicts(self, count):
+    rng = np.random.RandomState(0)
+    example_dicts = []
+    for i in range(count):
+      d = process_element_test.random_example_dict(rng)
+      d['mesh_name'] = f'02691156|{i}'
+      example_dicts.append(d)
+    return example_dicts
+
+  def testMakeDatasetReadsOptimizedSplits(self):
+    example_dicts = self.randomExampleDicts(2)
+    for version in [
+        process_element.FLOAT_LIST_FORMAT, process_element.RAW_FORMAT
+    ]:
+      self.writeOptimizedShard(example_dicts, version)
+      with tf.Graph().as_default():
+        batch = run_dataset_obj(
+            local_inputs.make_dataset(self.get_temp_dir(), 2, 'eval',
+                                      'train'))
+      (bounding_box_samples, depth_renders, mesh_names, near_surface_samples,
+       grid, world2grid, surface_point_samples) = batch
+      self.assertAllEqual(mesh_names, [b'02691156|0', b'02691156|1'])
+      for i, d in enumerate(example_dicts):
+        self.assertAllEqual(bounding_box_samples[i], d['bounding_box_samples'])
+        self.assertAllEqual(depth_renders[i], d['depth_renders'])
+        self.assertAllEqual(near_surface_samples[i], d['near_surface_samples'])
+        self.assertAllEqual(grid[i], d['grid'])
+        self.assertAllEqual(world2grid[i], d['world2grid'])
+        self.assertAllEqual(surface_point_samples[i],
+                            d['surface_point_samples'])
+
+  def testMakeDatasetReadsQuantizedSplits(self):
+    example_dicts = self.randomExampleDicts(3)
+    for d in example_dicts:
+      d['depth_renders'] = np.round(np.abs(d['depth_renders']) * 1000.0)
+    self.writeOptimizedShard(example_dicts, process_element.QUANTIZED_FORMAT)
+    with tf.Graph().as_default():
+      # As in training, shuffled, repeated and with subsampled supervision:
+      dataset = local_inputs.make_dataset(
+          self.get_temp_dir(), 2, 'train', 'train',
+          supervision_sample_count=64)
+      batches = [run_dataset_obj(dataset) for _ in range(3)]
+    by_name = {d['mesh_name'].encode('utf-8'): d for d in example_dicts}
+    for batch in batches:
+      (bounding_box_samples, depth_renders, mesh_names, near_surface_samples,
+       grid, world2grid, surface_point_samples) = batch
+      self.assertEqual(bounding_box_samples.shape, (2, 64, 4))
+      self.assertEqual(near_surface_samples.shape, (2, 64, 4))
+      for i, mesh_name in enumerate(mesh_names):
+        d = by_name[mesh_name]
+        self.assertAllEqual(depth_renders[i], d['depth_renders'])
+        self.assertAllEqual(grid[i], d['grid'])
+        self.assertAllEqual(world2grid[i], d['world2grid'])
+        self.assertAllClose(
+            surface_point_samples[i], d['surface_point_samples'], atol=1e-3)
+        # Each subsampled row is within the quantization error of a row:
+        for k, samples in [('bounding_box_samples', bounding_box_samples[i]),
+                           ('near_surface_samples', near_surface_samples[i])]:
+          distances = np.max(
+              np.abs(samples[:, np.newaxis, :] - d[k][np.newaxis, :, :]),
+              axis=-1)
+          self.assertLess(np.max(np.min(distances, axis=1)), 1e-3)
+
+  def testMakeDatasetRejectsMixedFormats(self):
+    example_dicts = self.randomExampleDicts(2)
+    self.writeOptimizedShard(example_dicts[:1],
+                             process_element.FLOAT_LIST_FORMAT, '00000')
+    self.writeOptimizedShard(example_dicts[1:], process_element.RAW_FORMAT,
+                             '00001')
+    with tf.Graph().as_default():
+      with self.assertRaisesRegex(ValueError, 'mixed format versions'):
+        local_inputs.make_dataset(self.get_temp_dir(), 2, 'train', 'train')
+
+  def testMemoryMappedSplitGather(self):
+    rng = np.random.RandomState(0)
+    example_dicts = []
+    for i in range(3):
+      d = process_element_test.random_example_dict(rng)
+      d['mesh_name'] = f'02691156|{i}'
+      example_dicts.append(d)
+    split_directory = self.get_temp_dir() + '/mmap/train'
+    process_element.write_mmap_shard(split_directory + '/00000',
+                                     example_dicts[:2])
+    process_element.write_mmap_shard(split_directory + '/00001',
+                                     example_dicts[2:])
+    split_data = local_inputs.MemoryMappedSplit(split_directory)
+    self.assertLen(split_data, 3)
+    batch = split_data.gather(np.array([2, 0]))
+    (bounding_box_samples, depth_renders, mesh_names, near_surface_samples,
+     grid, world2grid, surface_point_samples) = batch
+    self.assertAllEqual(mesh_names, [b'02691156|2', b'02691156|0'])
+    for i, index in enumerate([2, 0]):
+      d = example_dicts[index]
+      self.assertAllEqual(bounding_box_samples[i], d['bounding_box_samples'])
+      self.assertAllEqual(depth_renders[i], d['depth_renders'])
+      self.assertAllEqual(near_surface_samples[i], d['near_surface_samples'])
+      self.assertAllEqual(grid[i], d['grid'])
+      self.assertAllEqual(world2grid[i], d['world2grid'])
+      self.assertAllEqual(surface_point_samples[i], d['surface_point_samples'])
+
+  def testMemoryMappedSplitGatherSubsamplesSupervision(self):
+    rng = np.random.RandomState(0)
+    d = process_element_test.random_example_dict(rng)
+    d['mesh_name'] = '02691156|0'
+    split_directory = self.get_temp_dir() + '/mmap/train'
+    process_element.write_mmap_shard(split_directory + '/00000', [d])
+    split_data = local_inputs.MemoryMappedSplit(split_directory)
+    batch = split_data.gather(np.array([0, 0]), supervision_sample_count=64)
+    for k, field_idx in local_inputs.SUPERVISION_FIELDS.items():
+      self.assertEqual(batch[field_idx].shape, (2, 64, 4))
+      # Every subsampled row is a row of the full set:
+      matches = np.all(batch[field_idx][:, :, np.newaxis, :] ==
+                       d[k][np.newaxis, np.newaxis, :, :], axis=-1)
+      self.assertTrue(np.all(np.any(matches, axis=-1)))
+    self.assertAllEqual(batch[4][0], d['grid'])
+
+  def testSubsampleSupervision(self):
+    example = [
+        tf.reshape(tf.range(40, dtype=tf.float32), [10, 4]),
+        tf.zeros([2]),
+        tf.constant('name'),
+        tf.reshape(tf.range(40, 80, dtype=tf.float32), [10, 4]),
+        tf.zeros([2]),
+        tf.zeros([2]),
+        tf.zeros([2]),
+    ]
+    subsampled = local_inputs._subsample_supervision(6)(*example)
+    self.assertLen(subsampled, 7)
+    bounding_box_samples, near_surface_samples = self.evaluate(
+        [subsampled[0], subsampled[3]])
+    for samples, first in [(bounding_box_samples, 0),
+                           (near_surface_samples, 40)]:
+      self.assertEqual(samples.shape, (6, 4))
+      # Rows are kept intact:
+      self.assertAllEqual(samples[:, 1:] - samples[:, :1],
+                          np.tile([[1, 2, 3]], [6, 1]))
+      self.assertTrue(np.all(samples[:, 0] % 4 == 0))
+      self.assertTrue(np.all((samples >= first) & (samples < first + 40)))
+
+  def testSyntheticDataset(self):
+    with tf.Graph().as_default():
+      dataset = local_inputs.make_synthetic_dataset(
+          2, supervision_sample_count=1024)
+      fields = [
+          dataset.bounding_box_samples, dataset.depth_renders,
+          dataset.mesh_name, dataset.near_surface_samples, dataset.grid,
+          dataset.world2grid, dataset.surface_point_samples
+      ]
+      with tf.compat.v1.Session() as session:
+        first = session.run(fields)
+        second = session.run(fields)
+    self.assertEqual([np.shape(f) for f in first],
+                     [(2, 1024, 4), (2, 20, 224, 224, 1), (2,), (2, 1024, 4),
+                      (2, 32, 32, 32), (2, 4, 4), (2, 10000, 6)])
+    self.assertAllEqual(first[2], [b'03001627|synthetic'] * 2)
+    for a, b in zip(first, second):
+      self.assertAllEqual(a, b)
+
+  def testSplitDatasetObj(self):
+    with tf.Graph().as_default():
+      names = tf.constant([f'02691156|{i}' for i in range(4)])
+      dataset = local_inputs.build_dataset_obj(
+          (tf.zeros([4, 64, 4]), tf.zeros([4, 20, 224, 224, 1]), names,
+           tf.zeros([4, 64, 4]), tf.zeros([4, 32, 32, 32]),
+           tf.zeros([4, 4, 4]), tf.zeros([4, 10000, 6])), 4, 64)
+      parts = local_inputs.split_dataset_obj(dataset, 2)
+      self.assertLen(parts, 2)
+      self.assertEqual(parts[1].depth_renders.get_shape().as_list(),
+                       [2, 20, 224, 224, 1])
+      self.assertEqual(parts[1].supervision_sample_count, 64)
+      with tf.compat.v1.Session() as session:
+        self.assertAllEqual(
+            session.run(parts[1].mesh_name), [b'02691156|2', b'02691156|3'])
+      with self.assertRaisesRegex(ValueError, 'not divisible'):
+        local_inputs.split_dataset_obj(dataset, 3)
+
+
+if __name__ == '__main__':
+  tf.test.main()
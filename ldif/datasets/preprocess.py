@@ -59,7 +59,7 @@ def preprocess(model_config):
   training_example.apply_transformation(tx)
   if model_config.hparams.cri == 't':
     training_example.crop_input(model_config.hparams.cic)
-  if model_config.hparams.clc == 't' and (model_config.train or
+  if model_config.hparams.crl == 't' and (model_config.train or
                                           model_config.eval):
     training_example.crop_supervision(model_config.hparams.clc)
   return training_example
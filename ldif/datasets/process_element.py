@@ -16,9 +16,11 @@
 
 from fileinput import filename
 import os
+import struct
 import sys
 import time
 
+import numpy as np
 import tensorflow as tf
 
 # LDIF is an internal package, should be imported last.
@@ -27,6 +29,57 @@ from ldif.inference import example
 from ldif.util.file_util import log
 # pylint: enable=g-bad-import-order
 
+# The optimized (tfrecords) dataset formats. In FLOAT_LIST_FORMAT each record
+# is a tf.train.Example with a FloatList per field. In RAW_FORMAT each record is
+# a RAW_HEADER, the mesh name, zero padding up to RAW_HEADER_LENGTH bytes, and
+# then each field in FIELD_SHAPES order as contiguous little-endian float32s.
+# QUANTIZED_FORMAT is laid out like RAW_FORMAT, but with QUANTIZED_SCALES_LENGTH
+# bytes of float32 scales after the header, and each field in its
+# QUANTIZED_DTYPES type.
+FLOAT_LIST_FORMAT = 1
+RAW_FORMAT = 2
+QUANTIZED_FORMAT = 3
+
+# The magic bytes, format version and mesh name length:
+RAW_HEADER = struct.Struct('<4sii')
+RAW_MAGIC = b'LDIF'
+# A multiple of 64 bytes, as are all of the fields, so that every field of a
+# decoded record is aligned and slicing it out doesn't copy:
+RAW_HEADER_LENGTH = 256
+
+# The memory-mapped dataset is in <dataset>/mmap/<split>/<shard>/, with a
+# <field>.npy array for each float32 field, with the examples along the first
+# axis, and a text file with the mesh name of each example:
+MMAP_DIRECTORY = 'mmap'
+MESH_NAMES_FILENAME = 'mesh_names.txt'
+
+# The float32 fields of a dataset element, in order, and their shapes:
+FIELD_SHAPES = {
+    'bounding_box_samples': [100000, 4],
+    'depth_renders': [20, 224, 224, 1],
+    'near_surface_samples': [100000, 4],
+    'grid': [32, 32, 32],
+    'world2grid': [4, 4],
+    'surface_point_samples': [10000, 6],
+}
+
+# The storage types in QUANTIZED_FORMAT. The depth renders are in whole
+# millimetres already (GAPS writes 16-bit PNGs), so uint16 is exact. The sample
+# fields are int16 fixed point, with a per-example scale for each column, so
+# up to float32 rounding they are within half a scale step,
+# max(abs(column)) / 65534, of the input. That is 1.5e-5 for samples in
+# [-1, 1]:
+QUANTIZED_DTYPES = {
+    'bounding_box_samples': np.int16,
+    'depth_renders': np.uint16,
+    'near_surface_samples': np.int16,
+    'grid': np.float32,
+    'world2grid': np.float32,
+    'surface_point_samples': np.int16,
+}
+# Room for the scales of each column of the int16 fields, in FIELD_SHAPES order:
+QUANTIZED_SCALES_LENGTH = 64
+
 
 def load_example_dict(example_directory, log_level=None):  # log_level='verbose'):  # log_level=None
   """Loads an example from disk and makes a str:numpy dictionary out of it."""
@@ -124,6 +177,83 @@ def make_tf_example(d):
   return example_proto.SerializeToString()
 
 
+def _raw_header(mesh_name, version):
+  if isinstance(mesh_name, str):
+    mesh_name = mesh_name.encode('utf-8')
+  header = RAW_HEADER.pack(RAW_MAGIC, version, len(mesh_name)) + mesh_name
+  if len(header) > RAW_HEADER_LENGTH:
+    raise ValueError(f'The mesh name {mesh_name} is too long to serialize.')
+  return header.ljust(RAW_HEADER_LENGTH, b'\0')
+
+
+def make_raw_record(d):
+  """Serializes an example dictionary in RAW_FORMAT."""
+  fields = [
+      np.ascontiguousarray(d[k], dtype='<f4').reshape(shape).tobytes()
+      for k, shape in FIELD_SHAPES.items()
+  ]
+  return b''.join([_raw_header(d['mesh_name'], RAW_FORMAT)] + fields)
+
+
+def quantize_fixed_point(values):
+  """Quantizes to int16 with a scale for each column (the last axis).
+
+  Args:
+    values: Numpy array with shape [..., column_count].
+
+  Returns:
+    A tuple (quantized, scales). quantized is an int16 numpy array with the
+    shape of values, and scales is a float32 numpy array with shape
+    [column_count], such that quantized * scales is within scales / 2 of values.
+  """
+  columns = np.reshape(values, [-1, values.shape[-1]]).astype(np.float64)
+  scales = np.max(np.abs(columns), axis=0) / 32767.0
+  scales = np.where(scales > 0.0, scales, 1.0).astype(np.float32)
+  quantized = np.clip(np.round(values / scales), -32767, 32767)
+  return quantized.astype(np.int16), scales
+
+
+def make_quantized_record(d):
+  """Serializes an example dictionary in QUANTIZED_FORMAT."""
+  fields = []
+  scales = []
+  for k, shape in FIELD_SHAPES.items():
+    values = np.reshape(d[k], shape)
+    dtype = QUANTIZED_DTYPES[k]
+    if dtype == np.int16:
+      values, field_scales = quantize_fixed_point(values)
+      scales.append(field_scales)
+    elif dtype == np.uint16:
+      values = np.clip(np.round(values), 0, 65535)
+    fields.append(
+        np.ascontiguousarray(values, dtype=np.dtype(dtype).newbyteorder('<'))
+        .tobytes())
+  scales = np.concatenate(scales).astype('<f4').tobytes()
+  return b''.join([
+      _raw_header(d['mesh_name'], QUANTIZED_FORMAT),
+      scales.ljust(QUANTIZED_SCALES_LENGTH, b'\0')
+  ] + fields)
+
+
+def write_mmap_shard(shard_directory, example_dicts):
+  """Writes example dictionaries as a shard of the memory-mapped dataset."""
+  if not os.path.isdir(shard_directory):
+    os.makedirs(shard_directory)
+  for k, shape in FIELD_SHAPES.items():
+    out = np.lib.format.open_memmap(
+        os.path.join(shard_directory, f'{k}.npy'),
+        mode='w+',
+        dtype=np.float32,
+        shape=tuple([len(example_dicts)] + shape))
+    for i, d in enumerate(example_dicts):
+      out[i] = np.reshape(d[k], shape)
+    out.flush()
+    del out
+  # Written last, so a shard with a name index is complete:
+  with open(os.path.join(shard_directory, MESH_NAMES_FILENAME), 'wt') as f:
+    f.write(''.join(f'{d["mesh_name"]}\n' for d in example_dicts))
+
+
 def full_featurespec():
   return {
       'bounding_box_samples': tf.io.FixedLenFeature([100000, 4], tf.float32),
@@ -143,6 +273,142 @@ def parse_tf_example(example_proto):
           d['surface_point_samples'])
 
 
+def _parse_raw_header(record, header, version):
+  """Checks the header ints of a record, and returns the mesh name."""
+  magic = np.frombuffer(RAW_MAGIC, dtype='<i4')[0]
+  check_header = tf.debugging.assert_equal(
+      header[:2],
+      tf.constant([magic, version], dtype=tf.int32),
+      message='Unexpected optimized dataset format.')
+  with tf.control_dependencies([check_header]):
+    return tf.strings.substr(record, RAW_HEADER.size, header[2])
+
+
+def parse_raw_record(record):
+  """Parses a record serialized by make_raw_record()."""
+  flat = tf.io.decode_raw(record, tf.float32, little_endian=True)
+  header = tf.bitcast(flat[:RAW_HEADER.size // 4], tf.int32)
+  mesh_name = _parse_raw_header(record, header, RAW_FORMAT)
+  fields = {}
+  offset = RAW_HEADER_LENGTH // 4
+  for k, shape in FIELD_SHAPES.items():
+    length = int(np.prod(shape))
+    fields[k] = tf.reshape(flat[offset:offset + length], shape)
+    offset += length
+  return (fields['bounding_box_samples'], fields['depth_renders'], mesh_name,
+          fields['near_surface_samples'], fields['grid'], fields['world2grid'],
+          fields['surface_point_samples'])
+
+
+def parse_quantized_record(record):
+  """Parses and dequantizes a record serialized by make_quantized_record()."""
+  # Everything is decoded as 16-bit words, and the 32-bit values are bitcast
+  # from pairs of them, which assumes a little-endian host like bitcast does:
+  words = tf.io.decode_raw(record, tf.uint16, little_endian=True)
+
+  def words_to_float32(start, count):
+    return tf.bitcast(tf.reshape(words[start:start + 2 * count], [count, 2]),
+                      tf.float32)
+
+  header = tf.bitcast(
+      tf.reshape(words[:RAW_HEADER.size // 2], [-1, 2]), tf.int32)
+  mesh_name = _parse_raw_header(record, header, QUANTIZED_FORMAT)
+  scales = words_to_float32(RAW_HEADER_LENGTH // 2,
+                            QUANTIZED_SCALES_LENGTH // 4)
+  fields = {}
+  scale_offset = 0
+  offset = (RAW_HEADER_LENGTH + QUANTIZED_SCALES_LENGTH) // 2
+  for k, shape in FIELD_SHAPES.items():
+    length = int(np.prod(shape))
+    dtype = QUANTIZED_DTYPES[k]
+    if dtype == np.float32:
+      values = words_to_float32(offset, length)
+      offset += 2 * length
+    else:
+      values = words[offset:offset + length]
+      offset += length
+      if dtype == np.int16:
+        values = tf.bitcast(values, tf.int16)
+      values = tf.cast(values, tf.float32)
+    values = tf.reshape(values, shape)
+    if dtype == np.int16:
+      values *= scales[scale_offset:scale_offset + shape[-1]]
+      scale_offset += shape[-1]
+    fields[k] = values
+  return (fields['bounding_box_samples'], fields['depth_renders'], mesh_name,
+          fields['near_surface_samples'], fields['grid'], fields['world2grid'],
+          fields['surface_point_samples'])
+
+
+# The serializer and parser for each optimized dataset format:
+SERIALIZERS = {
+    FLOAT_LIST_FORMAT: make_tf_example,
+    RAW_FORMAT: make_raw_record,
+    QUANTIZED_FORMAT: make_quantized_record,
+}
+PARSERS = {
+    FLOAT_LIST_FORMAT: parse_tf_example,
+    RAW_FORMAT: parse_raw_record,
+    QUANTIZED_FORMAT: parse_quantized_record,
+}
+
+
+def serialize_example_directory(example_directory, version, log_level=None):
+  """Loads an example from disk and serializes it in an optimized format."""
+  return SERIALIZERS[version](load_example_dict(example_directory, log_level))
+
+
+def record_format_version(record):
+  """Returns the optimized dataset format of a serialized record."""
+  if record[:len(RAW_MAGIC)] == RAW_MAGIC:
+    return RAW_HEADER.unpack_from(record)[1]
+  return FLOAT_LIST_FORMAT
+
+
+def shard_format_version(path):
+  """Returns the optimized dataset format of a (GZIP) tfrecords shard."""
+  options = tf.io.TFRecordOptions(tf.compat.v1.io.TFRecordCompressionType.GZIP)
+  for record in tf.compat.v1.io.tf_record_iterator(path, options=options):
+    return record_format_version(record)
+  raise ValueError(f'The shard {path} is empty.')
+
+
+def parse_throughput(serialized_examples, version, repeat_count=4,
+                     parallel_calls=None):
+  """Measures how fast serialized examples are parsed by a tf.data map.
+
+  Args:
+    serialized_examples: A list of serialized examples in one format.
+    version: Int. The format of the examples.
+    repeat_count: Int. The number of times to parse each example.
+    parallel_calls: Int. The map parallelism. Defaults to the cpu count.
+
+  Returns:
+    The number of examples parsed per second.
+  """
+  with tf.Graph().as_default():
+    # Fed rather than a constant, which would be copied on every step:
+    serialized = tf.compat.v1.placeholder(tf.string, shape=[None])
+    dataset = tf.data.Dataset.from_tensor_slices(serialized)
+    dataset = dataset.repeat(repeat_count).map(
+        PARSERS[version], num_parallel_calls=parallel_calls or os.cpu_count())
+    iterator = tf.compat.v1.data.make_initializable_iterator(dataset)
+    parse_one = tf.group(*iterator.get_next())
+    example_count = 0
+    with tf.compat.v1.Session() as session:
+      session.run(
+          iterator.initializer, feed_dict={serialized: serialized_examples})
+      start_t = time.time()
+      try:
+        while True:
+          session.run(parse_one)
+          example_count += 1
+      except tf.errors.OutOfRangeError:
+        pass
+      elapsed = time.time() - start_t
+  return example_count / elapsed
+
+
 # Cannot print within here, I think because eager execution disabled.
 def _example_dict_tf_func_wrapper(mesh_orig_path):
   # log.info(mesh_orig_path)
@@ -0,0 +1,102 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.datasets.process_element."""
+
+import numpy as np
+import tensorflow as tf
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.datasets import process_element
+# pylint: enable=g-bad-import-order
+
+
+def random_example_dict(rng):
+  d = {
+      k: rng.normal(size=shape).astype(np.float32)
+      for k, shape in process_element.FIELD_SHAPES.items()
+  }
+  d['mesh_name'] = '02691156|1a04e3eab45ca15dd86060f189eb133'
+  return d
+
+
+class ProcessElementTest(tf.test.TestCase):
+
+  def testRawRecordRoundTrip(self):
+    d = random_example_dict(np.random.RandomState(0))
+    record = process_element.make_raw_record(d)
+    self.assertEqual(
+        process_element.record_format_version(record),
+        process_element.RAW_FORMAT)
+    parsed = self.evaluate(
+        process_element.parse_raw_record(tf.constant(record)))
+    (bounding_box_samples, depth_renders, mesh_name, near_surface_samples,
+     grid, world2grid, surface_point_samples) = parsed
+    self.assertEqual(mesh_name, d['mesh_name'].encode('utf-8'))
+    self.assertAllEqual(bounding_box_samples, d['bounding_box_samples'])
+    self.assertAllEqual(depth_renders, d['depth_renders'])
+    self.assertAllEqual(near_surface_samples, d['near_surface_samples'])
+    self.assertAllEqual(grid, d['grid'])
+    self.assertAllEqual(world2grid, d['world2grid'])
+    self.assertAllEqual(surface_point_samples, d['surface_point_samples'])
+
+  def testFormatsParseTheSame(self):
+    d = random_example_dict(np.random.RandomState(1))
+    float_list = process_element.make_tf_example(d)
+    self.assertEqual(
+        process_element.record_format_version(float_list),
+        process_element.FLOAT_LIST_FORMAT)
+    expected = self.evaluate(
+        process_element.parse_tf_example(tf.constant(float_list)))
+    parsed = self.evaluate(
+        process_element.parse_raw_record(
+            tf.constant(process_element.make_raw_record(d))))
+    for e, p in zip(expected, parsed):
+      self.assertAllEqual(e, p)
+
+  def testQuantizedRecordIsWithinTolerance(self):
+    d = random_example_dict(np.random.RandomState(3))
+    rng = np.random.RandomState(4)
+    d['depth_renders'] = rng.randint(
+        0, 3000, size=d['depth_renders'].shape).astype(np.float32)
+    record = process_element.make_quantized_record(d)
+    self.assertLess(
+        len(record), len(process_element.make_raw_record(d)) * 0.55)
+    self.assertEqual(
+        process_element.record_format_version(record),
+        process_element.QUANTIZED_FORMAT)
+    parsed = self.evaluate(
+        process_element.parse_quantized_record(tf.constant(record)))
+    (bounding_box_samples, depth_renders, mesh_name, near_surface_samples,
+     grid, world2grid, surface_point_samples) = parsed
+    self.assertEqual(mesh_name, d['mesh_name'].encode('utf-8'))
+    self.assertAllEqual(depth_renders, d['depth_renders'])
+    self.assertAllEqual(grid, d['grid'])
+    self.assertAllEqual(world2grid, d['world2grid'])
+    for k, values in [('bounding_box_samples', bounding_box_samples),
+                      ('near_surface_samples', near_surface_samples),
+                      ('surface_point_samples', surface_point_samples)]:
+      tolerance = np.max(np.abs(d[k]), axis=0) / 65534.0
+      self.assertTrue(np.all(np.abs(values - d[k]) <= tolerance * 1.01))
+
+  def testRawRecordRejectsLongNames(self):
+    d = random_example_dict(np.random.RandomState(2))
+    d['mesh_name'] = 'x' * process_element.RAW_HEADER_LENGTH
+    with self.assertRaises(ValueError):
+      process_element.make_raw_record(d)
+
+
+if __name__ == '__main__':
+  tf.test.main()
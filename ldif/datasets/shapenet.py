@@ -29,6 +29,28 @@ from ldif.util import image_util
 # pylint: enable=g-bad-import-order
 
 
+def supervision_sample_count(hparams):
+  """The number of SDF samples the losses take from each supervision set."""
+  return hparams.xsc if hparams.lrf == 'x' else hparams.spc
+
+
+def input_supervision_sample_count(hparams):
+  """The SDF sample count the input pipeline may subsample to, or None.
+
+  Cropping the supervision keeps the samples of the full sets that are nearest
+  the origin, so it needs them all: subsampling is disabled when it's enabled.
+
+  Args:
+    hparams: The model hparams.
+
+  Returns:
+    An int, or None if the supervision can't be subsampled before the graph.
+  """
+  if hparams.crl == 't':
+    return None
+  return supervision_sample_count(hparams)
+
+
 def ensure_shape_and_resize_if_needed(orig_renders, batch_size, frame_count,
                                       channel_count, orig_height, orig_width,
                                       target_height, target_width):
@@ -143,7 +165,13 @@ class ShapeNetExample(object):
 
     self.split = model_config.inputs['split']
     self._model_config = model_config
-    self._full_point_count = 100000
+    # If the dataset already subsampled the supervision, it's used as-is:
+    self._supervision_is_subsampled = bool(
+        getattr(ds, 'supervision_sample_count', None))
+    if self._supervision_is_subsampled:
+      self._full_point_count = ds.supervision_sample_count
+    else:
+      self._full_point_count = 100000
     self._world2grid = model_config.inputs['dataset'].world2grid
     if hasattr(ds, 'grid'):
       self._grid = model_config.inputs['dataset'].grid
@@ -155,7 +183,7 @@ class ShapeNetExample(object):
     if not hasattr(self, '_full_near_surface_samples'):
       self._full_near_surface_samples = tf.ensure_shape(
           self._model_config.inputs['dataset'].near_surface_samples,
-          [self._model_config.hparams.bs, 100000, 4])
+          [self._model_config.hparams.bs, self._full_point_count, 4])
     return self._full_near_surface_samples
 
   @property
@@ -164,7 +192,7 @@ class ShapeNetExample(object):
       # dataset entries are TF tensors. 
       self._full_uniform_samples = tf.ensure_shape(
           self._model_config.inputs['dataset'].bounding_box_samples,
-          [self._model_config.hparams.bs, 100000, 4])
+          [self._model_config.hparams.bs, self._full_point_count, 4])
     # print('not returning full uniform samples')
     return self._full_uniform_samples
 
@@ -181,6 +209,18 @@ class ShapeNetExample(object):
     subsamples = tf.batch_gather(samples, sample_indices)
     return self._finite_wrapper(subsamples)
 
+  def _subsample_supervision(self, samples, sample_count):
+    """Subsamples SDF supervision, unless the dataset already did."""
+    if (self._supervision_is_subsampled and
+        samples.get_shape().as_list()[1] == sample_count):
+      return self._finite_wrapper(samples)
+    if self._supervision_is_subsampled:
+      tf.logging.warning(
+          'The dataset subsampled %i supervision points, but %i were requested'
+          '. Resampling them in the graph.', self._full_point_count,
+          sample_count)
+    return self._subsample(samples, sample_count)
+
   @property
   def proto_name(self):
     return self._model_config.inputs['proto']
@@ -242,6 +282,12 @@ class ShapeNetExample(object):
         features=self._all_surface_normals)
 
   def crop_supervision(self, crop_count=1024):
+    """Keeps the near surface and uniform samples nearest the origin."""
+    if self._full_point_count < 2 * crop_count:
+      raise ValueError(
+          f'Cannot crop {2 * crop_count} supervision samples from the'
+          f' {self._full_point_count} the dataset provides. Cropping requires'
+          ' the full supervision sets; see input_supervision_sample_count().')
     self._full_near_surface_samples = geom_util.extract_points_near_origin(
         self._full_near_surface_samples, 2 * crop_count)
     self._full_uniform_samples = geom_util.extract_points_near_origin(
@@ -419,11 +465,13 @@ class ShapeNetExample(object):
     return self._finite_wrapper(self._bounding_box)
 
   def sample_sdf_near_surface(self, sample_count):
-    subsamples = self._subsample(self.full_near_surface_samples, sample_count)
+    subsamples = self._subsample_supervision(self.full_near_surface_samples,
+                                             sample_count)
     return self._finite_wrapper(tf.split(subsamples, [3, 1], axis=2))
 
   def sample_sdf_uniform(self, sample_count):
-    subsamples = self._subsample(self.full_uniform_samples, sample_count)
+    subsamples = self._subsample_supervision(self.full_uniform_samples,
+                                             sample_count)
     return self._finite_wrapper(tf.split(subsamples, [3, 1], axis=2))
 
   def all_uniform_samples(self):
@@ -0,0 +1,82 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.datasets.shapenet."""
+
+import numpy as np
+import tensorflow as tf
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.datasets import local_inputs
+from ldif.datasets import preprocess
+from ldif.datasets import shapenet
+from ldif.inference import experiment
+from ldif.model import hparams
+# pylint: enable=g-bad-import-order
+
+
+def cropping_model_config(crop_count):
+  """Makes a training ModelConfig whose loss crops the supervision."""
+  model_config = experiment.ModelConfig(hparams.build_ldif_hparams())
+  model_config.hparams.bs = 2
+  model_config.hparams.da = 'p'
+  model_config.hparams.crl = 't'
+  model_config.hparams.clc = crop_count
+  model_config.train = True
+  model_config.inference = False
+  model_config.inputs['split'] = 'train'
+  model_config.inputs['proto'] = 'ShapeNetNSSDodecaSparseLRGMediumSlimPC'
+  return model_config
+
+
+class ShapeNetTest(tf.test.TestCase):
+
+  def testCroppingDisablesInputSubsampling(self):
+    model_config = cropping_model_config(1024)
+    self.assertIsNone(
+        shapenet.input_supervision_sample_count(model_config.hparams))
+    model_config.hparams.crl = 'f'
+    self.assertEqual(
+        shapenet.input_supervision_sample_count(model_config.hparams),
+        shapenet.supervision_sample_count(model_config.hparams))
+
+  def testCropSupervision(self):
+    model_config = cropping_model_config(1024)
+    with tf.Graph().as_default():
+      model_config.inputs['dataset'] = local_inputs.make_synthetic_dataset(
+          2,
+          supervision_sample_count=shapenet.input_supervision_sample_count(
+              model_config.hparams))
+      example = preprocess.preprocess(model_config)
+      with tf.compat.v1.Session() as session:
+        near_surface, uniform = session.run(
+            [example.full_near_surface_samples, example.full_uniform_samples])
+    self.assertEqual(near_surface.shape, (2, 2048, 4))
+    self.assertEqual(uniform.shape, (2, 1024, 4))
+    # The kept samples are nearest the origin of the full sets:
+    distances = np.linalg.norm(near_surface[..., :3], axis=-1)
+    self.assertLess(np.max(distances), 0.2)
+
+  def testCropSupervisionRejectsSubsampledSupervision(self):
+    model_config = cropping_model_config(1024)
+    with tf.Graph().as_default():
+      model_config.inputs['dataset'] = local_inputs.make_synthetic_dataset(
+          2, supervision_sample_count=1024)
+      with self.assertRaisesRegex(ValueError, 'Cannot crop 2048'):
+        preprocess.preprocess(model_config)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -0,0 +1,187 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Writes GZIP tfrecords shards with a pipeline of serializers and writers.
+
+The examples are serialized by a pool of worker processes, in shard order, and
+each serialized record goes straight to the writer of its shard. The writers
+are threads (the TFRecordWriter compresses and writes without holding the GIL),
+so several shards are compressed at once, while the serialization of the
+following shards carries on. Nothing waits for a shard to be finished. The
+records of each shard are written in the order of its items, so the output
+doesn't depend on which serializations finish first.
+
+The number of records that have been requested but not yet written is bounded,
+which bounds the memory held by the pipeline.
+"""
+
+import collections
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import tensorflow as tf
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.util.file_util import log
+# pylint: enable=g-bad-import-order
+
+# How often the parent checks for failed writers while it waits:
+_POLL_INTERVAL_SECONDS = 1.0
+
+# One shard to write: the path of the tfrecords file, and the items that are
+# serialized into its records, in order.
+Shard = collections.namedtuple('Shard', ['path', 'items'])
+
+
+class _Failure(object):
+  """Sent to a shard writer in place of a record that failed to serialize."""
+
+  def __init__(self, item, error):
+    self.item = item
+    self.error = error
+
+
+def _put_record(records, index, record):
+  records.put((index, record))
+
+
+def _put_failure(records, index, item, error):
+  records.put((index, _Failure(item, repr(error))))
+
+
+def _write_shard(shard, records, written):
+  """Writes the records of a shard, in the order of its items.
+
+  Records that arrive before the ones preceding them are held until those are
+  written. Their count is bounded by the pending records of write_shards().
+
+  The shard is written to a temporary file and renamed when it's complete, so
+  an interrupted run never leaves a partial shard behind.
+
+  Args:
+    shard: The Shard to write.
+    records: A queue.Queue of (index in shard.items, serialized record or
+      _Failure) tuples, in any order.
+    written: A threading.Semaphore released once per record written.
+
+  Returns:
+    The number of bytes of serialized records written.
+  """
+  temp_path = f'{shard.path}.tmp'
+  options = tf.io.TFRecordOptions(tf.compat.v1.io.TFRecordCompressionType.GZIP)
+  byte_count = 0
+  arrived = {}
+  try:
+    with tf.io.TFRecordWriter(temp_path, options=options) as writer:
+      for index in range(len(shard.items)):
+        while index not in arrived:
+          arrived_index, record = records.get()
+          if isinstance(record, _Failure):
+            raise ValueError(
+                f'Failed to serialize {record.item}: {record.error}')
+          arrived[arrived_index] = record
+        record = arrived.pop(index)
+        writer.write(record)
+        written.release()
+        byte_count += len(record)
+  except:
+    if os.path.isfile(temp_path):
+      os.remove(temp_path)
+    raise
+  os.rename(temp_path, shard.path)
+  return byte_count
+
+
+def write_shards(shards, serialize_fn, worker_count=None, writer_count=None,
+                 max_pending_count=None):
+  """Serializes and writes tfrecords shards.
+
+  Args:
+    shards: A list of Shards.
+    serialize_fn: A picklable function that takes an item of a shard and
+      returns its serialized record as a bytes object.
+    worker_count: Int. The number of serialization processes. Defaults to the
+      number of CPUs.
+    writer_count: Int. The number of shards that are written (and compressed)
+      at once. Defaults to a quarter of the worker count.
+    max_pending_count: Int. The maximum number of records that are being
+      serialized or waiting to be written. Defaults to four per worker.
+
+  Returns:
+    A dictionary with the example_count, the byte counts of the serialized
+    records (serialized_bytes) and of the compressed shards
+    (compressed_bytes), and the elapsed seconds.
+  """
+  worker_count = worker_count or os.cpu_count()
+  writer_count = writer_count or max(1, worker_count // 4)
+  max_pending_count = max_pending_count or 4 * worker_count
+  start_t = time.time()
+  pending = threading.Semaphore(max_pending_count)
+  writes = []
+  # Spawn rather than fork, because the parent has tensorflow loaded:
+  pool = multiprocessing.get_context('spawn').Pool(worker_count)
+  try:
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=writer_count) as writers:
+      record_queues = []
+      try:
+        for shard in shards:
+          records = queue.Queue()
+          record_queues.append(records)
+          # The writers are started in shard order, so the earliest shards
+          # always have one. Otherwise a later shard could hold every writer,
+          # waiting for records that can't be requested until earlier shards
+          # are written.
+          writes.append(writers.submit(_write_shard, shard, records, pending))
+          for index, item in enumerate(shard.items):
+            while not pending.acquire(timeout=_POLL_INTERVAL_SECONDS):
+              for write in writes:
+                if write.done() and write.exception() is not None:
+                  raise write.exception()
+            pool.apply_async(
+                serialize_fn, (item,),
+                callback=functools.partial(_put_record, records, index),
+                error_callback=functools.partial(_put_failure, records, index,
+                                                 item))
+        serialized_bytes = sum(write.result() for write in writes)
+      except:
+        # Stop the writers that are still waiting for records:
+        for records in record_queues:
+          records.put((None, _Failure(None, 'Writing was aborted.')))
+        raise
+  finally:
+    pool.terminate()
+    pool.join()
+  elapsed = time.time() - start_t
+  return {
+      'example_count': sum(len(s.items) for s in shards),
+      'serialized_bytes': serialized_bytes,
+      'compressed_bytes': sum(os.path.getsize(s.path) for s in shards),
+      'elapsed': elapsed,
+  }
+
+
+def log_throughput(stats):
+  """Logs the throughput of a write_shards() call."""
+  elapsed = max(stats['elapsed'], 1e-6)
+  log.info(f'Wrote {stats["example_count"]} examples in {elapsed:.1f}s:'
+           f' {stats["example_count"] / elapsed:.1f} examples/s,'
+           f' {stats["serialized_bytes"] / 1e6 / elapsed:.1f} MB/s serialized,'
+           f' {stats["compressed_bytes"] / 1e6 / elapsed:.1f} MB/s compressed.')
@@ -0,0 +1,118 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.datasets.shard_writer."""
+
+import os
+import shutil
+import tempfile
+import time
+
+import tensorflow as tf
+
+from absl.testing import absltest
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.datasets import shard_writer
+# pylint: enable=g-bad-import-order
+
+
+def serialize_test_item(item):
+  """Makes a record that identifies its item."""
+  if item < 0:
+    raise ValueError('Negative item.')
+  return f'record-{item}'.encode('utf-8') * (item + 1)
+
+
+def serialize_test_item_slowly_first(item):
+  """Makes the record of an item, finishing the earliest items of 10 last."""
+  time.sleep(0.02 * (9 - item % 10))
+  return serialize_test_item(item)
+
+
+def read_shard(path):
+  options = tf.io.TFRecordOptions(tf.compat.v1.io.TFRecordCompressionType.GZIP)
+  return list(tf.compat.v1.io.tf_record_iterator(path, options=options))
+
+
+class ShardWriterTest(absltest.TestCase):
+
+  def setUp(self):
+    super(ShardWriterTest, self).setUp()
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory)
+
+  def testWritesEveryRecordToItsShard(self):
+    shards = [
+        shard_writer.Shard(
+            os.path.join(self.directory, f'{i}.tfrecords'),
+            list(range(10 * i, 10 * i + 10))) for i in range(5)
+    ]
+    stats = shard_writer.write_shards(
+        shards,
+        serialize_test_item,
+        worker_count=3,
+        writer_count=2,
+        max_pending_count=4)
+    for shard in shards:
+      self.assertEqual(
+          read_shard(shard.path),
+          [serialize_test_item(item) for item in shard.items])
+    self.assertEqual(stats['example_count'], 50)
+    self.assertEqual(
+        stats['serialized_bytes'],
+        sum(len(serialize_test_item(item)) for item in range(50)))
+    self.assertEqual(
+        stats['compressed_bytes'],
+        sum(os.path.getsize(shard.path) for shard in shards))
+    self.assertEqual(sorted(os.listdir(self.directory)),
+                     sorted(f'{i}.tfrecords' for i in range(5)))
+
+  def testWritesRecordsInItemOrder(self):
+    shards = [
+        shard_writer.Shard(
+            os.path.join(self.directory, f'{i}.tfrecords'),
+            list(range(10 * i, 10 * i + 10))) for i in range(2)
+    ]
+    shard_writer.write_shards(
+        shards,
+        serialize_test_item_slowly_first,
+        worker_count=10,
+        writer_count=1,
+        max_pending_count=10)
+    for shard in shards:
+      self.assertEqual(
+          read_shard(shard.path),
+          [serialize_test_item(item) for item in shard.items])
+
+  def testRaisesSerializationErrorsWithoutPartialShards(self):
+    shards = [
+        shard_writer.Shard(os.path.join(self.directory, '0.tfrecords'), [0, 1]),
+        shard_writer.Shard(os.path.join(self.directory, '1.tfrecords'),
+                           [2, -1, 3]),
+        shard_writer.Shard(
+            os.path.join(self.directory, '2.tfrecords'), list(range(4, 40))),
+    ]
+    with self.assertRaisesRegex(ValueError, 'Negative item'):
+      shard_writer.write_shards(
+          shards, serialize_test_item, worker_count=2, writer_count=1,
+          max_pending_count=2)
+    self.assertNotIn('1.tfrecords', os.listdir(self.directory))
+    self.assertEmpty(
+        [f for f in os.listdir(self.directory) if f.endswith('.tmp')])
+
+
+if __name__ == '__main__':
+  absltest.main()
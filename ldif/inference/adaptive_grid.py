@@ -0,0 +1,149 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Coarse-to-fine evaluation of implicit surfaces on voxel grids."""
+
+import numpy as np
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.inference import cpu_kernel
+from ldif.inference import extract_mesh
+from ldif.util.file_util import log
+# pylint: enable=g-bad-import-order
+
+
+def _lattice(resolution, stride):
+  """The voxel indices along one axis that are block corners at a stride."""
+  return np.unique(
+      np.append(np.arange(0, resolution, stride), resolution - 1))
+
+
+def _block_range(lattice_values):
+  """Returns the min, max and mean corner value of each block of a lattice."""
+  corners = []
+  for dz in range(2):
+    for dy in range(2):
+      for dx in range(2):
+        corners.append(lattice_values[dz:lattice_values.shape[0] - 1 + dz,
+                                      dy:lattice_values.shape[1] - 1 + dy,
+                                      dx:lattice_values.shape[2] - 1 + dx])
+  corners = np.stack(corners)
+  return np.min(corners, axis=0), np.max(corners, axis=0), np.mean(
+      corners, axis=0)
+
+
+def _dilate(mask):
+  """Grows a 3D boolean mask by one cell along each axis, diagonals included."""
+  for axis in range(3):
+    grown = np.copy(mask)
+    lower = [slice(None)] * 3
+    upper = [slice(None)] * 3
+    lower[axis] = slice(None, -1)
+    upper[axis] = slice(1, None)
+    grown[tuple(lower)] |= mask[tuple(upper)]
+    grown[tuple(upper)] |= mask[tuple(lower)]
+    mask = grown
+  return mask
+
+
+def _containment(fine_lattice, coarse_lattice):
+  """Returns whether each fine lattice index is in each coarse block."""
+  return ((fine_lattice[:, np.newaxis] >= coarse_lattice[np.newaxis, :-1]) &
+          (fine_lattice[:, np.newaxis] <= coarse_lattice[np.newaxis, 1:])
+         ).astype(np.float32)
+
+
+def adaptive_grid_eval(eval_fn,
+                       resolution,
+                       extent,
+                       coarse_resolution=32,
+                       level=extract_mesh.ISO_LEVEL,
+                       margin=0.0):
+  """Evaluates a function densely, but only near one of its level sets.
+
+  The grid is first evaluated at the corners of blocks with a stride of
+  resolution // coarse_resolution voxels. Blocks whose corner values bracket
+  the level set (and their neighbors, in case the surface passes through a
+  block without changing the sign at its corners) are halved and their new
+  corners evaluated, recursively, until the stride is one voxel. The remaining
+  voxels of each block are filled with the mean of its corner values, which is
+  on the same side of the level set as all of them, so marching cubes finds the
+  same surface as it would on the dense grid.
+
+  Args:
+    eval_fn: A function that maps a numpy array of samples with shape
+      [sample_count, 3] to a numpy array of values with shape [sample_count].
+    resolution: Int. The number of voxels along each axis.
+    extent: Float. The grid covers [-extent, extent]^3.
+    coarse_resolution: Int. The number of blocks along each axis at the coarsest
+      level. resolution // coarse_resolution must be a power of two.
+    level: Float. The level set to refine around.
+    margin: Float. Blocks are refined if their corner values are within this
+      distance of bracketing the level set. Increasing it trades speed for
+      robustness to thin features.
+
+  Returns:
+    Numpy array with shape [resolution, resolution, resolution], indexed
+    [z, y, x], the same as a dense evaluation with cpu_kernel.grid_axis.
+  """
+  stride = resolution // coarse_resolution
+  if resolution % coarse_resolution or stride & (stride - 1):
+    raise ValueError(f'The resolution ({resolution}) must be a power of two'
+                     f' multiple of the coarse resolution ({coarse_resolution}).')
+  axis = cpu_kernel.grid_axis(resolution, extent)
+  volume = np.zeros([resolution, resolution, resolution], dtype=np.float32)
+  is_evaluated = np.zeros(volume.shape, dtype=bool)
+
+  def evaluate(indices):
+    """Evaluates the voxels at [count, 3] (z, y, x) indices not yet known."""
+    indices = indices[~is_evaluated[tuple(indices.T)]]
+    if not indices.size:
+      return 0
+    samples = np.stack(
+        [axis[indices[:, 2]], axis[indices[:, 1]], axis[indices[:, 0]]],
+        axis=-1)
+    values = np.reshape(eval_fn(samples), [-1])
+    volume[tuple(indices.T)] = values
+    is_evaluated[tuple(indices.T)] = True
+    return indices.shape[0]
+
+  lattice = _lattice(resolution, stride)
+  zz, yy, xx = np.meshgrid(lattice, lattice, lattice, indexing='ij')
+  evaluated_count = evaluate(np.stack([zz, yy, xx], axis=-1).reshape([-1, 3]))
+  while stride > 1:
+    lattice_values = volume[np.ix_(lattice, lattice, lattice)]
+    block_min, block_max, block_mean = _block_range(lattice_values)
+    to_refine = _dilate((block_min <= level + margin) &
+                        (block_max >= level - margin))
+    # Fill the voxels that aren't known yet from their blocks. Those in blocks
+    # that are refined are overwritten at a later level:
+    block_of_voxel = np.minimum(
+        np.arange(resolution) // stride, block_mean.shape[0] - 1)
+    fill = block_mean[np.ix_(block_of_voxel, block_of_voxel, block_of_voxel)]
+    volume[~is_evaluated] = fill[~is_evaluated]
+
+    stride //= 2
+    fine_lattice = _lattice(resolution, stride)
+    contained = _containment(fine_lattice, lattice)
+    # The fine lattice points that are a corner of any block to refine:
+    needed = np.einsum('ia,jb,kc,abc->ijk', contained, contained, contained,
+                       to_refine.astype(np.float32), optimize=True) > 0
+    needed = np.stack(np.nonzero(needed), axis=-1)
+    evaluated_count += evaluate(fine_lattice[needed])
+    lattice = fine_lattice
+  log.verbose(f'Adaptive grid evaluation used {evaluated_count} of'
+              f' {resolution**3} samples'
+              f' ({100.0 * evaluated_count / resolution**3:.2f}%).')
+  return volume
@@ -0,0 +1,77 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.inference.adaptive_grid."""
+
+import numpy as np
+
+from tensorflow.python.platform import googletest
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.inference import adaptive_grid
+from ldif.inference import cpu_kernel
+# pylint: enable=g-bad-import-order
+
+
+def two_spheres(samples):
+  """A signed distance-like function that is -0.07 on two spheres."""
+  d0 = np.linalg.norm(samples - np.array([0.2, 0.0, 0.1]), axis=-1) - 0.3
+  d1 = np.linalg.norm(samples - np.array([-0.3, 0.25, -0.2]), axis=-1) - 0.15
+  return np.minimum(d0, d1) - 0.07
+
+
+class AdaptiveGridTest(googletest.TestCase):
+
+  def setUp(self):
+    super(AdaptiveGridTest, self).setUp()
+    self.resolution = 64
+    axis = cpu_kernel.grid_axis(self.resolution, 0.75)
+    zz, yy, xx = np.meshgrid(axis, axis, axis, indexing='ij')
+    self.dense = two_spheres(np.stack([xx, yy, zz], axis=-1))
+
+  def test_matches_dense_near_surface(self):
+    sample_counts = []
+
+    def eval_fn(samples):
+      sample_counts.append(samples.shape[0])
+      return two_spheres(samples)
+
+    volume = adaptive_grid.adaptive_grid_eval(
+        eval_fn, self.resolution, 0.75, coarse_resolution=8)
+    self.assertEqual(volume.shape, self.dense.shape)
+    iso_level = -0.07
+    np.testing.assert_array_equal(volume < iso_level, self.dense < iso_level)
+    # Every voxel with a neighbor on the other side of the surface is exact:
+    crossing = np.zeros(self.dense.shape, dtype=bool)
+    for axis in range(3):
+      inside = self.dense < iso_level
+      flips = np.diff(inside, axis=axis)
+      lower = [slice(None)] * 3
+      upper = [slice(None)] * 3
+      lower[axis] = slice(None, -1)
+      upper[axis] = slice(1, None)
+      crossing[tuple(lower)] |= flips
+      crossing[tuple(upper)] |= flips
+    np.testing.assert_allclose(volume[crossing], self.dense[crossing])
+    self.assertLess(sum(sample_counts), self.resolution**3 // 2)
+
+  def test_rejects_bad_coarse_resolution(self):
+    with self.assertRaises(ValueError):
+      adaptive_grid.adaptive_grid_eval(two_spheres, 64, 0.75,
+                                       coarse_resolution=24)
+
+
+if __name__ == '__main__':
+  googletest.main()
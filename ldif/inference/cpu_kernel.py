@@ -0,0 +1,774 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""A multithreaded numpy implementation of the LDIF inference kernel.
+
+This is a CPU counterpart to ldif2mesh/ldif2mesh.cu. It reads the same
+serialized .occnet files (see predict.Decoder.write_occnet_file), but places
+the grid samples exactly where the pure tensorflow path in predict.Decoder does,
+so the two produce the same volumes up to floating point error.
+"""
+
+import collections
+import concurrent.futures
+import copy
+import os
+import struct
+import time
+
+import numpy as np
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.inference import extract_mesh
+from ldif.util import file_util
+from ldif.util.file_util import log
+# pylint: enable=g-bad-import-order
+
+# Epsilons matching structured_implicit_function.py, quadrics.py and occnet.py:
+DIV_EPSILON = 1e-8
+NORMALIZATION_EPS = 1e-8
+SQRT_EPS = 1e-5
+
+# The number of samples evaluated per work item. Equal to the tensorflow
+# decoder's 32^3 block so memory use is comparable.
+DEFAULT_CHUNK_SIZE = 32**3
+
+FCLayer = collections.namedtuple('FCLayer', ['weights', 'biases'])
+CBNLayer = collections.namedtuple(
+    'CBNLayer', ['beta_fc', 'gamma_fc', 'running_mean', 'running_variance'])
+ResnetLayer = collections.namedtuple('ResnetLayer',
+                                     ['cbn_1', 'fc_1', 'cbn_2', 'fc_2'])
+
+
+def roll_pitch_yaw_to_rotation_matrices(roll_pitch_yaw):
+  """Converts roll-pitch-yaw angles to rotation matrices.
+
+  Args:
+    roll_pitch_yaw: Numpy array with shape [..., 3]. The roll, pitch, and yaw
+      angles in radians.
+
+  Returns:
+    Numpy array with shape [..., 3, 3]. The same matrices as
+    camera_util.roll_pitch_yaw_to_rotation_matrices.
+  """
+  cx, cy, cz = np.split(np.cos(roll_pitch_yaw), 3, axis=-1)
+  sx, sy, sz = np.split(np.sin(roll_pitch_yaw), 3, axis=-1)
+  # pyformat: disable
+  rotation = np.concatenate(
+      [cz * cy, cz * sy * sx - sz * cx, cz * sy * cx + sz * sx,
+       sz * cy, sz * sy * sx + cz * cx, sz * sy * cx - cz * sx,
+       -sy, cy * sx, cy * cx], axis=-1)
+  # pyformat: enable
+  return np.reshape(rotation, list(roll_pitch_yaw.shape[:-1]) + [3, 3])
+
+
+def grid_axis(resolution, extent, centered=False):
+  """The sample coordinates along one axis of a predict.Decoder grid.
+
+  Args:
+    resolution: Int. The number of samples along the axis.
+    extent: Float. The grid covers [-extent, extent].
+    centered: Boolean. If true, the samples are at the cell centers, so they are
+      symmetric about 0. Otherwise they are shifted by -0.5 / resolution.
+
+  Returns:
+    Numpy array with shape [resolution]. If not centered, identical to the
+    locations that the tensorflow decoder builds block by block in
+    Decoder._grid_eval.
+  """
+  cell_size = (2.0 * extent) / resolution
+  offset = 0.0 if centered else 0.5 / resolution
+  return (-extent + (np.arange(resolution) + 0.5) * cell_size -
+          offset).astype(np.float32)
+
+
+class OccNet(object):
+  """A numpy OccNet decoder with weights from a serialized .occnet file."""
+
+  def __init__(self, input_layer, resnet_layers, final_cbn, final_layer):
+    self.input_layer = input_layer
+    self.resnet_layers = resnet_layers
+    self.final_cbn = final_cbn
+    self.final_layer = final_layer
+
+  @property
+  def embedding_length(self):
+    return self.input_layer.weights.shape[1]
+
+  @classmethod
+  def from_file(cls, path):
+    """Parses the binary format written by Decoder.write_occnet_file()."""
+    content = file_util.readbin(path)
+    offset = [0]
+
+    def read_ints(count):
+      vals = struct.unpack_from('%ii' % count, content, offset[0])
+      offset[0] += 4 * count
+      return vals
+
+    def read_floats(shape):
+      count = int(np.prod(shape))
+      vals = np.frombuffer(
+          content, dtype='<f4', count=count, offset=offset[0])
+      offset[0] += 4 * count
+      return np.reshape(vals, shape).astype(np.float32)
+
+    def read_fc(input_length, output_length):
+      return FCLayer(
+          read_floats([input_length, output_length]),
+          read_floats([output_length]))
+
+    def read_cbn(dim):
+      beta_fc = read_fc(dim, dim)
+      gamma_fc = read_fc(dim, dim)
+      running_mean, running_variance = read_floats([2])
+      return CBNLayer(beta_fc, gamma_fc, running_mean, running_variance)
+
+    resnet_layer_count, dim = read_ints(2)
+    input_layer = read_fc(3, dim)
+    resnet_layers = []
+    for _ in range(resnet_layer_count):
+      cbn_1 = read_cbn(dim)
+      fc_1 = read_fc(dim, dim)
+      cbn_2 = read_cbn(dim)
+      fc_2 = read_fc(dim, dim)
+      resnet_layers.append(ResnetLayer(cbn_1, fc_1, cbn_2, fc_2))
+    final_cbn = read_cbn(dim)
+    final_layer = FCLayer(read_floats([dim, 1]), read_floats([1]))
+    if offset[0] != len(content):
+      raise ValueError(f'OccNet file {path} has {len(content) - offset[0]}'
+                       ' unexpected trailing bytes.')
+    log.verbose(f'Loaded OccNet with {resnet_layer_count} resnet layers and'
+                f' embedding length {dim} from {path}.')
+    return cls(input_layer, resnet_layers, final_cbn, final_layer)
+
+  def condition(self, embeddings, fix_residual=True):
+    """Precomputes everything in the network that depends only on the shape.
+
+    The conditional batch norm layers are affine in the sample embeddings once
+    their betas and gammas are known, so they are folded into the adjacent
+    fully connected layers. The final CBN layer and the final activation are
+    folded all the way through, which leaves a single [dim, dim] matmul per
+    sample and element.
+
+    Args:
+      embeddings: Numpy array with shape [element_count, embedding_length].
+      fix_residual: Boolean. Matches the 'fon' hparam; if true, the resnet skip
+        connection starts after the first CBN layer.
+
+    Returns:
+      A dictionary of per-element numpy arrays, for use with eval().
+    """
+    if len(self.resnet_layers) != 1:
+      raise ValueError('Only OccNets with a single resnet layer are supported,'
+                       f' but this one has {len(self.resnet_layers)}.')
+    layer = self.resnet_layers[0]
+
+    def cbn_params(cbn):
+      beta = np.matmul(embeddings, cbn.beta_fc.weights) + cbn.beta_fc.biases
+      gamma = np.matmul(embeddings, cbn.gamma_fc.weights) + cbn.gamma_fc.biases
+      scale = gamma / np.sqrt(cbn.running_variance + SQRT_EPS)
+      return scale, beta - cbn.running_mean * scale
+
+    scale_1, shift_1 = cbn_params(layer.cbn_1)
+    scale_2, shift_2 = cbn_params(layer.cbn_2)
+    scale_f, shift_f = cbn_params(self.final_cbn)
+    final_weights = self.final_layer.weights[:, 0]
+    # x = cbn_1(sample_resize_fc(p)):
+    input_weights = self.input_layer.weights[np.newaxis, :, :] * np.expand_dims(
+        scale_1, axis=1)
+    input_biases = self.input_layer.biases * scale_1 + shift_1
+    # y = cbn_2(fc_1(relu(x))):
+    hidden_weights = layer.fc_1.weights[np.newaxis, :, :] * np.expand_dims(
+        scale_2, axis=1)
+    hidden_biases = layer.fc_1.biases * scale_2 + shift_2
+    # out = final_activation(final_cbn(skip + fc_2(relu(y)))):
+    skip_weights = scale_f * final_weights
+    output_weights = np.matmul(layer.fc_2.weights, skip_weights[..., np.newaxis])
+    output_biases = (
+        np.sum((layer.fc_2.biases * scale_f + shift_f) * final_weights, axis=-1)
+        + self.final_layer.biases[0])
+    if fix_residual:
+      residual_weights = None
+    else:
+      # The skip connection is the sample_resize_fc output, which is affine in
+      # the samples, so its contribution is too:
+      residual_weights = np.matmul(self.input_layer.weights,
+                                   skip_weights[..., np.newaxis])[..., 0]
+      output_biases += np.sum(self.input_layer.biases * skip_weights, axis=-1)
+      skip_weights = None
+    as_float = lambda x: None if x is None else x.astype(np.float32)
+    return {
+        'input_weights': as_float(input_weights),
+        'input_biases': as_float(input_biases),
+        'hidden_weights': as_float(hidden_weights),
+        'hidden_biases': as_float(hidden_biases),
+        'skip_weights': as_float(skip_weights),
+        'residual_weights': as_float(residual_weights),
+        'output_weights': as_float(output_weights[..., 0]),
+        'output_biases': as_float(output_biases),
+    }
+
+  def eval(self, conditioning, element_index, samples):
+    """Decodes one element's embedding at a set of local sample locations.
+
+    Args:
+      conditioning: The output of condition().
+      element_index: Int. The element whose embedding should be decoded.
+      samples: Numpy array with shape [sample_count, 3]. The samples, already in
+        the local frame of the element.
+
+    Returns:
+      Numpy array with shape [sample_count]. The linear OccNet activations.
+    """
+    c = {k: v[element_index] if v is not None else None
+         for k, v in conditioning.items()}
+    x = np.matmul(samples, c['input_weights']) + c['input_biases']
+    y = np.matmul(np.maximum(x, 0.0), c['hidden_weights']) + c['hidden_biases']
+    out = np.matmul(np.maximum(y, 0.0), c['output_weights'])
+    if c['skip_weights'] is not None:
+      out += np.matmul(x, c['skip_weights'])
+    else:
+      out += np.matmul(samples, c['residual_weights'])
+    return out + c['output_biases']
+
+
+class CpuKernel(object):
+  """Evaluates (D)SIFs densely with batched, multithreaded numpy math."""
+
+  def __init__(self,
+               occnet,
+               symmetry_count,
+               implicit_multiplier=1.0,
+               fix_residual=True,
+               thread_count=None,
+               chunk_size=DEFAULT_CHUNK_SIZE,
+               influence_threshold=0.0,
+               centered_grid=False):
+    """Creates the kernel.
+
+    Args:
+      occnet: An OccNet, or None if the representation has no implicits (SIF).
+      symmetry_count: Int. The number of leading elements with left-right
+        symmetry (the 'lyr' hparam).
+      implicit_multiplier: Float. 1.0 if the OccNet residuals are enabled (the
+        'ipc' hparam), otherwise 0.0.
+      fix_residual: Boolean. The 'fon' hparam.
+      thread_count: Int. The number of worker threads. Defaults to the number
+        of cpus.
+      chunk_size: Int. The number of samples each worker evaluates at a time.
+      influence_threshold: Float. Element-sample pairs with an RBF weight at
+        or below this value are culled. At 0.0 (the default) only exact zeros
+        are skipped, so the output matches the dense tensorflow evaluation.
+      centered_grid: Boolean. Whether grid_eval() samples the centered grid
+        (see grid_axis()). It is symmetric about z=0, so the reflection of a
+        symmetric element contributes the z-mirrored volume of the element
+        itself, and each symmetric element is only evaluated once.
+    """
+    self.occnet = occnet
+    self.symmetry_count = symmetry_count
+    self.implicit_multiplier = implicit_multiplier
+    self.fix_residual = fix_residual
+    self.thread_count = thread_count or os.cpu_count() or 1
+    self.chunk_size = chunk_size
+    self.influence_threshold = influence_threshold
+    self.centered_grid = centered_grid
+
+  @classmethod
+  def from_model_config(cls, model_config, occnet_path=None, **kwargs):
+    """Creates a kernel for a model, loading the OccNet if it has one."""
+    hparams = model_config.hparams
+    if hparams.ipe == 't':
+      if occnet_path is None:
+        raise ValueError('An OccNet file is required when ipe=t.')
+      occnet = OccNet.from_file(occnet_path)
+    elif hparams.ipe == 'f':
+      occnet = None
+    else:
+      raise ValueError(f'The cpu kernel does not support ipe={hparams.ipe}.')
+    return cls(
+        occnet,
+        symmetry_count=hparams.lyr,
+        implicit_multiplier=1.0 if hparams.ipc == 't' else 0.0,
+        fix_residual=hparams.fon == 't',
+        **kwargs)
+
+  def _element_parameters(self, sif_vector):
+    """Splits a (D)SIF and precomputes the per-element quantities."""
+    sif_vector = np.asarray(sif_vector, dtype=np.float32)
+    sif_vector = np.reshape(sif_vector, [-1, sif_vector.shape[-1]])
+    element_count, element_length = sif_vector.shape
+    if element_length == 7:
+      radius_length = 3
+    elif element_length >= 10:
+      radius_length = 6
+    else:
+      raise ValueError(f'Unrecognized element length: {element_length}.')
+    constants = sif_vector[:, 0]
+    centers = sif_vector[:, 1:4]
+    variances = sif_vector[:, 4:7]
+    iparams = sif_vector[:, 4 + radius_length:]
+    if radius_length == 6:
+      rotations = roll_pitch_yaw_to_rotation_matrices(sif_vector[:, 7:10])
+    else:
+      rotations = np.tile(np.eye(3, dtype=np.float32), [element_count, 1, 1])
+    # The RBF falloff, as in quadrics.sample_cov_bf/sample_axis_aligned_bf:
+    if radius_length == 6:
+      inv_diag = 1.0 / (variances + DIV_EPSILON)
+    else:
+      inv_diag = -2.0 / np.minimum(-2.0 * variances, -NORMALIZATION_EPS)
+    inv_cov = np.matmul(rotations * np.expand_dims(inv_diag, axis=1),
+                        np.transpose(rotations, [0, 2, 1]))
+    # The local frames, as in StructuredImplicit._compute_world2local:
+    scale = 1.0 / (np.sqrt(variances + 1e-8) + 1e-8)
+    world2local = np.expand_dims(scale, axis=2) * np.transpose(
+        rotations, [0, 2, 1])
+    has_implicits = self.occnet is not None and iparams.shape[-1] > 0
+    if self.occnet is not None and not has_implicits:
+      raise ValueError('The kernel has an OccNet but the input has no'
+                       ' implicit parameters.')
+    conditioning = None
+    if has_implicits:
+      conditioning = self.occnet.condition(
+          iparams, fix_residual=self.fix_residual)
+    return {
+        'element_count': element_count,
+        'constants': constants,
+        'centers': centers,
+        'inv_cov': inv_cov.astype(np.float32),
+        'world2local': world2local.astype(np.float32),
+        'conditioning': conditioning,
+        'rotations': rotations,
+        'inv_diag': inv_diag,
+    }
+
+  def bind(self, sif_vector):
+    """Precomputes everything that depends only on the shape.
+
+    Args:
+      sif_vector: Numpy array with shape [element_count, element_length].
+
+    Returns:
+      An opaque bound shape, which can be passed to eval_at_samples() and
+      grid_eval() in place of sif_vector to skip the per-shape setup.
+    """
+    return self._element_parameters(sif_vector)
+
+  def _parameters(self, sif_vector):
+    if isinstance(sif_vector, dict):
+      return sif_vector
+    return self._element_parameters(sif_vector)
+
+  def _support_boxes(self, params, influence_threshold=None):
+    """Computes the boxes outside of which each element is culled.
+
+    An element's weight exceeds the influence threshold t exactly inside the
+    ellipsoid d^T cov^-1 d < -2 log(t). The tightest axis-aligned box around
+    that ellipsoid has half-widths sqrt(-2 log(t) * diag(cov)).
+
+    Args:
+      params: The output of _element_parameters().
+      influence_threshold: Float or None. The threshold t, if not the kernel's.
+
+    Returns:
+      Numpy array with shape [element_count, 2, 3]. The min and max corners of
+      each box, for the unreflected element. None if nothing is culled.
+    """
+    if influence_threshold is None:
+      influence_threshold = self.influence_threshold
+    if influence_threshold <= 0.0:
+      return None
+    if influence_threshold >= 1.0:
+      raise ValueError('The influence threshold must be less than 1, but got'
+                       f' {influence_threshold}.')
+    centers = params['centers']
+    cov_diag = np.sum(
+        np.square(params['rotations']) /
+        np.expand_dims(params['inv_diag'], axis=1),
+        axis=-1)
+    half_widths = np.sqrt(-2.0 * np.log(influence_threshold) * cov_diag)
+    return np.stack([centers - half_widths, centers + half_widths],
+                    axis=1).astype(np.float32)
+
+  def _support_box(self, support_boxes, element_index, is_reflected):
+    """Returns the culling box of an effective element in world space."""
+    lower, upper = support_boxes[element_index]
+    if is_reflected:
+      lower, upper = lower.copy(), upper.copy()
+      lower[2], upper[2] = -upper[2], -lower[2]
+    return lower, upper
+
+  def support_bounds(self, sif_vector, influence_threshold):
+    """Computes a box outside of which a (D)SIF is culled at a threshold.
+
+    Args:
+      sif_vector: Numpy array with shape [element_count, element_length], or
+        the output of bind().
+      influence_threshold: Float in (0, 1). See _support_boxes().
+
+    Returns:
+      A tuple (lower, upper) of numpy arrays with shape [3], the corners of the
+      union of the support boxes of the effective elements with a nonzero
+      constant, in the frame of the (D)SIF. None if there are none.
+    """
+    params = self._parameters(sif_vector)
+    support_boxes = self._support_boxes(params, influence_threshold)
+    if support_boxes is None:
+      raise ValueError('Support bounds require a positive influence threshold,'
+                       f' but got {influence_threshold}.')
+    boxes = [
+        self._support_box(support_boxes, i, is_reflected)
+        for i, is_reflected in self._effective_elements(params['element_count'])
+        if params['constants'][i] != 0.0
+    ]
+    if not boxes:
+      return None
+    lowers, uppers = zip(*boxes)
+    return np.min(lowers, axis=0), np.max(uppers, axis=0)
+
+  def _effective_elements(self, element_count):
+    """Yields (element_index, is_reflected) for each effective element."""
+    for i in range(element_count):
+      yield i, False
+    for i in range(min(self.symmetry_count, element_count)):
+      yield i, True
+
+  def _element_values(self, params, element_index, samples):
+    """Evaluates one element at samples that are already reflected if needed.
+
+    Args:
+      params: The output of _element_parameters().
+      element_index: Int. The element to evaluate.
+      samples: Numpy array with shape [sample_count, 3].
+
+    Returns:
+      Numpy array with shape [sample_count]. The weighted contribution of the
+      element, which is zero wherever its weight is not above the influence
+      threshold.
+    """
+    i = element_index
+    diff = samples - params['centers'][i]
+    dist = np.sum(np.matmul(diff, params['inv_cov'][i]) * diff, axis=-1)
+    weights = np.exp(-0.5 * dist)
+    # Elements are exactly zero far from their centers. Skipping those samples
+    # (or those below the influence threshold) avoids most of the OccNet work:
+    active = np.flatnonzero(weights > self.influence_threshold)
+    values = np.zeros_like(weights)
+    if not active.size:
+      return values
+    values[active] = params['constants'][i] * weights[active]
+    if params['conditioning'] is not None:
+      local = np.matmul(diff[active], params['world2local'][i].T)
+      values[active] *= 1.0 + self.implicit_multiplier * self.occnet.eval(
+          params['conditioning'], i, local)
+    return values
+
+  def _eval_chunk(self, params, support_boxes, samples, elements=None):
+    """Evaluates the algebraic (pre-class-transfer) value at some samples.
+
+    Args:
+      params: The output of _element_parameters().
+      support_boxes: The output of _support_boxes().
+      samples: Numpy array with shape [sample_count, 3].
+      elements: A list of (element_index, is_reflected) tuples to sum, or None
+        for all effective elements.
+
+    Returns:
+      Numpy array with shape [sample_count].
+    """
+    if elements is None:
+      elements = self._effective_elements(params['element_count'])
+    out = np.zeros(samples.shape[0], dtype=np.float32)
+    reflected = samples * np.array([1.0, 1.0, -1.0], dtype=np.float32)
+    for i, is_reflected in elements:
+      element_samples = reflected if is_reflected else samples
+      if support_boxes is None:
+        out += self._element_values(params, i, element_samples)
+        continue
+      # The box test is in the element's (possibly reflected) frame:
+      lower, upper = support_boxes[i]
+      inside = np.flatnonzero(
+          np.all((element_samples >= lower) & (element_samples <= upper),
+                 axis=-1))
+      if inside.size:
+        out[inside] += self._element_values(params, i, element_samples[inside])
+    return out
+
+  def _eval_culled_slab(self,
+                        params,
+                        support_boxes,
+                        axis,
+                        z_start,
+                        z_end,
+                        elements=None):
+    """Evaluates a z-slab of a grid, visiting only the voxels in each box.
+
+    Because the grid is axis aligned, binning the voxels into an element's
+    support box reduces to a range lookup along each axis.
+
+    Args:
+      params: The output of _element_parameters().
+      support_boxes: The output of _support_boxes().
+      axis: Numpy array with shape [resolution]. The output of grid_axis().
+      z_start: Int. The first z index of the slab.
+      z_end: Int. One past the last z index of the slab.
+      elements: A list of (element_index, is_reflected) tuples to sum, or None
+        for all effective elements.
+
+    Returns:
+      Numpy array with shape [z_end - z_start, resolution, resolution].
+    """
+    if elements is None:
+      elements = self._effective_elements(params['element_count'])
+    resolution = axis.shape[0]
+    out = np.zeros([z_end - z_start, resolution, resolution], dtype=np.float32)
+    for i, is_reflected in elements:
+      lower, upper = self._support_box(support_boxes, i, is_reflected)
+      starts = np.searchsorted(axis, lower, side='left')
+      ends = np.searchsorted(axis, upper, side='right')
+      x0, y0, z0 = starts
+      x1, y1, z1 = ends
+      z0, z1 = max(z0, z_start), min(z1, z_end)
+      if z0 >= z1 or y0 >= y1 or x0 >= x1:
+        continue
+      zz, yy, xx = np.meshgrid(
+          axis[z0:z1], axis[y0:y1], axis[x0:x1], indexing='ij')
+      if is_reflected:
+        zz = -zz
+      samples = np.stack([xx, yy, zz], axis=-1).reshape([-1, 3])
+      values = self._element_values(params, i, samples)
+      out[z0 - z_start:z1 - z_start, y0:y1, x0:x1] += np.reshape(
+          values, [z1 - z0, y1 - y0, x1 - x0])
+    return out
+
+  def _map_chunks(self, fun, chunks):
+    if self.thread_count == 1 or len(chunks) == 1:
+      return [fun(chunk) for chunk in chunks]
+    with concurrent.futures.ThreadPoolExecutor(self.thread_count) as executor:
+      return list(executor.map(fun, chunks))
+
+  def eval_at_samples(self, sif_vector, samples):
+    """Evaluates a (D)SIF at arbitrary sample locations.
+
+    Args:
+      sif_vector: Numpy array with shape [element_count, element_length], or
+        the output of bind().
+      samples: Numpy array with shape [sample_count, 3].
+
+    Returns:
+      Numpy array with shape [sample_count]. The value before the class
+      transfer function, as in Decoder.predicted_alg_grid.
+    """
+    params = self._parameters(sif_vector)
+    support_boxes = self._support_boxes(params)
+    samples = np.reshape(samples, [-1, 3]).astype(np.float32)
+    starts = range(0, samples.shape[0], self.chunk_size)
+    chunks = [samples[s:s + self.chunk_size, :] for s in starts]
+    if not chunks:
+      return np.zeros([0], dtype=np.float32)
+    return np.concatenate(
+        self._map_chunks(
+            lambda c: self._eval_chunk(params, support_boxes, c), chunks))
+
+  def grid_eval(self,
+                sif_vector,
+                resolution,
+                extent,
+                world2local=None,
+                out=None):
+    """Evaluates a (D)SIF densely on a voxel grid.
+
+    Args:
+      sif_vector: Numpy array with shape [element_count, element_length], or
+        the output of bind().
+      resolution: Int. The number of voxels along each axis.
+      extent: Float. The grid covers [-extent, extent]^3.
+      world2local: Numpy array with shape [4, 4], or None. If provided, applied
+        to the grid locations before evaluation.
+      out: Float32 numpy array with shape [resolution, resolution, resolution],
+        or None. If provided, the grid is written into it.
+
+    Returns:
+      Numpy array with shape [resolution, resolution, resolution], indexed
+      [z, y, x], like the output of Decoder._grid_eval. If centered_grid is
+      set, sampled at the centered grid_axis() instead.
+    """
+    params = self._parameters(sif_vector)
+    support_boxes = self._support_boxes(params)
+    axis = grid_axis(resolution, extent, centered=self.centered_grid)
+    slab_depth = max(1, self.chunk_size // (resolution * resolution))
+    slab_starts = list(range(0, resolution, slab_depth))
+    if out is None:
+      out = np.empty([resolution, resolution, resolution], dtype=np.float32)
+    element_count = params['element_count']
+    symmetry_count = min(self.symmetry_count, element_count)
+    mirror = (self.centered_grid and world2local is None and
+              symmetry_count > 0)
+    if mirror:
+      # The symmetric elements are summed separately, and their sum is added
+      # again mirrored in place of their reflections:
+      element_groups = [[(i, False) for i in range(symmetry_count)],
+                        [(i, False)
+                         for i in range(symmetry_count, element_count)]]
+      symmetric = np.empty_like(out)
+    else:
+      element_groups = [list(self._effective_elements(element_count))]
+
+    def eval_slab(z_start):
+      z_end = min(z_start + slab_depth, resolution)
+      values = [
+          eval_slab_values(z_start, z_end, elements)
+          for elements in element_groups
+      ]
+      out[z_start:z_end] = np.sum(values, axis=0)
+      if mirror:
+        symmetric[z_start:z_end] = values[0]
+
+    def eval_slab_values(z_start, z_end, elements):
+      if support_boxes is not None and world2local is None:
+        return self._eval_culled_slab(params, support_boxes, axis, z_start,
+                                      z_end, elements)
+      z = axis[z_start:z_end]
+      zz, yy, xx = np.meshgrid(z, axis, axis, indexing='ij')
+      samples = np.stack([xx, yy, zz], axis=-1).reshape([-1, 3])
+      if world2local is not None:
+        samples = (np.matmul(samples, world2local[:3, :3].T) +
+                   world2local[:3, 3]).astype(np.float32)
+      return np.reshape(
+          self._eval_chunk(params, support_boxes, samples, elements),
+          [len(z), resolution, resolution])
+
+    self._map_chunks(eval_slab, slab_starts)
+    if mirror:
+      out += symmetric[::-1]
+    return out
+
+  def element_grid_eval(self,
+                        sif_vector,
+                        element_index,
+                        resolution,
+                        extent,
+                        influence_threshold,
+                        part_resolution=None):
+    """Evaluates one element on a grid inside its support box.
+
+    Args:
+      sif_vector: Numpy array with shape [element_count, element_length], or
+        the output of bind().
+      element_index: Int. The (unreflected) element to evaluate.
+      resolution: Int. The number of voxels along each axis of the full grid.
+      extent: Float. The full grid covers [-extent, extent]^3.
+      influence_threshold: Float in (0, 1). Defines the support box, as in
+        _support_boxes().
+      part_resolution: Int or None. If None, the element is evaluated on the
+        voxels of the full grid inside its box. Otherwise on a grid of its own
+        with this many samples along the longest side of the box (clipped to
+        the full grid), and the same spacing along the other sides.
+
+    Returns:
+      A tuple (start, voxel_size, volume). start is a numpy array with the
+      [z, y, x] location of the first sample of the box in the full grid, in
+      voxels. voxel_size is the sample spacing, in voxels of the full grid.
+      Both are only whole numbers without a part_resolution. volume is a numpy
+      array indexed [z, y, x] with the contribution of the element, as in
+      Decoder.local_decisions. All are None if the box misses the grid.
+    """
+    if influence_threshold <= 0.0:
+      raise ValueError('Part extraction requires a positive influence'
+                       f' threshold, but got {influence_threshold}.')
+    params = self._parameters(sif_vector)
+    lower, upper = self._support_boxes(params,
+                                       influence_threshold)[element_index]
+    axis = grid_axis(resolution, extent, centered=self.centered_grid)
+    if part_resolution is None:
+      x0, y0, z0 = np.searchsorted(axis, lower, side='left')
+      x1, y1, z1 = np.searchsorted(axis, upper, side='right')
+      if z0 >= z1 or y0 >= y1 or x0 >= x1:
+        return None, None, None
+      xs, ys, zs = axis[x0:x1], axis[y0:y1], axis[z0:z1]
+      start = np.array([z0, y0, x0])
+      voxel_size = 1
+    else:
+      if part_resolution < 2:
+        raise ValueError('The part resolution must be at least 2, but got'
+                         f' {part_resolution}.')
+      lower = np.maximum(lower, axis[0])
+      upper = np.minimum(upper, axis[-1])
+      if np.any(lower >= upper):
+        return None, None, None
+      spacing = np.max(upper - lower) / (part_resolution - 1)
+      # Enough samples to cover each side, and at least a cube's worth:
+      counts = np.maximum(
+          np.ceil((upper - lower) / spacing - 1e-4).astype(np.int64) + 1, 2)
+      xs, ys, zs = [
+          (lower[i] + spacing * np.arange(counts[i])).astype(np.float32)
+          for i in range(3)
+      ]
+      cell_size = (2.0 * extent) / resolution
+      start = (lower[::-1] - axis[0]) / cell_size
+      voxel_size = spacing / cell_size
+    volume = np.empty([len(zs), len(ys), len(xs)], dtype=np.float32)
+    slab_depth = max(1, self.chunk_size // (len(ys) * len(xs)))
+    for z_start in range(0, len(zs), slab_depth):
+      z_end = min(z_start + slab_depth, len(zs))
+      zz, yy, xx = np.meshgrid(zs[z_start:z_end], ys, xs, indexing='ij')
+      samples = np.stack([xx, yy, zz], axis=-1).reshape([-1, 3])
+      volume[z_start:z_end] = np.reshape(
+          self._element_values(params, element_index, samples), zz.shape)
+    return start, voxel_size, volume
+
+
+def culling_report(kernel, sif_vector, resolution, extent, influence_threshold):
+  """Measures the speed and accuracy of culled against dense grid evaluation.
+
+  Args:
+    kernel: A CpuKernel. It is not modified.
+    sif_vector: Numpy array with shape [element_count, element_length].
+    resolution: Int. The grid resolution to evaluate at.
+    extent: Float. The grid covers [-extent, extent]^3.
+    influence_threshold: Float. The threshold to compare against the dense
+      (exact) evaluation.
+
+  Returns:
+    A dictionary with the timings of both evaluations, the speedup, the max and
+    mean absolute error, and the fraction of voxels that change sides of the
+    marching cubes iso level.
+  """
+  dense_kernel = copy.copy(kernel)
+  dense_kernel.influence_threshold = 0.0
+  culled_kernel = copy.copy(kernel)
+  culled_kernel.influence_threshold = influence_threshold
+  t = time.time()
+  dense = dense_kernel.grid_eval(sif_vector, resolution, extent)
+  dense_time = time.time() - t
+  t = time.time()
+  culled = culled_kernel.grid_eval(sif_vector, resolution, extent)
+  culled_time = time.time() - t
+  error = np.abs(culled - dense)
+  report = {
+      'resolution': resolution,
+      'influence_threshold': influence_threshold,
+      'dense_seconds': dense_time,
+      'culled_seconds': culled_time,
+      'speedup': dense_time / max(culled_time, 1e-9),
+      'max_abs_error': float(np.max(error)),
+      'mean_abs_error': float(np.mean(error)),
+      'flipped_voxel_fraction': float(
+          np.mean((dense < extract_mesh.ISO_LEVEL) !=
+                  (culled < extract_mesh.ISO_LEVEL))),
+  }
+  log.info('Culling report: ' +
+           ', '.join(f'{k}={v:.4g}' for k, v in report.items()))
+  return report
@@ -0,0 +1,308 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.inference.cpu_kernel."""
+
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+from tensorflow.python.platform import googletest
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.inference import cpu_kernel
+# pylint: enable=g-bad-import-order
+
+DIM = 32
+ELEMENT_COUNT = 8
+SYMMETRY_COUNT = 3
+
+
+def random_occnet_weights(rng):
+  """Makes a dictionary of weights in Decoder.write_occnet_file() order."""
+
+  def fc(input_length, output_length):
+    return (rng.normal(scale=0.3, size=[input_length, output_length]),
+            rng.normal(scale=0.1, size=[output_length]))
+
+  def cbn():
+    return {
+        'beta': fc(DIM, DIM),
+        'gamma': fc(DIM, DIM),
+        'mean': rng.normal(scale=0.1),
+        'var': rng.uniform(0.5, 1.5)
+    }
+
+  return {
+      'input': fc(3, DIM),
+      'cbn_1': cbn(),
+      'fc_1': fc(DIM, DIM),
+      'cbn_2': cbn(),
+      'fc_2': fc(DIM, DIM),
+      'final_cbn': cbn(),
+      'final': fc(DIM, 1),
+  }
+
+
+def write_occnet(weights, path):
+  """Serializes weights with the same layout as Decoder.write_occnet_file()."""
+  with open(path, 'wb') as f:
+    f.write(struct.pack('ii', 1, DIM))
+
+    def write_fc(layer):
+      f.write(layer[0].astype('f').tobytes())
+      f.write(layer[1].astype('f').tobytes())
+
+    def write_cbn(layer):
+      write_fc(layer['beta'])
+      write_fc(layer['gamma'])
+      f.write(struct.pack('ff', layer['mean'], layer['var']))
+
+    write_fc(weights['input'])
+    write_cbn(weights['cbn_1'])
+    write_fc(weights['fc_1'])
+    write_cbn(weights['cbn_2'])
+    write_fc(weights['fc_2'])
+    write_cbn(weights['final_cbn'])
+    f.write(weights['final'][0].astype('f').tobytes())
+    f.write(struct.pack('f', weights['final'][1][0]))
+
+
+def random_ldif(rng):
+  constants = -rng.uniform(0.1, 1.0, size=[ELEMENT_COUNT, 1])
+  centers = rng.uniform(-0.4, 0.4, size=[ELEMENT_COUNT, 3])
+  variances = rng.uniform(0.05, 0.15, size=[ELEMENT_COUNT, 3])**2
+  rotations = rng.uniform(-np.pi / 4, np.pi / 4, size=[ELEMENT_COUNT, 3])
+  iparams = rng.normal(size=[ELEMENT_COUNT, DIM])
+  return np.concatenate([constants, centers, variances, rotations, iparams],
+                        axis=1).astype(np.float32)
+
+
+def reference_eval(weights, sif_vector, samples, fix_residual=True):
+  """A direct float64 transcription of StructuredImplicit.class_at_samples."""
+
+  def fc(layer, x):
+    return np.matmul(x, layer[0]) + layer[1]
+
+  def cbn(layer, embedding, x):
+    beta = fc(layer['beta'], embedding)
+    gamma = fc(layer['gamma'], embedding)
+    return gamma * (x - layer['mean']) / np.sqrt(layer['var'] + 1e-5) + beta
+
+  def occnet(embedding, x):
+    x = fc(weights['input'], x)
+    init = x
+    x = cbn(weights['cbn_1'], embedding, x)
+    if fix_residual:
+      init = x
+    x = fc(weights['fc_1'], np.maximum(x, 0.0))
+    x = cbn(weights['cbn_2'], embedding, x)
+    x = fc(weights['fc_2'], np.maximum(x, 0.0))
+    x = cbn(weights['final_cbn'], embedding, init + x)
+    return fc(weights['final'], x)[:, 0]
+
+  sif_vector = sif_vector.astype(np.float64)
+  out = np.zeros(samples.shape[0])
+  effective = [(i, 1.0) for i in range(ELEMENT_COUNT)]
+  effective += [(i, -1.0) for i in range(SYMMETRY_COUNT)]
+  for i, z_sign in effective:
+    constant = sif_vector[i, 0]
+    center = sif_vector[i, 1:4]
+    variances = sif_vector[i, 4:7]
+    rotation = cpu_kernel.roll_pitch_yaw_to_rotation_matrices(
+        sif_vector[i, 7:10])
+    diff = samples * np.array([1.0, 1.0, z_sign]) - center
+    inv_cov = np.matmul(
+        np.matmul(rotation, np.diag(1.0 / (variances + 1e-8))), rotation.T)
+    weight = np.exp(-0.5 * np.sum(np.matmul(diff, inv_cov) * diff, axis=1))
+    scale = np.diag(1.0 / (np.sqrt(variances + 1e-8) + 1e-8))
+    world2local = np.matmul(scale, np.linalg.inv(rotation))
+    local = np.matmul(diff, world2local.T)
+    out += constant * weight * (1 + occnet(sif_vector[i, 10:], local))
+  return out
+
+
+class CpuKernelTest(googletest.TestCase):
+
+  def setUp(self):
+    super(CpuKernelTest, self).setUp()
+    rng = np.random.RandomState(0)
+    self.weights = random_occnet_weights(rng)
+    self.sif_vector = random_ldif(rng)
+    self.occnet_path = os.path.join(tempfile.mkdtemp(), 'test.occnet')
+    write_occnet(self.weights, self.occnet_path)
+    self.kernel = cpu_kernel.CpuKernel(
+        cpu_kernel.OccNet.from_file(self.occnet_path),
+        symmetry_count=SYMMETRY_COUNT,
+        thread_count=2,
+        chunk_size=1000)
+
+  def test_eval_at_samples_matches_reference(self):
+    samples = np.random.RandomState(1).uniform(-0.75, 0.75, size=[5000, 3])
+    expected = reference_eval(self.weights, self.sif_vector, samples)
+    out = self.kernel.eval_at_samples(self.sif_vector, samples)
+    self.assertEqual(out.shape, (5000,))
+    np.testing.assert_allclose(out, expected, rtol=1e-4, atol=1e-5)
+
+  def test_eval_without_residual_fix(self):
+    self.kernel.fix_residual = False
+    samples = np.random.RandomState(2).uniform(-0.75, 0.75, size=[2000, 3])
+    expected = reference_eval(
+        self.weights, self.sif_vector, samples, fix_residual=False)
+    out = self.kernel.eval_at_samples(self.sif_vector, samples)
+    np.testing.assert_allclose(out, expected, rtol=1e-4, atol=1e-5)
+
+  def test_grid_eval_layout(self):
+    resolution = 16
+    extent = 0.75
+    grid = self.kernel.grid_eval(self.sif_vector, resolution, extent)
+    self.assertEqual(grid.shape, (resolution, resolution, resolution))
+    self.assertEqual(grid.dtype, np.float32)
+    axis = cpu_kernel.grid_axis(resolution, extent)
+    zz, yy, xx = np.meshgrid(axis, axis, axis, indexing='ij')
+    samples = np.stack([xx, yy, zz], axis=-1).reshape([-1, 3])
+    expected = reference_eval(self.weights, self.sif_vector, samples)
+    np.testing.assert_allclose(
+        grid, expected.reshape(grid.shape), rtol=1e-4, atol=1e-5)
+
+  def test_grid_eval_world2local(self):
+    world2local = np.eye(4, dtype=np.float32)
+    world2local[:3, 3] = [0.1, -0.05, 0.2]
+    grid = self.kernel.grid_eval(
+        self.sif_vector, 8, 0.5, world2local=world2local)
+    axis = cpu_kernel.grid_axis(8, 0.5)
+    zz, yy, xx = np.meshgrid(axis, axis, axis, indexing='ij')
+    samples = np.stack([xx, yy, zz], axis=-1).reshape([-1, 3])
+    expected = self.kernel.eval_at_samples(self.sif_vector,
+                                           samples + world2local[:3, 3])
+    np.testing.assert_allclose(grid.reshape([-1]), expected, atol=1e-6)
+
+  def test_centered_grid_mirrors_symmetric_elements(self):
+    self.kernel.centered_grid = True
+    axis = cpu_kernel.grid_axis(16, 0.75, centered=True)
+    np.testing.assert_allclose(axis, -axis[::-1], atol=1e-7)
+    zz, yy, xx = np.meshgrid(axis, axis, axis, indexing='ij')
+    samples = np.stack([xx, yy, zz], axis=-1).reshape([-1, 3])
+    expected = reference_eval(self.weights, self.sif_vector, samples)
+    grid = self.kernel.grid_eval(self.sif_vector, 16, 0.75)
+    np.testing.assert_allclose(
+        grid.reshape([-1]), expected, rtol=1e-4, atol=1e-5)
+    self.kernel.influence_threshold = 1e-4
+    np.testing.assert_allclose(
+        self.kernel.grid_eval(self.sif_vector, 16, 0.75).reshape([-1]),
+        self.kernel.eval_at_samples(self.sif_vector, samples),
+        atol=1e-6)
+
+  def test_element_grid_eval_covers_support(self):
+    resolution = 24
+    axis = cpu_kernel.grid_axis(resolution, 0.75)
+    zz, yy, xx = np.meshgrid(axis, axis, axis, indexing='ij')
+    samples = np.stack([xx, yy, zz], axis=-1).reshape([-1, 3])
+    params = self.kernel.bind(self.sif_vector)
+    for i in range(ELEMENT_COUNT):
+      dense = np.reshape(
+          self.kernel._element_values(params, i, samples), zz.shape)
+      start, voxel_size, volume = self.kernel.element_grid_eval(
+          params, i, resolution, 0.75, 1e-4)
+      self.assertEqual(voxel_size, 1)
+      z0, y0, x0 = start
+      z1, y1, x1 = start + np.array(volume.shape)
+      np.testing.assert_allclose(volume, dense[z0:z1, y0:y1, x0:x1], atol=1e-6)
+      outside = np.copy(dense)
+      outside[z0:z1, y0:y1, x0:x1] = 0.0
+      self.assertLess(np.max(np.abs(outside)), 0.01)
+
+  def test_element_grid_eval_at_part_resolution(self):
+    resolution = 24
+    cell_size = 1.5 / resolution
+    axis = cpu_kernel.grid_axis(resolution, 0.75)
+    params = self.kernel.bind(self.sif_vector)
+    for i in range(ELEMENT_COUNT):
+      start, voxel_size, volume = self.kernel.element_grid_eval(
+          params, i, resolution, 0.75, 1e-4, part_resolution=12)
+      self.assertEqual(max(volume.shape), 12)
+      # The samples, from their location in voxels of the full grid:
+      zs, ys, xs = [
+          axis[0] + (start[j] + voxel_size * np.arange(volume.shape[j])) *
+          cell_size for j in range(3)
+      ]
+      zz, yy, xx = np.meshgrid(zs, ys, xs, indexing='ij')
+      samples = np.stack([xx, yy, zz], axis=-1).reshape([-1, 3])
+      np.testing.assert_allclose(
+          volume.reshape([-1]),
+          self.kernel._element_values(params, i, samples),
+          rtol=1e-4,
+          atol=1e-5)
+      # The box is covered, up to where it leaves the grid:
+      lower, upper = self.kernel._support_boxes(params, 1e-4)[i]
+      lower = np.maximum(lower, axis[0])
+      upper = np.minimum(upper, axis[-1])
+      self.assertTrue(np.all(np.min(samples, axis=0) <= lower + 1e-5))
+      self.assertTrue(np.all(np.max(samples, axis=0) >= upper - 1e-5))
+    with self.assertRaisesRegex(ValueError, 'at least 2'):
+      self.kernel.element_grid_eval(
+          params, 0, resolution, 0.75, 1e-4, part_resolution=1)
+
+  def test_support_bounds(self):
+    self.sif_vector[1, 0] = 0.0
+    lower, upper = self.kernel.support_bounds(self.sif_vector, 1e-4)
+    self.assertTrue(np.all(lower < upper))
+    samples = np.random.RandomState(4).uniform(-1.0, 1.0, size=[20000, 3])
+    values = self.kernel.eval_at_samples(self.sif_vector, samples)
+    outside = np.any((samples < lower) | (samples > upper), axis=-1)
+    self.assertGreater(np.count_nonzero(outside), 0)
+    self.assertLess(np.max(np.abs(values[outside])), 0.01)
+    self.sif_vector[:, 0] = 0.0
+    self.assertIsNone(self.kernel.support_bounds(self.sif_vector, 1e-4))
+
+  def test_bound_shape_matches_unbound(self):
+    samples = np.random.RandomState(3).uniform(-0.75, 0.75, size=[1000, 3])
+    bound = self.kernel.bind(self.sif_vector)
+    np.testing.assert_array_equal(
+        self.kernel.eval_at_samples(bound, samples),
+        self.kernel.eval_at_samples(self.sif_vector, samples))
+    self.kernel.influence_threshold = 1e-4
+    np.testing.assert_array_equal(
+        self.kernel.grid_eval(bound, 8, 0.75),
+        self.kernel.grid_eval(self.sif_vector, 8, 0.75))
+
+  def test_culled_grid_eval_is_close_to_dense(self):
+    self.kernel.influence_threshold = 1e-4
+    culled = self.kernel.grid_eval(self.sif_vector, 24, 0.75)
+    axis = cpu_kernel.grid_axis(24, 0.75)
+    zz, yy, xx = np.meshgrid(axis, axis, axis, indexing='ij')
+    samples = np.stack([xx, yy, zz], axis=-1).reshape([-1, 3])
+    # The binned grid path and the per-sample box test cull the same pairs:
+    np.testing.assert_allclose(
+        culled.reshape([-1]),
+        self.kernel.eval_at_samples(self.sif_vector, samples),
+        atol=1e-6)
+    expected = reference_eval(self.weights, self.sif_vector, samples)
+    # Each culled pair contributes at most |c| * t * |1 + occ|:
+    np.testing.assert_allclose(culled.reshape([-1]), expected, atol=1e-2)
+    self.assertGreater(np.max(np.abs(culled.reshape([-1]) - expected)), 0.0)
+
+  def test_culling_report(self):
+    report = cpu_kernel.culling_report(self.kernel, self.sif_vector, 16, 0.75,
+                                       1e-3)
+    self.assertEqual(self.kernel.influence_threshold, 0.0)
+    self.assertLess(report['max_abs_error'], 0.1)
+    self.assertBetween(report['flipped_voxel_fraction'], 0.0, 0.01)
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -22,35 +22,35 @@ import trimesh
 from ldif.util.file_util import log
 # pylint: enable=g-bad-import-order
 
+# The level set of the algebraic LDIF/SIF value that is the surface:
+ISO_LEVEL = -0.07
 
-def marching_cubes(volume, mcubes_extent):
-  """Maps from a voxel grid of implicit surface samples to a Trimesh mesh."""
+
+def marching_cubes(volume, mcubes_extent, centered_grid=False):
+  """Maps from a voxel grid of implicit surface samples to a Trimesh mesh.
+
+  Args:
+    volume: Numpy array indexed [z, y, x]. The grid of values.
+    mcubes_extent: Float. The grid covers [-mcubes_extent, mcubes_extent]^3.
+    centered_grid: Boolean. Whether the volume was sampled on the centered grid
+      of cpu_kernel.grid_axis rather than the default one. Its samples are
+      0.5 / resolution further along each axis, which the mesh is corrected
+      for, so it's the same as the mesh of the default grid.
+
+  Returns:
+    A tuple (had_crossing, mesh). If there is no surface, the mesh is a sphere.
+  """
   volume = np.squeeze(volume)
   length, height, width = volume.shape
   resolution = length
   # This function doesn't support non-cube volumes:
   assert resolution == height and resolution == width
-  thresh = -0.07
+  thresh = ISO_LEVEL
   try:
     vertices, faces, normals, _ = measure.marching_cubes_lewiner(volume, thresh)
     del normals
-    x, y, z = [np.array(x) for x in zip(*vertices)]
-    xyzw = np.stack([x, y, z, np.ones_like(x)], axis=1)
-    # Center the volume around the origin:
-    xyzw += np.array(
-        [[-resolution / 2.0, -resolution / 2.0, -resolution / 2.0, 0.]])
-    # This assumes the world is right handed with y up; matplotlib's renderer
-    # has z up and is left handed:
-    # Reflect across z, rotate about x, and rescale to [-0.5, 0.5].
-    xyzw *= np.array([[(2.0 * mcubes_extent) / resolution,
-                       (2.0 * mcubes_extent) / resolution,
-                       -1.0 * (2.0 * mcubes_extent) / resolution, 1]])
-    y_up_to_z_up = np.array([[0., 0., -1., 0.], [0., 1., 0., 0.],
-                             [1., 0., 0., 0.], [0., 0., 0., 1.]])
-    xyzw = np.matmul(y_up_to_z_up, xyzw.T).T
-    faces = np.stack([faces[..., 0], faces[..., 2], faces[..., 1]], axis=-1)
-    world_space_xyz = np.copy(xyzw[:, :3])
-    mesh = trimesh.Trimesh(vertices=world_space_xyz, faces=faces)
+    mesh = _voxel_space_to_mesh(vertices, faces, resolution, mcubes_extent,
+                                centered_grid)
     log.verbose('Generated mesh successfully.')
     return True, mesh
   except (ValueError, RuntimeError) as e:
@@ -58,3 +58,125 @@ def marching_cubes(volume, mcubes_extent):
         'Failed to extract mesh with error %s. Setting to unit sphere.' %
         repr(e))
     return False, trimesh.primitives.Sphere(radius=0.5)
+
+
+def marching_cubes_in_box(volume,
+                          start,
+                          resolution,
+                          mcubes_extent,
+                          voxel_size=1.0,
+                          centered_grid=False):
+  """Maps from a box of a grid to a mesh in the frame of the full grid.
+
+  Args:
+    volume: Numpy array indexed [z, y, x]. The values in the box.
+    start: Numpy array with the [z, y, x] location of the first voxel of the
+      box in the full grid, in voxels of the full grid.
+    resolution: Int. The number of voxels along each axis of the full grid.
+    mcubes_extent: Float. The full grid covers
+      [-mcubes_extent, mcubes_extent]^3.
+    voxel_size: Float. The spacing of the samples in the box, in voxels of the
+      full grid.
+    centered_grid: Boolean. Whether the full grid is the centered grid of
+      cpu_kernel.grid_axis. See marching_cubes().
+
+  Returns:
+    A tuple (had_crossing, mesh), like marching_cubes().
+  """
+  try:
+    vertices, faces, _, _ = measure.marching_cubes_lewiner(volume, ISO_LEVEL)
+    return True, _voxel_space_to_mesh(vertices * voxel_size + start, faces,
+                                      resolution, mcubes_extent, centered_grid)
+  except (ValueError, RuntimeError) as e:
+    log.warning(
+        'Failed to extract mesh with error %s. Setting to unit sphere.' %
+        repr(e))
+    return False, trimesh.primitives.Sphere(radius=0.5)
+
+
+def _voxel_space_to_mesh(vertices,
+                         faces,
+                         resolution,
+                         mcubes_extent,
+                         centered_grid=False):
+  """Maps marching cubes output in voxel coordinates to a world space mesh."""
+  x, y, z = [np.array(x) for x in zip(*vertices)]
+  xyzw = np.stack([x, y, z, np.ones_like(x)], axis=1)
+  if centered_grid:
+    # Move the vertices to where they are on the default grid, whose samples
+    # are 0.5 / resolution, or 1 / (4 * mcubes_extent) voxels, lower:
+    xyzw[:, :3] += 1.0 / (4.0 * mcubes_extent)
+  # Center the volume around the origin:
+  xyzw += np.array(
+      [[-resolution / 2.0, -resolution / 2.0, -resolution / 2.0, 0.]])
+  # This assumes the world is right handed with y up; matplotlib's renderer
+  # has z up and is left handed:
+  # Reflect across z, rotate about x, and rescale to [-0.5, 0.5].
+  xyzw *= np.array([[(2.0 * mcubes_extent) / resolution,
+                     (2.0 * mcubes_extent) / resolution,
+                     -1.0 * (2.0 * mcubes_extent) / resolution, 1]])
+  y_up_to_z_up = np.array([[0., 0., -1., 0.], [0., 1., 0., 0.],
+                           [1., 0., 0., 0.], [0., 0., 0., 1.]])
+  xyzw = np.matmul(y_up_to_z_up, xyzw.T).T
+  faces = np.stack([faces[..., 0], faces[..., 2], faces[..., 1]], axis=-1)
+  world_space_xyz = np.copy(xyzw[:, :3])
+  return trimesh.Trimesh(vertices=world_space_xyz, faces=faces)
+
+
+def streaming_marching_cubes(block_fn,
+                             resolution,
+                             mcubes_extent,
+                             block_resolution=64):
+  """Runs marching cubes block by block, without a full volume in memory.
+
+  Neighboring blocks overlap by one voxel, so every cube of the full grid is
+  in exactly one block. The vertices on the shared faces are computed from the
+  same voxel values in both blocks, so they are identical and get welded.
+
+  Args:
+    block_fn: A function that maps a voxel index range (z_start, z_end,
+      y_start, y_end, x_start, x_end), with exclusive ends, to a numpy array of
+      the volume in that range.
+    resolution: Int. The number of voxels along each axis of the full volume.
+    mcubes_extent: Float. The volume covers [-mcubes_extent, mcubes_extent]^3.
+    block_resolution: Int. The number of cubes along each axis of a block.
+
+  Returns:
+    A tuple (had_crossing, mesh), like marching_cubes().
+  """
+  starts = list(range(0, resolution - 1, block_resolution))
+  all_vertices = []
+  all_faces = []
+  vertex_count = 0
+  for z_start in starts:
+    for y_start in starts:
+      for x_start in starts:
+        block_range = (z_start, min(z_start + block_resolution + 1, resolution),
+                       y_start, min(y_start + block_resolution + 1, resolution),
+                       x_start, min(x_start + block_resolution + 1, resolution))
+        block = block_fn(*block_range)
+        if np.min(block) > ISO_LEVEL or np.max(block) < ISO_LEVEL:
+          continue
+        try:
+          vertices, faces, _, _ = measure.marching_cubes_lewiner(
+              block, ISO_LEVEL)
+        except (ValueError, RuntimeError):
+          continue
+        all_vertices.append(vertices.astype(np.float64) +
+                            np.array([z_start, y_start, x_start]))
+        all_faces.append(faces + vertex_count)
+        vertex_count += vertices.shape[0]
+  if not all_vertices:
+    log.warning('Failed to extract mesh: no block has a surface crossing.'
+                ' Setting to unit sphere.')
+    return False, trimesh.primitives.Sphere(radius=0.5)
+  # The two copies of a seam vertex can differ by float32 rounding of the
+  # block offset, so they are welded at a tolerance far below a voxel:
+  vertices, welded_index = np.unique(
+      np.round(np.concatenate(all_vertices), 4), axis=0, return_inverse=True)
+  faces = welded_index.reshape([-1])[np.concatenate(all_faces)]
+  log.verbose(f'Welded {vertex_count} block vertices into'
+              f' {vertices.shape[0]}.')
+  mesh = _voxel_space_to_mesh(vertices, faces, resolution, mcubes_extent)
+  log.verbose('Generated mesh successfully.')
+  return True, mesh
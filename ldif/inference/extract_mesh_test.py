@@ -0,0 +1,119 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.inference.extract_mesh."""
+
+import numpy as np
+
+from tensorflow.python.platform import googletest
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.inference import adaptive_grid_test
+from ldif.inference import cpu_kernel
+from ldif.inference import extract_mesh
+# pylint: enable=g-bad-import-order
+
+
+class ExtractMeshTest(googletest.TestCase):
+
+  def setUp(self):
+    super(ExtractMeshTest, self).setUp()
+    self.resolution = 48
+    self.extent = 0.75
+    axis = cpu_kernel.grid_axis(self.resolution, self.extent)
+    zz, yy, xx = np.meshgrid(axis, axis, axis, indexing='ij')
+    self.volume = adaptive_grid_test.two_spheres(
+        np.stack([xx, yy, zz], axis=-1)).astype(np.float32)
+    self.block_ranges = []
+
+  def block_fn(self, z_start, z_end, y_start, y_end, x_start, x_end):
+    self.block_ranges.append((z_start, z_end, y_start, y_end, x_start, x_end))
+    return self.volume[z_start:z_end, y_start:y_end, x_start:x_end]
+
+  def test_streaming_matches_dense(self):
+    _, dense = extract_mesh.marching_cubes(self.volume, self.extent)
+    success, streamed = extract_mesh.streaming_marching_cubes(
+        self.block_fn, self.resolution, self.extent, block_resolution=16)
+    self.assertTrue(success)
+    self.assertLen(self.block_ranges, 27)
+    for block_range in self.block_ranges:
+      self.assertLessEqual(block_range[1] - block_range[0], 17)
+    self.assertEqual(streamed.vertices.shape, dense.vertices.shape)
+    self.assertEqual(streamed.faces.shape, dense.faces.shape)
+    self.assertTrue(streamed.is_watertight)
+    self.assertAlmostEqual(streamed.volume, dense.volume, places=6)
+    np.testing.assert_allclose(
+        np.sort(streamed.vertices, axis=0),
+        np.sort(dense.vertices, axis=0),
+        atol=1e-4)
+
+  def test_marching_cubes_in_box_matches_dense(self):
+    _, dense = extract_mesh.marching_cubes(self.volume, self.extent)
+    start = np.array([4, 6, 2])
+    success, boxed = extract_mesh.marching_cubes_in_box(
+        self.volume[4:46, 6:40, 2:44], start, self.resolution, self.extent)
+    self.assertTrue(success)
+    self.assertEqual(boxed.faces.shape, dense.faces.shape)
+    np.testing.assert_allclose(boxed.vertices, dense.vertices, atol=1e-5)
+
+  def test_marching_cubes_in_box_with_voxel_size(self):
+    _, dense = extract_mesh.marching_cubes(self.volume, self.extent)
+    start = np.array([4, 6, 2])
+    success, boxed = extract_mesh.marching_cubes_in_box(
+        self.volume[4:46:2, 6:40:2, 2:44:2],
+        start,
+        self.resolution,
+        self.extent,
+        voxel_size=2)
+    self.assertTrue(success)
+    # Half the detail, in the same place:
+    np.testing.assert_allclose(boxed.bounds, dense.bounds, atol=0.04)
+    self.assertAlmostEqual(boxed.volume, dense.volume, delta=0.1 * dense.volume)
+
+  def test_centered_grid_matches_default(self):
+    _, dense = extract_mesh.marching_cubes(self.volume, self.extent)
+    axis = cpu_kernel.grid_axis(self.resolution, self.extent, centered=True)
+    zz, yy, xx = np.meshgrid(axis, axis, axis, indexing='ij')
+    volume = adaptive_grid_test.two_spheres(
+        np.stack([xx, yy, zz], axis=-1)).astype(np.float32)
+    success, centered = extract_mesh.marching_cubes(
+        volume, self.extent, centered_grid=True)
+    self.assertTrue(success)
+    # Uncorrected, the meshes would be 0.5 / resolution apart along each axis:
+    shift = 0.5 / self.resolution
+    np.testing.assert_allclose(centered.bounds, dense.bounds, atol=0.1 * shift)
+    np.testing.assert_allclose(
+        centered.center_mass, dense.center_mass, atol=0.02 * shift)
+    self.assertAlmostEqual(
+        centered.volume, dense.volume, delta=0.01 * dense.volume)
+    start = np.array([4, 6, 2])
+    success, boxed = extract_mesh.marching_cubes_in_box(
+        volume[4:46, 6:40, 2:44],
+        start,
+        self.resolution,
+        self.extent,
+        centered_grid=True)
+    self.assertTrue(success)
+    np.testing.assert_allclose(boxed.vertices, centered.vertices, atol=1e-5)
+
+  def test_streaming_without_surface(self):
+    self.volume[...] = 1.0
+    success, _ = extract_mesh.streaming_marching_cubes(
+        self.block_fn, self.resolution, self.extent, block_resolution=32)
+    self.assertFalse(success)
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,239 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""A long-lived process that evaluates (D)SIFs on voxel grids.
+
+The worker loads its evaluator (and so the network weights) once. Each request
+is a fixed binary header followed by the raw float32 (D)SIF, sent over a pipe.
+The worker writes the grid directly into a shared memory buffer, and the reply
+is only a status, so no grid data is serialized or copied between processes.
+
+An evaluator is any picklable object with the method
+  grid_eval(sif_vector, resolution, extent, out)
+that fills out, a float32 numpy array with shape [resolution]*3, indexed
+[z, y, x]. cpu_kernel.CpuKernel is one.
+
+CudaGridEvalWorker speaks the same protocol to the CUDA kernel binary
+ldif2mesh, run with -serve, over its stdin and stdout. Each reply is the status
+byte, followed by the uint32 length and text of the error if it failed, and the
+grid buffer is a memory-mapped file.
+"""
+
+import mmap
+import multiprocessing
+import os
+import struct
+import subprocess
+import tempfile
+
+import numpy as np
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.util.file_util import log
+# pylint: enable=g-bad-import-order
+
+# The protocol version, resolution, extent, element count and element length:
+REQUEST_HEADER = struct.Struct('<iifii')
+PROTOCOL_VERSION = 1
+
+_STATUS_OK = b'\x00'
+_STATUS_ERROR = b'\x01'
+_ERROR_LENGTH = struct.Struct('<I')
+
+
+def _serve(evaluator, connection, grid_buffer, max_resolution):
+  """The worker process main loop. Exits when it receives an empty request."""
+  while True:
+    request = connection.recv_bytes()
+    if not request:
+      break
+    try:
+      version, resolution, extent, element_count, element_length = (
+          REQUEST_HEADER.unpack_from(request))
+      if version != PROTOCOL_VERSION:
+        raise ValueError(f'Unsupported protocol version {version}.')
+      if resolution > max_resolution:
+        raise ValueError(f'Resolution {resolution} exceeds the maximum'
+                         f' resolution {max_resolution} of the grid buffer.')
+      sif_vector = np.frombuffer(
+          request,
+          dtype='<f4',
+          count=element_count * element_length,
+          offset=REQUEST_HEADER.size).reshape([element_count, element_length])
+      out = np.frombuffer(
+          grid_buffer, dtype=np.float32, count=resolution**3).reshape(
+              [resolution, resolution, resolution])
+      evaluator.grid_eval(sif_vector, resolution, extent, out=out)
+    except Exception as e:  # pylint: disable=broad-except
+      connection.send_bytes(_STATUS_ERROR + repr(e).encode('utf-8'))
+      continue
+    connection.send_bytes(_STATUS_OK)
+  connection.close()
+
+
+class GridEvalWorker(object):
+  """Evaluates grids in a persistent subprocess. Also a context manager."""
+
+  def __init__(self, evaluator, max_resolution=256):
+    """Starts the worker process.
+
+    Args:
+      evaluator: The evaluator to run in the worker. See the module docstring.
+      max_resolution: Int. The largest resolution that can be requested. The
+        shared grid buffer is allocated once with this size.
+    """
+    self.max_resolution = max_resolution
+    # Spawn rather than fork, because the parent usually has tensorflow loaded:
+    context = multiprocessing.get_context('spawn')
+    self._grid_buffer = context.RawArray('f', max_resolution**3)
+    self._connection, worker_connection = context.Pipe()
+    self._process = context.Process(
+        target=_serve,
+        args=(evaluator, worker_connection, self._grid_buffer, max_resolution),
+        daemon=True)
+    self._process.start()
+    worker_connection.close()
+    log.verbose(f'Started grid evaluation worker {self._process.pid}.')
+
+  def grid_eval(self, sif_vector, resolution, extent):
+    """Evaluates a (D)SIF on a grid in the worker.
+
+    Args:
+      sif_vector: Numpy array with shape [element_count, element_length].
+      resolution: Int. The number of voxels along each axis.
+      extent: Float. The grid covers [-extent, extent]^3.
+
+    Returns:
+      Numpy array with shape [resolution, resolution, resolution], indexed
+      [z, y, x]. It is a view of the shared grid buffer, so it is overwritten by
+      the next call; copy it to keep it.
+    """
+    if self._process is None:
+      raise ValueError('The grid evaluation worker has been closed.')
+    sif_vector = np.ascontiguousarray(sif_vector, dtype='<f4')
+    element_count, element_length = sif_vector.shape
+    error = self._exchange(
+        REQUEST_HEADER.pack(PROTOCOL_VERSION, resolution, extent, element_count,
+                            element_length) + sif_vector.tobytes())
+    if error is not None:
+      raise ValueError(f'Grid evaluation worker failed with error: {error}')
+    return np.frombuffer(
+        self._grid_buffer, dtype=np.float32, count=resolution**3).reshape(
+            [resolution, resolution, resolution])
+
+  def _exchange(self, request):
+    """Sends a request to the worker, and returns its error message or None."""
+    try:
+      self._connection.send_bytes(request)
+      reply = self._connection.recv_bytes()
+    except (EOFError, OSError) as e:
+      raise ValueError('The grid evaluation worker exited unexpectedly with'
+                       f' code {self._process.exitcode}.') from e
+    if reply[:1] != _STATUS_OK:
+      return reply[1:].decode('utf-8')
+    return None
+
+  def close(self):
+    """Stops the worker process."""
+    if self._process is None:
+      return
+    try:
+      self._connection.send_bytes(b'')
+    except OSError:
+      pass  # The worker has already exited.
+    self._process.join()
+    self._connection.close()
+    self._process = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+class CudaGridEvalWorker(GridEvalWorker):
+  """Evaluates grids with a persistent ldif2mesh -serve process."""
+
+  def __init__(self, kernel_path, occnet_path, symmetry_count,
+               max_resolution=256, env=None):
+    """Starts the kernel process.
+
+    Args:
+      kernel_path: String. The path to the ldif2mesh binary.
+      occnet_path: String. The path to the .occnet weights. They are loaded
+        once, with the first request that has implicit parameters.
+      symmetry_count: Int. The number of mirrored elements.
+      max_resolution: Int. The largest resolution that can be requested.
+      env: Dict or None. The environment of the kernel process.
+    """
+    self.max_resolution = max_resolution
+    # Prefer a memory-backed file for the grid buffer where there is one:
+    buffer_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    self._buffer_file = tempfile.NamedTemporaryFile(
+        prefix='ldif-grid-', dir=buffer_dir)
+    buffer_size = 4 * max_resolution**3
+    self._buffer_file.truncate(buffer_size)
+    self._grid_buffer = mmap.mmap(self._buffer_file.fileno(), buffer_size)
+    self._log_file = tempfile.TemporaryFile()
+    command = [
+        kernel_path, '-serve', occnet_path, self._buffer_file.name,
+        str(max_resolution), str(symmetry_count)
+    ]
+    self._process = subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=self._log_file,
+        env=env)
+    log.verbose(f'Started CUDA grid evaluation worker {self._process.pid}.')
+
+  def _read_reply(self, size):
+    reply = self._process.stdout.read(size)
+    if len(reply) != size:
+      raise EOFError
+    return reply
+
+  def _exchange(self, request):
+    """Sends a request to the kernel, and returns its error message or None."""
+    try:
+      self._process.stdin.write(request)
+      self._process.stdin.flush()
+      if self._read_reply(1) == _STATUS_OK:
+        return None
+      length, = _ERROR_LENGTH.unpack(self._read_reply(_ERROR_LENGTH.size))
+      return self._read_reply(length).decode('utf-8')
+    except (EOFError, OSError) as e:
+      code = self._process.wait()
+      self._log_file.seek(0)
+      output = self._log_file.read().decode('utf-8', errors='replace')
+      raise ValueError('The CUDA grid evaluation worker exited unexpectedly'
+                       f' with code {code}. Its output was:\n{output}') from e
+
+  def close(self):
+    """Stops the kernel process."""
+    if self._process is None:
+      return
+    try:
+      self._process.stdin.close()
+    except OSError:
+      pass  # The kernel has already exited.
+    self._process.wait()
+    self._process.stdout.close()
+    self._log_file.close()
+    # The buffer stays mapped, because returned grids may still view it. The
+    # file is removed now, and the memory freed once they are gone.
+    self._buffer_file.close()
+    self._process = None
@@ -0,0 +1,145 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.inference.grid_worker."""
+
+import os
+import stat
+import sys
+import tempfile
+
+import numpy as np
+
+from tensorflow.python.platform import googletest
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.inference import cpu_kernel
+from ldif.inference import cpu_kernel_test
+from ldif.inference import grid_worker
+# pylint: enable=g-bad-import-order
+
+# Serves requests like ldif2mesh -serve, with the CPU kernel:
+FAKE_KERNEL = """#!{python}
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+
+from ldif.inference import cpu_kernel
+from ldif.inference import grid_worker
+
+# Like ldif2mesh, reply on the original stdout and print anything else to
+# stderr:
+reply = os.fdopen(os.dup(1), 'wb')
+os.dup2(2, 1)
+occnet_path, buffer_path, max_resolution, symmetry_count = sys.argv[2:]
+max_resolution = int(max_resolution)
+kernel = cpu_kernel.CpuKernel(
+    cpu_kernel.OccNet.from_file(occnet_path),
+    symmetry_count=int(symmetry_count),
+    thread_count=1)
+with open(buffer_path, 'r+b') as f:
+  grid_buffer = mmap.mmap(f.fileno(), 4 * max_resolution**3)
+while True:
+  header = sys.stdin.buffer.read(grid_worker.REQUEST_HEADER.size)
+  if not header:
+    break
+  _, resolution, extent, element_count, element_length = (
+      grid_worker.REQUEST_HEADER.unpack(header))
+  sif_vector = np.frombuffer(
+      sys.stdin.buffer.read(4 * element_count * element_length),
+      dtype=np.float32).reshape([element_count, element_length])
+  if resolution > max_resolution:
+    error = b'Resolution exceeds the maximum resolution.'
+    reply.write(b'\\x01' + struct.pack('<I', len(error)) + error)
+  else:
+    out = np.frombuffer(
+        grid_buffer, dtype=np.float32, count=resolution**3).reshape(
+            [resolution, resolution, resolution])
+    kernel.grid_eval(sif_vector, resolution, extent, out=out)
+    reply.write(b'\\x00')
+  reply.flush()
+"""
+
+
+class GridWorkerTest(googletest.TestCase):
+
+  def setUp(self):
+    super(GridWorkerTest, self).setUp()
+    rng = np.random.RandomState(0)
+    occnet_path = os.path.join(tempfile.mkdtemp(), 'test.occnet')
+    cpu_kernel_test.write_occnet(
+        cpu_kernel_test.random_occnet_weights(rng), occnet_path)
+    self.occnet_path = occnet_path
+    self.sif_vector = cpu_kernel_test.random_ldif(rng)
+    self.kernel = cpu_kernel.CpuKernel(
+        cpu_kernel.OccNet.from_file(occnet_path),
+        symmetry_count=cpu_kernel_test.SYMMETRY_COUNT,
+        thread_count=1)
+
+  def test_matches_in_process_evaluation(self):
+    with grid_worker.GridEvalWorker(self.kernel, max_resolution=16) as worker:
+      for resolution in [8, 16]:
+        grid = worker.grid_eval(self.sif_vector, resolution, 0.75)
+        np.testing.assert_array_equal(
+            grid, self.kernel.grid_eval(self.sif_vector, resolution, 0.75))
+      # Errors are reported without stopping the worker:
+      with self.assertRaisesRegex(ValueError, 'exceeds the maximum'):
+        worker.grid_eval(self.sif_vector, 32, 0.75)
+      grid = worker.grid_eval(self.sif_vector, 8, 0.5)
+      np.testing.assert_array_equal(
+          grid, self.kernel.grid_eval(self.sif_vector, 8, 0.5))
+    with self.assertRaises(ValueError):
+      worker.grid_eval(self.sif_vector, 8, 0.75)
+
+  def test_cuda_worker_matches_in_process_evaluation(self):
+    kernel_path = os.path.join(tempfile.mkdtemp(), 'ldif2mesh')
+    with open(kernel_path, 'w') as f:
+      f.write(FAKE_KERNEL.format(python=sys.executable))
+    os.chmod(kernel_path, os.stat(kernel_path).st_mode | stat.S_IXUSR)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    with grid_worker.CudaGridEvalWorker(
+        kernel_path,
+        self.occnet_path,
+        cpu_kernel_test.SYMMETRY_COUNT,
+        max_resolution=16,
+        env=env) as worker:
+      for resolution in [8, 16]:
+        grid = worker.grid_eval(self.sif_vector, resolution, 0.75)
+        np.testing.assert_array_equal(
+            grid, self.kernel.grid_eval(self.sif_vector, resolution, 0.75))
+      with self.assertRaisesRegex(ValueError, 'exceeds the maximum'):
+        worker.grid_eval(self.sif_vector, 32, 0.75)
+      grid = worker.grid_eval(self.sif_vector, 8, 0.5)
+      np.testing.assert_array_equal(
+          grid, self.kernel.grid_eval(self.sif_vector, 8, 0.5))
+    with self.assertRaises(ValueError):
+      worker.grid_eval(self.sif_vector, 8, 0.75)
+
+  def test_cuda_worker_reports_a_kernel_that_exits(self):
+    kernel_path = os.path.join(tempfile.mkdtemp(), 'ldif2mesh')
+    with open(kernel_path, 'w') as f:
+      f.write('#!/bin/sh\necho "no CUDA-capable device" >&2\n')
+    os.chmod(kernel_path, os.stat(kernel_path).st_mode | stat.S_IXUSR)
+    with grid_worker.CudaGridEvalWorker(
+        kernel_path, self.occnet_path, 0, max_resolution=8) as worker:
+      with self.assertRaisesRegex(ValueError, 'no CUDA-capable device'):
+        worker.grid_eval(self.sif_vector, 8, 0.75)
+
+
+if __name__ == '__main__':
+  googletest.main()
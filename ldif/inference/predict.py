@@ -14,6 +14,7 @@
 # Lint as: python3
 """Class to do trained model inference in beam."""
 
+import concurrent.futures
 import importlib
 import os
 import struct
@@ -23,13 +24,17 @@ import time
 import numpy as np
 import tensorflow as tf
 from tensorflow.contrib import framework as contrib_framework
+import trimesh
 
 # LDIF is an internal package, should be imported last.
 # pylint: disable=g-bad-import-order
 from ldif.datasets import preprocess
 from ldif.datasets import shapenet
+from ldif.inference import adaptive_grid
+from ldif.inference import cpu_kernel
 from ldif.inference import experiment as experiments
 from ldif.inference import extract_mesh
+from ldif.inference import grid_worker
 from ldif.inference import metrics
 from ldif.model import model as sdf_model
 from ldif.representation import structured_implicit_function
@@ -42,6 +47,7 @@ from ldif.util import gpu_util
 from ldif.util import path_util
 from ldif.util import py_util
 from ldif.util import sdf_util
+from ldif.util import tf_util
 from ldif.util import np_util
 
 from ldif.util.file_util import log
@@ -159,6 +165,29 @@ def conform_prediction(vector):
       [consts, centers, radii_aa, radii_cov, vector[..., 10:]], axis=-1)
 
 
+def _cuda_kernel_error(output):
+  """Makes the error to raise for a failure of the CUDA kernel."""
+  if 'out of memory' in output:
+    return ValueError('The GPU does not have enough free memory left for the'
+                      ' inference kernel. Please reduce the fraction'
+                      ' reserved by tensorflow.')
+  if 'no kernel image is available' in output:
+    return ValueError('It appears that the CUDA kernel was not built to your '
+                      'gpu\'s architecture. Hopefully this is an easy fix. '
+                      'Please go to developer.nvidia.com/cuda-gpus, and find '
+                      'your gpu from the list. Then, modify ./build_kernel.sh '
+                      'by adding compute_XX and sm_XX for whatever your GPU '
+                      'compute capability is according to the website. For '
+                      'example, a 2080 Ti would use compute_75 and sm_75. '
+                      'Note that if your card supports below 35, it likely '
+                      'will fail to compile using this method. If you are '
+                      'seeing this error, please feel free to open up an issue '
+                      'and report it. We would like to support as many gpus as '
+                      'possible.')
+  return ValueError('An unrecognized error occurred during inference kernel'
+                    f' evaluation: {output}')
+
+
 class SingleViewDepthEncoder(TrainedNetwork):
   """Maps from a single depth image (max-0) to a shape representation."""
 
@@ -269,6 +298,33 @@ class DepthEncoder(TrainedNetwork):
     return self.run(ex.depth_images, ex.precomputed_surface_samples_from_dodeca)
 
 
+class BoundShape(object):
+  """A (D)SIF bound to a Decoder by Decoder.bind().
+
+  The per-shape state is computed on first use, separately for each backend.
+  """
+
+  def __init__(self, decoder, sif_vector):
+    self.decoder = decoder
+    self.sif_vector = np.reshape(sif_vector, decoder.unbatched_vector_shape)
+    self._shape_feed = None
+    self._cpu_shape = None
+
+  @property
+  def shape_feed(self):
+    """A feed_dict for the tensorflow decoder, without the samples."""
+    if self._shape_feed is None:
+      self._shape_feed = self.decoder._shape_feed(self.sif_vector)  # pylint: disable=protected-access
+    return self._shape_feed
+
+  @property
+  def cpu_shape(self):
+    """The shape bound to the decoder's cpu kernel."""
+    if self._cpu_shape is None:
+      self._cpu_shape = self.decoder.cpu_kernel.bind(self.sif_vector)
+    return self._cpu_shape
+
+
 class Decoder(TrainedNetwork):
   """A SIF -> Mesh decoder."""
 
@@ -317,6 +373,38 @@ class Decoder(TrainedNetwork):
           self.block_res
       ])
 
+      # Batched decoding, for evaluating several shapes per session call. The
+      # total sample count per call is the same as for a single shape, so the
+      # memory use is too:
+      self._set_decode_batch_size(kwargs.get('decode_batch_size', 8))
+      self.batched_sif_input = tf.placeholder(
+          tf.float32, [self.decode_batch_size] + self.unbatched_vector_shape)
+      self.batched_sample_locations_ph = tf.placeholder(
+          tf.float32,
+          shape=[self.decode_batch_size, self.batched_point_count, 3])
+      batched_implicit = (
+          structured_implicit_function.StructuredImplicit.from_packed_vector(
+              self.job.model_config, self.batched_sif_input, net))
+      batched_alg, _ = batched_implicit.class_at_samples(
+          self.batched_sample_locations_ph, apply_class_transfer=False)
+      batched_class = sdf_util.apply_class_transfer(
+          batched_alg,
+          self.job.model_config,
+          soft_transfer=True,
+          offset=self.job.model_config.hparams.lset)
+      batched_shape = [self.decode_batch_size, self.batched_point_count]
+      self.batched_predicted_alg = tf.reshape(batched_alg, batched_shape)
+      self.batched_predicted_class = tf.reshape(batched_class, batched_shape)
+
+      # The tensors that depend only on the shape, not the samples. See bind().
+      self._shape_only_tensors = tf_util.fixed_input_frontier(
+          [
+              self.predicted_alg_grid, self.predicted_class_grid,
+              self.local_decisions
+          ],
+          fixed_inputs=[self.sif_input],
+          varying_inputs=[self.sample_locations_ph])
+
       self.base_grid = np_util.make_coordinate_grid_3d(
           length=self.block_res,
           height=self.block_res,
@@ -326,7 +414,11 @@ class Decoder(TrainedNetwork):
 
       self._world2local = structured_implicit.world2local
 
-      self._use_inference_kernel = True
+      self._use_inference_kernel = 'cuda'
+      self._cpu_kernel = None
+      self._grid_eval_worker = None
+      self._influence_threshold = 0.0
+      self._symmetric_grid = False
 
       # Influence samples
       self.true_sample_count = 10000
@@ -388,6 +480,15 @@ class Decoder(TrainedNetwork):
       except ValueError:
         log.warning('No variables to restore or restoration otherwise failed.')
 
+  def _set_decode_batch_size(self, decode_batch_size):
+    """Sets the number of shapes per batched call, and their sample count."""
+    if not 1 <= decode_batch_size <= self.native_point_count:
+      raise ValueError('The decode batch size must be between 1 and'
+                       f' {self.native_point_count}, but is'
+                       f' {decode_batch_size}.')
+    self.decode_batch_size = decode_batch_size
+    self.batched_point_count = self.native_point_count // decode_batch_size
+
   @property
   def unbatched_vector_shape(self):
     shape_count = self.job.model_config.hparams.sc
@@ -404,7 +505,97 @@ class Decoder(TrainedNetwork):
 
   @use_inference_kernel.setter
   def use_inference_kernel(self, should_use):
-    self._use_inference_kernel = bool(should_use)
+    """Selects the backend for dense grid evaluation.
+
+    Args:
+      should_use: True or 'cuda' for the compiled ldif2mesh CUDA kernel, 'cpu'
+        for the multithreaded numpy kernel in cpu_kernel.py, 'cpu_worker' for
+        the same kernel in a persistent worker process (see grid_worker.py),
+        and False or 'tf' for pure tensorflow. Both 'cuda' and 'cpu_worker'
+        keep their kernel running between evaluations.
+    """
+    if should_use is True or should_use == 'cuda':
+      kernel = 'cuda'
+    elif should_use in ['cpu', 'cpu_worker']:
+      kernel = should_use
+    elif not should_use or should_use == 'tf':
+      kernel = False
+    else:
+      raise ValueError(f'Unrecognized inference kernel: {should_use}.')
+    if kernel != self._use_inference_kernel:
+      # The worker runs the kernel that was selected when it started:
+      self.close_grid_eval_worker()
+    self._use_inference_kernel = kernel
+
+  def bind(self, sif_vector):
+    """Binds a (D)SIF, precomputing the state that depends only on the shape.
+
+    The world2local transformations, symmetry tiling, RBF covariances and the
+    OccNet conditional batch norm parameters are computed once here instead of
+    on every decoder call. The result can be passed to class_at_samples(),
+    iou() and extract_mesh() in place of the (D)SIF vector.
+
+    Args:
+      sif_vector: A numpy array with shape (element_count, element_length).
+
+    Returns:
+      A BoundShape.
+    """
+    return BoundShape(self, sif_vector)
+
+  def _bound(self, sif_vector):
+    if isinstance(sif_vector, BoundShape):
+      return sif_vector
+    return self.bind(sif_vector)
+
+  def _shape_feed(self, sif_vector):
+    """Computes the feed_dict entries that depend only on the shape."""
+    feed_dict = {
+        self.sif_input: np.reshape(sif_vector, self.batched_vector_shape)
+    }
+    values = self.session.run(self._shape_only_tensors, feed_dict=feed_dict)
+    feed_dict.update(zip(self._shape_only_tensors, values))
+    return feed_dict
+
+  @property
+  def influence_threshold(self):
+    return self._influence_threshold
+
+  @influence_threshold.setter
+  def influence_threshold(self, threshold):
+    """Sets the RBF weight at or below which the cpu kernel culls elements.
+
+    Args:
+      threshold: Float in [0, 1). 0.0 evaluates every element everywhere it is
+        nonzero, which matches the other backends.
+    """
+    self._influence_threshold = threshold
+    if self._cpu_kernel is not None:
+      self._cpu_kernel.influence_threshold = threshold
+    # The worker has its own copy of the kernel, so it is restarted on next use:
+    self.close_grid_eval_worker()
+
+  @property
+  def symmetric_grid(self):
+    return self._symmetric_grid
+
+  @symmetric_grid.setter
+  def symmetric_grid(self, symmetric):
+    """Sets whether dense cpu grids are sampled symmetrically about z=0.
+
+    The tensorflow and CUDA grids are shifted by -0.5 / resolution, so they are
+    not symmetric. On the centered grid the cpu kernel evaluates each 'lyr'
+    element once and mirrors it in place of its reflection. Marching cubes
+    corrects for the shift, so the meshes stay where they are on the other
+    grids. Adaptive and streaming extraction are unaffected.
+
+    Args:
+      symmetric: Boolean. Whether the dense cpu grid evaluation is centered.
+    """
+    self._symmetric_grid = symmetric
+    if self._cpu_kernel is not None:
+      self._cpu_kernel.centered_grid = symmetric
+    self.close_grid_eval_worker()
 
   # TODO(kgenova) The intermediate vector should really be its own class...
   def savetxt(self, sif_vector, path=None, version='v1'):
@@ -805,11 +996,8 @@ class Decoder(TrainedNetwork):
                                              m_path, init_camera)
       sp.check_output(cmd, shell=True)
 
-  def _grid_eval_cuda(self, sif_vector, resolution, extent):
-    """Evaluates a SIF/LDIF densely on a voxel grid."""
-    log.verbose('Using custom CUDA kernel for evaluation.')
-
-    # First step: Get the path where the serialized occnet should be.
+  def _occnet_path(self):
+    """Gets the path to the serialized OccNet, writing it if necessary."""
     # The serialized occnet should be at whatever the checkpoint path is,
     # but replace model.ckpt-[idx] with serialized-occnet-[idx].occnet
     checkpoint_path = self.ckpt.abspath
@@ -817,7 +1005,7 @@ class Decoder(TrainedNetwork):
     assert 'model.ckpt-' in checkpoint_path
     occnet_path = checkpoint_path.replace('model.ckpt-', 'serialized-occnet-')
     occnet_path = occnet_path + '.occnet'
-    # Second step: If it isn't there, write it to disk.
+    # If it isn't there, write it to disk.
     if not os.path.isfile(occnet_path):
       assert os.path.isdir(os.path.dirname(occnet_path))
       if self.job.model_config.hparams.ipe == 't':
@@ -825,83 +1013,201 @@ class Decoder(TrainedNetwork):
       else:
         occnet_path = path_util.get_path_to_ldif_root(
         ) + '/ldif2mesh/extracted.occnet'
-    # Third step: open a temporary directory, and write the embedding.
-    #   Make sure that the temp directories are deleted afterwards.
-    with py_util.py2_temporary_directory() as d:
-      rep_path = f'{d}/ldif.txt'
-      self.savetxt(sif_vector, rep_path)
-
-      # Pick the path to the output grd file:
-      grd_path = f'{d}/grid.grd'
-
-      # Fourth step: Get the path to the kernel
-      kernel_path = os.path.join(path_util.get_path_to_ldif_root(),
-                                 'ldif2mesh/ldif2mesh')
-      if not os.path.isfile(kernel_path):
-        raise ValueError(
-            f'There is no compiled CUDA executable at {kernel_path}.')
-
-      cmd = (f'CUDA_VISIBLE_DEVICES=0 {kernel_path} {rep_path} {occnet_path} '
-             f'{grd_path} -resolution {resolution}')
-      log.verbose(f'Executing command {cmd}')
-
-      # TODO(kgenova) Support extent as a flag
-      if extent != 0.75:
-        raise ValueError(
-            'Currently only 0.75 extent is supported on the '
-            'custom kernel. Please set use_inference_kernel to false for an'
-            f' extent of {extent}.')
-      # Fifth step: Invoke the kernel.
-      try:
-        cmd_result = sp.check_output(cmd, shell=True)
-        log.info(cmd_result.decode('utf-8').replace('\n', ''))
-      except sp.CalledProcessError as e:
-        if 'out of memory' in e.output.decode('utf-8'):
-          raise ValueError(
-              'The GPU does not have enough free memory left for the'
-              ' inference kernel. Please reduce the fraction'
-              ' reserved by tensorflow.')
-        elif 'no kernel image is available' in e.output.decode('utf-8'):
+    return occnet_path
+
+  @property
+  def cpu_kernel(self):
+    """The numpy inference kernel, created on first use."""
+    if self._cpu_kernel is None:
+      model_config = self.job.model_config
+      occnet_path = None
+      if model_config.hparams.ipe == 't':
+        occnet_path = self._occnet_path()
+      self._cpu_kernel = cpu_kernel.CpuKernel.from_model_config(
+          model_config,
+          occnet_path,
+          influence_threshold=self.influence_threshold,
+          centered_grid=self.symmetric_grid)
+    return self._cpu_kernel
+
+  def grid_eval_worker(self, resolution):
+    """Returns a worker process running the inference kernel.
+
+    The worker is started on first use, with the numpy kernel for 'cpu_worker'
+    and ldif2mesh for 'cuda'. Its shared grid buffer is allocated once, so it is
+    restarted with a larger buffer for a grid that doesn't fit.
+
+    Args:
+      resolution: Int. The resolution of the grid to evaluate.
+    """
+    worker = self._grid_eval_worker
+    if worker is not None and worker.max_resolution < resolution:
+      self.close_grid_eval_worker()
+    if self._grid_eval_worker is None:
+      if self.use_inference_kernel == 'cuda':
+        kernel_path = os.path.join(path_util.get_path_to_ldif_root(),
+                                   'ldif2mesh/ldif2mesh')
+        if not os.path.isfile(kernel_path):
           raise ValueError(
-              'It appears that the CUDA kernel was not built to your '
-              'gpu\'s architecture. Hopefully this is an easy fix. '
-              'Please go to developer.nvidia.com/cuda-gpus, and find '
-              'your gpu from the list. Then, modify ./build_kernel.sh '
-              'by adding compute_XX and sm_XX for whatever your GPU '
-              'compute capability is according to the website. For '
-              'example, a 2080 Ti would use compute_75 and sm_75. '
-              'Note that if your card supports below 35, it likely '
-              'will fail to compile using this method. If you are '
-              'seeing this error, please feel free to open up an issue '
-              'and report it. We would like to support as many gpus as '
-              'possible.')
-        else:
-          raise ValueError(f'Unrecognized error code {e.returncode} occurred'
-                           f' during inference kernel evaluation: {e.output}')
+              f'There is no compiled CUDA executable at {kernel_path}.')
+        self._grid_eval_worker = grid_worker.CudaGridEvalWorker(
+            kernel_path,
+            self._occnet_path(),
+            self.job.model_config.hparams.lyr,
+            max_resolution=resolution,
+            env=dict(os.environ, CUDA_VISIBLE_DEVICES='0'))
+      else:
+        self._grid_eval_worker = grid_worker.GridEvalWorker(
+            self.cpu_kernel, max_resolution=resolution)
+    return self._grid_eval_worker
+
+  def close_grid_eval_worker(self):
+    if self._grid_eval_worker is not None:
+      self._grid_eval_worker.close()
+      self._grid_eval_worker = None
+
+  def _grid_eval_in_worker(self, sif_vector, resolution, extent):
+    """Evaluates a SIF/LDIF densely on a voxel grid in the worker process.
+
+    Returns:
+      A view of the worker's shared grid buffer, so the grid is not copied. It
+      is overwritten by the next evaluation in the worker; copy it to keep it.
+    """
+    log.verbose(f'Using the {self.use_inference_kernel} grid evaluation worker'
+                ' for evaluation.')
+    t = time.time()
+    worker = self.grid_eval_worker(resolution)
+    try:
+      grid_out = worker.grid_eval(
+          self._bound(sif_vector).sif_vector, resolution, extent)
+    except ValueError as e:
+      if self.use_inference_kernel == 'cuda':
+        # The worker is restarted for the next evaluation:
+        self.close_grid_eval_worker()
+        raise _cuda_kernel_error(str(e)) from e
+      raise
+    log.verbose(f'Grid Eval Time: {time.time() - t}')
+    return grid_out
+
+  def _grid_eval_cpu(self, sif_vector, resolution, extent, world2local=None):
+    """Evaluates a SIF/LDIF densely on a voxel grid with numpy."""
+    log.verbose('Using the numpy cpu kernel for evaluation.')
+    t = time.time()
+    grid_out = self.cpu_kernel.grid_eval(
+        self._bound(sif_vector).cpu_shape,
+        resolution,
+        extent,
+        world2local=world2local)
+    log.verbose(f'Grid Eval Time: {time.time() - t}')
+    return grid_out
+
+  def _alg_at_samples(self, sif_vector, samples):
+    """Evaluates the algebraic (pre-class-transfer) value at samples."""
+    bound = self._bound(sif_vector)
+    if self.use_inference_kernel in ['cpu', 'cpu_worker']:
+      return self.cpu_kernel.eval_at_samples(bound.cpu_shape, samples)
+
+    def query(sample_chunk):
+      alg = self.session.run(
+          self.predicted_alg_grid,
+          feed_dict={
+              **bound.shape_feed, self.sample_locations_ph:
+                  np.reshape(sample_chunk,
+                             [self.block_res, self.block_res, self.block_res, 3])
+          })
+      return np.reshape(alg, [self.block_res**3, 1])
+
+    return self._chunk_sample_eval(
+        samples.astype(np.float32), query, self.block_res**3)[:, 0]
 
-      # Seventh step: Read the grid file.
-      _, grd = file_util.read_grd(grd_path)
-    # Eighth step: Verify the grid shape and return the grid.
-    log.verbose(f'The output CUDA grid has shape {grd.shape}.')
-    # gaps_util.grdview(grd)
-    return grd
+  def _adaptive_grid_eval(self,
+                          sif_vectors,
+                          resolution,
+                          extent,
+                          coarse_resolution,
+                          world2local=None):
+    """Evaluates the sum of LDIFs/SIFs on a grid, refining near its surface.
+
+    Args:
+      sif_vectors: A list of (D)SIFs or bound shapes. The refinement follows
+        the surface of the sum of their values, so the result matches the sum
+        of the dense grids wherever it determines the mesh.
+      resolution: Int. The resolution of the output grid.
+      extent: Float. The grid covers [-extent, extent]^3.
+      coarse_resolution: Int. The resolution the refinement starts at.
+      world2local: A list with a 4x4 numpy array or None for each (D)SIF, or
+        None.
+
+    Returns:
+      A numpy array with shape [resolution, resolution, resolution].
+    """
+    log.verbose('Evaluating SDF grid adaptively for mesh.')
+    t = time.time()
+    bound_shapes = [self._bound(v) for v in sif_vectors]
+    if world2local is None:
+      world2local = [None] * len(bound_shapes)
+
+    def eval_fn(samples):
+      values = np.zeros(samples.shape[0], dtype=np.float32)
+      for bound, tx in zip(bound_shapes, world2local):
+        shape_samples = samples
+        if tx is not None:
+          shape_samples = geom_util_np.apply_4x4(samples, tx, are_points=True)
+        values += self._alg_at_samples(bound, shape_samples)
+      return values
+
+    grid_out = adaptive_grid.adaptive_grid_eval(
+        eval_fn, resolution, extent, coarse_resolution=coarse_resolution)
+    log.verbose(f'Grid Eval Time: {time.time() - t}')
+    return grid_out
 
   def _grid_eval(self,
                  sif_vector,
                  resolution,
                  extent,
                  extract_parts,
-                 world2local=None):
-    """Evalutes the LDIF/SIF on a grid."""
+                 world2local=None,
+                 coarse_resolution=None,
+                 borrow=False):
+    """Evalutes the LDIF/SIF on a grid.
+
+    Args:
+      sif_vector: The (D)SIF or bound shape to evaluate.
+      resolution: Int. The number of voxels along each axis.
+      extent: Float. The grid covers [-extent, extent]^3.
+      extract_parts: Boolean. Whether to evaluate the per-element decisions.
+      world2local: A 4x4 numpy array or None.
+      coarse_resolution: Int or None. The resolution adaptive evaluation starts
+        at, if any.
+      borrow: Boolean. Whether a grid evaluated by a worker process may be
+        returned as a view of its buffer, which the next evaluation overwrites.
+        Otherwise it is copied, and the caller owns it.
+
+    Returns:
+      A numpy array with shape [resolution, resolution, resolution].
+    """
     log.verbose('Evaluating SDF grid for mesh.')
-    if self.use_inference_kernel and not extract_parts:
-      return self._grid_eval_cuda(sif_vector, resolution, extent)
+    if coarse_resolution is not None and not extract_parts:
+      # The CUDA kernel only evaluates whole grids, and is fast enough that it
+      # wouldn't benefit anyway:
+      if self.use_inference_kernel == 'cuda':
+        log.warning('Adaptive grid evaluation is not supported with the CUDA'
+                    ' kernel, evaluating the full grid.')
+      else:
+        return self._adaptive_grid_eval([sif_vector], resolution, extent,
+                                        coarse_resolution, [world2local])
+    if ((self.use_inference_kernel == 'cpu_worker' and world2local is None or
+         self.use_inference_kernel == 'cuda') and not extract_parts):
+      grid = self._grid_eval_in_worker(sif_vector, resolution, extent)
+      return grid if borrow else np.array(grid)
+    if self.use_inference_kernel in ['cpu', 'cpu_worker'] and not extract_parts:
+      return self._grid_eval_cpu(sif_vector, resolution, extent, world2local)
     if extract_parts or world2local:
       log.warning('Part extraction and world2local are not supported with the'
                   ' custom kernel.')
     log.warning('Using pure tensorflow for grid evaluation, this will be slow.')
     t = time.time()
-    sif_vector = np.reshape(sif_vector, self.batched_vector_shape)
+    shape_feed = self._bound(sif_vector).shape_feed
     assert not resolution % self.block_res
     block_count = resolution // self.block_res
     block_size = (2.0 * extent) / block_count
@@ -926,8 +1232,7 @@ class Decoder(TrainedNetwork):
           grid_out_np = self.session.run(
               grid,
               feed_dict={
-                  self.sif_input: sif_vector,
-                  self.sample_locations_ph: sample_locations
+                  **shape_feed, self.sample_locations_ph: sample_locations
               })
           i += 1
           w_block.append(grid_out_np)
@@ -945,49 +1250,348 @@ class Decoder(TrainedNetwork):
                    resolution=128,
                    extent=0.75,
                    return_success=False,
-                   world2local=None):
-    """Extracts a mesh that is the sum of one or more SIF meshes."""
+                   world2local=None,
+                   coarse_resolution=None,
+                   block_resolution=None):
+    """Extracts a mesh that is the sum of one or more SIF meshes.
+
+    Args:
+      sif_vectors: A numpy array with a (D)SIF (or the output of bind()), or a
+        list of them. A numpy array with shape (shape_count, element_count,
+        element_length) is instead treated as a stack of separate shapes, which
+        are evaluated in batches of decode_batch_size.
+      resolution: Int. The marching cubes resolution.
+      extent: Float. The volume covers [-extent, extent]^3.
+      return_success: Boolean. Whether to also return whether marching cubes
+        found a surface.
+      world2local: A 4x4 numpy array (or a list of them, if sif_vectors is a
+        list or stack) applied to the grid locations before evaluation.
+      coarse_resolution: Int or None. If provided, the grid is evaluated coarse
+        to fine starting at this resolution, and only refined near the surface
+        (see adaptive_grid.py). Not supported by the CUDA kernel.
+      block_resolution: Int or None. If provided, the volume is evaluated and
+        meshed in blocks of this many voxels per side, so the full volume is
+        never in memory. Not supported by the CUDA kernel, and can't be
+        combined with coarse_resolution.
+
+    Returns:
+      A trimesh.Trimesh, and a boolean if return_success is true. For a stack,
+      a list of them, one per shape.
+    """
     extract_start_time = time.time()
+    is_stack = self._is_stack(sif_vectors)
+    if block_resolution is not None and self.use_inference_kernel == 'cuda':
+      log.warning('Streaming extraction is not supported with the CUDA kernel,'
+                  ' evaluating the full grid.')
+      block_resolution = None
+    if block_resolution is not None:
+      if coarse_resolution is not None:
+        raise ValueError('Streaming and adaptive grid evaluation can not be'
+                         ' combined.')
+      # Groups of shapes whose values are summed into one mesh:
+      if is_stack or isinstance(sif_vectors, list):
+        if world2local is None:
+          world2local = [None] * len(sif_vectors)
+        if is_stack:
+          groups = [[v] for v in sif_vectors]
+          group_world2local = [[m] for m in world2local]
+        else:
+          groups = [sif_vectors]
+          group_world2local = [world2local]
+      else:
+        groups = [[sif_vectors]]
+        group_world2local = [[world2local]]
+      extracted = [
+          self._streaming_marching_cubes(shapes, shape_world2local, resolution,
+                                         extent, block_resolution)
+          for shapes, shape_world2local in zip(groups, group_world2local)
+      ]
+      log.verbose('Streaming extraction time:'
+                  f' {time.time() - extract_start_time}')
+    else:
+      volumes = self._extract_volumes(sif_vectors, resolution, extent,
+                                      world2local, coarse_resolution)
+      grid_out_time = time.time()
+      log.verbose(f'Grid eval time: {grid_out_time - extract_start_time}')
+      # The dense cpu grids are centered, unless they are refined adaptively:
+      centered_grid = (
+          self.symmetric_grid and coarse_resolution is None and
+          self.use_inference_kernel in ['cpu', 'cpu_worker'])
+      extracted = [
+          extract_mesh.marching_cubes(
+              volume, extent, centered_grid=centered_grid)
+          for volume in volumes
+      ]
+      log.verbose(f'MCubes Time: {time.time() - grid_out_time}')
+    results = []
+    for had_crossing, mesh in extracted:
+      if not had_crossing:
+        log.warning('Warning: Marching Cubes found no surface.')
+      mesh.marching_cubes_successful = had_crossing
+      results.append((mesh, had_crossing) if return_success else mesh)
+    if is_stack:
+      return results
+    return results[0]
+
+  def _extract_volumes(self, sif_vectors, resolution, extent, world2local,
+                       coarse_resolution):
+    """Evaluates the volumes to mesh for extract_mesh()."""
+    if self._is_stack(sif_vectors):
+      return self._grid_eval_stack(sif_vectors, resolution, extent,
+                                   world2local, coarse_resolution)
     if isinstance(sif_vectors, list):
-      volumes = []
       if world2local is not None:
         assert isinstance(world2local, list)
+      # The sum is refined as a whole. Refining each term around its own
+      # surface would fill the blocks away from it with constants, which are
+      # wrong near the surface of the sum:
+      if coarse_resolution is not None and self.use_inference_kernel != 'cuda':
+        return [
+            self._adaptive_grid_eval(sif_vectors, resolution, extent,
+                                     coarse_resolution, world2local)
+        ]
+      # Summed as they are evaluated, before the next overwrites a worker grid:
+      volume = np.zeros([resolution, resolution, resolution], dtype=np.float32)
       for i, v in enumerate(sif_vectors):
-        volumes.append(
-            self._grid_eval(
-                v,
-                resolution,
-                extent,
-                extract_parts=False,
-                world2local=world2local[i]
-                if world2local is not None else None))
-      volume = np.sum(volumes, axis=0)
-    else:
-      volume = self._grid_eval(
-          sif_vectors,
-          resolution,
-          extent,
-          extract_parts=False,
-          world2local=world2local)
+        volume += self._grid_eval(
+            v,
+            resolution,
+            extent,
+            extract_parts=False,
+            world2local=world2local[i] if world2local is not None else None,
+            coarse_resolution=coarse_resolution,
+            borrow=True)
+      return [volume]
+    return [
+        self._grid_eval(
+            sif_vectors,
+            resolution,
+            extent,
+            extract_parts=False,
+            world2local=world2local,
+            coarse_resolution=coarse_resolution)
+    ]
+
+  def _streaming_marching_cubes(self, sif_vectors, world2local, resolution,
+                                extent, block_resolution):
+    """Meshes the sum of some (D)SIFs block by block.
+
+    Args:
+      sif_vectors: A list of (D)SIFs or bound shapes.
+      world2local: A list with a 4x4 numpy array or None for each (D)SIF.
+      resolution: Int. The marching cubes resolution.
+      extent: Float. The volume covers [-extent, extent]^3.
+      block_resolution: Int. The number of voxels along each side of a block.
+
+    Returns:
+      A tuple (had_crossing, mesh), like extract_mesh.marching_cubes().
+    """
+    bound_shapes = [self._bound(v) for v in sif_vectors]
+    axis = cpu_kernel.grid_axis(resolution, extent)
+
+    def block_fn(z_start, z_end, y_start, y_end, x_start, x_end):
+      zz, yy, xx = np.meshgrid(
+          axis[z_start:z_end],
+          axis[y_start:y_end],
+          axis[x_start:x_end],
+          indexing='ij')
+      samples = np.reshape(np.stack([xx, yy, zz], axis=-1), [-1, 3])
+      block = np.zeros(samples.shape[0], dtype=np.float32)
+      for bound, tx in zip(bound_shapes, world2local):
+        shape_samples = samples
+        if tx is not None:
+          shape_samples = geom_util_np.apply_4x4(samples, tx, are_points=True)
+        block += self._alg_at_samples(bound, shape_samples)
+      return np.reshape(block, zz.shape)
+
+    return extract_mesh.streaming_marching_cubes(
+        block_fn, resolution, extent, block_resolution=block_resolution)
+
+  def extract_scene_mesh(self,
+                         sif_vectors,
+                         world2local,
+                         resolution=128,
+                         extent=0.75,
+                         influence_threshold=1e-4,
+                         return_success=False):
+    """Extracts a mesh of a scene composed of many posed (D)SIFs.
+
+    The result is the same as extract_mesh(sif_vectors, world2local=...) up to
+    the influence threshold, but each object is only evaluated on the voxels
+    inside its world space bounds, and accumulated into one shared volume. So
+    the cost scales with the occupied space instead of with the object count.
+
+    Args:
+      sif_vectors: A list of (D)SIFs, or of the outputs of bind().
+      world2local: A list of 4x4 numpy arrays, one per object, that map from the
+        scene to the frame of the object.
+      resolution: Int. The marching cubes resolution.
+      extent: Float. The volume covers [-extent, extent]^3.
+      influence_threshold: Float. An object's bounds are where the RBF weight
+        of any of its elements exceeds this.
+      return_success: Boolean. Whether to also return whether marching cubes
+        found a surface.
+
+    Returns:
+      A trimesh.Trimesh, and a boolean if return_success is true.
+    """
+    t = time.time()
+    volume, evaluated_count = self._scene_volume(sif_vectors, world2local,
+                                                 resolution, extent,
+                                                 influence_threshold)
     grid_out_time = time.time()
-    log.verbose(f'Grid eval time: {grid_out_time - extract_start_time}')
+    log.verbose(f'Scene grid eval time: {grid_out_time - t}. Evaluated'
+                f' {evaluated_count} samples for {len(sif_vectors)} objects'
+                f' ({evaluated_count / resolution**3:.2f} grids).')
     had_crossing, mesh = extract_mesh.marching_cubes(volume, extent)
+    log.verbose(f'MCubes Time: {time.time() - grid_out_time}')
     if not had_crossing:
       log.warning('Warning: Marching Cubes found no surface.')
     mesh.marching_cubes_successful = had_crossing
-    done_time = time.time()
-    log.verbose(f'MCubes Time: {done_time - grid_out_time}')
     if return_success:
       return mesh, had_crossing
     return mesh
 
-  def extract_part_meshes(self, sif_vector, resolution, extent=0.75):
-    elt_volume = self._grid_eval(
-        sif_vector, resolution, extent, extract_parts=True, world2local=None)
-    local_meshes = []
-    for i in range(self.job.model_config.hparams.sc):
-      had_crossing, mesh_i = extract_mesh.marching_cubes(
+  def _scene_volume(self, sif_vectors, world2local, resolution, extent,
+                    influence_threshold):
+    """Accumulates posed (D)SIFs into one volume, each inside its bounds.
+
+    Returns:
+      A tuple (volume, evaluated_count). volume is a numpy array with shape
+      [resolution, resolution, resolution], and evaluated_count the total
+      number of samples the objects were evaluated at.
+    """
+    axis = cpu_kernel.grid_axis(resolution, extent)
+    volume = np.zeros([resolution, resolution, resolution], dtype=np.float32)
+    evaluated_count = 0
+    for sif_vector, tx in zip(sif_vectors, world2local):
+      bound = self._bound(sif_vector)
+      local_bounds = self.cpu_kernel.support_bounds(bound.cpu_shape,
+                                                    influence_threshold)
+      if local_bounds is None:
+        continue
+      # The world space box around the corners of the local space box:
+      corners = np.stack(
+          np.meshgrid(*zip(*local_bounds), indexing='ij'), axis=-1)
+      corners = geom_util_np.apply_4x4(
+          np.reshape(corners, [8, 3]), np.linalg.inv(tx), are_points=True)
+      x0, y0, z0 = np.searchsorted(axis, np.min(corners, axis=0), side='left')
+      x1, y1, z1 = np.searchsorted(axis, np.max(corners, axis=0), side='right')
+      if z0 >= z1 or y0 >= y1 or x0 >= x1:
+        continue
+      # Slabs of about a million samples, to bound the memory use:
+      slab_depth = max(1, 2**20 // ((y1 - y0) * (x1 - x0)))
+      for z_start in range(z0, z1, slab_depth):
+        z_end = min(z_start + slab_depth, z1)
+        zz, yy, xx = np.meshgrid(
+            axis[z_start:z_end], axis[y0:y1], axis[x0:x1], indexing='ij')
+        samples = np.reshape(np.stack([xx, yy, zz], axis=-1), [-1, 3])
+        samples = geom_util_np.apply_4x4(samples, tx, are_points=True)
+        volume[z_start:z_end, y0:y1, x0:x1] += np.reshape(
+            self._alg_at_samples(bound, samples), zz.shape)
+        evaluated_count += samples.shape[0]
+    return volume, evaluated_count
+
+  def _grid_eval_stack(self, sif_vectors, resolution, extent, world2local,
+                       coarse_resolution):
+    """Evaluates a stack of LDIFs/SIFs, each on its own grid."""
+    shape_count = sif_vectors.shape[0]
+    if world2local is None:
+      world2local = [None] * shape_count
+    # Only the tensorflow backend has per-call overhead worth batching away:
+    if self.use_inference_kernel or coarse_resolution is not None:
+      return [
+          self._grid_eval(
+              sif_vectors[i],
+              resolution,
+              extent,
+              extract_parts=False,
+              world2local=world2local[i],
+              coarse_resolution=coarse_resolution)
+          for i in range(shape_count)
+      ]
+    log.verbose(f'Evaluating {shape_count} SDF grids in batches of'
+                f' {self.decode_batch_size}.')
+    t = time.time()
+    axis = cpu_kernel.grid_axis(resolution, extent)
+    zz, yy, xx = np.meshgrid(axis, axis, axis, indexing='ij')
+    samples = np.reshape(np.stack([xx, yy, zz], axis=-1), [-1, 3])
+    if any(m is not None for m in world2local):
+      samples = np.stack([
+          samples if m is None else geom_util_np.apply_4x4(
+              samples, m, are_points=True) for m in world2local
+      ])
+    volumes = self._batched_sample_eval(
+        sif_vectors, samples, apply_class_transfer=False)
+    log.verbose(f'Grid Eval Time: {time.time() - t}')
+    return list(np.reshape(volumes, [shape_count] + [resolution] * 3))
+
+  def extract_part_meshes(self,
+                          sif_vector,
+                          resolution,
+                          extent=0.75,
+                          influence_threshold=1e-4,
+                          part_resolution=None):
+    """Extracts a mesh of the contribution of each shape element.
+
+    With any inference kernel, each element is only evaluated inside its
+    support box, and the parts are meshed in parallel threads. That includes
+    the CUDA kernel, because ldif2mesh only evaluates whole (D)SIFs, so the
+    parts are always evaluated with the numpy cpu kernel. With pure tensorflow,
+    every element is evaluated on the full grid.
+
+    Args:
+      sif_vector: A numpy array with a (D)SIF, or the output of bind().
+      resolution: Int. The marching cubes resolution of the full grid.
+      extent: Float. The full grid covers [-extent, extent]^3.
+      influence_threshold: Float. An element's support box is where its RBF
+        weight exceeds this. Not used with pure tensorflow.
+      part_resolution: Int or None. If None, each element is evaluated on the
+        voxels of the full grid inside its support box. Otherwise on a grid of
+        its own with this many samples along the longest side of the box, so
+        every part has the same level of detail whatever its size. See
+        CpuKernel.element_grid_eval(). Not used with pure tensorflow.
+
+    Returns:
+      A list with a trimesh.Trimesh for each (unreflected) element.
+    """
+    part_count = self.job.model_config.hparams.sc
+    if not self.use_inference_kernel:
+      elt_volume = self._grid_eval(
+          sif_vector, resolution, extent, extract_parts=True, world2local=None)
+      extract_part = lambda i: extract_mesh.marching_cubes(
           elt_volume[i, ...], extent)
+    else:
+      kernel = self.cpu_kernel
+      cpu_shape = self._bound(sif_vector).cpu_shape
+
+      def extract_part(i):
+        start, voxel_size, volume = kernel.element_grid_eval(
+            cpu_shape,
+            i,
+            resolution,
+            extent,
+            influence_threshold,
+            part_resolution=part_resolution)
+        if volume is None:
+          log.warning(f'The support of element {i} is outside of the grid.'
+                      ' Setting to unit sphere.')
+          return False, trimesh.primitives.Sphere(radius=0.5)
+        return extract_mesh.marching_cubes_in_box(
+            volume,
+            start,
+            resolution,
+            extent,
+            voxel_size=voxel_size,
+            centered_grid=kernel.centered_grid)
+
+    t = time.time()
+    thread_count = os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(thread_count) as executor:
+      parts = list(executor.map(extract_part, range(part_count)))
+    log.verbose(f'Part extraction time: {time.time() - t}')
+    local_meshes = []
+    for had_crossing, mesh_i in parts:
       mesh_i.marching_cubes_successful = had_crossing
       local_meshes.append(mesh_i)
     return local_meshes
@@ -1015,7 +1619,79 @@ class Decoder(TrainedNetwork):
       out.append(out_i)
     return np.concatenate(out, axis=0)[:point_count, :]
 
+  def _is_stack(self, sif_vectors):
+    return isinstance(sif_vectors, np.ndarray) and len(sif_vectors.shape) == 3
+
+  def _batched_sample_eval(self, sif_vectors, samples, apply_class_transfer):
+    """Evaluates a stack of shapes, decode_batch_size shapes per session call.
+
+    Args:
+      sif_vectors: A numpy array with shape (shape_count, element_count,
+        element_length).
+      samples: A numpy array with shape (sample_count, 3), shared by all shapes,
+        or (shape_count, sample_count, 3).
+      apply_class_transfer: Boolean. Whether to return the class (as in
+        class_at_samples) rather than the algebraic value (as in _grid_eval).
+
+    Returns:
+      A numpy array with shape (shape_count, sample_count).
+    """
+    shape_count = sif_vectors.shape[0]
+    if len(samples.shape) == 2:
+      samples = np.broadcast_to(samples, [shape_count] + list(samples.shape))
+    sample_count = samples.shape[1]
+    batch_size = self.decode_batch_size
+    chunk_size = self.batched_point_count
+    output = (
+        self.batched_predicted_class
+        if apply_class_transfer else self.batched_predicted_alg)
+    out = np.zeros([shape_count, sample_count], dtype=np.float32)
+    for shape_start in range(0, shape_count, batch_size):
+      shape_end = min(shape_start + batch_size, shape_count)
+      # The last batch is padded with copies of its last shape:
+      pad_shapes = ((0, batch_size - (shape_end - shape_start)), (0, 0), (0, 0))
+      sif_batch = np.pad(
+          np.reshape(sif_vectors[shape_start:shape_end],
+                     [-1] + self.unbatched_vector_shape),
+          pad_shapes,
+          mode='edge')
+      for sample_start in range(0, sample_count, chunk_size):
+        sample_end = min(sample_start + chunk_size, sample_count)
+        sample_batch = samples[shape_start:shape_end, sample_start:sample_end]
+        sample_batch = np.pad(
+            sample_batch,
+            (pad_shapes[0], (0, chunk_size - (sample_end - sample_start)),
+             (0, 0)),
+            mode='constant')
+        out_np = self.session.run(
+            output,
+            feed_dict={
+                self.batched_sif_input: sif_batch,
+                self.batched_sample_locations_ph: sample_batch
+            })
+        out[shape_start:shape_end, sample_start:sample_end] = (
+            out_np[:shape_end - shape_start, :sample_end - sample_start])
+    return out
+
   def iou(self, sif_vector, example):
+    """Computes the IoU of a (D)SIF with an example, or of a stack of them.
+
+    Args:
+      sif_vector: A numpy array with shape (element_count, element_length), or
+        (shape_count, element_count, element_length).
+      example: An InferenceExample, or a list of shape_count of them if
+        sif_vector is a stack.
+
+    Returns:
+      The IoU, or a list with one IoU per shape if sif_vector is a stack.
+    """
+    if self._is_stack(sif_vector):
+      samps = np.stack([e.uniform_samples[:, :3] for e in example])
+      pred_is_inside = self.class_at_samples(sif_vector, samps) < 0.5
+      return [
+          metrics.point_iou(pred_is_inside[i], e.uniform_samples[:, 3:4] < 0.0)
+          for i, e in enumerate(example)
+      ]
     samps = example.uniform_samples[:, :3]
     gt_is_inside = example.uniform_samples[:, 3:4] < 0.0
     pred_is_inside = self.class_at_samples(sif_vector, samps) < 0.5
@@ -1027,15 +1703,24 @@ class Decoder(TrainedNetwork):
 
     Args:
       sif_vector: A numpy array containing the LDIF/SIF to evaluate. Has shape
-        (element_count, element_length).
+        (element_count, element_length), or (shape_count, element_count,
+        element_length) to evaluate a stack of shapes in batches of
+        decode_batch_size. May also be the output of bind().
       samples: A numpy array containing samples in the LDIF/SIF frame. Has shape
-        (sample_count, 3).
+        (sample_count, 3). For a stack of shapes, it may also have shape
+        (shape_count, sample_count, 3), with different samples per shape.
 
     Returns:
-      A numpy array with shape (sample_count, 1). A float that is positive
-      outside the LDIF/SIF, and negative inside.
+      A numpy array with shape (sample_count, 1), or (shape_count,
+      sample_count, 1) for a stack. A float that is positive outside the
+      LDIF/SIF, and negative inside.
     """
-    sif_vector = np.reshape(sif_vector, self.batched_vector_shape)
+    if self._is_stack(sif_vector):
+      return np.expand_dims(
+          self._batched_sample_eval(
+              sif_vector, samples, apply_class_transfer=True),
+          axis=-1)
+    shape_feed = self._bound(sif_vector).shape_feed
 
     def query(sample_chunk):
       chunk_grid = sample_chunk.reshape(
@@ -1043,8 +1728,7 @@ class Decoder(TrainedNetwork):
       classes = self.session.run(
           self.predicted_class_grid,
           feed_dict={
-              self.sif_input: sif_vector,
-              self.sample_locations_ph: chunk_grid
+              **shape_feed, self.sample_locations_ph: chunk_grid
           })
       classes = classes.reshape([self.block_res**3, 1])
       return classes
@@ -0,0 +1,345 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.inference.predict."""
+
+import collections
+import os
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from tensorflow.python.platform import googletest
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.inference import cpu_kernel
+from ldif.inference import cpu_kernel_test
+from ldif.inference import experiment
+from ldif.inference import extract_mesh
+from ldif.inference import predict
+from ldif.model import hparams
+# pylint: enable=g-bad-import-order
+
+
+class NumpyDecoder(predict.Decoder):
+  """A Decoder without a network, that evaluates shapes with a CpuKernel.
+
+  It is not restored from a checkpoint. Its session maps the placeholders and
+  outputs of the decoder graph, which are names here, to the kernel's values,
+  so the tensorflow code paths of Decoder run on top of the numpy kernel.
+  """
+
+  def __init__(self, kernel, inference_kernel='cpu', decode_batch_size=2):  # pylint: disable=super-init-not-called
+    self._use_inference_kernel = 'cuda'
+    self._cpu_kernel = kernel
+    self._grid_eval_worker = None
+    self._influence_threshold = 0.0
+    self._symmetric_grid = False
+    self.use_inference_kernel = inference_kernel
+    self.block_res = 8
+    self.native_point_count = self.block_res**3
+    self.base_grid = predict.np_util.make_coordinate_grid_3d(
+        length=self.block_res,
+        height=self.block_res,
+        width=self.block_res,
+        is_screen_space=False,
+        is_homogeneous=False).astype(np.float32)
+    self._set_decode_batch_size(decode_batch_size)
+    self.sif_input = 'sif_input'
+    self.sample_locations_ph = 'sample_locations'
+    self.predicted_alg_grid = 'predicted_alg_grid'
+    self.predicted_class_grid = 'predicted_class_grid'
+    self.batched_sif_input = 'batched_sif_input'
+    self.batched_sample_locations_ph = 'batched_sample_locations'
+    self.batched_predicted_alg = 'batched_predicted_alg'
+    self.batched_predicted_class = 'batched_predicted_class'
+    self._shape_only_tensors = []
+    self.session = self
+    self.run_counts = collections.Counter()
+
+  @property
+  def unbatched_vector_shape(self):
+    return [cpu_kernel_test.ELEMENT_COUNT, 10 + cpu_kernel_test.DIM]
+
+  def run(self, fetches, feed_dict):
+    """Evaluates the decoder graph outputs, like a tf.Session would."""
+    if not fetches:
+      return []
+    self.run_counts[fetches] += 1
+    if fetches in [self.predicted_alg_grid, self.predicted_class_grid]:
+      sif_vectors = feed_dict[self.sif_input]
+      samples = feed_dict[self.sample_locations_ph][np.newaxis, ...]
+    else:
+      sif_vectors = feed_dict[self.batched_sif_input]
+      samples = feed_dict[self.batched_sample_locations_ph]
+    values = np.stack([
+        self._cpu_kernel.eval_at_samples(v, np.reshape(s, [-1, 3]))
+        for v, s in zip(sif_vectors, samples)
+    ])
+    if fetches in [self.predicted_class_grid, self.batched_predicted_class]:
+      # A stand-in for sdf_util.apply_class_transfer():
+      values = 0.5 + 0.5 * np.tanh(50.0 * (values - extract_mesh.ISO_LEVEL))
+    if fetches in [self.predicted_alg_grid, self.predicted_class_grid]:
+      return np.reshape(values, samples.shape[1:-1])
+    return np.reshape(values, samples.shape[:-1])
+
+
+def crossing_voxels(inside):
+  """Whether each voxel has a neighbor on the other side of the surface."""
+  crossing = np.zeros(inside.shape, dtype=bool)
+  for axis in range(3):
+    flips = np.diff(inside, axis=axis)
+    lower = [slice(None)] * 3
+    upper = [slice(None)] * 3
+    lower[axis] = slice(None, -1)
+    upper[axis] = slice(1, None)
+    crossing[tuple(lower)] |= flips
+    crossing[tuple(upper)] |= flips
+  return crossing
+
+
+class DecoderTest(googletest.TestCase):
+
+  def setUp(self):
+    super(DecoderTest, self).setUp()
+    rng = np.random.RandomState(0)
+    occnet_path = os.path.join(tempfile.mkdtemp(), 'test.occnet')
+    cpu_kernel_test.write_occnet(
+        cpu_kernel_test.random_occnet_weights(rng), occnet_path)
+    self.kernel = cpu_kernel.CpuKernel(
+        cpu_kernel.OccNet.from_file(occnet_path),
+        symmetry_count=cpu_kernel_test.SYMMETRY_COUNT,
+        thread_count=2)
+    self.sif_vectors = [cpu_kernel_test.random_ldif(rng) for _ in range(3)]
+    self.decoder = NumpyDecoder(self.kernel)
+
+  def test_adaptive_list_matches_dense(self):
+    world2local = [np.eye(4, dtype=np.float32) for _ in range(2)]
+    world2local[1][:3, 3] = [0.2, 0.1, 0.0]
+    dense, = self.decoder._extract_volumes(
+        self.sif_vectors[:2], 32, 0.75, world2local, coarse_resolution=None)
+    adaptive, = self.decoder._extract_volumes(
+        self.sif_vectors[:2], 32, 0.75, world2local, coarse_resolution=8)
+    inside = dense < extract_mesh.ISO_LEVEL
+    self.assertTrue(np.any(inside))
+    self.assertFalse(np.all(inside))
+    # So marching cubes finds the same surface:
+    np.testing.assert_array_equal(adaptive < extract_mesh.ISO_LEVEL, inside)
+    crossing = crossing_voxels(inside)
+    np.testing.assert_allclose(
+        adaptive[crossing], dense[crossing], rtol=1e-5, atol=1e-6)
+
+  def test_worker_grows_and_its_grids_are_not_aliased(self):
+    decoder = NumpyDecoder(self.kernel, inference_kernel='cpu_worker')
+    self.addCleanup(decoder.close_grid_eval_worker)
+    expected = [self.kernel.grid_eval(v, 8, 0.75) for v in self.sif_vectors]
+    for resolution in [8, 16]:
+      grid = decoder._grid_eval(
+          self.sif_vectors[0], resolution, 0.75, extract_parts=False)
+      np.testing.assert_array_equal(
+          grid, self.kernel.grid_eval(self.sif_vectors[0], resolution, 0.75))
+    self.assertEqual(decoder._grid_eval_worker.max_resolution, 16)
+    summed, = decoder._extract_volumes(
+        self.sif_vectors[:2], 8, 0.75, None, coarse_resolution=None)
+    np.testing.assert_allclose(
+        summed, expected[0] + expected[1], rtol=1e-6, atol=1e-6)
+    volumes = decoder._extract_volumes(
+        np.stack(self.sif_vectors), 8, 0.75, None, coarse_resolution=None)
+    for volume, expected_volume in zip(volumes, expected):
+      np.testing.assert_array_equal(volume, expected_volume)
+
+  def test_symmetric_grid_keeps_the_mesh_in_place(self):
+    default = self.decoder.extract_mesh(self.sif_vectors[0], resolution=32)
+    self.decoder.symmetric_grid = True
+    self.assertTrue(self.kernel.centered_grid)
+    centered = self.decoder.extract_mesh(self.sif_vectors[0], resolution=32)
+    # Much closer than the 0.5 / resolution = 0.016 that the grids are apart:
+    np.testing.assert_allclose(centered.bounds, default.bounds, atol=8e-3)
+    np.testing.assert_allclose(
+        centered.center_mass, default.center_mass, atol=1e-3)
+
+  def posed_world2local(self, position, angle):
+    """Places an object at a position, rotated about y and at half size."""
+    cos, sin = np.cos(angle), np.sin(angle)
+    rotation = np.array([[cos, 0.0, sin], [0.0, 1.0, 0.0], [-sin, 0.0, cos]])
+    world2local = np.eye(4, dtype=np.float32)
+    world2local[:3, :3] = 2.0 * rotation
+    world2local[:3, 3] = -2.0 * np.matmul(rotation, position)
+    return world2local
+
+  def test_scene_volume_matches_dense_sum(self):
+    world2local = [
+        self.posed_world2local([-0.35, 0.0, 0.1], 0.0),
+        self.posed_world2local([0.3, 0.2, -0.2], np.pi / 3),
+    ]
+    volume, evaluated_count = self.decoder._scene_volume(
+        self.sif_vectors[:2], world2local, 32, 0.75, influence_threshold=1e-6)
+    dense = sum(
+        self.kernel.grid_eval(v, 32, 0.75, world2local=m)
+        for v, m in zip(self.sif_vectors[:2], world2local))
+    inside = dense < extract_mesh.ISO_LEVEL
+    self.assertTrue(np.any(inside))
+    np.testing.assert_array_equal(volume < extract_mesh.ISO_LEVEL, inside)
+    np.testing.assert_allclose(volume, dense, atol=1e-3)
+    # Each object is only evaluated over its part of the grid:
+    self.assertGreater(evaluated_count, 0)
+    self.assertLess(evaluated_count, 32**3)
+
+  def test_empty_scene(self):
+    culled = np.copy(self.sif_vectors[0])
+    culled[:, 0] = 0.0
+    world2local = [
+        np.eye(4, dtype=np.float32),
+        self.posed_world2local([5.0, 0.0, 0.0], 0.0),
+    ]
+    volume, evaluated_count = self.decoder._scene_volume(
+        [culled, self.sif_vectors[1]], world2local, 16, 0.75, 1e-4)
+    self.assertEqual(evaluated_count, 0)
+    self.assertFalse(np.any(volume))
+    _, had_crossing = self.decoder.extract_scene_mesh(
+        [culled, self.sif_vectors[1]],
+        world2local,
+        resolution=16,
+        return_success=True)
+    self.assertFalse(had_crossing)
+
+
+class BatchedDecoderTest(googletest.TestCase):
+
+  def setUp(self):
+    super(BatchedDecoderTest, self).setUp()
+    rng = np.random.RandomState(1)
+    occnet_path = os.path.join(tempfile.mkdtemp(), 'test.occnet')
+    cpu_kernel_test.write_occnet(
+        cpu_kernel_test.random_occnet_weights(rng), occnet_path)
+    self.kernel = cpu_kernel.CpuKernel(
+        cpu_kernel.OccNet.from_file(occnet_path),
+        symmetry_count=cpu_kernel_test.SYMMETRY_COUNT,
+        thread_count=2)
+    self.sif_vectors = np.stack(
+        [cpu_kernel_test.random_ldif(rng) for _ in range(3)])
+    self.samples = rng.uniform(-0.75, 0.75, size=[3, 200, 3])
+    # Pure tensorflow, which evaluates stacks in batches:
+    self.decoder = NumpyDecoder(
+        self.kernel, inference_kernel='tf', decode_batch_size=2)
+
+  def test_batched_class_matches_per_shape(self):
+    batched = self.decoder.class_at_samples(self.sif_vectors, self.samples[0])
+    self.assertEqual(batched.shape, (3, 200, 1))
+    for i, sif_vector in enumerate(self.sif_vectors):
+      np.testing.assert_allclose(
+          batched[i],
+          self.decoder.class_at_samples(sif_vector, self.samples[0]),
+          rtol=1e-5,
+          atol=1e-6)
+    # Two batches of shapes, the second padded, each in one call:
+    self.assertEqual(
+        self.decoder.run_counts[self.decoder.batched_predicted_class], 2)
+
+  def test_batched_class_with_per_shape_samples(self):
+    batched = self.decoder.class_at_samples(self.sif_vectors, self.samples)
+    for i, sif_vector in enumerate(self.sif_vectors):
+      np.testing.assert_allclose(
+          batched[i],
+          self.decoder.class_at_samples(sif_vector, self.samples[i]),
+          rtol=1e-5,
+          atol=1e-6)
+
+  def test_batched_volumes_match_per_shape(self):
+    world2local = [None, np.eye(4, dtype=np.float32), None]
+    world2local[1][:3, 3] = [0.1, -0.05, 0.2]
+    volumes = self.decoder._extract_volumes(
+        self.sif_vectors, 16, 0.75, world2local, coarse_resolution=None)
+    self.assertLen(volumes, 3)
+    for i, volume in enumerate(volumes):
+      np.testing.assert_allclose(
+          volume,
+          self.kernel.grid_eval(
+              self.sif_vectors[i], 16, 0.75, world2local=world2local[i]),
+          rtol=1e-5,
+          atol=1e-6)
+    # Without world2local, the tensorflow path of a single shape agrees:
+    np.testing.assert_allclose(
+        volumes[0],
+        self.decoder._grid_eval(
+            self.sif_vectors[0], 16, 0.75, extract_parts=False),
+        rtol=1e-5,
+        atol=1e-6)
+
+  def test_rejects_bad_decode_batch_size(self):
+    with self.assertRaisesRegex(ValueError, 'decode batch size'):
+      NumpyDecoder(self.kernel, decode_batch_size=0)
+    with self.assertRaisesRegex(ValueError, 'decode batch size'):
+      NumpyDecoder(self.kernel, decode_batch_size=8**3 + 1)
+
+
+class RandomlyInitializedDecoder(predict.Decoder):
+  """A Decoder whose network weights are random instead of restored."""
+
+  def restore(self):
+    with self.graph.as_default():
+      self.session = tf.Session()
+      self.session.run(tf.global_variables_initializer())
+
+
+class DecoderGraphTest(tf.test.TestCase):
+  """Runs the tensorflow graphs of a Decoder."""
+
+  def setUp(self):
+    super(DecoderGraphTest, self).setUp()
+    model_config = experiment.ModelConfig(hparams.build_ldif_hparams())
+    model_config.hparams.sc = cpu_kernel_test.ELEMENT_COUNT
+    model_config.hparams.lyr = cpu_kernel_test.SYMMETRY_COUNT
+    job = collections.namedtuple('Job', ['model_config'])(model_config)
+    self.decoder = RandomlyInitializedDecoder(
+        job, ckpt=None, use_gpu=False, decode_batch_size=3)
+    rng = np.random.RandomState(2)
+    # Two batches of shapes, the second padded with two copies of the last:
+    self.sif_vectors = np.stack(
+        [cpu_kernel_test.random_ldif(rng) for _ in range(4)])
+    # Two chunks of samples per batch, the second padded:
+    sample_count = self.decoder.batched_point_count + 100
+    self.samples = rng.uniform(
+        -0.75, 0.75, size=[4, sample_count, 3]).astype(np.float32)
+
+  def tearDown(self):
+    self.decoder.session.close()
+    super(DecoderGraphTest, self).tearDown()
+
+  def test_batched_class_matches_per_shape(self):
+    batched = self.decoder.class_at_samples(self.sif_vectors, self.samples)
+    self.assertEqual(batched.shape, self.samples.shape[:2] + (1,))
+    for i, sif_vector in enumerate(self.sif_vectors):
+      single = self.decoder.class_at_samples(sif_vector, self.samples[i])
+      # The random weights make large values, which the batched graph sums in
+      # another order. Near the surface the class is steep in them:
+      self.assertAllClose(batched[i], single, rtol=1e-3, atol=5e-3)
+    # The shapes differ, so a mixed up batch wouldn't match:
+    self.assertNotAllClose(batched[0], batched[1])
+
+  def test_batched_alg_matches_per_shape(self):
+    batched = self.decoder._batched_sample_eval(
+        self.sif_vectors, self.samples[0], apply_class_transfer=False)
+    for i, sif_vector in enumerate(self.sif_vectors):
+      single = self.decoder._alg_at_samples(sif_vector, self.samples[0])
+      # The randomly initialized values span several orders of magnitude, so
+      # small values near cancellations carry float32 error of the large ones:
+      atol = 1e-6 * np.max(np.abs(single))
+      self.assertAllClose(batched[i], single, rtol=1e-3, atol=atol)
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -15,11 +15,18 @@
 #include <cuda.h>
 #include <cuda_profiler_api.h>
 #include <cuda_runtime.h>
+#include <fcntl.h>
 #include <math.h>
+#include <stdint.h>
+#include <sys/mman.h>
+#include <unistd.h>
 
+#include <algorithm>
 #include <chrono>  // NOLINT(build/c++11)
 #include <fstream>
 #include <iostream>
+#include <memory>
+#include <string>
 #include <vector>
 
 // Final value is in first element of array.
@@ -489,7 +496,10 @@ void OccNet::LoadFile(const std::string& path_to_occnet) {
 class LDIF {
  public:
   explicit LDIF(const std::string& path_to_ldif);
+  LDIF(int num_blobs, int len_implicits);
   void LoadFile(const std::string& path_to_ldif);
+  void SetFromVector(const float* sif_vector, int element_length,
+                     int symmetry_count);
   void LoadOccNet(const std::string& path_to_occnet) {
     assert(this->len_implicits > 0);
     assert(this->num_blobs > 0);  // Should not load occnet before loading LDIF?
@@ -530,6 +540,7 @@ class LDIF {
 
   OccNet occnet;
 
+  void Allocate(int num_blobs, int len_implicits);
   void BuildRotation(int index);
   __device__ __host__ void BuildRollPitchYaw(const float rotation[3],
                                              float* output) const;
@@ -604,6 +615,10 @@ __device__ __host__ void LDIF::World2Local(const float* position,
 
 LDIF::LDIF(const std::string& path_to_ldif) { this->LoadFile(path_to_ldif); }
 
+LDIF::LDIF(int num_blobs, int len_implicits) {
+  this->Allocate(num_blobs, len_implicits);
+}
+
 __device__ __host__ void LDIF::BuildRollPitchYaw(const float rotation[3],
                                                  float* output) const {
   float c[3];
@@ -783,6 +798,19 @@ __device__ __host__ void LDIF::AssignMemory(void* supplied) {
   this->occnet.AssignMemory(reinterpret_cast<void*>(base));
 }
 
+void LDIF::Allocate(int num_blobs, int len_implicits) {
+  assert(num_blobs >= 0);
+  assert(len_implicits >= 0);
+  this->num_blobs = num_blobs;
+  this->len_implicits = len_implicits;
+  this->symmetry_count = 0;
+  this->occnet.Initialize(this->len_implicits, this->num_blobs);
+  // We have now initialized the object, DynamicSize+AssignMemory are fair game.
+  int size_to_malloc = this->DynamicSize();
+  char* block_h = new char[size_to_malloc];
+  this->AssignMemory(block_h);
+}
+
 void LDIF::LoadFile(const std::string& path_to_ldif) {
   std::ifstream f(path_to_ldif);
   assert(f.is_open());
@@ -796,15 +824,7 @@ void LDIF::LoadFile(const std::string& path_to_ldif) {
   f >> version_id;
   f >> len_implicits;
   assert(version_id == 0);
-  assert(num_blobs >= 0);
-  assert(len_implicits >= 0);
-  this->num_blobs = num_blobs;
-  this->len_implicits = len_implicits;
-  this->occnet.Initialize(this->len_implicits, this->num_blobs);
-  // We have now initialized the object, DynamicSize+AssignMemory are fair game.
-  int size_to_malloc = this->DynamicSize();
-  char* block_h = new char[size_to_malloc];
-  this->AssignMemory(block_h);
+  this->Allocate(num_blobs, len_implicits);
   // Now that we have allocated and assigned memory, we can read the rest of the
   // file.
 
@@ -840,6 +860,39 @@ void LDIF::LoadFile(const std::string& path_to_ldif) {
   }
 }
 
+// Sets the shape from a (D)SIF vector, as the Decoder represents it. Each of
+// its rows has the constant, the center, the radii variances, optionally the
+// roll-pitch-yaw rotation, and then the implicit parameters. The first
+// symmetry_count elements are mirrored. The weights of the OccNet, if any,
+// must already be loaded; only its per-shape activations are recomputed.
+void LDIF::SetFromVector(const float* sif_vector, int element_length,
+                         int symmetry_count) {
+  int explicit_length = element_length == 7 ? 7 : 10;
+  assert(element_length - explicit_length == this->len_implicits);
+  int nb = this->num_blobs;
+  for (int i = 0; i < nb; ++i) {
+    const float* row = sif_vector + i * element_length;
+    this->constants[i] = row[0];
+    for (int j = 0; j < 3; ++j) {
+      this->centers[j * nb + i] = row[1 + j];
+      // The SIF file stores the square root of the variance, which LoadFile
+      // squares back:
+      this->radii[i * 3 + j] = std::max(row[4 + j], 0.0f);
+      this->rotations[i * 3 + j] = explicit_length == 10 ? row[7 + j] : 0.0f;
+    }
+    for (int j = 0; j < this->len_implicits; ++j) {
+      this->implicits[i * this->len_implicits + j] = row[explicit_length + j];
+    }
+  }
+  this->symmetry_count = std::min(std::max(symmetry_count, 0), nb);
+  for (int i = 0; i < nb; ++i) {
+    this->BuildRotation(i);
+  }
+  if (this->HasImplicits()) {
+    this->occnet.SetShape(this->implicits);
+  }
+}
+
 static void WriteGrid(const std::string& path, float* grid, int resolution) {
   std::ofstream f(path, std::ios::out | std::ios::binary);
   assert(f.is_open());
@@ -922,7 +975,7 @@ __device__ void make_shared_ldif(char* shared_memory, LDIF* global_ldif,
 #define MAX_THREADS_PER_BLOCK 1000
 
 __global__ void Eval(float* grid, const LDIF* ldif, char* ldif_dynamic_memory_g,
-                     int resolution) {
+                     int resolution, float extent) {
   // float position[3] = {0.02, 0.008, -0.05};
   extern __shared__ char shared_memory_base[];
 
@@ -931,7 +984,6 @@ __global__ void Eval(float* grid, const LDIF* ldif, char* ldif_dynamic_memory_g,
                           &shared_ldif);
   char* scratch_shared_memory = shared_memory_base + sizeof(LDIF);
 
-  float extent = 0.75;
   float total_size = 2 * extent;
 
   // LDIF* shared_ldif;
@@ -980,9 +1032,211 @@ inline void GPUCheckOk(cudaError_t code, const char* file, int line) {
   }
 }
 
+// Evaluates LDIFs on grids on the GPU. The device buffers are allocated once
+// and reused by every evaluation.
+class GridEvaluator {
+ public:
+  explicit GridEvaluator(int max_resolution);
+  ~GridEvaluator();
+  // Evaluates the LDIF on a resolution^3 grid covering [-extent, extent]^3,
+  // and copies it to grid_h, indexed [z, y, x].
+  void Eval(const LDIF& ldif, int resolution, float extent, float* grid_h);
+
+ private:
+  int max_resolution;
+  float* grid_d;
+  LDIF* ldif_d;
+  char* dynamic_d;
+  int dynamic_size;
+};
+
+GridEvaluator::GridEvaluator(int max_resolution) {
+  this->max_resolution = max_resolution;
+  this->dynamic_d = 0;
+  this->dynamic_size = 0;
+  this->grid_d = 0;
+  GPU_CHECK_OK(cudaMalloc(&this->grid_d, static_cast<size_t>(max_resolution) *
+                                             max_resolution * max_resolution *
+                                             sizeof(float)));
+  this->ldif_d = 0;
+  GPU_CHECK_OK(cudaMalloc(&this->ldif_d, sizeof(LDIF)));
+}
+
+GridEvaluator::~GridEvaluator() {
+  cudaFree(this->grid_d);
+  cudaFree(this->ldif_d);
+  cudaFree(this->dynamic_d);
+}
+
+void GridEvaluator::Eval(const LDIF& ldif, int resolution, float extent,
+                         float* grid_h) {
+  assert(resolution <= this->max_resolution);
+  // The LDIF's dynamic memory is copied to the device, and a copy of the LDIF
+  // that points to it is copied next to it. The host LDIF is left as is, so it
+  // can be updated for the next evaluation.
+  LDIF device_ldif = ldif;
+  int dynamic_size = device_ldif.DynamicSize();
+  if (dynamic_size > this->dynamic_size) {
+    GPU_CHECK_OK(cudaFree(this->dynamic_d));
+    GPU_CHECK_OK(cudaMalloc(&this->dynamic_d, dynamic_size));
+    this->dynamic_size = dynamic_size;
+  }
+  GPU_CHECK_OK(cudaMemcpy(this->dynamic_d, ldif.block_start, dynamic_size,
+                          cudaMemcpyHostToDevice));
+  device_ldif.AssignMemory(reinterpret_cast<void*>(this->dynamic_d));
+  GPU_CHECK_OK(cudaMemcpy(this->ldif_d, &device_ldif, sizeof(LDIF),
+                          cudaMemcpyHostToDevice));
+
+  int fc_required_shared_size = sizeof(float) * ldif.len_implicits * 2;
+  int sif_required_shared_size = sizeof(float) * ldif.num_blobs +
+                                 sizeof(bool) * ldif.num_blobs + sizeof(LDIF);
+  int shared_size = fc_required_shared_size + sif_required_shared_size;
+  int N = resolution * resolution * resolution;
+  int xres = 32;
+  int num_blocks = N;
+  ::Eval<<<num_blocks, xres, shared_size>>>(
+      this->grid_d, this->ldif_d, this->dynamic_d, resolution, extent);
+  GPU_CHECK_OK(cudaGetLastError());
+  GPU_CHECK_OK(cudaDeviceSynchronize());
+  GPU_CHECK_OK(cudaMemcpy(grid_h, this->grid_d, sizeof(float) * N,
+                          cudaMemcpyDeviceToHost));
+}
+
+// The header of a request to the grid evaluation server. It matches
+// REQUEST_HEADER in ldif/inference/grid_worker.py, and is followed by the
+// element_count * element_length float32 values of the (D)SIF.
+struct RequestHeader {
+  int32_t version;
+  int32_t resolution;
+  float extent;
+  int32_t element_count;
+  int32_t element_length;
+};
+static_assert(sizeof(RequestHeader) == 20, "The request header is packed.");
+
+const int32_t kProtocolVersion = 1;
+const char kStatusOk = 0;
+const char kStatusError = 1;
+
+// Reads exactly size bytes. Returns false at the end of the input.
+static bool ReadFully(int fd, void* buffer, size_t size) {
+  char* out = reinterpret_cast<char*>(buffer);
+  while (size > 0) {
+    ssize_t count = read(fd, out, size);
+    if (count <= 0) return false;
+    out += count;
+    size -= count;
+  }
+  return true;
+}
+
+static void WriteFully(int fd, const void* buffer, size_t size) {
+  const char* in = reinterpret_cast<const char*>(buffer);
+  while (size > 0) {
+    ssize_t count = write(fd, in, size);
+    if (count <= 0) exit(1);
+    in += count;
+    size -= count;
+  }
+}
+
+static void Reply(int fd, const std::string& error) {
+  if (error.empty()) {
+    WriteFully(fd, &kStatusOk, 1);
+    return;
+  }
+  uint32_t length = error.size();
+  WriteFully(fd, &kStatusError, 1);
+  WriteFully(fd, &length, sizeof(length));
+  WriteFully(fd, error.data(), length);
+}
+
+// Serves grid evaluation requests from stdin until it is closed. The OccNet
+// weights are loaded once, with the first request. Each grid is written to the
+// memory-mapped file at grid_buffer_path, which holds max_resolution^3 floats,
+// and the reply on stdout is a status byte, followed by the length and text of
+// the error if it isn't kStatusOk. Anything else printed goes to stderr.
+static int Serve(const std::string& occnet_path,
+                 const std::string& grid_buffer_path, int max_resolution,
+                 int symmetry_count) {
+  int reply_fd = dup(1);
+  dup2(2, 1);
+  size_t buffer_size = static_cast<size_t>(max_resolution) * max_resolution *
+                       max_resolution * sizeof(float);
+  int buffer_fd = open(grid_buffer_path.c_str(), O_RDWR);
+  if (buffer_fd < 0) {
+    std::cerr << "Could not open the grid buffer " << grid_buffer_path
+              << std::endl;
+    return 1;
+  }
+  void* mapped =
+      mmap(0, buffer_size, PROT_READ | PROT_WRITE, MAP_SHARED, buffer_fd, 0);
+  close(buffer_fd);
+  if (mapped == MAP_FAILED) {
+    std::cerr << "Could not map the grid buffer " << grid_buffer_path
+              << std::endl;
+    return 1;
+  }
+  float* grid_buffer = reinterpret_cast<float*>(mapped);
+  GridEvaluator evaluator(max_resolution);
+  std::unique_ptr<LDIF> ldif;
+  std::vector<float> sif_vector;
+  RequestHeader header;
+  while (ReadFully(0, &header, sizeof(header))) {
+    sif_vector.resize(static_cast<size_t>(header.element_count) *
+                      header.element_length);
+    if (!ReadFully(0, sif_vector.data(), sif_vector.size() * sizeof(float))) {
+      break;
+    }
+    int len_implicits =
+        header.element_length - (header.element_length == 7 ? 7 : 10);
+    std::string error;
+    if (header.version != kProtocolVersion) {
+      error = "Unsupported protocol version " + std::to_string(header.version);
+    } else if (header.resolution < 1 || header.resolution > max_resolution) {
+      error = "Resolution " + std::to_string(header.resolution) +
+              " exceeds the maximum resolution " +
+              std::to_string(max_resolution) + " of the grid buffer.";
+    } else if (len_implicits < 0) {
+      error = "Unsupported element length " +
+              std::to_string(header.element_length);
+    } else if (ldif && (ldif->num_blobs != header.element_count ||
+                        ldif->len_implicits != len_implicits)) {
+      error = "The worker evaluates shapes of " +
+              std::to_string(ldif->num_blobs) + " elements with " +
+              std::to_string(ldif->len_implicits) + " implicit parameters.";
+    }
+    if (error.empty()) {
+      if (!ldif) {
+        ldif.reset(new LDIF(header.element_count, len_implicits));
+        if (ldif->HasImplicits()) {
+          ldif->occnet.LoadFile(occnet_path);
+        }
+      }
+      ldif->SetFromVector(sif_vector.data(), header.element_length,
+                          symmetry_count);
+      evaluator.Eval(*ldif, header.resolution, header.extent, grid_buffer);
+    }
+    Reply(reply_fd, error);
+  }
+  munmap(mapped, buffer_size);
+  return 0;
+}
+
 int main(int argc, char** argv) {
   auto start_t = std::chrono::high_resolution_clock::now();
   GPU_CHECK_OK(cudaFree(0));  // Get started warming cuda up asap.
+  if (argc > 1 && std::string(argv[1]) == "-serve") {
+    if (argc != 6) {
+      std::cout << "Usage: ldif2mesh -serve [occnet_path] [grid_buffer_path]"
+                   " [max_resolution] [symmetry_count]."
+                << std::endl;
+      return 1;
+    }
+    return Serve(std::string(argv[2]), std::string(argv[3]),
+                 std::stoi(std::string(argv[4])),
+                 std::stoi(std::string(argv[5])));
+  }
   // Default to test paths for profiling:
   std::string input_ldif_path = "./test-ldif.txt";
   std::string occnet_path = "./extracted.occnet";
@@ -990,7 +1244,8 @@ int main(int argc, char** argv) {
   int resolution = 256;
   std::string usage_message =
       "Usage: ldif2mesh [input_ldif_path] [occnet_path] [output_path] "
-      "[-resolution #].";
+      "[-resolution #], or ldif2mesh -serve [occnet_path] [grid_buffer_path] "
+      "[max_resolution] [symmetry_count].";
   if (argc > 1 && argc < 4) {
     std::cout << usage_message << std::endl;
     return 1;
@@ -1015,37 +1270,11 @@ int main(int argc, char** argv) {
   if (ldif.HasImplicits()) {
     ldif.LoadOccNet(occnet_path);
   }
-  char* gpu_ldif_dynamic_memory;
-  GPU_CHECK_OK(cudaMalloc(&gpu_ldif_dynamic_memory, ldif.DynamicSize()));
-  GPU_CHECK_OK(cudaMemcpy(gpu_ldif_dynamic_memory, ldif.block_start,
-                          ldif.DynamicSize(), cudaMemcpyHostToDevice));
-  ldif.AssignMemory(reinterpret_cast<void*>(gpu_ldif_dynamic_memory));
-
-  float* grid = 0;
-  GPU_CHECK_OK(cudaMalloc(
-      &grid, resolution * resolution * resolution * sizeof(float)));
-  LDIF* gpu_ldif = 0;
-  GPU_CHECK_OK(cudaMalloc(&gpu_ldif, sizeof(LDIF)));
-  GPU_CHECK_OK(cudaMemcpy(gpu_ldif, &ldif, sizeof(LDIF),
-                          cudaMemcpyHostToDevice));
-
-  int fc_required_shared_size = sizeof(float) * ldif.len_implicits * 2;
-  int sif_required_shared_size = sizeof(float) * ldif.num_blobs +
-                                 sizeof(bool) * ldif.num_blobs + sizeof(LDIF);
-  int shared_size = fc_required_shared_size + sif_required_shared_size;
-  int N = resolution * resolution * resolution;
-  int xres = 32;
-  int num_blocks = N;
+  GridEvaluator evaluator(resolution);
+  float* grid_h = new float[resolution * resolution * resolution];
   auto kernel_start_t = std::chrono::high_resolution_clock::now();
-  Eval<<<num_blocks, xres, shared_size>>>(grid, gpu_ldif,
-                                          gpu_ldif_dynamic_memory, resolution);
-  GPU_CHECK_OK(cudaGetLastError());
-  GPU_CHECK_OK(cudaDeviceSynchronize());
+  evaluator.Eval(ldif, resolution, 0.75f, grid_h);
   auto kernel_stop_t = std::chrono::high_resolution_clock::now();
-  float* grid_h = new float[resolution * resolution * resolution];
-  GPU_CHECK_OK(cudaMemcpy(grid_h, grid,
-                          sizeof(float) * resolution * resolution * resolution,
-                          cudaMemcpyDeviceToHost));
   // Dummy position for testing...
   // float position[3] = { 0.02, 0.008, -0.05 };
   WriteGrid(output_path, grid_h, resolution);
@@ -298,6 +298,13 @@ autoencoder_hparams = tf.contrib.training.HParams(
     # [vbs]: The virtual batch size; only used if 'sync' is true. The number of
     #   training examples to pool before applying a gradient.
     vbs=64,
+    # [gac]: The gradient accumulation count. The number of batches whose mean
+    #   gradients are applied in each weights update, so the effective batch
+    #   size is [gac] * [bs] without the memory of a larger batch.
+    gac=1,
+    # [gcn]: The global norm the gradients are clipped to before each weights
+    #   update. 0.0 disables clipping.
+    gcn=0.0,
     # [r]: 'iso' for isotropic, 'aa' for anisotropic and axis-aligned to the
     #   normalized mesh coordinates, 'cov' for general Gaussian RBFs.
     r='cov',
@@ -447,6 +454,8 @@ def backwards_compatible_hparam_defaults(ident):
           'clc': 1024,
           'hyo': 'f',
           'hyp': 'f',
+          'gac': 1,
+          'gcn': 0.0,
       },
       'rgb2q': {
           'l': 'l2',
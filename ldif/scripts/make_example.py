@@ -14,13 +14,20 @@
 # Lint as: python3
 """Library code to create an LDIF example directory from a file."""
 
+import collections
+import concurrent.futures
+import functools
+import multiprocessing
 import os
+import platform
 
 import subprocess as sp
 import numpy as np
 
 # LDIF is an internal package, should be imported last.
 # pylint: disable=g-bad-import-order
+from ldif.scripts import render_dodeca
+from ldif.scripts import sample_sdf
 from ldif.util import file_util
 from ldif.util import gaps_util
 from ldif.util import path_util
@@ -52,26 +59,48 @@ def write_depth_and_normals_npz(dirpath, path_out):
   remove_png_dir(f'{dirpath}/normals')
 
 
-def mesh_to_example(codebase_root_dir, mesh_path, dirpath, skip_existing, log_level):
-  # Logging level must be specified because mesh_to_example is an entry point
-  # for a subprocess call.
-  log.set_level(log_level)
-  log.info('codebase_root_dir: ' + str(codebase_root_dir))  # ex: /mnt/c/users/jryan/Documents/GitHub/ldif/ldif
-  # log.info(f'Processing {mesh_path}')  # ex: ./input_meshes_shapenet_ply/shapenet/train/02691156/1.ply
-  log.info('dirpath: ' + str(dirpath))  # ex: shapenet_subsample_ds/train/02691156/1/
-  log.info('skip_existing: ' + str(skip_existing))  # ex: True
-  ldif_path = path_util.get_path_to_ldif_root()  # ex: /mnt/c/users/jryan/Documents/GitHub/ldif/ldif
-  # log.info('ldif_path: ' + str(ldif_path))
-  log.info('mesh_path: ' + str(mesh_path))  # ex: ./input_meshes_shapenet_ply/shapenet/train/02691156/1.ply
-  if not skip_existing or not os.path.isfile(f'{dirpath}/depth_and_normals.npz'):
-    sp.check_output(
-      f'{codebase_root_dir}/scripts/process_mesh_local.sh {mesh_path} {dirpath} {ldif_path}',  # mesh_in is messed up
-        shell=True)
-    write_depth_and_normals_npz(dirpath, f'{dirpath}/depth_and_normals.npz')
-  else:
-    log.verbose(f'Skipping shell script processing for {dirpath},'
-                ' the output already exists.')
-  # Precompute the dodeca samples for later:
+# One preprocessing step of one mesh. run is a function with no arguments,
+# called once every step named in dependencies has finished. Each step is
+# single threaded (the GAPS executables are), so it uses one CPU of the budget.
+Step = collections.namedtuple('Step', ['name', 'dependencies', 'run'])
+
+
+def _run_command(command):
+  """Runs an executable, raising a ValueError with its output if it fails."""
+  try:
+    sp.check_output(command, stderr=sp.STDOUT)
+  except sp.CalledProcessError as e:
+    output = e.output.decode('utf-8', errors='replace')[-2000:]
+    raise ValueError(f'{os.path.basename(command[0])} failed with code'
+                     f' {e.returncode}:\n{output}') from e
+
+
+def _link_mesh(mesh_path, mesh_orig):
+  """Symlinks the input mesh into the example directory."""
+  os.makedirs(os.path.dirname(mesh_orig), exist_ok=True)
+  if os.path.lexists(mesh_orig):
+    os.remove(mesh_orig)
+  os.symlink(os.path.realpath(mesh_path), mesh_orig)
+
+
+def _render_normals(gaps, depth_dir, dirpath, mesa):
+  """Renders the normal images from the depth images with conf2img."""
+  ldif_path = path_util.get_path_to_ldif_root()
+  local_conf = f'{dirpath}/custom_conf.conf'
+  with open(f'{ldif_path}/data/base_conf.conf', 'rt') as f:
+    base_conf = f.read()
+  with open(local_conf, 'wt') as f:
+    f.write(f'dataset_processed\ndepth_directory {depth_dir}\n{base_conf}')
+  # TODO(kgenova) We have to write out normals as well?
+  _run_command([
+      f'{gaps}/conf2img', local_conf, f'{dirpath}/normals',
+      '-create_normal_images', '-width', '224', '-height', '224'
+  ] + mesa)
+  os.remove(local_conf)
+
+
+def _write_surface_samples(dirpath, skip_existing):
+  """Precomputes the dodeca surface samples for later."""
   e = example.InferenceExample.from_directory(dirpath)
   sample_path = e.precomputed_surface_samples_from_dodeca_path
   if not skip_existing or not os.path.isfile(sample_path):
@@ -81,5 +110,255 @@ def mesh_to_example(codebase_root_dir, mesh_path, dirpath, skip_existing, log_le
     assert precomputed_samples.shape[1] == 6
     file_util.write_points(sample_path, precomputed_samples)
   else:
-    log.verbose(f'Skipping surface sample precompution for {dirpath}, it\'s already done.')
+    log.verbose(f'Skipping surface sample precompution for {dirpath}, it\'s'
+                ' already done.')
+
+
+def mesh_steps(mesh_path, dirpath, skip_existing, gaps_directory=None,
+               sdf_pool=None, render_pool=None):
+  """Returns the preprocessing steps that make an example from a mesh.
+
+  Only the normalization (msh2msh) has to happen before the grid, sample and
+  render steps, which are otherwise independent of each other.
+
+  Args:
+    mesh_path: String. The path to the input mesh.
+    dirpath: String. The example directory to write.
+    skip_existing: Boolean. Whether to skip the steps whose outputs exist.
+    gaps_directory: String. The directory containing the GAPS executables.
+      Defaults to the one built by build_gaps.sh. Other executables with the
+      same interface can be provided instead, for example for testing.
+    sdf_pool: A multiprocessing pool, or None. If provided, the SDF samples and
+      grid are computed in it by sample_sdf, rather than by GAPS.
+    render_pool: A multiprocessing pool, or None. If provided, the depth and
+      normal images are rendered in it by render_dodeca, rather than by GAPS.
+
+  Returns:
+    A list of Steps, in an order that satisfies their dependencies.
+  """
+  ldif_path = path_util.get_path_to_ldif_root()
+  gaps = gaps_directory or f'{ldif_path}/gaps/bin/x86_64'
+  # On macos osmesa is not used, on linux it is:
+  mesa = [] if platform.system() == 'Darwin' else ['-mesa']
+  dirpath = dirpath.rstrip('/')
+  mesh_orig = f'{dirpath}/mesh_orig{os.path.splitext(mesh_path)[1]}'
+  mesh = f'{dirpath}/model_normalized.obj'
+  depth_dir = f'{dirpath}/depth_images/'
+  bbox = ['-0.7', '-0.7', '-0.7', '0.7', '0.7', '0.7']
+  steps = []
+  npz_path = f'{dirpath}/depth_and_normals.npz'
+  if sdf_pool is not None:
+    sdf_steps = [
+        Step(
+            'sdf_samples', ('msh2msh',),
+            functools.partial(sdf_pool.apply, sample_sdf.write_sdf_samples,
+                              (mesh, dirpath)))
+    ]
+  else:
+    sdf_steps = [
+        # The coarse inside/outside grid:
+        Step(
+            'msh2df', ('msh2msh',),
+            functools.partial(
+                _run_command,
+                [f'{gaps}/msh2df', mesh, f'{dirpath}/coarse_grid.grd', '-bbox'] +
+                bbox + ['-border', '0', '-spacing', '0.044', '-estimate_sign'])),
+        Step(
+            'near_surface_samples', ('msh2msh',),
+            functools.partial(_run_command, [
+                f'{gaps}/msh2pts', mesh, f'{dirpath}/nss_points.sdf',
+                '-near_surface', '-max_distance', '0.04', '-num_points',
+                '100000', '-binary_sdf'
+            ])),
+        Step(
+            'uniform_samples', ('msh2msh',),
+            functools.partial(
+                _run_command, [
+                    f'{gaps}/msh2pts', mesh, f'{dirpath}/uniform_points.sdf',
+                    '-uniform_in_bbox', '-bbox'
+                ] + bbox + ['-npoints', '100000', '-binary_sdf'])),
+    ]
+  if render_pool is not None:
+    render_steps = [
+        Step(
+            'depth_and_normals', ('msh2msh',),
+            functools.partial(render_pool.apply,
+                              render_dodeca.write_depth_and_normals_npz,
+                              (mesh, npz_path))),
+    ]
+  else:
+    render_steps = [
+        Step(
+            'scn2img', ('msh2msh',),
+            functools.partial(_run_command, [
+                f'{gaps}/scn2img', mesh,
+                f'{ldif_path}/data/dodeca_cameras.cam', depth_dir,
+                '-capture_depth_images', '-width', '224', '-height', '224'
+            ] + mesa)),
+        Step('conf2img', ('scn2img',),
+             functools.partial(_render_normals, gaps, depth_dir, dirpath,
+                               mesa)),
+        Step('depth_and_normals', ('scn2img', 'conf2img'),
+             functools.partial(write_depth_and_normals_npz, dirpath,
+                               npz_path)),
+    ]
+  if not skip_existing or not os.path.isfile(npz_path):
+    steps += [
+        Step('link', (), functools.partial(_link_mesh, mesh_path, mesh_orig)),
+        # Normalize the mesh before applying all other operations:
+        Step(
+            'msh2msh', ('link',),
+            functools.partial(_run_command, [
+                f'{gaps}/msh2msh', mesh_orig, mesh, '-scale_by_pca',
+                '-translate_by_centroid', '-scale', '0.25', '-debug_matrix',
+                f'{dirpath}/orig_to_gaps.txt'
+            ])),
+    ] + sdf_steps + render_steps + [
+        # The normalized mesh is no longer needed on disk; we have the
+        # transformation, so if we need it we can load the original symlinked
+        # mesh and transform it to the normalized frame.
+        Step('remove_mesh',
+             tuple(s.name for s in sdf_steps + render_steps[:1]),
+             functools.partial(os.remove, mesh)),
+    ]
+  else:
+    log.verbose(f'Skipping GAPS processing for {dirpath}, the output already'
+                ' exists.')
+  steps.append(
+      Step('surface_samples', ('depth_and_normals',) if steps else (),
+           functools.partial(_write_surface_samples, dirpath, skip_existing)))
+  return steps
+
+
+def run_steps(step_lists, cpu_budget):
+  """Runs the preprocessing steps of many meshes concurrently.
+
+  A step starts as soon as its dependencies have finished and a CPU of the
+  budget is free. Ready steps of earlier meshes go first, so meshes are
+  completed roughly in order and few are in progress at once. If a step fails,
+  the remaining steps of its mesh are skipped, but the other meshes continue.
+
+  Args:
+    step_lists: A list with the list of Steps of each mesh.
+    cpu_budget: Int. The maximum number of steps to run at once.
+
+  Returns:
+    A list with, for each mesh, None if all its steps succeeded, or else a
+    string describing the failure.
+  """
+  remaining = [collections.OrderedDict((s.name, s) for s in steps)
+               for steps in step_lists]
+  finished = [set() for _ in step_lists]
+  errors = [None] * len(step_lists)
+  running = {}
+  first_open = 0
+  completed_count = 0
+  log_interval = max(1, len(step_lists) // 100)
+
+  def mesh_done(mesh_idx):
+    return not remaining[mesh_idx] and mesh_idx not in (
+        i for i, _ in running.values())
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=cpu_budget) as pool:
 
+    def submit_ready_steps():
+      nonlocal first_open
+      while first_open < len(remaining) and not remaining[first_open]:
+        first_open += 1
+      for mesh_idx in range(first_open, len(remaining)):
+        if len(running) >= cpu_budget:
+          return
+        for name, step in list(remaining[mesh_idx].items()):
+          if len(running) >= cpu_budget:
+            return
+          if all(d in finished[mesh_idx] for d in step.dependencies):
+            del remaining[mesh_idx][name]
+            running[pool.submit(step.run)] = (mesh_idx, name)
+
+    submit_ready_steps()
+    while running:
+      done, _ = concurrent.futures.wait(
+          running, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        mesh_idx, name = running.pop(future)
+        try:
+          future.result()
+          finished[mesh_idx].add(name)
+        except Exception as e:  # pylint: disable=broad-except
+          errors[mesh_idx] = f'Step {name} failed: {e}'
+          log.error(f'Mesh {mesh_idx}: {errors[mesh_idx]}')
+          remaining[mesh_idx].clear()
+        if mesh_done(mesh_idx):
+          completed_count += 1
+          if completed_count % log_interval == 0:
+            log.info(f'Preprocessed {completed_count} of {len(step_lists)}'
+                     ' meshes.')
+      submit_ready_steps()
+  return errors
+
+
+def meshes_to_examples(meshes, skip_existing, cpu_budget=None,
+                       gaps_directory=None, sdf_sampler='gaps',
+                       renderer='gaps'):
+  """Makes LDIF example directories from many meshes at once.
+
+  Args:
+    meshes: A list of (mesh_path, dirpath) pairs, the input mesh and the example
+      directory to write for each mesh.
+    skip_existing: Boolean. Whether to skip the steps whose outputs exist.
+    cpu_budget: Int. The maximum number of steps to run at once, across all
+      meshes. Defaults to the number of CPUs.
+    gaps_directory: String. See mesh_steps().
+    sdf_sampler: String. 'gaps' to compute the SDF samples and grid with the
+      GAPS msh2pts and msh2df, or 'python' to compute them with sample_sdf in a
+      pool of worker processes.
+    renderer: String. 'gaps' to render the depth and normal images with the
+      GAPS scn2img and conf2img, or 'python' to rasterize them with
+      render_dodeca in a pool of worker processes, which doesn't need OpenGL.
+  """
+  cpu_budget = cpu_budget or os.cpu_count()
+  if sdf_sampler not in ['gaps', 'python']:
+    raise ValueError(f'Unrecognized SDF sampler {sdf_sampler}.')
+  if renderer not in ['gaps', 'python']:
+    raise ValueError(f'Unrecognized renderer {renderer}.')
+  pool = None
+  if 'python' in [sdf_sampler, renderer]:
+    # Spawn rather than fork, because the parent usually has tensorflow loaded.
+    # A step waits for its task, so the pool never has more than one task per
+    # CPU of the budget:
+    pool = multiprocessing.get_context('spawn').Pool(cpu_budget)
+  try:
+    step_lists = [
+        mesh_steps(
+            mesh_path,
+            dirpath,
+            skip_existing,
+            gaps_directory,
+            sdf_pool=pool if sdf_sampler == 'python' else None,
+            render_pool=pool if renderer == 'python' else None)
+        for mesh_path, dirpath in meshes
+    ]
+    errors = run_steps(step_lists, cpu_budget)
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+  failures = [(m[0], e) for m, e in zip(meshes, errors) if e is not None]
+  if failures:
+    raise ValueError(f'Failed to preprocess {len(failures)} of {len(meshes)}'
+                     f' meshes. The first was {failures[0][0]}:'
+                     f' {failures[0][1]}')
+
+
+def mesh_to_example(codebase_root_dir, mesh_path, dirpath, skip_existing,
+                    log_level, gaps_directory=None, sdf_sampler='gaps',
+                    renderer='gaps'):
+  """Makes an LDIF example directory from a single mesh."""
+  # Logging level must be specified because mesh_to_example is an entry point
+  # for a subprocess call.
+  del codebase_root_dir  # Unused, the steps no longer run a shell script.
+  log.set_level(log_level)
+  log.verbose(f'Processing {mesh_path} into {dirpath}')
+  meshes_to_examples([(mesh_path, dirpath)], skip_existing,
+                     gaps_directory=gaps_directory, sdf_sampler=sdf_sampler,
+                     renderer=renderer)
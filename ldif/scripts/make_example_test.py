@@ -0,0 +1,181 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.scripts.make_example."""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from multiprocessing import pool
+
+import trimesh
+
+from absl.testing import absltest
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.scripts import make_example
+from ldif.util import file_util
+# pylint: enable=g-bad-import-order
+
+# A stand-in for the GAPS executables. It logs its name, then creates its
+# output as a file, or as a directory of images:
+STAND_IN = """#!/bin/sh
+echo "$(basename $0)" >> {log_path}
+sleep 0.2
+case "$(basename $0)" in
+  scn2img) mkdir -p "$3" ;;
+  conf2img) mkdir -p "$2" ;;
+  *) touch "$2" ;;
+esac
+"""
+
+
+class MakeExampleTest(absltest.TestCase):
+
+  def testRunStepsRespectsDependenciesAndBudget(self):
+    lock = threading.Lock()
+    events = []
+    active = [0]
+    max_active = [0]
+
+    def run(mesh_idx, name):
+      with lock:
+        active[0] += 1
+        max_active[0] = max(max_active[0], active[0])
+        events.append((mesh_idx, name))
+      time.sleep(0.02)
+      with lock:
+        active[0] -= 1
+
+    def steps(mesh_idx):
+      return [
+          make_example.Step('a', (), lambda: run(mesh_idx, 'a')),
+          make_example.Step('b', ('a',), lambda: run(mesh_idx, 'b')),
+          make_example.Step('c', ('a',), lambda: run(mesh_idx, 'c')),
+          make_example.Step('d', ('b', 'c'), lambda: run(mesh_idx, 'd')),
+      ]
+
+    errors = make_example.run_steps([steps(i) for i in range(5)],
+                                    cpu_budget=3)
+    self.assertEqual(errors, [None] * 5)
+    self.assertLen(events, 20)
+    self.assertLessEqual(max_active[0], 3)
+    self.assertGreater(max_active[0], 1)
+    for i in range(5):
+      order = [name for mesh_idx, name in events if mesh_idx == i]
+      self.assertEqual(order[0], 'a')
+      self.assertEqual(order[-1], 'd')
+
+  def testRunStepsIsolatesFailures(self):
+    ran = []
+
+    def fail():
+      raise ValueError('Bad mesh.')
+
+    step_lists = [
+        [
+            make_example.Step('a', (), fail),
+            make_example.Step('b', ('a',), lambda: ran.append(0)),
+        ],
+        [
+            make_example.Step('a', (), lambda: None),
+            make_example.Step('b', ('a',), lambda: ran.append(1)),
+        ],
+    ]
+    errors = make_example.run_steps(step_lists, cpu_budget=2)
+    self.assertIn('Bad mesh.', errors[0])
+    self.assertIsNone(errors[1])
+    self.assertEqual(ran, [1])
+
+  def testMeshStepsRunWithStandInExecutables(self):
+    root = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, root)
+    gaps_directory = os.path.join(root, 'gaps')
+    os.mkdir(gaps_directory)
+    log_path = os.path.join(root, 'log.txt')
+    for name in ['msh2msh', 'msh2df', 'msh2pts', 'scn2img', 'conf2img']:
+      path = os.path.join(gaps_directory, name)
+      with open(path, 'wt') as f:
+        f.write(STAND_IN.format(log_path=log_path))
+      os.chmod(path, 0o755)
+    mesh_path = os.path.join(root, 'mesh.ply')
+    with open(mesh_path, 'wt') as f:
+      f.write('ply\n')
+    dirpath = os.path.join(root, 'train', '02691156', 'mesh') + '/'
+    steps = make_example.mesh_steps(
+        mesh_path, dirpath, skip_existing=True, gaps_directory=gaps_directory)
+    # The steps that read the outputs need real GAPS files, so they're left out:
+    steps = [
+        s for s in steps
+        if s.name not in ['depth_and_normals', 'surface_samples']
+    ]
+    start_t = time.time()
+    errors = make_example.run_steps([steps], cpu_budget=4)
+    elapsed = time.time() - start_t
+    self.assertEqual(errors, [None])
+    with open(log_path, 'rt') as f:
+      invocations = f.read().split()
+    self.assertEqual(invocations[0], 'msh2msh')
+    self.assertCountEqual(
+        invocations,
+        ['msh2msh', 'msh2df', 'msh2pts', 'msh2pts', 'scn2img', 'conf2img'])
+    self.assertEqual(invocations[-1], 'conf2img')
+    # The four steps after msh2msh run concurrently, so this takes about three
+    # sleeps rather than six:
+    self.assertLess(elapsed, 1.0)
+    self.assertTrue(os.path.islink(os.path.join(dirpath, 'mesh_orig.ply')))
+    self.assertTrue(os.path.isfile(os.path.join(dirpath, 'coarse_grid.grd')))
+    self.assertTrue(os.path.isdir(os.path.join(dirpath, 'normals')))
+    self.assertFalse(
+        os.path.exists(os.path.join(dirpath, 'model_normalized.obj')))
+    self.assertFalse(os.path.exists(os.path.join(dirpath, 'custom_conf.conf')))
+
+  def testMeshStepsRenderInPython(self):
+    root = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, root)
+    gaps_directory = os.path.join(root, 'gaps')
+    os.mkdir(gaps_directory)
+    # The normalization just copies the mesh:
+    with open(os.path.join(gaps_directory, 'msh2msh'), 'wt') as f:
+      f.write('#!/bin/sh\ncp "$1" "$2"\n')
+    os.chmod(os.path.join(gaps_directory, 'msh2msh'), 0o755)
+    mesh_path = os.path.join(root, 'mesh.obj')
+    trimesh.creation.box(extents=[0.6, 0.4, 0.2]).export(mesh_path)
+    dirpath = os.path.join(root, 'train', '02691156', 'mesh')
+    render_pool = pool.ThreadPool(1)
+    self.addCleanup(render_pool.close)
+    steps = make_example.mesh_steps(
+        mesh_path,
+        dirpath,
+        skip_existing=True,
+        gaps_directory=gaps_directory,
+        sdf_pool=render_pool,
+        render_pool=render_pool)
+    names = [s.name for s in steps]
+    self.assertNotIn('scn2img', names)
+    self.assertNotIn('conf2img', names)
+    errors = make_example.run_steps(
+        [[s for s in steps if s.name != 'surface_samples']], cpu_budget=2)
+    self.assertEqual(errors, [None])
+    arr = file_util.read_npz(os.path.join(dirpath, 'depth_and_normals.npz'))
+    self.assertEqual(arr['arr_0'].shape, (20, 224, 224, 4))
+    self.assertFalse(
+        os.path.exists(os.path.join(dirpath, 'model_normalized.obj')))
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,283 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Renders the dodecahedron depth and normal images in process, without GAPS.
+
+The preprocessing renders 20 depth images of the normalized mesh with scn2img,
+derives normal images from them with conf2img, and then reads the PNGs back
+into depth_and_normals.npz. Both executables need OpenGL (OSMesa on linux).
+This instead rasterizes the mesh with a z-buffer in numpy, and writes the npz
+directly, in the same conventions:
+  depth: The distance along the view axis, in units, quantized to the 1000ths
+    that GAPS writes to its 16-bit PNGs. 0 where nothing is hit.
+  normals: Unit normals in the camera frame (x right, y up, z towards the
+    camera), facing the camera. 0 where nothing is hit.
+Row 0 is the top of the image. gaps_util.gaps_depth_image_to_cam_image is the
+inverse of the projection.
+
+The normals are those of the mesh faces, rather than estimated from the depth
+image as conf2img does, so they are sharper at creases and silhouettes.
+"""
+
+import glob
+import math
+
+import numpy as np
+import trimesh
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.util import file_util
+from ldif.util import gaps_util
+from ldif.util import path_util
+# pylint: enable=g-bad-import-order
+
+# The parameters of the GAPS calls in the preprocessing:
+IMAGE_SIZE = 224
+VIEW_COUNT = 20
+
+# Triangles with a vertex closer to the camera plane than this are not drawn:
+_NEAR_DEPTH = 1e-3
+# The maximum number of (triangle, pixel) candidates to test at once, which
+# bounds the memory use to a few hundred MB:
+_CHUNK_SIZE = 2**22
+# Pixel centers on a shared edge belong to both triangles, so there are no
+# cracks between them:
+_EDGE_TOLERANCE = 1e-7
+
+
+def dodeca_cameras():
+  """Returns the cam2world matrices [20, 4, 4] and xfovs [20] of the views."""
+  ldif_path = path_util.get_path_to_ldif_root()
+  return gaps_util.read_cam_file(f'{ldif_path}/data/dodeca_cameras.cam')
+
+
+def _candidates(row_lo, col_lo, widths, counts):
+  """Enumerates the pixels in the bounding boxes of some triangles."""
+  triangles = np.repeat(np.arange(counts.shape[0]), counts)
+  starts = np.cumsum(counts) - counts
+  offsets = np.arange(triangles.shape[0]) - starts[triangles]
+  rows = row_lo[triangles] + offsets // widths[triangles]
+  cols = col_lo[triangles] + offsets % widths[triangles]
+  return triangles, rows, cols
+
+
+def rasterize(vertices, faces, cam2world, xfov, height=IMAGE_SIZE,
+              width=IMAGE_SIZE):
+  """Renders the depth and normal images of a mesh from one camera.
+
+  Args:
+    vertices: Numpy array with shape [vertex_count, 3]. The world space vertex
+      positions.
+    faces: Int numpy array with shape [face_count, 3].
+    cam2world: Numpy array with shape [4, 4]. The camera looks down its -z axis.
+    xfov: Float. The GAPS xfov (the half-angle in radians).
+    height: Int. The image height.
+    width: Int. The image width.
+
+  Returns:
+    depth: Float32 numpy array with shape [height, width]. In units, not
+      quantized.
+    normals: Float32 numpy array with shape [height, width, 3].
+  """
+  world2cam = np.linalg.inv(cam2world.astype(np.float64))
+  cam_vertices = (np.matmul(vertices.astype(np.float64), world2cam[:3, :3].T) +
+                  world2cam[:3, 3])
+  vertex_depth = -cam_vertices[:, 2]
+  tan_x = math.tan(xfov)
+  tan_y = (height / float(width)) * tan_x
+  safe_depth = np.maximum(vertex_depth, _NEAR_DEPTH)
+  # Pixel centers are at integer coordinates:
+  vertex_cols = (cam_vertices[:, 0] / (safe_depth * tan_x) + 1.0) * (
+      width / 2.0) - 0.5
+  vertex_rows = (1.0 - cam_vertices[:, 1] / (safe_depth * tan_y)) * (
+      height / 2.0) - 0.5
+
+  faces = np.asarray(faces, dtype=np.int64)
+  cols = vertex_cols[faces]
+  rows = vertex_rows[faces]
+  depths = vertex_depth[faces]
+  col_lo = np.maximum(np.ceil(np.min(cols, axis=1)), 0).astype(np.int64)
+  col_hi = np.minimum(np.floor(np.max(cols, axis=1)), width - 1).astype(
+      np.int64)
+  row_lo = np.maximum(np.ceil(np.min(rows, axis=1)), 0).astype(np.int64)
+  row_hi = np.minimum(np.floor(np.max(rows, axis=1)), height - 1).astype(
+      np.int64)
+  areas = ((cols[:, 1] - cols[:, 0]) * (rows[:, 2] - rows[:, 0]) -
+           (cols[:, 2] - cols[:, 0]) * (rows[:, 1] - rows[:, 0]))
+  visible = ((np.min(depths, axis=1) > _NEAR_DEPTH) & (col_lo <= col_hi) &
+             (row_lo <= row_hi) & (np.abs(areas) > 1e-12))
+  visible_faces = np.nonzero(visible)[0]
+  widths = col_hi - col_lo + 1
+  counts = widths * (row_hi - row_lo + 1)
+
+  z_buffer = np.full([height * width], np.inf)
+  face_buffer = np.full([height * width], -1, dtype=np.int64)
+  cumulative_counts = np.cumsum(counts[visible_faces])
+  chunk_start = 0
+  while chunk_start < visible_faces.shape[0]:
+    done = cumulative_counts[chunk_start - 1] if chunk_start else 0
+    # A single triangle covers at most the image, which fits in a chunk:
+    chunk_end = max(
+        np.searchsorted(cumulative_counts, done + _CHUNK_SIZE, side='right'),
+        chunk_start + 1)
+    chunk = visible_faces[chunk_start:chunk_end]
+    chunk_start = chunk_end
+    triangles, pixel_rows, pixel_cols = _candidates(
+        row_lo[chunk], col_lo[chunk], widths[chunk], counts[chunk])
+    c = cols[chunk][triangles]
+    r = rows[chunk][triangles]
+    area = areas[chunk][triangles]
+    w0 = ((c[:, 1] - pixel_cols) * (r[:, 2] - pixel_rows) -
+          (c[:, 2] - pixel_cols) * (r[:, 1] - pixel_rows)) / area
+    w1 = ((c[:, 2] - pixel_cols) * (r[:, 0] - pixel_rows) -
+          (c[:, 0] - pixel_cols) * (r[:, 2] - pixel_rows)) / area
+    w2 = 1.0 - w0 - w1
+    inside = ((w0 >= -_EDGE_TOLERANCE) & (w1 >= -_EDGE_TOLERANCE) &
+              (w2 >= -_EDGE_TOLERANCE))
+    triangles = triangles[inside]
+    d = depths[chunk][triangles]
+    # Depth isn't linear in screen space, but its inverse is:
+    pixel_depth = 1.0 / (w0[inside] / d[:, 0] + w1[inside] / d[:, 1] +
+                         w2[inside] / d[:, 2])
+    pixels = pixel_rows[inside] * width + pixel_cols[inside]
+    # The nearest candidate of each pixel:
+    order = np.lexsort((pixel_depth, pixels))
+    pixels = pixels[order]
+    is_first = np.concatenate([[True], pixels[1:] != pixels[:-1]])
+    pixels = pixels[is_first]
+    pixel_depth = pixel_depth[order][is_first]
+    nearer = pixel_depth < z_buffer[pixels]
+    z_buffer[pixels[nearer]] = pixel_depth[nearer]
+    face_buffer[pixels[nearer]] = chunk[triangles[order][is_first][nearer]]
+
+  hit = face_buffer >= 0
+  depth = np.where(hit, z_buffer, 0.0)
+  corners = cam_vertices[faces[face_buffer[hit]]]
+  normals = np.cross(corners[:, 1] - corners[:, 0],
+                     corners[:, 2] - corners[:, 0])
+  normals /= np.maximum(np.linalg.norm(normals, axis=-1, keepdims=True), 1e-12)
+  # Face the camera, whichever way the face is wound:
+  pixel_indices = np.nonzero(hit)[0]
+  view_rays = np.stack([
+      ((pixel_indices % width + 0.5) * (2.0 / width) - 1.0) * tan_x,
+      (1.0 - (pixel_indices // width + 0.5) * (2.0 / height)) * tan_y,
+      -np.ones(pixel_indices.shape[0])
+  ], axis=-1)
+  normals *= np.where(np.sum(normals * view_rays, axis=-1) > 0, -1.0,
+                      1.0)[:, np.newaxis]
+  normal_image = np.zeros([height * width, 3])
+  normal_image[hit] = normals
+  return (depth.reshape([height, width]).astype(np.float32),
+          normal_image.reshape([height, width, 3]).astype(np.float32))
+
+
+def quantize_depth(depth):
+  """Rounds depth in units to the 1000ths that GAPS writes to its PNGs."""
+  return (np.round(np.clip(depth, 0.0, 65.535) * 1000.0) / 1000.0).astype(
+      np.float32)
+
+
+def render_dodeca(mesh, cam2world=None, xfov=None):
+  """Renders the dodecahedron views of a normalized mesh.
+
+  Args:
+    mesh: A trimesh.Trimesh, in the normalized (GAPS) frame.
+    cam2world: Numpy array with shape [view_count, 4, 4], or None for the
+      dodecahedron cameras.
+    xfov: Numpy array with shape [view_count], or None for the dodecahedron
+      cameras.
+
+  Returns:
+    depth: Float32 numpy array with shape [view_count, 224, 224]. Quantized.
+    normals: Float32 numpy array with shape [view_count, 224, 224, 3].
+  """
+  if cam2world is None:
+    cam2world, xfov = dodeca_cameras()
+  depths = []
+  normals = []
+  for i in range(cam2world.shape[0]):
+    depth, normal_image = rasterize(mesh.vertices, mesh.faces, cam2world[i],
+                                    float(xfov[i]))
+    depths.append(quantize_depth(depth))
+    normals.append(normal_image)
+  return np.stack(depths), np.stack(normals)
+
+
+def compare_renders(depth, normals, reference_depth, reference_normals):
+  """Compares two renders of the same views.
+
+  Args:
+    depth: Numpy array with shape [view_count, height, width].
+    normals: Numpy array with shape [view_count, height, width, 3].
+    reference_depth: Numpy array with the shape of depth.
+    reference_normals: Numpy array with the shape of normals.
+
+  Returns:
+    A dictionary with the fraction of pixels where the two agree on whether
+    the mesh is hit, and, over the pixels both hit, the mean and 99th
+    percentile absolute depth difference and the mean angle in degrees between
+    the normals.
+  """
+  hit = depth > 0
+  reference_hit = reference_depth > 0
+  both = hit & reference_hit
+  difference = np.abs(depth[both] - reference_depth[both])
+  cosines = np.clip(np.sum(normals[both] * reference_normals[both], axis=-1),
+                    -1.0, 1.0)
+  return {
+      'mask_agreement': float(np.mean(hit == reference_hit)),
+      'mean_depth_difference': float(np.mean(difference)),
+      'depth_difference_99th_percentile': float(np.percentile(difference, 99)),
+      'mean_normal_angle': float(np.mean(np.degrees(np.arccos(cosines)))),
+  }
+
+
+def compare_with_gaps(example_directory):
+  """Renders an example again in process, and compares it with GAPS' renders.
+
+  The normalized mesh isn't kept by the preprocessing, so it's recomputed from
+  mesh_orig (which keeps the extension of the input mesh) and orig_to_gaps.txt.
+
+  Args:
+    example_directory: String. An example directory preprocessed with GAPS.
+
+  Returns:
+    The comparison of the renders. See compare_renders().
+  """
+  mesh_orig = glob.glob(f'{example_directory}/mesh_orig.*')
+  if not mesh_orig:
+    raise ValueError(f'No mesh_orig found in {example_directory}')
+  mesh = trimesh.load(mesh_orig[0], process=False)
+  mesh.apply_transform(file_util.read_txt_to_np(
+      f'{example_directory}/orig_to_gaps.txt').reshape([4, 4]))
+  depth, normals = render_dodeca(mesh)
+  reference = file_util.read_npz(
+      f'{example_directory}/depth_and_normals.npz')['arr_0']
+  return compare_renders(depth, normals, reference[..., 0], reference[..., 1:])
+
+
+def write_depth_and_normals_npz(mesh_path, path_out):
+  """Renders a normalized mesh and writes its depth_and_normals.npz.
+
+  Args:
+    mesh_path: String. The path to the mesh, already in the normalized frame.
+    path_out: String. The path to the npz to write.
+  """
+  mesh = trimesh.load(mesh_path, process=False, force='mesh')
+  if not mesh.faces.shape[0]:
+    raise ValueError(f'The mesh {mesh_path} has no faces.')
+  depth, normals = render_dodeca(mesh)
+  arr = np.concatenate([depth[..., np.newaxis], normals], axis=-1)
+  np.savez_compressed(path_out, arr)
@@ -0,0 +1,147 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.scripts.render_dodeca."""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import trimesh
+
+from absl.testing import absltest
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.scripts import render_dodeca
+from ldif.util import file_util
+from ldif.util import gaps_util
+# pylint: enable=g-bad-import-order
+
+
+def world_points_and_normals(depth, normals, cam2world, xfov):
+  """Unprojects the hit pixels of each view to world space."""
+  cam_images = gaps_util.batch_gaps_depth_image_to_cam_image(depth, xfov)
+  points = []
+  world_normals = []
+  for i in range(depth.shape[0]):
+    mask = depth[i] > 0
+    points.append(
+        np.matmul(cam_images[i][mask], cam2world[i, :3, :3].T) +
+        cam2world[i, :3, 3])
+    world_normals.append(np.matmul(normals[i][mask], cam2world[i, :3, :3].T))
+  return np.concatenate(points), np.concatenate(world_normals)
+
+
+class RenderDodecaTest(absltest.TestCase):
+
+  def testSphereMatchesTheGapsUnprojection(self):
+    mesh = trimesh.creation.icosphere(subdivisions=4, radius=0.3)
+    depth, normals = render_dodeca.render_dodeca(mesh)
+    self.assertEqual(depth.shape, (20, 224, 224))
+    self.assertEqual(normals.shape, (20, 224, 224, 3))
+    cam2world, xfov = render_dodeca.dodeca_cameras()
+    points, world_normals = world_points_and_normals(depth, normals, cam2world,
+                                                     xfov)
+    # Within the tessellation error plus the quantization:
+    np.testing.assert_allclose(
+        np.linalg.norm(points, axis=-1), 0.3, atol=2e-3)
+    directions = points / np.linalg.norm(points, axis=-1, keepdims=True)
+    self.assertGreater(np.min(np.sum(world_normals * directions, axis=-1)),
+                       0.99)
+    # The silhouette of the sphere, seen from 1.039 away:
+    radius = 0.3 / np.sqrt(np.sum(np.square(cam2world[0, :3, 3])) - 0.09)
+    expected = np.pi * radius**2 / np.square(2 * np.tan(xfov[0]))
+    self.assertAlmostEqual(np.mean(depth > 0), expected, places=2)
+
+  def testBoxFaceDepth(self):
+    mesh = trimesh.creation.box(extents=[0.4, 0.4, 0.4])
+    # A camera at z=1 looking down -z sees the z=0.2 face:
+    cam2world = np.eye(4, dtype=np.float32)
+    cam2world[2, 3] = 1.0
+    depth, normals = render_dodeca.rasterize(
+        mesh.vertices, mesh.faces, cam2world, 0.5, height=64, width=96)
+    self.assertEqual(depth.shape, (64, 96))
+    mask = depth > 0
+    np.testing.assert_allclose(depth[mask], 0.8, atol=1e-6)
+    np.testing.assert_allclose(normals[mask], [[0.0, 0.0, 1.0]] * np.sum(mask),
+                               atol=1e-6)
+    self.assertTrue(np.all(normals[~mask] == 0))
+    # The face spans tan(x) = 0.25, so half of the image height and width:
+    rows, cols = np.nonzero(mask)
+    self.assertEqual(np.min(rows), 64 - np.max(rows) - 1)
+    self.assertAlmostEqual((np.max(rows) - np.min(rows) + 1) / 64.0,
+                           0.25 / np.tan(0.5) / (64 / 96.0), delta=2 / 64.0)
+    self.assertAlmostEqual((np.max(cols) - np.min(cols) + 1) / 96.0,
+                           0.25 / np.tan(0.5), delta=2 / 96.0)
+    # The image is watertight:
+    self.assertEqual(np.sum(mask), (np.max(rows) - np.min(rows) + 1) *
+                     (np.max(cols) - np.min(cols) + 1))
+
+  def testRowZeroIsTheTop(self):
+    # A triangle above the view axis only:
+    vertices = np.array([[-0.1, 0.05, 0.0], [0.1, 0.05, 0.0], [0.0, 0.2, 0.0]])
+    cam2world = np.eye(4, dtype=np.float32)
+    cam2world[2, 3] = 1.0
+    depth, _ = render_dodeca.rasterize(vertices, [[0, 1, 2]], cam2world, 0.5)
+    rows = np.nonzero(depth > 0)[0]
+    self.assertLess(np.max(rows), 112)
+
+  def testNormalsDontDependOnWinding(self):
+    mesh = trimesh.creation.icosphere(subdivisions=2, radius=0.3)
+    cam2world, xfov = render_dodeca.dodeca_cameras()
+    depth, normals = render_dodeca.render_dodeca(mesh, cam2world[:2], xfov[:2])
+    flipped_depth, flipped_normals = render_dodeca.render_dodeca(
+        trimesh.Trimesh(mesh.vertices, mesh.faces[:, ::-1], process=False),
+        cam2world[:2], xfov[:2])
+    np.testing.assert_array_equal(depth, flipped_depth)
+    np.testing.assert_allclose(normals, flipped_normals, atol=1e-6)
+
+  def testNearestFaceWins(self):
+    far = trimesh.creation.box(extents=[0.4, 0.4, 0.4])
+    near = trimesh.creation.box(extents=[0.1, 0.1, 0.1])
+    near.apply_translation([0.0, 0.0, 0.5])
+    mesh = trimesh.util.concatenate([near, far])
+    cam2world = np.eye(4, dtype=np.float32)
+    cam2world[2, 3] = 1.0
+    depth, _ = render_dodeca.rasterize(mesh.vertices, mesh.faces, cam2world,
+                                       0.5)
+    self.assertAlmostEqual(depth[112, 112], 0.45, places=5)
+    self.assertAlmostEqual(depth[112, 80], 0.8, places=5)
+
+  def testQuantizeDepth(self):
+    np.testing.assert_allclose(
+        render_dodeca.quantize_depth(np.array([0.0, 0.12345, 70.0])),
+        [0.0, 0.123, 65.535], rtol=1e-6)
+
+  def testWriteDepthAndNormalsNpz(self):
+    dirpath = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, dirpath)
+    mesh_path = os.path.join(dirpath, 'model_normalized.obj')
+    trimesh.creation.box(extents=[0.6, 0.4, 0.2]).export(mesh_path)
+    npz_path = os.path.join(dirpath, 'depth_and_normals.npz')
+    render_dodeca.write_depth_and_normals_npz(mesh_path, npz_path)
+    arr = file_util.read_npz(npz_path)['arr_0']
+    self.assertEqual(arr.shape, (20, 224, 224, 4))
+    depth, normals = arr[..., 0], arr[..., 1:]
+    stats = render_dodeca.compare_renders(depth, normals, depth, normals)
+    self.assertEqual(stats['mask_agreement'], 1.0)
+    self.assertEqual(stats['mean_depth_difference'], 0.0)
+    np.testing.assert_allclose(
+        np.linalg.norm(normals[depth > 0], axis=-1), 1.0, atol=1e-5)
+
+
+if __name__ == '__main__':
+  absltest.main()
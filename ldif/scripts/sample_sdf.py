@@ -0,0 +1,401 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Computes the SDF supervision of an example in process, without GAPS.
+
+This writes the same files as the GAPS msh2pts and msh2df calls of the
+preprocessing, in the same formats and frame:
+  nss_points.sdf: 100K samples within a distance of the surface.
+  uniform_points.sdf: 100K samples uniformly distributed in the bounding box.
+  coarse_grid.grd: A 32^3 grid of the signed distance, with its world2grid.
+Signed distances are negative inside.
+
+The distance to a mesh is found by looking up, in a KD-tree of points on the
+surface, a few candidate triangles near each query, and then computing the
+exact closest point on each candidate. The sign comes from the side of the
+closest triangle the query is on, so the mesh need not be watertight, but its
+faces must be consistently oriented.
+"""
+
+import glob
+import os
+
+import numpy as np
+from scipy import spatial
+from scipy import stats
+import trimesh
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.util import file_util
+from ldif.util.file_util import log
+# pylint: enable=g-bad-import-order
+
+# The parameters of the GAPS calls in the preprocessing:
+SAMPLE_COUNT = 100000
+NEAR_SURFACE_MAX_DISTANCE = 0.04
+BOX_LOWER = -0.7
+BOX_UPPER = 0.7
+GRID_SPACING = 0.044
+
+
+def _dot(x, y):
+  return np.sum(x * y, axis=-1)
+
+
+def closest_points_on_triangles(p, a, b, c):
+  """Finds the closest point on each triangle to a query point.
+
+  Follows Ericson, Real-Time Collision Detection, section 5.1.5.
+
+  Args:
+    p: Numpy array with shape [..., 3]. The query points.
+    a: Numpy array with shape [..., 3]. The first vertex of each triangle.
+    b: Numpy array with shape [..., 3]. The second vertex of each triangle.
+    c: Numpy array with shape [..., 3]. The third vertex of each triangle.
+
+  Returns:
+    Numpy array with shape [..., 3]. The barycentric coordinates of the closest
+    points.
+  """
+  ab = b - a
+  ac = c - a
+  ap = p - a
+  bp = p - b
+  cp = p - c
+  d1 = _dot(ab, ap)
+  d2 = _dot(ac, ap)
+  d3 = _dot(ab, bp)
+  d4 = _dot(ac, bp)
+  d5 = _dot(ab, cp)
+  d6 = _dot(ac, cp)
+  va = d3 * d6 - d5 * d4
+  vb = d5 * d2 - d1 * d6
+  vc = d1 * d4 - d3 * d2
+
+  def safe_divide(x, y):
+    return x / np.where(y == 0.0, 1.0, y)
+
+  # The regions are assigned from the last to the first test in Ericson, so
+  # that the earlier tests take precedence:
+  denominator = va + vb + vc
+  v = safe_divide(vb, denominator)
+  w = safe_divide(vc, denominator)
+  barycentric = np.stack([1.0 - v - w, v, w], axis=-1)
+  regions = []
+  # Edge BC:
+  w = safe_divide(d4 - d3, (d4 - d3) + (d5 - d6))
+  regions.append(((va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0),
+                  [np.zeros_like(w), 1.0 - w, w]))
+  # Edge AC:
+  w = safe_divide(d2, d2 - d6)
+  regions.append(((vb <= 0) & (d2 >= 0) & (d6 <= 0),
+                  [1.0 - w, np.zeros_like(w), w]))
+  # Vertex C:
+  regions.append(((d6 >= 0) & (d5 <= d6), [0.0, 0.0, 1.0]))
+  # Edge AB:
+  v = safe_divide(d1, d1 - d3)
+  regions.append(((vc <= 0) & (d1 >= 0) & (d3 <= 0),
+                  [1.0 - v, v, np.zeros_like(v)]))
+  # Vertex B:
+  regions.append(((d3 >= 0) & (d4 <= d3), [0.0, 1.0, 0.0]))
+  # Vertex A:
+  regions.append(((d1 <= 0) & (d2 <= 0), [1.0, 0.0, 0.0]))
+  for mask, region_barycentric in regions:
+    region_barycentric = np.stack(
+        np.broadcast_arrays(*region_barycentric, mask)[:3], axis=-1)
+    barycentric = np.where(mask[..., np.newaxis], region_barycentric,
+                           barycentric)
+  return barycentric
+
+
+class SignedDistance(object):
+  """Computes the signed distance to a mesh at batches of points."""
+
+  def __init__(self, mesh, candidate_count=16, surface_point_count=20000,
+               seed=0):
+    """Builds the candidate search structure.
+
+    Args:
+      mesh: A trimesh.Trimesh.
+      candidate_count: Int. The number of nearby surface points whose
+        triangles are candidates for the closest triangle to each query.
+      surface_point_count: Int. The number of random points on the surface to
+        look up candidates with, in addition to the triangle corners and
+        centroids. More points make it less likely that the closest triangle is
+        missed, in which case the distance is slightly overestimated.
+      seed: Int. The seed of the random surface points.
+    """
+    self._triangles = np.asarray(mesh.triangles, dtype=np.float64)
+    self._face_normals = np.asarray(mesh.face_normals, dtype=np.float64)
+    face_count = self._triangles.shape[0]
+    rng = np.random.RandomState(seed)
+    surface_points, surface_faces = sample_surface(mesh, surface_point_count,
+                                                   rng)
+    points = np.concatenate([
+        self._triangles.reshape([-1, 3]),
+        np.mean(self._triangles, axis=1), surface_points
+    ])
+    self._point_faces = np.concatenate([
+        np.repeat(np.arange(face_count), 3),
+        np.arange(face_count), surface_faces
+    ])
+    self._tree = spatial.cKDTree(points)
+    self._candidate_count = candidate_count
+
+  def __call__(self, points, batch_size=8192):
+    """Returns the signed distances at a numpy array of [count, 3] points."""
+    distances = np.zeros(points.shape[0], dtype=np.float32)
+    for start in range(0, points.shape[0], batch_size):
+      p = np.asarray(points[start:start + batch_size], dtype=np.float64)
+      _, nearby = self._tree.query(p, k=self._candidate_count)
+      faces = self._point_faces[nearby.reshape([p.shape[0], -1])]
+      triangles = self._triangles[faces]
+      barycentric = closest_points_on_triangles(p[:, np.newaxis, :],
+                                                triangles[..., 0, :],
+                                                triangles[..., 1, :],
+                                                triangles[..., 2, :])
+      closest = np.sum(barycentric[..., np.newaxis] * triangles, axis=-2)
+      candidate_distances = np.linalg.norm(p[:, np.newaxis, :] - closest,
+                                           axis=-1)
+      # When the closest point is on an edge or a vertex, several triangles
+      # are closest. The one whose plane is furthest from the query has the
+      # correct sign, which is the same as using angle-weighted pseudonormals:
+      offsets = _dot(p[:, np.newaxis, :] - closest, self._face_normals[faces])
+      distance = np.min(candidate_distances, axis=1)
+      is_closest = candidate_distances <= distance[:, np.newaxis] + 1e-9
+      best = np.argmax(np.where(is_closest, np.abs(offsets), -1.0), axis=1)
+      is_inside = offsets[np.arange(p.shape[0]), best] < 0.0
+      distances[start:start + batch_size] = np.where(is_inside, -distance,
+                                                     distance)
+    return distances
+
+
+def sample_surface(mesh, count, rng):
+  """Samples points uniformly by area on a mesh.
+
+  Args:
+    mesh: A trimesh.Trimesh.
+    count: Int. The number of points.
+    rng: A numpy RandomState.
+
+  Returns:
+    points: Numpy array with shape [count, 3].
+    faces: Numpy int array with shape [count]. The face of each point.
+  """
+  areas = np.asarray(mesh.area_faces, dtype=np.float64)
+  faces = rng.choice(areas.shape[0], size=count, p=areas / np.sum(areas))
+  uv = rng.uniform(size=[count, 2])
+  # Reflect the points outside the triangle back in:
+  outside = np.sum(uv, axis=1) > 1.0
+  uv[outside] = 1.0 - uv[outside]
+  triangles = np.asarray(mesh.triangles, dtype=np.float64)[faces]
+  points = (triangles[:, 0] + uv[:, :1] * (triangles[:, 1] - triangles[:, 0]) +
+            uv[:, 1:] * (triangles[:, 2] - triangles[:, 0]))
+  return points, faces
+
+
+def near_surface_samples(mesh, signed_distance, rng, count=SAMPLE_COUNT,
+                         max_distance=NEAR_SURFACE_MAX_DISTANCE):
+  """Samples the SDF at points within a distance of the surface.
+
+  Each point is a uniform random point on the surface, moved in a random
+  direction by a distance drawn uniformly from [0, max_distance].
+
+  Args:
+    mesh: A trimesh.Trimesh.
+    signed_distance: The SignedDistance of the mesh.
+    rng: A numpy RandomState.
+    count: Int. The number of samples.
+    max_distance: Float. The largest distance to move a point off the surface.
+
+  Returns:
+    Numpy array with shape [count, 4]. The xyz position and SDF of each sample.
+  """
+  points, _ = sample_surface(mesh, count, rng)
+  directions = rng.normal(size=[count, 3])
+  directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+  points += directions * rng.uniform(0.0, max_distance, size=[count, 1])
+  points = points.astype(np.float32)
+  return np.concatenate([points, signed_distance(points)[:, np.newaxis]],
+                        axis=1)
+
+
+def uniform_samples(signed_distance, rng, count=SAMPLE_COUNT, lower=BOX_LOWER,
+                    upper=BOX_UPPER):
+  """Samples the SDF at points uniformly distributed in a box.
+
+  Args:
+    signed_distance: The SignedDistance of the mesh.
+    rng: A numpy RandomState.
+    count: Int. The number of samples.
+    lower: Float. The lower corner of the box, along every axis.
+    upper: Float. The upper corner of the box, along every axis.
+
+  Returns:
+    Numpy array with shape [count, 4]. The xyz position and SDF of each sample.
+  """
+  points = rng.uniform(lower, upper, size=[count, 3]).astype(np.float32)
+  return np.concatenate([points, signed_distance(points)[:, np.newaxis]],
+                        axis=1)
+
+
+def coarse_grid(signed_distance, lower=BOX_LOWER, upper=BOX_UPPER,
+                spacing=GRID_SPACING):
+  """Samples the SDF on a grid covering a box.
+
+  Args:
+    signed_distance: The SignedDistance of the mesh.
+    lower: Float. The lower corner of the box, along every axis.
+    upper: Float. The upper corner of the box, along every axis.
+    spacing: Float. The distance between grid samples.
+
+  Returns:
+    world2grid: Numpy array with shape [4, 4]. Maps world space to voxel
+      coordinates (x, y, z), which are integers at the samples.
+    grid: Numpy array with shape [resolution, resolution, resolution], indexed
+      [z, y, x], like file_util.read_grd() returns. The grid is centered in the
+      box, with resolution = ceil((upper - lower) / spacing).
+  """
+  resolution = int(np.ceil((upper - lower) / spacing - 1e-6))
+  # The world position of voxel 0, so that the samples are centered in the box:
+  origin = (lower + upper) / 2.0 - spacing * (resolution - 1) / 2.0
+  world2grid = np.diag([1.0 / spacing] * 3 + [1.0]).astype(np.float32)
+  world2grid[:3, 3] = -origin / spacing
+  axis = origin + spacing * np.arange(resolution)
+  zz, yy, xx = np.meshgrid(axis, axis, axis, indexing='ij')
+  points = np.stack([xx, yy, zz], axis=-1).reshape([-1, 3])
+  grid = signed_distance(points).reshape([resolution] * 3)
+  return world2grid, grid
+
+
+def read_sdf_samples(path):
+  """Reads a binary .sdf file of [count, 4] float32 samples."""
+  return np.fromfile(path, dtype=np.float32).reshape([-1, 4])
+
+
+def compare_samples(samples, reference):
+  """Compares the statistics of two SDF sample sets of the same distribution.
+
+  Args:
+    samples: Numpy array with shape [count, 4]. Positions and SDF values.
+    reference: Numpy array with shape [reference_count, 4]. The same, from the
+      reference sampler (for example GAPS).
+
+  Returns:
+    A dictionary of statistics:
+      inside_fraction, reference_inside_fraction: The fraction of samples with
+        negative SDF.
+      sdf_ks_statistic: The Kolmogorov-Smirnov statistic between the SDF
+        distributions, 0 if they are identical.
+      position_ks_statistic: The largest KS statistic of the three coordinates.
+      abs_sdf_quantiles, reference_abs_sdf_quantiles: The 10th, 50th and 90th
+        percentiles of the absolute SDF.
+  """
+  quantiles = [10, 50, 90]
+  return {
+      'inside_fraction': float(np.mean(samples[:, 3] < 0)),
+      'reference_inside_fraction': float(np.mean(reference[:, 3] < 0)),
+      'sdf_ks_statistic': float(
+          stats.ks_2samp(samples[:, 3], reference[:, 3])[0]),
+      'position_ks_statistic': float(
+          max(stats.ks_2samp(samples[:, i], reference[:, i])[0]
+              for i in range(3))),
+      'abs_sdf_quantiles': np.percentile(np.abs(samples[:, 3]),
+                                         quantiles).tolist(),
+      'reference_abs_sdf_quantiles': np.percentile(
+          np.abs(reference[:, 3]), quantiles).tolist(),
+  }
+
+
+def compare_grids(signed_distance, world2grid, grid):
+  """Compares the SDF of a mesh with a reference grid, in the grid's frame.
+
+  Args:
+    signed_distance: The SignedDistance of the mesh.
+    world2grid: Numpy array with shape [4, 4]. The reference grid's transform.
+    grid: Numpy array with shape [depth, height, width], indexed [z, y, x].
+
+  Returns:
+    A dictionary with the sign_agreement (the fraction of voxels on the same
+    side of the surface) and the mean and max absolute SDF difference.
+  """
+  zz, yy, xx = np.meshgrid(*[np.arange(s) for s in grid.shape], indexing='ij')
+  voxels = np.stack([xx, yy, zz, np.ones_like(xx)], axis=-1).reshape([-1, 4])
+  points = np.matmul(voxels, np.linalg.inv(world2grid).T)[:, :3]
+  sdf = signed_distance(points)
+  reference = grid.reshape([-1])
+  difference = np.abs(sdf - reference)
+  return {
+      'sign_agreement': float(np.mean((sdf < 0) == (reference < 0))),
+      'mean_abs_difference': float(np.mean(difference)),
+      'max_abs_difference': float(np.max(difference)),
+  }
+
+
+def compare_with_gaps(example_directory, seed=0):
+  """Samples an example again in process, and compares it with GAPS' samples.
+
+  The normalized mesh isn't kept by the preprocessing, so it's recomputed from
+  mesh_orig (which keeps the extension of the input mesh) and orig_to_gaps.txt.
+
+  Args:
+    example_directory: String. An example directory preprocessed with GAPS.
+    seed: Int. The seed of the native samples.
+
+  Returns:
+    A dictionary with the comparisons of the near_surface and uniform samples
+    (see compare_samples()) and of the grid (see compare_grids()).
+  """
+  mesh_orig = glob.glob(f'{example_directory}/mesh_orig.*')
+  if not mesh_orig:
+    raise ValueError(f'No mesh_orig found in {example_directory}')
+  mesh = trimesh.load(mesh_orig[0], process=False)
+  mesh.apply_transform(file_util.read_txt_to_np(
+      f'{example_directory}/orig_to_gaps.txt').reshape([4, 4]))
+  signed_distance = SignedDistance(mesh, seed=seed)
+  rng = np.random.RandomState(seed)
+  world2grid, grid = file_util.read_grd(f'{example_directory}/coarse_grid.grd')
+  return {
+      'near_surface': compare_samples(
+          near_surface_samples(mesh, signed_distance, rng),
+          read_sdf_samples(f'{example_directory}/nss_points.sdf')),
+      'uniform': compare_samples(
+          uniform_samples(signed_distance, rng),
+          read_sdf_samples(f'{example_directory}/uniform_points.sdf')),
+      'grid': compare_grids(signed_distance, world2grid, grid),
+  }
+
+
+def write_sdf_samples(mesh_path, dirpath, seed=None):
+  """Writes the SDF samples of a normalized mesh to its example directory.
+
+  Args:
+    mesh_path: String. The path to the mesh, already in the normalized frame.
+    dirpath: String. The example directory.
+    seed: Int or None. The random seed, or None to seed from the OS.
+  """
+  mesh = trimesh.load(mesh_path, process=False, force='mesh')
+  if not mesh.faces.shape[0]:
+    raise ValueError(f'The mesh {mesh_path} has no faces.')
+  rng = np.random.RandomState(seed)
+  signed_distance = SignedDistance(mesh, seed=rng.randint(2**31))
+  nss = near_surface_samples(mesh, signed_distance, rng)
+  nss.astype(np.float32).tofile(os.path.join(dirpath, 'nss_points.sdf'))
+  uniform = uniform_samples(signed_distance, rng)
+  uniform.astype(np.float32).tofile(os.path.join(dirpath, 'uniform_points.sdf'))
+  world2grid, grid = coarse_grid(signed_distance)
+  file_util.write_grd(os.path.join(dirpath, 'coarse_grid.grd'), grid,
+                      world2grid)
+  log.verbose(f'Wrote the SDF samples of {mesh_path} to {dirpath}.')
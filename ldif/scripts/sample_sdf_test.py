@@ -0,0 +1,146 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.scripts.sample_sdf."""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from skimage import measure
+import trimesh
+
+from absl.testing import absltest
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.scripts import sample_sdf
+from ldif.util import file_util
+from ldif.util import path_util
+# pylint: enable=g-bad-import-order
+
+
+def box_sdf(points, half_extents):
+  q = np.abs(points) - half_extents
+  return (np.linalg.norm(np.maximum(q, 0.0), axis=-1) +
+          np.minimum(np.max(q, axis=-1), 0.0))
+
+
+class SampleSdfTest(absltest.TestCase):
+
+  def testSignedDistanceToBox(self):
+    half_extents = np.array([0.3, 0.2, 0.1])
+    mesh = trimesh.creation.box(extents=2 * half_extents)
+    points = np.random.RandomState(0).uniform(-0.7, 0.7, size=[5000, 3])
+    sdf = sample_sdf.SignedDistance(mesh)(points)
+    np.testing.assert_allclose(sdf, box_sdf(points, half_extents), atol=1e-5)
+
+  def testSignedDistanceToSphere(self):
+    mesh = trimesh.creation.icosphere(subdivisions=4, radius=0.3)
+    points = np.random.RandomState(0).uniform(-0.7, 0.7, size=[5000, 3])
+    sdf = sample_sdf.SignedDistance(mesh)(points)
+    # The tessellation is within 1e-3 of the sphere:
+    np.testing.assert_allclose(
+        sdf, np.linalg.norm(points, axis=-1) - 0.3, atol=1e-3)
+
+  def testSamples(self):
+    half_extents = np.array([0.3, 0.2, 0.1])
+    mesh = trimesh.creation.box(extents=2 * half_extents)
+    signed_distance = sample_sdf.SignedDistance(mesh)
+    rng = np.random.RandomState(0)
+    nss = sample_sdf.near_surface_samples(mesh, signed_distance, rng)
+    self.assertEqual(nss.shape, (100000, 4))
+    self.assertLessEqual(np.max(np.abs(nss[:, 3])), 0.04 + 1e-5)
+    np.testing.assert_allclose(
+        nss[:, 3], box_sdf(nss[:, :3], half_extents), atol=1e-5)
+    uniform = sample_sdf.uniform_samples(signed_distance, rng)
+    self.assertEqual(uniform.shape, (100000, 4))
+    self.assertLessEqual(np.max(np.abs(uniform[:, :3])), 0.7)
+    # The box is 0.048 of the volume of the sampling box:
+    self.assertAlmostEqual(np.mean(uniform[:, 3] < 0), 0.048 / 2.744, places=2)
+
+  def testCoarseGridFrame(self):
+    half_extents = np.array([0.3, 0.2, 0.1])
+    mesh = trimesh.creation.box(extents=2 * half_extents)
+    world2grid, grid = sample_sdf.coarse_grid(sample_sdf.SignedDistance(mesh))
+    self.assertEqual(grid.shape, (32, 32, 32))
+    # Voxel (x, y, z) = (3, 20, 7) is at grid[7, 20, 3]:
+    point = np.matmul(np.linalg.inv(world2grid), [3.0, 20.0, 7.0, 1.0])[:3]
+    self.assertAlmostEqual(
+        grid[7, 20, 3], box_sdf(point, half_extents), places=5)
+    # The grid is centered:
+    center = np.matmul(np.linalg.inv(world2grid), [15.5, 15.5, 15.5, 1.0])
+    np.testing.assert_allclose(center[:3], 0.0, atol=1e-6)
+
+  def testWriteSdfSamples(self):
+    dirpath = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, dirpath)
+    mesh_path = os.path.join(dirpath, 'model_normalized.obj')
+    trimesh.creation.box(extents=[0.6, 0.4, 0.2]).export(mesh_path)
+    sample_sdf.write_sdf_samples(mesh_path, dirpath, seed=0)
+    nss = sample_sdf.read_sdf_samples(os.path.join(dirpath, 'nss_points.sdf'))
+    uniform = sample_sdf.read_sdf_samples(
+        os.path.join(dirpath, 'uniform_points.sdf'))
+    self.assertEqual(nss.shape, (100000, 4))
+    self.assertEqual(uniform.shape, (100000, 4))
+    world2grid, grid = file_util.read_grd(
+        os.path.join(dirpath, 'coarse_grid.grd'))
+    self.assertEqual(grid.shape, (32, 32, 32))
+    np.testing.assert_allclose(world2grid[0, 0], 1.0 / 0.044, rtol=1e-6)
+    stats = sample_sdf.compare_samples(nss, nss)
+    self.assertEqual(stats['sdf_ks_statistic'], 0.0)
+
+  def testCompareWithGapsKeepsTheMeshExtension(self):
+    dirpath = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, dirpath)
+    mesh_path = os.path.join(dirpath, 'mesh_orig.obj')
+    trimesh.creation.box(extents=[0.6, 0.4, 0.2]).export(mesh_path)
+    np.savetxt(os.path.join(dirpath, 'orig_to_gaps.txt'), np.eye(4))
+    sample_sdf.write_sdf_samples(mesh_path, dirpath, seed=0)
+    stats = sample_sdf.compare_with_gaps(dirpath)
+    self.assertEqual(stats['grid']['sign_agreement'], 1.0)
+    os.remove(mesh_path)
+    with self.assertRaisesRegex(ValueError, 'No mesh_orig'):
+      sample_sdf.compare_with_gaps(dirpath)
+
+  def testAgreesWithReferenceGrid(self):
+    # A reference SDF grid of a ShapeNet shape. Its surface, extracted with
+    # marching cubes, should have the same SDF near the surface:
+    test_data = path_util.util_test_data_path()
+    shape = '1042d723dfc31ce5ec56aed2da084563'
+    grid = np.load(os.path.join(test_data, f'{shape}_sdf.npy'))
+    world2grid = np.load(os.path.join(test_data, f'{shape}_tx.npy'))
+    vertices, faces = measure.marching_cubes(grid, 0.0)[:2]
+    # Marching cubes returns [z, y, x] vertices, which flips the winding:
+    vertices = np.concatenate(
+        [vertices[:, ::-1], np.ones([vertices.shape[0], 1])], axis=1)
+    vertices = np.matmul(vertices, np.linalg.inv(world2grid).T)[:, :3]
+    mesh = trimesh.Trimesh(vertices, faces[:, ::-1], process=False)
+    signed_distance = sample_sdf.SignedDistance(mesh)
+    stats = sample_sdf.compare_grids(signed_distance, world2grid, grid)
+    self.assertGreater(stats['sign_agreement'], 0.99)
+    # Away from the surface the reference values are about 7% larger, so only
+    # the voxels near the surface are compared:
+    zz, yy, xx = np.nonzero(np.abs(grid) < 0.05)
+    points = np.matmul(
+        np.stack([xx, yy, zz, np.ones_like(xx)], axis=-1),
+        np.linalg.inv(world2grid).T)[:, :3]
+    difference = np.abs(signed_distance(points) - grid[zz, yy, xx])
+    # A fifth of a voxel:
+    self.assertLess(np.mean(difference), 0.005)
+
+
+if __name__ == '__main__':
+  absltest.main()
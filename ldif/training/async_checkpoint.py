@@ -0,0 +1,130 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Writes checkpoints in a background thread while training carries on.
+
+A save copies every global variable into a host-memory shadow variable, which
+only takes as long as the copy. The shadows are then written to disk by a
+tf.train.Saver in a background thread. The saved names are those of the
+original variables, so the checkpoints restore with an ordinary
+tf.train.Saver.
+
+At most one checkpoint is being written at a time: a save waits for the
+previous write to finish before it overwrites the shadows. The Saver writes
+the checkpoint data to temporary files and renames them before it updates the
+checkpoint state file, so the latest checkpoint is never a partial one, and
+the checkpoints beyond max_to_keep are deleted as usual.
+"""
+
+import concurrent.futures
+import time
+
+import tensorflow as tf
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.util.file_util import log
+# pylint: enable=g-bad-import-order
+
+
+class AsyncCheckpointer(object):
+  """Saves the global variables of the default graph asynchronously."""
+
+  def __init__(self, var_list=None, max_to_keep=5, pad_step_number=False,
+               save_relative_paths=True):
+    """Adds the snapshot ops to the default graph.
+
+    Must be called after the model is built and before the graph is finalized.
+
+    Args:
+      var_list: A list of the variables to save. Defaults to all the global
+        variables.
+      max_to_keep: Int. The number of most recent checkpoints to keep, as in
+        tf.train.Saver.
+      pad_step_number: Boolean. Passed to tf.train.Saver.
+      save_relative_paths: Boolean. Passed to tf.train.Saver.
+    """
+    if var_list is None:
+      var_list = tf.compat.v1.global_variables()
+    shadows = {}
+    assigns = []
+    with tf.name_scope('async_checkpoint'), tf.device('/cpu:0'):
+      for variable in var_list:
+        name = variable.op.name
+        # Outside of every collection, so that it's never initialized, saved,
+        # or trained by anything else:
+        shadow = tf.compat.v1.Variable(
+            tf.zeros(variable.shape, variable.dtype.base_dtype),
+            trainable=False,
+            collections=[],
+            name=name)
+        shadows[name] = shadow
+        assigns.append(tf.compat.v1.assign(shadow, variable))
+    self._snapshot = tf.group(*assigns)
+    self._saver = tf.compat.v1.train.Saver(
+        var_list=shadows,
+        max_to_keep=max_to_keep,
+        pad_step_number=pad_step_number,
+        save_relative_paths=save_relative_paths)
+    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    self._pending = None
+
+  def _write(self, session, save_path, global_step):
+    # The default graph is thread-local, so it's entered in the writer thread:
+    with session.graph.as_default():
+      # No meta graph is written: its saver_def would restore into the
+      # shadows.
+      self._saver.save(
+          session, save_path, global_step=global_step, write_meta_graph=False)
+
+  def flush(self):
+    """Waits for the pending checkpoint, if any, to be written.
+
+    Raises:
+      The exception the pending write raised, if it failed.
+    """
+    if self._pending is None:
+      return
+    pending, self._pending = self._pending, None
+    start_t = time.time()
+    pending.result()
+    log.verbose(f'Waited {time.time() - start_t:.2f}s for the previous'
+                ' checkpoint to be written.')
+
+  def save(self, session, save_path, global_step=None):
+    """Snapshots the variables, then writes them in the background.
+
+    Args:
+      session: The tf.Session the variables live in. It must stay open until
+        the write finishes, so flush() or close() before closing it.
+      save_path: String. The checkpoint path prefix, as in tf.train.Saver.
+      global_step: Int. If set, appended to the checkpoint file names.
+    """
+    self.flush()
+    session.run(self._snapshot)
+    self._pending = self._executor.submit(self._write, session, save_path,
+                                          global_step)
+
+  def close(self):
+    """Flushes the pending checkpoint and stops the background thread."""
+    try:
+      self.flush()
+    finally:
+      self._executor.shutdown()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
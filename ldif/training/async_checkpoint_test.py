@@ -0,0 +1,92 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.training.async_checkpoint."""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from absl.testing import absltest
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.training import async_checkpoint
+# pylint: enable=g-bad-import-order
+
+
+class AsyncCheckpointerTest(absltest.TestCase):
+
+  def setUp(self):
+    super(AsyncCheckpointerTest, self).setUp()
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory)
+    self.path = os.path.join(self.directory, 'model.ckpt')
+
+  def testSavesTheSnapshotAndKeepsTheMostRecent(self):
+    with tf.Graph().as_default():
+      weights = tf.compat.v1.get_variable(
+          'weights', initializer=tf.zeros([3, 4]))
+      step = tf.compat.v1.get_variable(
+          'step', initializer=tf.constant(0, dtype=tf.int64), trainable=False)
+      increment = tf.group(
+          tf.compat.v1.assign_add(weights, tf.ones([3, 4])),
+          tf.compat.v1.assign_add(step, 1))
+      checkpointer = async_checkpoint.AsyncCheckpointer(max_to_keep=2)
+      self.assertLen(tf.compat.v1.global_variables(), 2)
+      with tf.compat.v1.Session() as session, checkpointer:
+        session.run(tf.compat.v1.global_variables_initializer())
+        for i in range(4):
+          session.run(increment)
+          checkpointer.save(session, self.path, global_step=i)
+          # Changing the variables doesn't change the pending checkpoint:
+          session.run(increment)
+
+    self.assertEqual(
+        tf.train.latest_checkpoint(self.directory), f'{self.path}-3')
+    self.assertCountEqual(
+        tf.train.get_checkpoint_state(
+            self.directory).all_model_checkpoint_paths,
+        [f'{self.path}-2', f'{self.path}-3'])
+    self.assertFalse(os.path.exists(f'{self.path}-1.index'))
+    for i in [2, 3]:
+      reader = tf.train.load_checkpoint(f'{self.path}-{i}')
+      self.assertCountEqual(reader.get_variable_to_shape_map(),
+                            ['weights', 'step'])
+      np.testing.assert_array_equal(
+          reader.get_tensor('weights'), np.full([3, 4], 2 * i + 1))
+      self.assertEqual(reader.get_tensor('step'), 2 * i + 1)
+
+  def testRestoresWithAnOrdinarySaver(self):
+    with tf.Graph().as_default():
+      weights = tf.compat.v1.get_variable(
+          'weights', initializer=tf.constant([1.0, 2.0]))
+      checkpointer = async_checkpoint.AsyncCheckpointer()
+      with tf.compat.v1.Session() as session:
+        session.run(tf.compat.v1.global_variables_initializer())
+        checkpointer.save(session, self.path, global_step=7)
+        checkpointer.close()
+    with tf.Graph().as_default():
+      weights = tf.compat.v1.get_variable('weights', shape=[2])
+      saver = tf.compat.v1.train.Saver()
+      with tf.compat.v1.Session() as session:
+        saver.restore(session, tf.train.latest_checkpoint(self.directory))
+        np.testing.assert_array_equal(session.run(weights), [1.0, 2.0])
+
+
+if __name__ == '__main__':
+  absltest.main()
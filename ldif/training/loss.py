@@ -319,9 +319,7 @@ def sample_loss(model_config, gt_sdf, structured_implicit, global_samples, name,
 def uniform_sample_loss(model_config, training_example, structured_implicit):
   """Loss that uniformly sampled points should have the right insidedness."""
   print('uniform_sample_loss')
-  sample_count = (
-      model_config.hparams.xsc
-      if model_config.hparams.lrf == 'x' else model_config.hparams.spc)
+  sample_count = shapenet.supervision_sample_count(model_config.hparams)
   samples, gt_sdf = training_example.sample_sdf_uniform(
       sample_count=sample_count)
   tf.logging.info('Building Uniform Sample Loss.')
@@ -341,9 +339,7 @@ def uniform_sample_loss(model_config, training_example, structured_implicit):
 
 def overlap_loss(model_config, training_example, structured_implicit):
   """A loss on the overlap between RBF weights."""
-  sample_count = (
-      model_config.hparams.xsc
-      if model_config.hparams.lrf == 'x' else model_config.hparams.spc)
+  sample_count = shapenet.supervision_sample_count(model_config.hparams)
   samples, _ = training_example.sample_sdf_near_surface(
       sample_count=sample_count)
   rbf_influences = structured_implicit.rbf_influence_at_samples(samples)
@@ -357,9 +353,7 @@ def overlap_loss(model_config, training_example, structured_implicit):
 def near_surface_sample_loss(model_config, training_example,
                              structured_implicit):
   """An inside/outside loss that samples based on distance to the surface."""
-  sample_count = (
-      model_config.hparams.xsc
-      if model_config.hparams.lrf == 'x' else model_config.hparams.spc)
+  sample_count = shapenet.supervision_sample_count(model_config.hparams)
   samples, gt_sdf = training_example.sample_sdf_near_surface(
       sample_count=sample_count)
   tf.logging.info('Building Near Surface Sample Loss.')
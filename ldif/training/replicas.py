@@ -0,0 +1,135 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Builds a graph replicated across devices, for data-parallel training.
+
+Every replica shares one set of variables, which are placed on the CPU. The
+first replica is built without a name scope, so its ops (and summaries) are
+named as in a single device graph, and the variables have the same names, so
+the checkpoints restore into single device graphs. The other replicas are
+built in 'replica_{i}' name scopes.
+"""
+
+import contextlib
+
+import tensorflow as tf
+
+# The variable ops, which are placed on the CPU by replica_device_fn():
+_VARIABLE_OP_TYPES = ['Variable', 'VariableV2', 'VarHandleOp']
+REPLICA_SCOPE_PREFIX = 'replica_'
+
+DEVICE_TYPES = ['cpu', 'gpu']
+
+
+def replica_devices(replica_count, device_type):
+  """Returns the names of the devices of each replica."""
+  if device_type not in DEVICE_TYPES:
+    raise ValueError(f'Unrecognized device type {device_type}. Expected one'
+                     f' of {DEVICE_TYPES}.')
+  return [f'/{device_type}:{i}' for i in range(replica_count)]
+
+
+def session_config(replica_count, device_type):
+  """Returns a ConfigProto with a device for each replica.
+
+  Soft placement is allowed, so that the ops without a GPU kernel (e.g. on
+  mesh names) run on the CPU rather than failing.
+  """
+  config = tf.compat.v1.ConfigProto(allow_soft_placement=True)
+  if device_type == 'cpu':
+    config.device_count['CPU'] = replica_count
+  return config
+
+
+def replica_device_fn(device):
+  """Returns a device function that places variables on the CPU.
+
+  Args:
+    device: String. The device of the other ops of a replica.
+  """
+
+  def device_fn(op):
+    if op.type in _VARIABLE_OP_TYPES:
+      return '/cpu:0'
+    return device
+
+  return device_fn
+
+
+def is_replica_op(op):
+  """Whether an op was built by a replica other than the first."""
+  return op.name.startswith(REPLICA_SCOPE_PREFIX)
+
+
+def build_replicas(build_fn, devices):
+  """Calls build_fn once per device, sharing the variables it creates.
+
+  Args:
+    build_fn: A function that takes the index of a replica and builds its
+      graph, creating its variables with tf.compat.v1.get_variable().
+    devices: A list of the device of each replica.
+
+  Returns:
+    A list of the results of build_fn.
+  """
+  results = []
+  for i, device in enumerate(devices):
+    with contextlib.ExitStack() as stack:
+      stack.enter_context(
+          tf.compat.v1.variable_scope(
+              tf.compat.v1.get_variable_scope(), reuse=i > 0))
+      # Inside the variable scope, which would otherwise reset the name scope:
+      if i > 0:
+        stack.enter_context(
+            tf.compat.v1.name_scope(f'{REPLICA_SCOPE_PREFIX}{i}'))
+      stack.enter_context(tf.compat.v1.device(replica_device_fn(device)))
+      results.append(build_fn(i))
+  return results
+
+
+def remove_replica_ops(collection_key):
+  """Removes the ops of all but the first replica from a graph collection.
+
+  Used so that the summaries and the update ops (e.g. batch norm moving
+  averages) are those of the first replica only.
+  """
+  collection = tf.compat.v1.get_collection_ref(collection_key)
+  collection[:] = [
+      x for x in collection
+      if not is_replica_op(x if isinstance(x, tf.Operation) else x.op)
+  ]
+
+
+def average_gradients(replica_grads_and_vars):
+  """Averages the gradients of each variable over the replicas.
+
+  Args:
+    replica_grads_and_vars: A list with the list of (gradient, variable) pairs
+      of each replica, in the same variable order.
+
+  Returns:
+    A list of (mean gradient, variable) pairs. A None gradient counts as zero,
+    and the variables without a gradient in any replica have a None gradient.
+  """
+  averaged = []
+  for pairs in zip(*replica_grads_and_vars):
+    variable = pairs[0][1]
+    grads = [g for g, _ in pairs if g is not None]
+    if not grads:
+      averaged.append((None, variable))
+      continue
+    with tf.compat.v1.colocate_with(variable):
+      grad = tf.add_n([tf.convert_to_tensor(g) for g in grads]) / len(pairs)
+    averaged.append((grad, variable))
+  return averaged
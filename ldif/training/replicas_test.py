@@ -0,0 +1,96 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.training.replicas."""
+
+import numpy as np
+import tensorflow as tf
+
+from absl.testing import absltest
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.training import replicas
+# pylint: enable=g-bad-import-order
+
+INPUTS = np.arange(24, dtype=np.float32).reshape([4, 6]) / 10.0
+
+
+def build_model(inputs):
+  """A small model whose loss is the mean over its batch."""
+  with tf.compat.v1.variable_scope('model'):
+    weights = tf.compat.v1.get_variable(
+        'weights', initializer=tf.ones([6, 2]) / 4.0)
+    bias = tf.compat.v1.get_variable('bias', initializer=tf.zeros([2]))
+  outputs = tf.matmul(inputs, weights) + bias
+  tf.compat.v1.summary.scalar('output-mean', tf.reduce_mean(outputs))
+  return tf.reduce_mean(tf.square(outputs - 1.0))
+
+
+def gradients(replica_count):
+  """Evaluates the gradients of the loss of INPUTS, split over replicas."""
+  with tf.Graph().as_default():
+    inputs = tf.split(tf.constant(INPUTS), replica_count)
+    devices = replicas.replica_devices(replica_count, 'cpu')
+    losses = replicas.build_replicas(lambda i: build_model(inputs[i]),
+                                     devices)
+    variables = tf.compat.v1.global_variables()
+    replica_grads_and_vars = [
+        list(zip(tf.gradients(loss, variables), variables)) for loss in losses
+    ]
+    grads_and_vars = replicas.average_gradients(replica_grads_and_vars)
+    replicas.remove_replica_ops(tf.compat.v1.GraphKeys.SUMMARIES)
+    summaries = tf.compat.v1.get_collection(tf.compat.v1.GraphKeys.SUMMARIES)
+    config = replicas.session_config(replica_count, 'cpu')
+    with tf.compat.v1.Session(config=config) as session:
+      session.run(tf.compat.v1.global_variables_initializer())
+      grads = session.run([g for g, _ in grads_and_vars])
+    return ([v.op.name for v in variables], [losses[-1].device], grads,
+            [s.op.name for s in summaries])
+
+
+class ReplicasTest(absltest.TestCase):
+
+  def testReplicasShareVariablesAndAverageGradients(self):
+    names, _, grads, summaries = gradients(1)
+    replicated_names, devices, replicated_grads, replicated_summaries = (
+        gradients(2))
+    self.assertEqual(names, ['model/weights', 'model/bias'])
+    self.assertEqual(replicated_names, names)
+    self.assertIn('CPU:1', devices[0].upper())
+    for grad, replicated_grad in zip(grads, replicated_grads):
+      np.testing.assert_allclose(grad, replicated_grad, rtol=1e-5)
+    # Only the first replica's summaries are kept, named as with one replica:
+    self.assertEqual(summaries, ['output-mean'])
+    self.assertEqual(replicated_summaries, ['output-mean'])
+
+  def testVariablesAreOnTheCpu(self):
+    with tf.Graph().as_default():
+      replicas.build_replicas(
+          lambda i: build_model(tf.constant(INPUTS)),
+          replicas.replica_devices(2, 'gpu'))
+      for variable in tf.compat.v1.global_variables():
+        self.assertIn('CPU:0', variable.device.upper())
+      self.assertTrue(
+          all('GPU' in op.device.upper()
+              for op in tf.compat.v1.get_default_graph().get_operations()
+              if op.type == 'MatMul'))
+
+  def testUnknownDeviceType(self):
+    with self.assertRaisesRegex(ValueError, 'Unrecognized device type'):
+      replicas.replica_devices(2, 'tpu')
+
+
+if __name__ == '__main__':
+  absltest.main()
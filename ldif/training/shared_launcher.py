@@ -14,17 +14,23 @@
 # Lint as: python3
 """Launcher functionality that is shared between local and remote training."""
 
+import copy
+import functools
+
 from absl import flags
 
 import tensorflow as tf
 
 # LDIF is an internal package, should be imported last.
 # pylint: disable=g-bad-import-order
+from ldif.datasets import local_inputs
 from ldif.training import eval_step
 from ldif.training import loss
 from ldif.model import model
 from ldif.datasets import preprocess
+from ldif.training import replicas
 from ldif.training import summarize
+from ldif.util import opt_util
 # pylint: enable=g-bad-import-order
 
 from tensorflow.contrib import framework as contrib_framework
@@ -49,8 +55,71 @@ FLAGS = flags.FLAGS
 #     7 numbers for our current model) and how many shape elements there are.
 
 
-def set_train_op(model_config):
-  """Sets the train op for a single weights update."""
+def _set_gradient_train_ops(model_config, optimizer, update_ops,
+                            variables_to_train, transform_grads_fn,
+                            replica_losses=None):
+  """Sets train ops that compute and apply the gradients step by step.
+
+  Used instead of create_train_op() to average the gradients of several
+  replicas, or to apply the mean gradients of [gac] micro-batches. In that
+  case, model_config.accumulate_op adds the gradients of a micro-batch to the
+  sums. model_config.train_op does the same for the last micro-batch of a
+  step, then applies the mean gradients, increments the global step and
+  zeroes the sums. The ops evaluate to the total loss of their batch (the mean
+  over the replicas), like the op made by create_train_op().
+  """
+  global_step = tf.compat.v1.train.get_or_create_global_step()
+  losses = replica_losses or [model_config.loss[0]]
+  # The update ops (e.g. batch norm statistics) run for every micro-batch:
+  with tf.control_dependencies(update_ops):
+    total_loss = tf.add_n(losses) / len(losses)
+  # Each replica's backward pass runs on its device:
+  replica_grads_and_vars = [
+      optimizer.compute_gradients(
+          replica_loss,
+          var_list=variables_to_train,
+          colocate_gradients_with_ops=len(losses) > 1)
+      for replica_loss in losses
+  ]
+  grads_and_vars = replicas.average_gradients(replica_grads_and_vars)
+  if model_config.hparams.gac == 1:
+    if transform_grads_fn is not None:
+      grads_and_vars = transform_grads_fn(grads_and_vars)
+    apply_op = optimizer.apply_gradients(
+        grads_and_vars, global_step=global_step)
+    model_config.accumulate_op = None
+    with tf.control_dependencies([apply_op]):
+      model_config.train_op = tf.identity(total_loss)
+    return
+  accumulator = opt_util.GradientAccumulator(grads_and_vars)
+  accumulate = accumulator.accumulate()
+  with tf.control_dependencies([accumulate]):
+    model_config.accumulate_op = tf.identity(total_loss)
+    grads_and_vars = accumulator.mean_grads_and_vars(
+        model_config.hparams.gac)
+  if transform_grads_fn is not None:
+    grads_and_vars = transform_grads_fn(grads_and_vars)
+  apply_op = optimizer.apply_gradients(grads_and_vars, global_step=global_step)
+  with tf.control_dependencies([apply_op]):
+    reset = accumulator.reset()
+  with tf.control_dependencies([reset]):
+    model_config.train_op = tf.identity(total_loss)
+
+
+def set_train_op(model_config, replica_losses=None):
+  """Sets the train op for a single weights update.
+
+  If the [gac] hparam is greater than 1, a weights update takes that many
+  micro-batches: model_config.accumulate_op must be run on the first [gac] - 1,
+  then model_config.train_op on the last. Otherwise model_config.accumulate_op
+  is None.
+
+  Args:
+    model_config: A ModelConfig instance.
+    replica_losses: A list of the total loss of each replica built by
+      data_parallel_sif_transcoder(), whose gradients are averaged. If None,
+      the gradients are those of model_config.loss[0].
+  """
   # print('model_config.hparams.opt:', model_config.hparams.opt)  # adm
   # print('Learning Rate:', model_config.hparams.lr)  # 5e-05
   # print(model_config.hparams.sync, model_config.hparams.ob)  # f, t
@@ -71,6 +140,9 @@ def set_train_op(model_config):
     if model_config.hparams.sync == 't':  # False in LDIF training
       assert model_config.hparams.gpuc > 0
       assert model_config.hparams.vbs > 0
+      if model_config.hparams.gac > 1 or replica_losses is not None:
+        raise ValueError('Gradient accumulation and data-parallel replicas'
+                         ' are not supported with synchronized replicas.')
       optimizer = tf.train.SyncReplicasOptimizer(
           optimizer,
           replicas_to_aggregate=model_config.hparams.vbs,
@@ -85,21 +157,37 @@ def set_train_op(model_config):
       update_ops = contrib_framework.filter_variables(
           update_ops, exclude_patterns=['explicit_embedding_cnn'])
 
+    transform_grads_fn = None
+    if model_config.hparams.gcn > 0.0:
+      transform_grads_fn = functools.partial(
+          opt_util.clip_by_global_norm, clip_norm=model_config.hparams.gcn)
+    if model_config.hparams.gac < 1:
+      raise ValueError('The gradient accumulation count [gac] must be >= 1,'
+                       f' but is {model_config.hparams.gac}.')
+    if model_config.hparams.gac > 1 or replica_losses is not None:
+      _set_gradient_train_ops(model_config, optimizer, update_ops,
+                              variables_to_train, transform_grads_fn,
+                              replica_losses)
+      return
+    model_config.accumulate_op = None
     model_config.train_op = contrib_training.create_train_op(
         model_config.loss[0],
         optimizer=optimizer,
         update_ops=update_ops,
         variables_to_train=variables_to_train,
-        # transform_grads_fn=opt_util.clip_by_global_norm,
+        transform_grads_fn=transform_grads_fn,
         summarize_gradients=False,
         colocate_gradients_with_ops=False)
 
 
-def sif_transcoder(model_config):
+def sif_transcoder(model_config, build_train_op=True):
   """Builds a structured implicit function transcoder.
 
   Args:
     model_config: A ModelConfig instance.
+    build_train_op: Boolean. Whether to set the train op when training. False
+      for the replicas of data_parallel_sif_transcoder(), whose train op is
+      made from the losses of all of them.
   """
   # Get the input data from the input_fn.
   if not model_config.train:
@@ -166,8 +254,45 @@ def sif_transcoder(model_config):
   if model_config.train:  # True when training
     print('model_config.train')
     summarize.add_train_summaries(model_config, prediction)
-    set_train_op(model_config)
+    if build_train_op:
+      set_train_op(model_config)
   elif model_config.eval:
     model_config.eval_step = eval_step.make_eval_step(model_config,
                                                       training_example,
                                                       prediction)
+
+
+def data_parallel_sif_transcoder(model_config, devices):
+  """Builds a transcoder for training, replicated across devices.
+
+  Replica i trains on the i-th contiguous part of each batch of
+  model_config.inputs['dataset'], and the gradients are averaged over the
+  replicas before each weights update. The variables are shared, and named as
+  in a single device graph. The summaries, the update ops, and
+  model_config.loss are those of the first replica.
+
+  Args:
+    model_config: A training ModelConfig instance. Its hparams.bs is the
+      global batch size, and is set to the batch size of a replica.
+    devices: A list of the device of each replica. See
+      replicas.replica_devices().
+  """
+  if not model_config.train:
+    raise ValueError('Only training can be replicated.')
+  datasets = local_inputs.split_dataset_obj(model_config.inputs['dataset'],
+                                            len(devices))
+  model_config.hparams.bs //= len(devices)
+
+  def build_replica(i):
+    replica_config = copy.copy(model_config)
+    replica_config.inputs = dict(model_config.inputs, dataset=datasets[i])
+    sif_transcoder(replica_config, build_train_op=False)
+    return replica_config
+
+  replica_configs = replicas.build_replicas(build_replica, devices)
+  replicas.remove_replica_ops(tf.GraphKeys.SUMMARIES)
+  replicas.remove_replica_ops(tf.GraphKeys.UPDATE_OPS)
+  model_config.loss = replica_configs[0].loss
+  set_train_op(
+      model_config,
+      replica_losses=[config.loss[0] for config in replica_configs])
@@ -0,0 +1,178 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Breaks the time of each training step down into phases.
+
+The phases of a step are:
+  - input_wait: The time the step waited for the input pipeline to produce a
+    batch. It's measured in the graph, by timestamps taken when the step
+    starts and when the batch is ready (see input_timestamps()).
+  - compute: The rest of the session.run() call of a step without summaries.
+  - summary_compute: The same, for a step that also evaluates the summaries.
+  With gradient accumulation a step makes a session.run() call per batch, and
+  these three phases are summed over them.
+  - summary_write: Writing the summaries to the event file.
+  - checkpoint: Saving a checkpoint (or, when checkpoints are written in the
+    background, snapshotting the variables).
+  - step: The whole step, including the python overhead.
+Each phase keeps the durations of its most recent steps, and the profiler
+reports their percentiles.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from tensorflow.python.client import timeline
+
+PHASES = [
+    'input_wait', 'compute', 'summary_compute', 'summary_write', 'checkpoint',
+    'step'
+]
+PERCENTILES = [50, 95, 99]
+
+
+def input_timestamps(tensors):
+  """Adds timestamps of the start of a step and of its batch being ready.
+
+  The start timestamp has no inputs, so it runs as soon as the step starts,
+  at the same time as the iterator's get_next().
+
+  Args:
+    tensors: A list of the tensors of a batch of the input pipeline.
+
+  Returns:
+    A tuple of two float64 scalar tensors: the start and ready timestamps, in
+    seconds.
+  """
+  start = tf.timestamp(name='step_start_timestamp')
+  with tf.control_dependencies(tensors):
+    ready = tf.timestamp(name='batch_ready_timestamp')
+  return start, ready
+
+
+def trace_run_options():
+  return tf.compat.v1.RunOptions(
+      trace_level=tf.compat.v1.RunOptions.FULL_TRACE)
+
+
+def write_timeline(run_metadata, path):
+  """Writes the step stats of a traced step as a chrome://tracing file."""
+  trace = timeline.Timeline(run_metadata.step_stats)
+  with tf.io.gfile.GFile(path, 'w') as f:
+    f.write(trace.generate_chrome_trace_format())
+
+
+class StepProfiler(object):
+  """Records the duration of the phases of each step."""
+
+  def __init__(self, window=100):
+    """Initializes the profiler.
+
+    Args:
+      window: Int. The number of most recent durations of each phase that the
+        percentiles are computed over.
+    """
+    self.window = window
+    self._durations = {
+        phase: collections.deque(maxlen=window) for phase in PHASES
+    }
+
+  def record(self, phase, seconds):
+    if phase not in self._durations:
+      raise ValueError(f'Unknown phase {phase}. Expected one of {PHASES}.')
+    self._durations[phase].append(seconds)
+
+  @contextlib.contextmanager
+  def timed(self, phase):
+    """Records the duration of the enclosed block."""
+    start_t = time.time()
+    try:
+      yield
+    finally:
+      self.record(phase, time.time() - start_t)
+
+  def record_runs(self, runs, is_summary_step):
+    """Splits the duration of the session.run() calls of a step into phases.
+
+    The phases are summed over the calls, so that they are per step, like the
+    'step' phase they are a part of.
+
+    Args:
+      runs: A list with a tuple (run_seconds, timestamps) for each call of the
+        step. run_seconds is the wall time of the call, and timestamps are the
+        values of the input_timestamps() tensors for the call.
+      is_summary_step: Boolean. Whether the step evaluated the summaries.
+    """
+    input_wait = 0.0
+    compute = 0.0
+    for run_seconds, timestamps in runs:
+      run_input_wait = min(max(timestamps[1] - timestamps[0], 0.0), run_seconds)
+      input_wait += run_input_wait
+      compute += run_seconds - run_input_wait
+    self.record('input_wait', input_wait)
+    self.record('summary_compute' if is_summary_step else 'compute', compute)
+
+  def report(self):
+    """Returns the statistics of each phase over the window.
+
+    Returns:
+      A dictionary with the 'phases' (the count, mean, and percentiles of the
+      durations of each phase that was recorded, in seconds), and the
+      'input_wait_fraction' of the mean step time, or None if unknown.
+    """
+    phases = {}
+    for phase, durations in self._durations.items():
+      if not durations:
+        continue
+      durations = np.array(durations)
+      stats = {'count': len(durations), 'mean': float(np.mean(durations))}
+      for p, value in zip(PERCENTILES, np.percentile(durations, PERCENTILES)):
+        stats[f'p{p}'] = float(value)
+      phases[phase] = stats
+    input_wait_fraction = None
+    if 'input_wait' in phases and 'step' in phases:
+      input_wait_fraction = (
+          phases['input_wait']['mean'] / max(phases['step']['mean'], 1e-9))
+    return {'phases': phases, 'input_wait_fraction': input_wait_fraction}
+
+  def write_json(self, path, step):
+    """Writes the report, replacing the previous one atomically."""
+    report = self.report()
+    report.update({'step': int(step), 'window': self.window})
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wt') as f:
+      json.dump(report, f, indent=1, sort_keys=True)
+    os.replace(temp_path, path)
+
+  def summary(self):
+    """Returns a Summary proto with the percentiles of each phase."""
+    report = self.report()
+    values = []
+    for phase, stats in report['phases'].items():
+      for p in PERCENTILES:
+        values.append(
+            tf.compat.v1.Summary.Value(
+                tag=f'step_time/{phase}/p{p}', simple_value=stats[f'p{p}']))
+    if report['input_wait_fraction'] is not None:
+      values.append(
+          tf.compat.v1.Summary.Value(
+              tag='step_time/input_wait_fraction',
+              simple_value=report['input_wait_fraction']))
+    return tf.compat.v1.Summary(value=values)
@@ -0,0 +1,116 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.training.step_profiler."""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from absl.testing import absltest
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.training import step_profiler
+# pylint: enable=g-bad-import-order
+
+
+class StepProfilerTest(absltest.TestCase):
+
+  def testReportsPercentilesOverTheWindow(self):
+    profiler = step_profiler.StepProfiler(window=100)
+    for i in range(200):
+      profiler.record('step', float(i))
+      profiler.record('input_wait', float(i) / 4)
+    profiler.record('checkpoint', 3.0)
+    report = profiler.report()
+    self.assertCountEqual(report['phases'], ['step', 'input_wait',
+                                             'checkpoint'])
+    step = report['phases']['step']
+    self.assertEqual(step['count'], 100)
+    self.assertAlmostEqual(step['mean'], 149.5)
+    self.assertAlmostEqual(step['p50'], 149.5)
+    self.assertAlmostEqual(step['p99'], 198.01)
+    self.assertAlmostEqual(report['input_wait_fraction'], 0.25)
+    self.assertEqual(report['phases']['checkpoint']['p95'], 3.0)
+    with self.assertRaisesRegex(ValueError, 'Unknown phase'):
+      profiler.record('loading', 1.0)
+
+  def testRecordRunsSplitsTheInputWait(self):
+    profiler = step_profiler.StepProfiler()
+    profiler.record_runs([(1.0, (10.0, 10.25))], is_summary_step=False)
+    profiler.record_runs([(2.0, (10.0, 10.5))], is_summary_step=True)
+    phases = profiler.report()['phases']
+    self.assertEqual(phases['input_wait']['count'], 2)
+    self.assertEqual(phases['compute']['mean'], 0.75)
+    self.assertEqual(phases['summary_compute']['mean'], 1.5)
+
+  def testRecordRunsSumsTheRunsOfAStep(self):
+    profiler = step_profiler.StepProfiler()
+    # Two steps that accumulate the gradients of three batches each:
+    for _ in range(2):
+      runs = [(1.0, (10.0, 10.5)), (1.0, (11.0, 11.5)), (1.0, (12.0, 12.5))]
+      profiler.record_runs(runs, is_summary_step=False)
+      profiler.record('step', 3.0)
+    report = profiler.report()
+    self.assertEqual(report['phases']['input_wait']['count'], 2)
+    self.assertEqual(report['phases']['input_wait']['mean'], 1.5)
+    self.assertEqual(report['phases']['compute']['mean'], 1.5)
+    # The steps waited for their input half of the time:
+    self.assertAlmostEqual(report['input_wait_fraction'], 0.5)
+
+  def testWritesJsonAndSummary(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    profiler = step_profiler.StepProfiler(window=10)
+    with profiler.timed('checkpoint'):
+      time.sleep(0.01)
+    path = os.path.join(directory, 'step_times.json')
+    profiler.write_json(path, 40)
+    with open(path, 'rt') as f:
+      report = json.load(f)
+    self.assertEqual(report['step'], 40)
+    self.assertEqual(report['window'], 10)
+    self.assertIsNone(report['input_wait_fraction'])
+    self.assertGreaterEqual(report['phases']['checkpoint']['p50'], 0.01)
+    tags = [v.tag for v in profiler.summary().value]
+    self.assertEqual(tags, [
+        'step_time/checkpoint/p50', 'step_time/checkpoint/p95',
+        'step_time/checkpoint/p99'
+    ])
+
+  def testInputTimestampsMeasureTheWaitForABatch(self):
+
+    def slow_batches():
+      while True:
+        time.sleep(0.2)
+        yield np.zeros([2], dtype=np.float32)
+
+    with tf.Graph().as_default():
+      dataset = tf.data.Dataset.from_generator(
+          slow_batches, output_types=tf.float32, output_shapes=[2])
+      batch = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
+      timestamps = step_profiler.input_timestamps([batch])
+      with tf.compat.v1.Session() as session:
+        start, ready = session.run(timestamps)
+    self.assertGreater(ready - start, 0.15)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -253,11 +253,11 @@ def write_grd(path, volume, world2grid=None):
   header = [int(s) for s in volume.shape]
   if world2grid is not None:
     header += [x.astype(np.float32) for x in np.reshape(world2grid, [16])]
-    log.info('header: ', repr(header))
+    log.verbose(f'header: {header}')
   else:
     header += [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1]
   header = struct.pack(3*'i' + 16*'f', *header)
-  content = volume.astype('f').tostring()
+  content = volume.astype('f').tobytes()
   with base_util.FS.open(path, 'wb') as f:
     f.write(header)
     f.write(content)
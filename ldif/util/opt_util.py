@@ -87,7 +87,58 @@ def clip_by_global_norm_custom(t_list, clip_norm, use_norm=None, name=None):
   return list_clipped, use_norm
 
 
-def clip_by_global_norm(grads_and_vars):
+def clip_by_global_norm(grads_and_vars, clip_norm=5.0):
   grads, variables = list(zip(*grads_and_vars))
-  clipped_grads, _ = clip_by_global_norm_custom(grads, 5.0)
+  clipped_grads, _ = clip_by_global_norm_custom(grads, clip_norm)
   return list(zip(clipped_grads, variables))
+
+
+class GradientAccumulator(object):
+  """Sums the gradients of several micro-batches, to apply them as one batch.
+
+  The sums are local variables, so they are initialized by
+  tf.local_variables_initializer() and aren't saved in checkpoints.
+  """
+
+  def __init__(self, grads_and_vars, name='gradient_accumulator'):
+    """Adds a zero-initialized sum for each variable that has a gradient.
+
+    Args:
+      grads_and_vars: A list of (gradient, variable) pairs, as returned by
+        Optimizer.compute_gradients(). Pairs with a None gradient are dropped.
+      name: A name scope for the sums.
+    """
+    self.grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+    self._sums = []
+    with tf.name_scope(name):
+      for _, v in self.grads_and_vars:
+        with tf.compat.v1.colocate_with(v):
+          self._sums.append(
+              tf.compat.v1.Variable(
+                  tf.zeros(v.shape, v.dtype.base_dtype),
+                  trainable=False,
+                  collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES],
+                  name=v.op.name))
+
+  def accumulate(self):
+    """Returns an op that adds the gradients to the sums."""
+    return tf.group(*[
+        tf.compat.v1.assign_add(s, tf.convert_to_tensor(g))
+        for s, (g, _) in zip(self._sums, self.grads_and_vars)
+    ])
+
+  def mean_grads_and_vars(self, count):
+    """Returns (mean gradient, variable) pairs, given the micro-batch count.
+
+    The sums are read when the returned tensors are evaluated, so to include
+    a step's gradients they must be created under a control dependency on
+    that step's accumulate().
+    """
+    return [(s.read_value() / tf.cast(count, s.dtype.base_dtype), v)
+            for s, (_, v) in zip(self._sums, self.grads_and_vars)]
+
+  def reset(self):
+    """Returns an op that zeroes the sums."""
+    return tf.group(*[
+        tf.compat.v1.assign(s, tf.zeros_like(s)) for s in self._sums
+    ])
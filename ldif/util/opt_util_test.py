@@ -0,0 +1,93 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python3
+"""Tests for ldif.util.opt_util."""
+
+import numpy as np
+import tensorflow as tf
+
+# LDIF is an internal package, should be imported last.
+# pylint: disable=g-bad-import-order
+from ldif.util import opt_util
+# pylint: enable=g-bad-import-order
+
+
+class GradientAccumulatorTest(tf.test.TestCase):
+
+  def accumulated_step(self, batches, clip_norm=None):
+    """Takes one SGD step on the mean gradients of a least squares loss."""
+    with tf.Graph().as_default():
+      x = tf.compat.v1.placeholder(tf.float32, [2])
+      weights = tf.compat.v1.get_variable(
+          'weights', initializer=tf.constant([1.0, -2.0]))
+      unused = tf.compat.v1.get_variable('unused', initializer=3.0)
+      loss = tf.reduce_sum(tf.square(weights - x))
+      optimizer = tf.compat.v1.train.GradientDescentOptimizer(0.5)
+      global_step = tf.compat.v1.train.get_or_create_global_step()
+      grads_and_vars = optimizer.compute_gradients(loss,
+                                                   [weights, unused])
+      accumulator = opt_util.GradientAccumulator(grads_and_vars)
+      self.assertLen(accumulator.grads_and_vars, 1)
+      self.assertEmpty(tf.compat.v1.trainable_variables()[2:])
+      accumulate = accumulator.accumulate()
+      with tf.control_dependencies([accumulate]):
+        grads_and_vars = accumulator.mean_grads_and_vars(len(batches))
+      if clip_norm is not None:
+        grads_and_vars = opt_util.clip_by_global_norm(grads_and_vars,
+                                                      clip_norm)
+      apply_op = optimizer.apply_gradients(grads_and_vars, global_step)
+      with tf.control_dependencies([apply_op]):
+        train_op = accumulator.reset()
+      with tf.compat.v1.Session() as session:
+        session.run([
+            tf.compat.v1.global_variables_initializer(),
+            tf.compat.v1.local_variables_initializer()
+        ])
+        for batch in batches[:-1]:
+          session.run(accumulate, feed_dict={x: batch})
+          self.assertEqual(session.run(global_step), 0)
+        session.run(train_op, feed_dict={x: batches[-1]})
+        # The sums are zeroed for the next step:
+        session.run(train_op, feed_dict={x: [1.0, -2.0]})
+        return session.run([weights, global_step])
+
+  def expected_weights(self, batches, clip_norm=None):
+    """Replicates accumulated_step() in numpy."""
+
+    def clip(gradient):
+      if clip_norm is None:
+        return gradient
+      return gradient * clip_norm / max(np.linalg.norm(gradient), clip_norm)
+
+    initial = np.array([1.0, -2.0])
+    gradient = np.mean([2 * (initial - b) for b in batches], axis=0)
+    weights = initial - 0.5 * clip(gradient)
+    # The sums were zeroed, so the second step has one batch's gradient:
+    gradient = 2 * (weights - initial) / len(batches)
+    return weights - 0.5 * clip(gradient)
+
+  def testAppliesTheMeanGradients(self):
+    batches = [[0.0, 0.0], [2.0, 0.0], [4.0, 2.0]]
+    weights, global_step = self.accumulated_step(batches)
+    self.assertAllClose(weights, self.expected_weights(batches))
+    self.assertEqual(global_step, 2)
+
+  def testClipsTheMeanGradients(self):
+    batches = [[0.0, 0.0], [2.0, 0.0], [4.0, 2.0]]
+    weights, _ = self.accumulated_step(batches, clip_norm=1.0)
+    self.assertAllClose(weights, self.expected_weights(batches, clip_norm=1.0))
+
+
+if __name__ == '__main__':
+  tf.test.main()
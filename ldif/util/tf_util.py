@@ -116,3 +116,51 @@ def remove_element(t, elt, axis):
   return tf.reshape(
       masked, t_shape[:num_dims_before_axis] + [t.shape[axis].value - 1] +
       t_shape[num_dims_before_axis + 1:])
+
+
+def fixed_input_frontier(outputs, fixed_inputs, varying_inputs):
+  """Finds the tensors that only need to be computed once per fixed input.
+
+  Every tensor in the returned list depends on the fixed inputs but not on the
+  varying inputs, and is consumed by an op that depends on the varying inputs.
+  Feeding their values back in a later Session.run() call prunes the part of
+  the graph that only depends on the fixed inputs.
+
+  Args:
+    outputs: A list of tensors that will be evaluated.
+    fixed_inputs: A list of tensors (usually placeholders) that stay the same
+      across Session.run() calls.
+    varying_inputs: A list of tensors (usually placeholders) that change.
+
+  Returns:
+    A list of feedable tensors.
+  """
+  fixed_ops = set(t.op for t in fixed_inputs)
+  varying_ops = set(t.op for t in varying_inputs)
+  # Whether each op (transitively) depends on the fixed and varying inputs:
+  depends = {}
+  stack = [t.op for t in outputs]
+  while stack:
+    op = stack[-1]
+    if op in depends:
+      stack.pop()
+      continue
+    pending = [t.op for t in op.inputs if t.op not in depends]
+    if pending:
+      stack.extend(pending)
+      continue
+    stack.pop()
+    on_fixed = op in fixed_ops or any(depends[t.op][0] for t in op.inputs)
+    on_varying = op in varying_ops or any(
+        depends[t.op][1] for t in op.inputs)
+    depends[op] = (on_fixed, on_varying)
+  frontier = []
+  for op, (_, on_varying) in depends.items():
+    if not on_varying:
+      continue
+    for t in op.inputs:
+      on_fixed, input_on_varying = depends[t.op]
+      if (on_fixed and not input_on_varying and t.op not in fixed_ops and
+          t not in frontier and t.graph.is_feedable(t)):
+        frontier.append(t)
+  return frontier
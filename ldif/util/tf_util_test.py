@@ -45,6 +45,23 @@ class TfUtilTest(tf.test.TestCase):
         distance, DISTANCE_EPS, 'Expected \n%s\n but got \n%s' %
         (np.array_str(expected), np.array_str(returned)))
 
+  def testFixedInputFrontier(self):
+    fixed = tf.placeholder(tf.float32, shape=[2, 2])
+    varying = tf.placeholder(tf.float32, shape=[3, 2])
+    fixed_only = tf.matmul(
+        tf.square(fixed), tf.constant(np.eye(2, dtype=np.float32)))
+    out = tf.matmul(varying, fixed_only) + tf.reduce_sum(varying)
+    frontier = tf_util.fixed_input_frontier([out], [fixed], [varying])
+    self.assertEqual(frontier, [fixed_only])
+    fixed_np = np.array([[1.0, 2.0], [3.0, 4.0]], dtype=np.float32)
+    varying_np = np.ones([3, 2], dtype=np.float32)
+    with self.test_session() as sess:
+      expected = sess.run(out, {fixed: fixed_np, varying: varying_np})
+      cached = sess.run(frontier, {fixed: fixed_np})
+      # The fixed input is no longer needed once the frontier is fed:
+      returned = sess.run(out, {frontier[0]: cached[0], varying: varying_np})
+    self.assertAllClose(expected, returned)
+
 
 if __name__ == '__main__':
   tf.test.main()
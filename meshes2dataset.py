@@ -17,6 +17,7 @@
 The dataset can be used for training, evaluation, and inference on ldif models.
 """
 
+import functools
 import glob
 import random
 import os
@@ -29,19 +30,25 @@ from joblib import Parallel, delayed
 # pylint: enable=g-multiple-import
 
 import tqdm
-import tensorflow as tf
 
 # LDIF is local code, should be imported last.
 # pylint: disable=g-bad-import-order
+from ldif.datasets import build_manifest
 from ldif.datasets import process_element
+from ldif.datasets import shard_writer
 from ldif.scripts import make_example
 from ldif.util import file_util
-from ldif.util import path_util
 from ldif.util.file_util import log
 # pylint: enable=g-bad-import-order
 
 FLAGS = flags.FLAGS
 
+OPTIMIZED_FORMATS = {
+    'raw': process_element.RAW_FORMAT,
+    'quantized': process_element.QUANTIZED_FORMAT,
+    'float_list': process_element.FLOAT_LIST_FORMAT,
+}
+
 flags.DEFINE_string('mesh_directory', '', 'Path to meshes. This folder should'
                     ' have the structure <root>/{train,test,val}/<class>/*.ply')
 
@@ -59,6 +66,22 @@ flags.DEFINE_integer(
     'max_threads', -1, 'The maximum number of threads to use.'
     ' If -1, will allocate all available threads on CPU.')
 
+flags.DEFINE_string(
+    'gaps_directory', '', 'The directory with the GAPS executables that'
+    ' preprocess the meshes. If empty, uses the ones built by build_gaps.sh.')
+
+flags.DEFINE_enum(
+    'sdf_sampler', 'gaps', ['gaps', 'python'], 'How to compute the near'
+    ' surface samples, uniform samples and coarse grid. \'gaps\' runs msh2pts'
+    ' and msh2df. \'python\' computes them in process with trimesh and scipy,'
+    ' in a pool of worker processes.')
+
+flags.DEFINE_enum(
+    'renderer', 'gaps', ['gaps', 'python'], 'How to render the 20 depth and'
+    ' normal images of each mesh. \'gaps\' runs scn2img and conf2img, which'
+    ' need OpenGL (OSMesa on linux). \'python\' rasterizes them with numpy, in'
+    ' a pool of worker processes.')
+
 flags.DEFINE_string('log_level', 'INFO',
     'One of VERBOSE, INFO, WARNING, ERROR. Sets logs to print '
     'only at or above the specified level.')
@@ -77,13 +100,47 @@ flags.DEFINE_boolean(
     'dataset since the last time meshes2dataset was run; set '
     'False to complete optimization if it was halted midway.')
 
+flags.DEFINE_enum(
+    'optimized_format', 'raw', ['raw', 'quantized', 'float_list'], 'The'
+    ' format of the optimized tfrecords. \'raw\' stores each field as one'
+    ' contiguous little-endian float32 blob, which is much faster to write.'
+    ' \'quantized\' is the same, but with uint16 depth and int16 fixed point'
+    ' samples, which is about half the size.'
+    ' \'float_list\' stores tf.train.Examples with FloatList features, and is'
+    ' the format of datasets written before \'raw\' existed.')
+
+flags.DEFINE_integer(
+    'shard_writer_count', 0, 'The number of optimized shards that are'
+    ' compressed and written at once, while the examples of the following'
+    ' shards are serialized. If 0, uses a quarter of the threads.')
+
+flags.DEFINE_boolean(
+    'manifest', True, 'Whether to keep a build manifest (manifest.json) in the'
+    ' dataset directory, with the content hash of each source mesh, the files'
+    ' made from it, and the shard it is in. With it, a rebuild preprocesses'
+    ' only the meshes that are new or changed, and rewrites only the shards'
+    ' whose examples changed; skip_existing then only applies to meshes the'
+    ' manifest doesn\'t know yet, and trample_optimized is ignored.')
+
+flags.DEFINE_boolean(
+    'measure_parse_throughput', False, 'Whether to measure and log how fast'
+    ' examples of each optimized format are parsed, after optimizing.')
+
+flags.DEFINE_boolean(
+    'mmap', False, 'Whether to also write the dataset as shards of .npy'
+    ' arrays, which training memory-maps instead of reading tfrecords. Takes'
+    ' about as much disk space as the optimized tfrecords, and is much faster'
+    ' to read from a local drive. If false, the memory-mapped shards of a'
+    ' previous build are removed once the dataset changes, since training'
+    ' would read them in place of the optimized tfrecords.')
+
 flags.DEFINE_boolean(
     'optimize_only', False, 'Whether to skip dataset creation '
     'and only write tfrecords files.')
 
 
-def process_one(f, mesh_directory, dataset_directory, skip_existing, log_level):
-  """Processes a single mesh, adding it to the dataset."""
+def example_directory(f, mesh_directory, dataset_directory):
+  """Returns the example directory to write for a mesh."""
   relpath = f.replace(mesh_directory, '')
   print('relpath:', relpath)
   assert relpath[0] == '/'
@@ -96,19 +153,145 @@ def process_one(f, mesh_directory, dataset_directory, skip_existing, log_level):
   if extension not in valid_extensions:
     raise ValueError(f'File with unsupported extension {extension} found: {f}.'
                      f' Only {valid_extensions} are supported.')
-  output_dir = f'{dataset_directory}/{split}/{synset}/{name}/'
-  # This is the last file the processing writes, if it already exists the
-  # example has already been processed.
-  final_file_written = f'{output_dir}/depth_and_normals.npz'
-  make_example.mesh_to_example(
-      os.path.join(path_util.get_path_to_ldif_parent(), 'ldif'), f,
-      f'{dataset_directory}/{split}/{synset}/{name}/', skip_existing, log_level)
-  return output_dir
-
-def serialize(example_dir, log_level):
-  d = process_element.load_example_dict(example_dir, log_level)
-  s = process_element.make_tf_example(d)
-  return s
+  return f'{dataset_directory}/{split}/{synset}/{name}/'
+
+def preprocessing_settings():
+  """The flags that change what the preprocessing writes for a mesh."""
+  return {'sdf_sampler': FLAGS.sdf_sampler, 'renderer': FLAGS.renderer}
+
+
+def make_examples(meshes, n_jobs, manifest=None):
+  """Preprocesses meshes into example directories.
+
+  Args:
+    meshes: A list of (mesh_path, example_directory) pairs.
+    n_jobs: Int. The CPU budget.
+    manifest: A build_manifest.Manifest, or None. If provided, only the meshes
+      that are new or stale according to it are preprocessed, and it's updated.
+
+  Returns:
+    The example directories that were preprocessed.
+  """
+  if manifest is None:
+    to_process = meshes
+  else:
+    settings = preprocessing_settings()
+    # Nothing made for a stale example is kept, so it is remade in full even
+    # with skip_existing:
+    to_process, reasons = manifest.stale_examples(meshes, settings)
+    log.info(f'{len(to_process)} of {len(meshes)} meshes need preprocessing:'
+             f' {dict(reasons)}')
+    manifest.save()
+  try:
+    if to_process:
+      # The preprocessing steps of all meshes share one CPU budget, and the
+      # independent steps of each mesh run concurrently:
+      make_example.meshes_to_examples(
+          to_process,
+          FLAGS.skip_existing,
+          cpu_budget=n_jobs,
+          gaps_directory=FLAGS.gaps_directory or None,
+          sdf_sampler=FLAGS.sdf_sampler,
+          renderer=FLAGS.renderer)
+  finally:
+    # Even if some meshes failed, the others are recorded:
+    if manifest is not None:
+      for mesh_path, dirpath in to_process:
+        manifest.record_example(mesh_path, dirpath, settings)
+      manifest.save()
+  return [dirpath for _, dirpath in to_process]
+
+
+def write_optimized_shards(shards, n_jobs):
+  """Writes a list of shard_writer.Shards of example directories."""
+  # Serialization and compression are pipelined across the shards:
+  stats = shard_writer.write_shards(
+      shards,
+      functools.partial(
+          process_element.serialize_example_directory,
+          version=OPTIMIZED_FORMATS[FLAGS.optimized_format],
+          log_level=FLAGS.log_level),
+      worker_count=n_jobs,
+      writer_count=FLAGS.shard_writer_count or None)
+  shard_writer.log_throughput(stats)
+
+
+def write_mmap_shard(shard_dir, example_dirs, n_jobs):
+  example_dicts = Parallel(n_jobs=n_jobs)(
+      delayed(process_element.load_example_dict)(d, FLAGS.log_level)
+      for d in example_dirs)
+  process_element.write_mmap_shard(shard_dir, example_dicts)
+
+
+def write_mmap_split(split, elements_of_split, n_jobs, examples_per_shard=64):
+  """Writes the memory-mapped shards of a split."""
+  split_dir = (f'{FLAGS.dataset_directory}/{process_element.MMAP_DIRECTORY}/'
+               f'{split}')
+  n_shards = (len(elements_of_split) + examples_per_shard - 1) // (
+      examples_per_shard)
+  for shard_idx in tqdm.tqdm(range(n_shards)):
+    shard_dir = f'{split_dir}/{shard_idx:05d}'
+    if FLAGS.skip_existing and os.path.isfile(
+        f'{shard_dir}/{process_element.MESH_NAMES_FILENAME}'):
+      continue
+    to_process = elements_of_split[shard_idx * examples_per_shard:
+                                   (shard_idx + 1) * examples_per_shard]
+    write_mmap_shard(shard_dir, to_process, n_jobs)
+
+
+def update_split_shards(manifest, split, elements_of_split, changed, n_jobs,
+                        examples_per_shard=64):
+  """Rewrites the shards of a split that the manifest shows have changed.
+
+  See build_manifest.update_split_shards().
+
+  Args:
+    manifest: The build_manifest.Manifest.
+    split: String. The split name.
+    elements_of_split: A list of the example directories of the split.
+    changed: A set of the keys of the examples that were preprocessed again.
+    n_jobs: Int. The CPU budget.
+    examples_per_shard: Int. The size of a full shard.
+  """
+  def write_optimized(shards):
+    write_optimized_shards(
+        [shard_writer.Shard(path, d) for path, d in shards], n_jobs)
+
+  def write_mmap(shards):
+    for path, d in tqdm.tqdm(shards):
+      write_mmap_shard(path, d, n_jobs)
+
+  writers = {}
+  if FLAGS.optimize:
+    writers['optimized'] = write_optimized
+  if FLAGS.mmap:
+    writers['mmap'] = write_mmap
+  directories = {
+      'optimized': f'{FLAGS.dataset_directory}/optimized/{split}',
+      'mmap': (f'{FLAGS.dataset_directory}/{process_element.MMAP_DIRECTORY}/'
+               f'{split}'),
+  }
+  keys = [
+      build_manifest.example_key(FLAGS.dataset_directory, d)
+      for d in elements_of_split
+  ]
+  build_manifest.update_split_shards(
+      manifest, split, keys, changed, directories, writers,
+      OPTIMIZED_FORMATS[FLAGS.optimized_format], examples_per_shard)
+
+
+def log_parse_throughput(example_dirs, log_level):
+  """Logs the parse throughput of each optimized format on some examples."""
+  example_dicts = [
+      process_element.load_example_dict(d, log_level) for d in example_dirs
+  ]
+  for name, version in OPTIMIZED_FORMATS.items():
+    serialized = [
+        process_element.SERIALIZERS[version](d) for d in example_dicts
+    ]
+    throughput = process_element.parse_throughput(serialized, version)
+    log.info(f'The {name} format parses {throughput:.1f} examples per second'
+             f' with {os.cpu_count()} threads.')
 
 def main(argv):
   if len(argv) > 1:
@@ -126,6 +309,9 @@ def main(argv):
     mesh_directory = mesh_directory[:-1]
 
   files = glob.glob(f'{mesh_directory}/*/*/*.ply')
+  manifest = None
+  if FLAGS.manifest:
+    manifest = build_manifest.Manifest(FLAGS.dataset_directory)
 
   if not files and not FLAGS.optimize_only:
     raise ValueError(f"Didn't find any ply files in {mesh_directory}. "
@@ -146,24 +332,48 @@ def main(argv):
       if not os.path.isdir(f'{FLAGS.dataset_directory}/{split}/{synset}'):
         os.mkdir(f'{FLAGS.dataset_directory}/{split}/{synset}')
     log.info('Making dataset...')
-    # Flags can't be pickled:
-    output_dirs = Parallel(n_jobs=n_jobs)(
-        delayed(process_one)(f, mesh_directory, FLAGS.dataset_directory,
-                             FLAGS.skip_existing, FLAGS.log_level) for f in tqdm.tqdm(files))
+    output_dirs = [
+        example_directory(f, mesh_directory, FLAGS.dataset_directory)
+        for f in files
+    ]
+    changed = make_examples(list(zip(files, output_dirs)), n_jobs, manifest)
+    changed = {
+        build_manifest.example_key(FLAGS.dataset_directory, d) for d in changed
+    }
     log.info('Making dataset registry...')
   else:
     output_dirs = glob.glob(f'{FLAGS.dataset_directory}/*/*/*/surface_samples_from_dodeca.pts')
     output_dirs = [os.path.dirname(f) + '/' for f in output_dirs]
+    changed = set()
+  if manifest is not None:
+    removed = manifest.prune(
+        build_manifest.example_key(FLAGS.dataset_directory, d)
+        for d in output_dirs)
+    if removed:
+      log.info(f'{len(removed)} examples are no longer in the dataset.')
   output_dirs.sort()  # So randomize with a fixed seed always results in the same order
   splits = {x.split('/')[-4] for x in output_dirs}
   if 'optimized' in splits:
     raise ValueError(f'The keyword "optimized" cannot be used for a split name, it is reserved.')
+  if process_element.MMAP_DIRECTORY in splits:
+    raise ValueError(f'The keyword "{process_element.MMAP_DIRECTORY}" cannot'
+                     ' be used for a split name, it is reserved.')
   for split in splits:
     elements_of_split = [x for x in output_dirs if x.split('/')[-4] == split]
     with open(f'{FLAGS.dataset_directory}/{split}.txt', 'wt') as f:
       f.write('\n'.join(elements_of_split) + '\n')
   log.info('Done!')
 
+  if manifest is not None:
+    if FLAGS.optimize or FLAGS.mmap:
+      log.info('Updating the shards...')
+    for split in splits:
+      elements_of_split = [x for x in output_dirs if x.split('/')[-4] == split]
+      update_split_shards(manifest, split, elements_of_split, changed, n_jobs)
+    if FLAGS.optimize and FLAGS.measure_parse_throughput and output_dirs:
+      log_parse_throughput(output_dirs[:16], FLAGS.log_level)
+    return
+
   if FLAGS.optimize:
     log.info('Precomputing optimized tfrecord files...')
     opt_dir = f'{FLAGS.dataset_directory}/optimized'
@@ -185,19 +395,31 @@ def main(argv):
       shard_dir = f'{FLAGS.dataset_directory}/optimized/{split}'
       if not os.path.isdir(shard_dir):
         os.mkdir(shard_dir)
-      for shard_idx in tqdm.tqdm(range(n_shards)):
+      elif FLAGS.trample_optimized:
+        # A split's shards must all be in the same format:
+        for f in os.listdir(shard_dir):
+          if f.endswith('.tfrecords'):
+            os.remove(os.path.join(shard_dir, f))
+      shards = []
+      for shard_idx in range(n_shards):
         shard_name = f'{shard_dir}/{split}-%.5d-of-%.5d.tfrecords' % (shard_idx, n_shards)
         if not FLAGS.trample_optimized and os.path.isfile(shard_name):
           continue
         start_idx = shard_idx * examples_per_shard
         end_idx = (shard_idx + 1) * examples_per_shard
-        options = tf.io.TFRecordOptions(tf.compat.v1.io.TFRecordCompressionType.GZIP)
-        with tf.io.TFRecordWriter(shard_name, options=options) as writer:
-          to_process = elements_of_split[start_idx:end_idx]
-          serialized = Parallel(n_jobs=n_jobs)(delayed(serialize)(d, FLAGS.log_level)
-                for d in to_process)
-          for s in serialized:
-            writer.write(s)
+        shards.append(
+            shard_writer.Shard(shard_name,
+                               elements_of_split[start_idx:end_idx]))
+      write_optimized_shards(shards, n_jobs)
+    if FLAGS.measure_parse_throughput and output_dirs:
+      log_parse_throughput(output_dirs[:16], FLAGS.log_level)
+
+  if FLAGS.mmap:
+    log.info('Writing memory-mapped shards...')
+    for split in splits:
+      log.info(f'Writing split {split}...')
+      elements_of_split = [x for x in output_dirs if x.split('/')[-4] == split]
+      write_mmap_split(split, elements_of_split, n_jobs)
 
 
 if __name__ == '__main__':
@@ -33,11 +33,15 @@ tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 # LDIF is an internal package, should be imported last.
 # pylint: disable=g-bad-import-order
 from ldif.datasets import local_inputs
+from ldif.datasets import shapenet
 from ldif.util import gaps_util
 from ldif.inference import example
 from ldif.model import hparams
 from ldif.inference import experiment as experiments
+from ldif.training import async_checkpoint
+from ldif.training import replicas
 from ldif.training import shared_launcher
+from ldif.training import step_profiler
 from ldif.util import file_util
 from ldif.util import gpu_util
 from ldif.util import path_util
@@ -47,7 +51,29 @@ from ldif.util.file_util import log
 
 FLAGS = flags.FLAGS
 
-flags.DEFINE_integer('batch_size', 1, 'The batch size to use when training.')
+flags.DEFINE_integer(
+    'batch_size', 1, 'The batch size to use when training. With several'
+    ' replicas, this is the global batch size, which is split evenly between'
+    ' them.')
+
+flags.DEFINE_integer(
+    'replica_count', 1,
+    'The number of devices the model is replicated across for data-parallel'
+    ' training. Each replica trains on its part of each batch, and their'
+    ' gradients are averaged.')
+
+flags.DEFINE_enum(
+    'replica_device_type', 'gpu', ['gpu', 'cpu'],
+    'The type of the devices of the replicas. With cpu, the process gets'
+    ' replica_count CPU devices, which is mostly useful for testing.')
+
+flags.DEFINE_integer(
+    'gradient_accumulation_count', 1,
+    'The number of batches whose gradients are averaged in each training step'
+    ' (weights update), for an effective batch size of'
+    ' gradient_accumulation_count * batch_size in the memory of batch_size.'
+    ' The logged loss and the summaries are those of the last batch of each'
+    ' step.')
 
 flags.DEFINE_integer(
     'summary_step_interval', 10,
@@ -61,6 +87,39 @@ flags.DEFINE_integer(
     ' checkpoints written before old checkpoints are erased, and a permanent'
     ' save frequency.')
 
+flags.DEFINE_boolean(
+    'async_checkpoint', False,
+    'If true, checkpoints are written by a background thread while training'
+    ' continues. Each save only waits for the variables to be copied to host'
+    ' memory (and for the previous checkpoint to finish writing), at the cost'
+    ' of a second copy of the variables in host memory.')
+
+flags.DEFINE_boolean(
+    'profile_step_times', False,
+    'If true, the time of each step is broken down into input pipeline wait,'
+    ' compute, summary, and checkpoint phases, and rolling percentiles of'
+    ' each are written to step_times.json in the experiment directory and to'
+    ' TensorBoard.')
+
+flags.DEFINE_integer(
+    'profile_window', 100,
+    'The number of most recent steps the step time percentiles cover.')
+
+flags.DEFINE_integer(
+    'profile_report_interval', 100,
+    'The step time percentiles are reported on step indices divisible by'
+    ' this number.')
+
+flags.DEFINE_integer(
+    'trace_start_step', -1,
+    'If nonnegative, full TensorFlow traces of trace_step_count steps are'
+    ' captured from this step index on. They are written to TensorBoard and'
+    ' as chrome://tracing timelines to the timeline directory of the'
+    ' experiment.')
+
+flags.DEFINE_integer('trace_step_count', 5,
+                     'The number of steps that are traced.')
+
 
 flags.DEFINE_string(
     'experiment_name', 'reproduce-ldif',
@@ -99,6 +158,25 @@ flags.DEFINE_string('log_level', 'INFO',
                     'One of VERBOSE, INFO, WARNING, ERROR. Sets logs to print '
                     'only at or above the specified level.')
 
+flags.DEFINE_boolean(
+    'subsample_supervision', False,
+    'If true, the input pipeline randomly subsamples the uniform and near'
+    ' surface samples of each example to the count the losses use (set by'
+    ' the hparams), rather than passing all 100K of each to the graph. The'
+    ' inside bounding box used by the element center loss is then estimated'
+    ' from the subsampled uniform samples. Ignored if the hparams crop the'
+    ' supervision, which needs the full sample sets.')
+
+flags.DEFINE_integer(
+    'loader_worker_count', 0,
+    'The number of worker processes that read examples on the fly when the'
+    ' dataset has no optimized or memory-mapped version. 0 uses one per CPU.')
+
+flags.DEFINE_integer(
+    'loader_prefetch_count', 0,
+    'The number of examples the on the fly loader reads ahead of training.'
+    ' 0 uses twice the worker count.')
+
 flags.DEFINE_boolean('reserve_memory_for_inference_kernel', True,
                      'Normally TensorFlow preallocates the entire GPU\'s memory'
                      ' when the session is created. The inference CUDA'
@@ -111,7 +189,7 @@ flags.DEFINE_boolean('reserve_memory_for_inference_kernel', True,
 print(f'PATH: {sys.path}')
 
 
-def build_model_config(dataset):
+def build_model_config():
   """Creates the ModelConfig object, which contains model hyperparameters."""
   # TODO(kgenova) This needs to somehow at least support LDIF/SIF/SingleView.
   # TODO(kgenova) Add support for eval/inference.
@@ -122,10 +200,10 @@ def build_model_config(dataset):
   }
   model_config = experiments.ModelConfig(builder_fun_dict[FLAGS.model_type]())
   model_config.hparams.bs = FLAGS.batch_size
+  model_config.hparams.gac = FLAGS.gradient_accumulation_count
   model_config.train = True
   model_config.eval = False
   model_config.inference = False
-  model_config.inputs['dataset'] = dataset
   model_config.inputs['split'] = FLAGS.split
   model_config.inputs['proto'] = 'ShapeNetNSSDodecaSparseLRGMediumSlimPC'
   # This function is defined by the library; we don't need it, but
@@ -186,30 +264,60 @@ def main(argv):
     raise ValueError('A dataset directory must be provided.')
   if not os.path.isdir(FLAGS.dataset_directory):
     raise ValueError(f'No dataset directory found at {FLAGS.dataset_directory}')
+  # Sets up the hyperparameters and tf.Dataset
+  model_config = build_model_config()
+  supervision_sample_count = None
+  if FLAGS.subsample_supervision:
+    supervision_sample_count = shapenet.input_supervision_sample_count(
+        model_config.hparams)
+    if supervision_sample_count:
+      log.info('Subsampling the supervision to'
+               f' {supervision_sample_count} points in the input pipeline.')
+    else:
+      log.warning('Not subsampling the supervision, because it is cropped.')
   # TODO(kgenova) This batch size should match.
   dataset = local_inputs.make_dataset(  # DATASET
       FLAGS.dataset_directory,
       mode='train',
       batch_size=FLAGS.batch_size,
-      split=FLAGS.split)
+      split=FLAGS.split,
+      supervision_sample_count=supervision_sample_count,
+      loader_worker_count=FLAGS.loader_worker_count or None,
+      loader_prefetch_count=FLAGS.loader_prefetch_count or None)
 
   # log.info(f'dataset.bounding_box_samples type: {type(dataset.bounding_box_samples)}')  # tf tensor
 
-  # Sets up the hyperparameters and tf.Dataset
-  model_config = build_model_config(dataset)  # model_config contains dataset info
+  model_config.inputs['dataset'] = dataset  # model_config contains dataset info
   print('Config built.')
 
   # print(f'model_config.inputs[dataset].bounding_box_samples: {type(model_config.inputs["dataset"].bounding_box_samples)}')  # tf tensor
 
   # Generates the graph for a single train step, including summaries
-  shared_launcher.sif_transcoder(model_config)
+  if FLAGS.replica_count > 1:
+    devices = replicas.replica_devices(FLAGS.replica_count,
+                                       FLAGS.replica_device_type)
+    log.info(f'Replicating the model across {devices}.')
+    shared_launcher.data_parallel_sif_transcoder(model_config, devices)
+  else:
+    shared_launcher.sif_transcoder(model_config)
   summary_op = tf.summary.merge_all()
   global_step_op = tf.compat.v1.train.get_global_step()
+  input_timestamps = step_profiler.input_timestamps([
+      dataset.bounding_box_samples, dataset.depth_renders, dataset.mesh_name,
+      dataset.near_surface_samples, dataset.grid, dataset.world2grid,
+      dataset.surface_point_samples
+  ])
 
   saver = tf.train.Saver(
       max_to_keep=5, pad_step_number=False, save_relative_paths=True)
+  checkpointer = None
+  if FLAGS.async_checkpoint:
+    checkpointer = async_checkpoint.AsyncCheckpointer(
+        max_to_keep=5, pad_step_number=False, save_relative_paths=True)
 
-  init_op = tf.initialize_all_variables()
+  # The local variables hold the accumulated gradients:
+  init_op = tf.group(tf.initialize_all_variables(),
+                     tf.local_variables_initializer())
 
   model_root = get_model_root()
 
@@ -230,7 +338,13 @@ def main(argv):
   gpu_options = tf.GPUOptions(
       per_process_gpu_memory_fraction=allowable_fraction)
 
-  with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as session:
+  session_config = tf.ConfigProto(gpu_options=gpu_options)
+  if FLAGS.replica_count > 1:
+    session_config = replicas.session_config(FLAGS.replica_count,
+                                             FLAGS.replica_device_type)
+    session_config.gpu_options.CopyFrom(gpu_options)
+
+  with tf.Session(config=session_config) as session:
     log.info(f'experiment_dir: {experiment_dir}')
     log.info(f'graph: {session.graph}')
     writer = tf.summary.FileWriter(f'{experiment_dir}/log', session.graph)
@@ -275,36 +389,91 @@ def main(argv):
       log.info(f'The global step is {initial_index}')
       initial_index = int(initial_index)
       log.info(f'Parsed to {initial_index}')
-    start_time = time.time()
-    log_every = 1
-    for i in range(initial_index, FLAGS.train_step_count):  # The actual training loop
-      # log.info('Training step')
-      # print('Eager Execution.')
-      log.verbose(f'Starting step {i}...')
-      is_summary_step = i % FLAGS.summary_step_interval == 0
-      if is_summary_step:
-        log.info(f'Starting summary for step {i}...')
-        _, summaries, loss = session.run(
-            [model_config.train_op, summary_op, model_config.loss])
-        writer.add_summary(summaries, i)
-      else:
-        # print(model_config.train_op, model_config.loss)
-        _, loss = session.run([model_config.train_op, model_config.loss])
-        # print(_)
-      if not (i % log_every) or i == 0:
-        end_time = time.time()
-        steps_per_second = float(log_every) / (end_time - start_time)
-        start_time = end_time
-        # log.info(_)  # Loss
-        # log.info(f'Step: {i}\tLoss (uniform, nss, element centers, inside box): {loss[0:2]}\tSteps/second: {steps_per_second}')
-        log.info(f'Step: {i}\tLoss (uniform, nss, element centers, inside box): {loss}\tSteps/second: {steps_per_second}')
-        # log.info(f'Step: {i}\tLoss (uniform, nss, element centers, inside box): {loss}\tSteps/second: {steps_per_second}')
+    profiler = step_profiler.StepProfiler(window=FLAGS.profile_window)
+    if FLAGS.trace_start_step >= 0:
+      timeline_dir = f'{experiment_dir}/timeline'
+      if not os.path.isdir(timeline_dir):
+        os.makedirs(timeline_dir)
+    # The pending checkpoint is written even if training fails:
+    try:
+      start_time = time.time()
+      log_every = 1
+      for i in range(initial_index, FLAGS.train_step_count):  # The actual training loop
+        # log.info('Training step')
+        # print('Eager Execution.')
+        log.verbose(f'Starting step {i}...')
+        step_start_time = time.time()
+        is_summary_step = i % FLAGS.summary_step_interval == 0
+        is_trace_step = (
+            0 <= FLAGS.trace_start_step <= i <
+            FLAGS.trace_start_step + FLAGS.trace_step_count)
+        # The session.run() calls of the step, profiled together:
+        step_runs = []
+        # All but the last batch of a step only accumulate their gradients:
+        for _ in range(model_config.hparams.gac - 1):
+          accumulate_fetches = {'accumulate_op': model_config.accumulate_op}
+          if FLAGS.profile_step_times:
+            accumulate_fetches['input_timestamps'] = input_timestamps
+          run_start_time = time.time()
+          accumulate_results = session.run(accumulate_fetches)
+          if FLAGS.profile_step_times:
+            step_runs.append((time.time() - run_start_time,
+                              accumulate_results['input_timestamps']))
+        fetches = {'train_op': model_config.train_op, 'loss': model_config.loss}
+        if is_summary_step:
+          log.info(f'Starting summary for step {i}...')
+          fetches['summaries'] = summary_op
+        if FLAGS.profile_step_times:
+          fetches['input_timestamps'] = input_timestamps
+        run_metadata = None
+        if is_trace_step:
+          run_metadata = tf.compat.v1.RunMetadata()
+        run_start_time = time.time()
+        results = session.run(
+            fetches,
+            options=(step_profiler.trace_run_options()
+                     if is_trace_step else None),
+            run_metadata=run_metadata)
+        if FLAGS.profile_step_times:
+          step_runs.append(
+              (time.time() - run_start_time, results['input_timestamps']))
+          profiler.record_runs(step_runs, is_summary_step)
+        loss = results['loss']
+        if is_summary_step:
+          with profiler.timed('summary_write'):
+            writer.add_summary(results['summaries'], i)
+        if is_trace_step:
+          writer.add_run_metadata(run_metadata, f'step_{i}', i)
+          timeline_path = f'{timeline_dir}/step-{i}.json'
+          step_profiler.write_timeline(run_metadata, timeline_path)
+          log.info(f'Wrote the trace of step {i} to {timeline_path}')
+        if not (i % log_every) or i == 0:
+          end_time = time.time()
+          steps_per_second = float(log_every) / (end_time - start_time)
+          start_time = end_time
+          # log.info(_)  # Loss
+          # log.info(f'Step: {i}\tLoss (uniform, nss, element centers, inside box): {loss[0:2]}\tSteps/second: {steps_per_second}')
+          log.info(f'Step: {i}\tLoss (uniform, nss, element centers, inside box): {loss}\tSteps/second: {steps_per_second}')
+          # log.info(f'Step: {i}\tLoss (uniform, nss, element centers, inside box): {loss}\tSteps/second: {steps_per_second}')
   
-      is_checkpoint_step = i % FLAGS.checkpoint_interval == 0
-      if is_checkpoint_step or i == FLAGS.train_step_count - 1:
-        ckpt_path = os.path.join(checkpoint_dir, 'model.ckpt')
-        log.info(f'Writing checkpoint to {ckpt_path}...')
-        saver.save(session, ckpt_path, global_step=i)
+        is_checkpoint_step = i % FLAGS.checkpoint_interval == 0
+        if is_checkpoint_step or i == FLAGS.train_step_count - 1:
+          ckpt_path = os.path.join(checkpoint_dir, 'model.ckpt')
+          log.info(f'Writing checkpoint to {ckpt_path}...')
+          with profiler.timed('checkpoint'):
+            if checkpointer is None:
+              saver.save(session, ckpt_path, global_step=i)
+            else:
+              checkpointer.save(session, ckpt_path, global_step=i)
+        profiler.record('step', time.time() - step_start_time)
+        if FLAGS.profile_step_times and i % FLAGS.profile_report_interval == 0:
+          profiler.write_json(f'{experiment_dir}/step_times.json', i)
+          writer.add_summary(profiler.summary(), i)
+          log.verbose(f'Step times at step {i}: {profiler.report()}')
+    finally:
+      if checkpointer is not None:
+        log.info('Waiting for the final checkpoint to be written...')
+        checkpointer.close()
     log.info('Done training!')
 
 